@@ -45,6 +45,10 @@ CIPHERTEXT = AES_GCM(KEY, cleartext) + resulting_tag if not armor
 
 encrypted_payload = PREAMBLE + SEPARATOR + CIPHERTEXT
 
+If ENC_METHOD is aes_256_gcm_zlib, the cleartext is compressed with zlib
+before being encrypted, and the size in the PREAMBLE is the (rounded) size of
+the compressed cleartext.
+
 Decryption
 ----------
 
@@ -70,16 +74,25 @@ checked during PREAMBLE reading.
 import base64
 import hashlib
 import hmac
+import json
+import multiprocessing
 import os
+import tempfile
+import threading
+import zlib
 
 from io import BytesIO
 from collections import namedtuple
+from collections import OrderedDict
+from itertools import chain
 
 from twisted.internet import defer
 from twisted.internet import interfaces
 from twisted.web.client import FileBodyProducer
+from twisted.web.iweb import IBodyProducer
 
 from leap.soledad.common import soledad_assert
+from leap.soledad.client._pipes import TruncatedTailPipe
 from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
@@ -91,10 +104,13 @@ from leap.soledad.common.blobs.preamble import decode_preamble
 from leap.soledad.common.blobs.preamble import Preamble
 from leap.soledad.common.blobs.preamble import ENC_SCHEME, ENC_METHOD
 from leap.soledad.common.blobs.preamble import MAGIC, PREAMBLE_SIZE
+from leap.soledad.common.sync_frames import Blob
+from leap.soledad.common.threads import DaemonThreadPool
 
 
 SECRET_LENGTH = 64
 SEPARATOR = ' '  # Anything that doesn't belong to base64 encoding
+SUPPORTED_METHODS = (ENC_METHOD.aes_256_gcm, ENC_METHOD.aes_256_gcm_zlib)
 
 CRYPTO_BACKEND = default_backend()
 DocInfo = namedtuple('DocInfo', 'doc_id rev')
@@ -116,15 +132,128 @@ class SoledadCrypto(object):
     """
     This class provides convenient methods for document encryption and
     decryption using BlobEncryptor and BlobDecryptor classes.
+
+    Single documents are encrypted and decrypted in the reactor thread, in
+    small steps. Batches of documents are handed to a pool of threads, so
+    that syncing many documents can use all cores of the machine. Each
+    thread processes its share of a batch in one pass: small documents are
+    encrypted at once with keys taken from a cache, and only documents larger
+    than ``batch_threshold`` are processed in chunks.
     """
-    def __init__(self, secret):
+
+    batch_threshold = 2 ** 16  # larger documents are processed in chunks
+    keys_cache_size = 4096  # maximum number of derived keys kept in memory
+
+    def __init__(self, secret, pool_size=None,
+                 method=ENC_METHOD.aes_256_gcm):
         """
         Initialize the crypto object.
 
         :param secret: The Soledad remote storage secret.
         :type secret: str
+        :param pool_size: The maximum number of threads used to encrypt and
+            decrypt batches of documents. Defaults to the number of cores.
+        :type pool_size: int
+        :param method: The method used to encrypt documents. Documents are
+            decrypted with whatever method their preamble says.
+        :type method: int
         """
         self.secret = secret
+        self.method = method
+        self.pool_size = pool_size or _cpu_count()
+        self._pool = None
+        self._keys = _KeyCache(secret, self.keys_cache_size)
+
+    def close(self):
+        """
+        Stop the threadpool used for batches of documents, if it was started,
+        and forget the cached keys.
+        """
+        self._keys.clear()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _run(self, f, *args):
+        """
+        Run a blocking function in the crypto threadpool.
+
+        :return: A deferred that fires with the result of the function.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if self._pool is None:
+            self._pool = DaemonThreadPool(self.pool_size, 'soledad-crypto')
+        return self._pool.run(f, *args)
+
+    def _map(self, f, docs):
+        # the batch is split in one slice for each thread, and each slice is
+        # processed in a single call.
+        docs = list(docs)
+        size = -(-len(docs) // self.pool_size) or 1
+        calls = [self._run(f, docs[i:i + size])
+                 for i in xrange(0, len(docs), size)]
+        d = defer.gatherResults(calls, consumeErrors=True)
+        d.addCallback(lambda results: list(chain.from_iterable(results)))
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+    def _encrypt_slice(self, docs, armor):
+        result = []
+        for doc_id, rev, content in docs:
+            info, content = DocInfo(doc_id, rev), str(content)
+            if len(content) > self.batch_threshold:
+                result.append(encrypt_payload(
+                    info, content, self.secret, armor, self.method))
+            else:
+                result.append(_encrypt_at_once(
+                    info, content, self._keys.get(doc_id), armor,
+                    self.method))
+        return result
+
+    def _decrypt_slice(self, docs):
+        result = []
+        for doc_id, rev, content in docs:
+            info = DocInfo(doc_id, rev)
+            if len(content) > self.batch_threshold:
+                result.append(decrypt_payload(info, content, self.secret))
+            else:
+                result.append(_decrypt_at_once(
+                    info, content, self._keys.get(doc_id)))
+        return result
+
+    def encrypt_docs(self, docs, armor=True):
+        """
+        Encrypt a batch of documents in the crypto threadpool.
+
+        :param docs: A list of (doc_id, rev, content) tuples, where content
+            is the JSON serialization of each document.
+        :type docs: list
+        :param armor: Whether to return the ciphertexts in the default JSON
+            format, or as unarmored blobs for the binary sync format.
+        :type armor: bool
+
+        :return: A deferred that fires with a list of JSON strings containing
+            the ciphertext of each document as the value of "raw" key (or of
+            blobs, if armor is not set), in the same order as the documents
+            were given.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._map(lambda s: self._encrypt_slice(s, armor), docs)
+
+    def decrypt_docs(self, docs):
+        """
+        Decrypt a batch of documents in the crypto threadpool.
+
+        :param docs: A list of (doc_id, rev, content) tuples, where content
+            is a JSON string with the ciphertext as the value of "raw" key, or
+            a blob received in the binary sync format.
+        :type docs: list
+
+        :return: A deferred that fires with a list of the cleartext contents
+            of the documents, in the same order as they were given.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._map(self._decrypt_slice, docs)
 
     def encrypt_doc(self, doc):
         """
@@ -145,7 +274,8 @@ class SoledadCrypto(object):
         content = BytesIO(str(doc.get_json()))
         info = DocInfo(doc.doc_id, doc.rev)
         del doc
-        encryptor = BlobEncryptor(info, content, secret=self.secret)
+        encryptor = BlobEncryptor(
+            info, content, secret=self.secret, method=self.method)
         d = encryptor.encrypt()
         d.addCallback(put_raw)
         return d
@@ -161,14 +291,119 @@ class SoledadCrypto(object):
         :rtype: str
         """
         info = DocInfo(doc.doc_id, doc.rev)
-        ciphertext = BytesIO()
-        payload = doc.content['raw']
+        ciphertext = _StringReader(str(doc.content['raw']))
         del doc
-        ciphertext.write(str(payload))
         decryptor = BlobDecryptor(info, ciphertext, secret=self.secret)
         return decryptor.decrypt()
 
 
+def encrypt_payload(doc_info, content, secret, armor=True,
+                    method=ENC_METHOD.aes_256_gcm):
+    """
+    Encrypt the content of a document at once. This blocks until encryption
+    is done, so it is meant to be called from a thread.
+
+    :param doc_info: The id and revision of the document.
+    :type doc_info: DocInfo
+    :param content: The JSON serialization of the document.
+    :type content: str
+    :param secret: The secret used to derive the encryption key.
+    :type secret: str
+    :param armor: Whether to encode the ciphertext with base64.
+    :type armor: bool
+    :param method: The encryption method.
+    :type method: int
+
+    :return: A JSON string containing the ciphertext as the value of "raw"
+        key, or the unarmored blob if armor is not set.
+    :rtype: str or Blob
+    """
+    sink = BytesIO()
+    encryptor = BlobEncryptor(
+        doc_info, BytesIO(str(content)), secret=secret, armor=armor,
+        method=method)
+    writer = encryptor._start_crypto_stream(sink)
+    encryptor._aes.write(encryptor._content_fd.read())
+    encryptor._end_crypto_stream(writer)
+    if not armor:
+        return Blob(sink.getvalue())
+    return '{"raw": "' + sink.getvalue() + '"}'
+
+
+def decrypt_payload(doc_info, content, secret):
+    """
+    Decrypt the content of a document at once. This blocks until decryption
+    is done, so it is meant to be called from a thread.
+
+    :param doc_info: The id and revision of the document.
+    :type doc_info: DocInfo
+    :param content: A JSON string with the ciphertext as the value of "raw"
+        key, or an unarmored blob.
+    :type content: str or Blob
+    :param secret: The secret used to derive the encryption key.
+    :type secret: str
+
+    :return: The cleartext content of the document.
+    :rtype: str
+    """
+    armor = not isinstance(content, Blob)
+    payload = str(json.loads(content)['raw']) if armor else content
+    decryptor = BlobDecryptor(
+        doc_info, _StringReader(payload), secret=secret, armor=armor,
+        start_stream=False)
+    return decryptor._decrypt_all().getvalue()
+
+
+def _encrypt_at_once(doc_info, content, sym_key, armor, method):
+    # the same as encrypt_payload, without the machinery for streaming.
+    if method == ENC_METHOD.aes_256_gcm_zlib:
+        content = zlib.compress(content)
+    iv = os.urandom(16)
+    preamble = Preamble(
+        doc_info.doc_id, doc_info.rev, ENC_SCHEME.symkey, method, iv=iv,
+        content_size=_ceiling(len(content))).encode()
+    encryptor = _get_aes_cipher(sym_key, iv, None).encryptor()
+    encryptor.authenticate_additional_data(preamble)
+    ciphertext = encryptor.update(content) + encryptor.finalize()
+    ciphertext += encryptor.tag
+    preamble = base64.urlsafe_b64encode(preamble)
+    if not armor:
+        return Blob(preamble + SEPARATOR + ciphertext)
+    ciphertext = base64.urlsafe_b64encode(ciphertext)
+    return '{"raw": "' + preamble + SEPARATOR + ciphertext + '"}'
+
+
+def _decrypt_at_once(doc_info, content, sym_key):
+    # the same as decrypt_payload, without the machinery for streaming.
+    armor = not isinstance(content, Blob)
+    payload = str(json.loads(content)['raw']) if armor else content
+    encoded, _, ciphertext = payload.partition(SEPARATOR)
+    try:
+        encoded = base64.urlsafe_b64decode(encoded)
+        if armor:
+            ciphertext = base64.urlsafe_b64decode(ciphertext)
+    except (TypeError, ValueError):
+        raise InvalidBlob('Invalid base64 encoding.')
+    preamble = _check_preamble(doc_info, encoded)
+    if len(ciphertext) < 16:
+        raise InvalidBlob('Blob is too short to have a tag.')
+    ciphertext, tag = ciphertext[:-16], ciphertext[-16:]
+    decryptor = _get_aes_cipher(sym_key, preamble.iv, None).decryptor()
+    decryptor.authenticate_additional_data(encoded)
+    try:
+        cleartext = decryptor.update(ciphertext)
+        cleartext += decryptor.finalize_with_tag(tag)
+    except (InvalidTag, ValueError, TypeError):
+        raise InvalidBlob('Invalid Tag. Blob authentication failed.')
+    if preamble.method == ENC_METHOD.aes_256_gcm_zlib:
+        sink = BytesIO()
+        decompressor = _Decompressor(sink)
+        decompressor.write(cleartext)
+        decompressor.finish()
+        cleartext = sink.getvalue()
+    return cleartext
+
+
 def encrypt_sym(data, key, method=ENC_METHOD.aes_256_gcm):
     """
     Encrypt data using AES-256 cipher in selected mode.
@@ -219,6 +454,7 @@ def decrypt_sym(data, key, iv, method=ENC_METHOD.aes_256_gcm):
 
 # TODO maybe rename this to Encryptor, since it will be used by blobs an non
 # blobs in soledad.
+@implementer(IBodyProducer)
 class BlobEncryptor(object):
     """
     Produces encrypted data from the cleartext data associated with a given
@@ -228,40 +464,65 @@ class BlobEncryptor(object):
     Cooperator to schedule calls and can be paused/resumed. Each call takes at
     most 65536 bytes from the input.
 
-    Both the production input and output are file descriptors, so they can be
-    applied to a stream of data.
+    The result is written to a sink as it is produced: first the preamble,
+    then the ciphertext in chunks (encoded with base64 in 3-byte aligned
+    chunks if armor is set) and finally the tag. So memory use does not
+    depend on the size of the content, as long as the sink doesn't keep it.
+    The encryptor is also a body producer, so it can be passed directly to an
+    HTTP request.
+
+    If the method compresses the content, it is compressed at once when the
+    encryptor is created, because the size of the result has to be known
+    before encryption starts.
     """
-    # TODO
-    # This class needs further work to allow for proper streaming.
-    # Right now we HAVE TO WAIT until the end of the stream before encoding the
-    # result. It should be possible to do that just encoding the chunks and
-    # passing them to a sink, but for that we have to encode the chunks at
-    # proper alignment (3 bytes?) with b64 if armor is defined.
 
     def __init__(self, doc_info, content_fd, secret=None, armor=True,
-                 sink=None):
+                 sink=None, method=ENC_METHOD.aes_256_gcm):
+        """
+        Initialize the encryptor.
+
+        :param doc_info: The id and revision of the document.
+        :type doc_info: DocInfo
+        :param content_fd: A file-like object with the cleartext.
+        :type content_fd: file
+        :param secret: The secret used to derive the encryption key.
+        :type secret: str
+        :param armor: Whether to encode the ciphertext with base64.
+        :type armor: bool
+        :param sink: A file-like object to write the result to. If not given,
+            the result is written to a new BytesIO.
+        :type sink: file
+        :param method: The encryption method, one of SUPPORTED_METHODS.
+        :type method: int
+        """
         if not secret:
             raise EncryptionDecryptionError('no secret given')
+        if method not in SUPPORTED_METHODS:
+            raise EncryptionDecryptionError(
+                'Unsupported encryption method: %s' % method)
 
         self.doc_id = doc_info.doc_id
         self.rev = doc_info.rev
         self.armor = armor
+        self.method = method
+
+        if method == ENC_METHOD.aes_256_gcm_zlib:
+            content_fd = _compress(content_fd)
 
         self._content_fd = content_fd
-        self._content_size = self._get_rounded_size(content_fd)
+        self._cleartext_size = self._get_size(content_fd)
+        self._content_size = _ceiling(self._cleartext_size)
         self._producer = FileBodyProducer(content_fd, readSize=2**16)
+        self._sink = sink
 
         self.sym_key = _get_sym_key_for_doc(doc_info.doc_id, secret)
-        self._aes = AESWriter(self.sym_key, _buffer=sink)
-        self._aes.authenticate(self._encode_preamble())
+        self._aes = AESWriter(self.sym_key)
+        self._preamble = self._encode_preamble()
+        self._aes.authenticate(self._preamble)
 
-    def _get_rounded_size(self, fd):
-        """
-        Returns a rounded value in order to minimize information leaks due to
-        the original size being exposed.
-        """
+    def _get_size(self, fd):
         fd.seek(0, os.SEEK_END)
-        size = _ceiling(fd.tell())
+        size = fd.tell()
         fd.seek(0)
         return size
 
@@ -273,49 +534,104 @@ class BlobEncryptor(object):
     def tag(self):
         return self._aes.tag
 
+    @property
+    def length(self):
+        """
+        The size of the result, which is known before encryption starts.
+        """
+        size = self._cleartext_size + 16  # the tag goes after the ciphertext
+        if self.armor:
+            size = 4 * ((size + 2) // 3)
+        preamble_size = len(base64.urlsafe_b64encode(self._preamble))
+        return preamble_size + len(SEPARATOR) + size
+
     def encrypt(self):
         """
         Starts producing encrypted data from the cleartext data.
 
         :return: A deferred which will be fired when encryption ends and whose
-                 callback will be invoked with the resulting ciphertext.
+                 callback will be invoked with the sink holding the result.
+                 If no sink was given, the result is in a BytesIO positioned
+                 at its start.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        sink = self._sink if self._sink is not None else BytesIO()
+        d = self.startProducing(sink)
+        if self._sink is None:
+            d.addCallback(lambda _: sink.seek(0))
+        d.addCallback(lambda _: sink)
+        return d
+
+    def startProducing(self, consumer):
+        """
+        Encrypt the cleartext, writing the result to a consumer.
+
+        :param consumer: Any object with a ``write`` method.
+        :type consumer: twisted.internet.interfaces.IConsumer
+
+        :return: A deferred that fires when the whole result was written.
         :rtype: twisted.internet.defer.Deferred
         """
-        # XXX pass a sink to aes?
+        writer = self._start_crypto_stream(consumer)
         d = self._producer.startProducing(self._aes)
-        d.addCallback(lambda _: self._end_crypto_stream_and_encode_result())
+        d.addCallback(lambda _: self._end_crypto_stream(writer))
         return d
 
+    def pauseProducing(self):
+        self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
     def _encode_preamble(self):
         scheme = ENC_SCHEME.symkey
-        method = ENC_METHOD.aes_256_gcm
         content_size = self._content_size
 
-        return Preamble(self.doc_id, self.rev, scheme, method, iv=self.iv,
-                        content_size=content_size).encode()
+        return Preamble(self.doc_id, self.rev, scheme, self.method,
+                        iv=self.iv, content_size=content_size).encode()
 
-    def _end_crypto_stream_and_encode_result(self):
+    def _start_crypto_stream(self, consumer):
+        consumer.write(base64.urlsafe_b64encode(self._preamble))
+        consumer.write(SEPARATOR)
+        writer = _ArmoredWriter(consumer) if self.armor else consumer
+        self._aes.buffer = writer
+        return writer
 
-        # TODO ---- this needs to be refactored to allow PROPER streaming
-        # We should write the preamble as soon as possible,
-        # Is it possible to write the AES stream as soon as it is encrypted by
-        # chunks?
-        # FIXME also, it needs to be able to encode chunks with base64 if armor
+    def _end_crypto_stream(self, writer):
+        self._aes.finish()
+        writer.write(self.tag)
+        if self.armor:
+            writer.flush()
 
-        raw_preamble, encrypted = self._aes.end()
-        result = BytesIO()
-        result.write(
-            base64.urlsafe_b64encode(raw_preamble))
-        result.write(SEPARATOR)
 
-        if self.armor:
-            result.write(
-                base64.urlsafe_b64encode(encrypted + self.tag))
-        else:
-            result.write(encrypted + self.tag)
+class _ArmoredWriter(object):
+    """
+    Encodes data with base64 before writing it to a sink. Data is encoded in
+    chunks whose sizes are multiples of 3 bytes, so the result is the same as
+    if it was all encoded at once.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self._rest = b''
+
+    def write(self, data):
+        data = self._rest + data
+        aligned = len(data) - len(data) % 3
+        self._rest = data[aligned:]
+        if aligned:
+            self._sink.write(base64.urlsafe_b64encode(data[:aligned]))
 
-        result.seek(0)
-        return defer.succeed(result)
+    def flush(self):
+        """
+        Encode and write the remaining data, with padding if needed.
+        """
+        if self._rest:
+            self._sink.write(base64.urlsafe_b64encode(self._rest))
+            self._rest = b''
 
 
 # TODO maybe rename this to just Decryptor, since it will be used by blobs
@@ -324,9 +640,16 @@ class BlobDecryptor(object):
     """
     Decrypts an encrypted blob associated with a given Document.
 
+    The ciphertext is read from the file descriptor as a stream: the preamble
+    is parsed from its first bytes and the rest is decoded and decrypted chunk
+    by chunk, while the last 16 bytes are held back as the GCM tag.
+
     Will raise an exception if the blob doesn't have the expected structure, or
     if the GCM tag doesn't verify.
     """
+
+    read_size = 2 ** 16
+
     def __init__(self, doc_info, ciphertext_fd, result=None,
                  secret=None, armor=True, start_stream=True, tag=None):
         if not secret:
@@ -340,79 +663,81 @@ class BlobDecryptor(object):
         self.result = result or BytesIO()
         sym_key = _get_sym_key_for_doc(doc_info.doc_id, secret)
         self.size = None
-        self.tag = None
+        self.tag = tag
+        self._tag_in_stream = False
 
         preamble, iv = self._consume_preamble()
         soledad_assert(preamble)
         soledad_assert(iv)
 
-        self._aes = AESWriter(sym_key, iv, self.result, tag=tag or self.tag)
+        sink = self.result
+        self._decompressor = None
+        if self.method == ENC_METHOD.aes_256_gcm_zlib:
+            sink = self._decompressor = _Decompressor(self.result)
+        self._aes = AESWriter(sym_key, iv, sink, decrypt=True)
         self._aes.authenticate(preamble)
+        # the ciphertext read from the file descriptor ends with the tag
+        self._tail = TruncatedTailPipe(self._aes, tail_size=16)
+        self._body = _ArmorDecoder(self._tail) if armor else self._tail
         if start_stream:
             self._start_stream()
 
     @property
     def decrypted_content_size(self):
+        if self._decompressor is not None:
+            return self._decompressor.written
         return self._aes.written
 
     def _start_stream(self):
-        self._producer = FileBodyProducer(self.fd, readSize=2**16)
+        self._producer = FileBodyProducer(self.fd, readSize=self.read_size)
 
     def _consume_preamble(self):
         """
-        Consume the preamble and write remaining bytes as ciphertext. This
-        function is called during a stream and can be holding both, so we need
-        to consume only preamble and store the remaining.
+        Consume the preamble, leaving the file descriptor positioned at the
+        start of the ciphertext, if there is any.
         """
         self.fd.seek(0)
+        encoded = self._read_until_separator()
         try:
-            parts = self.fd.getvalue().split(SEPARATOR, 1)
-            encoded_preamble = base64.urlsafe_b64decode(parts[0])
-            if len(parts) == 2:
-                ciphertext = parts[1]
-                if self.armor:
-                    ciphertext = base64.urlsafe_b64decode(ciphertext)
-                self.tag, ciphertext = ciphertext[-16:], ciphertext[:-16]
-                self.fd.seek(0)
-                self.fd.write(ciphertext)
-                self.fd.seek(len(ciphertext))
-                self.fd.truncate()
-                self.fd.seek(0)
-
+            encoded_preamble = base64.urlsafe_b64decode(encoded)
         except (TypeError, ValueError):
             raise InvalidBlob
 
-        try:
-            preamble = decode_preamble(encoded_preamble)
-        except InvalidPreambleException as e:
-            raise InvalidBlob(e)
-
-        if preamble.magic != MAGIC:
-            raise InvalidBlob
-        # TODO check timestamp. Just as a sanity check, but for instance
-        # we can refuse to process something that is in the future or
-        # too far in the past (1984 would be nice, hehe)
-        if preamble.scheme != ENC_SCHEME.symkey:
-            raise EncryptionSchemeNotImplementedException(preamble.scheme)
-        if preamble.method != ENC_METHOD.aes_256_gcm:
-            method = preamble.method
-            raise InvalidBlob('Invalid encryption scheme: %s' % method)
-        if preamble.rev != self.rev:
-            rev = preamble.rev
-            msg = 'Invalid revision. Expected: %s, was: %s' % (self.rev, rev)
-            raise InvalidBlob(msg)
-        if preamble.doc_id != self.doc_id:
-            msg = 'Invalid doc_id. '
-            + 'Expected: %s, was: %s' % (self.doc_id, preamble.doc_id)
-            raise InvalidBlob(msg)
-
+        doc_info = DocInfo(self.doc_id, self.rev)
+        preamble = _check_preamble(doc_info, encoded_preamble)
+        self.method = preamble.method
         return encoded_preamble, preamble.iv
 
+    def _read_until_separator(self):
+        # the preamble has a fixed size, but legacy ones are a bit shorter, so
+        # we look for the separator instead of reading an exact amount.
+        encoded = b''
+        while len(encoded) <= PREAMBLE_SIZE:
+            chunk = self.fd.read(PREAMBLE_SIZE + 1)
+            if not chunk:
+                return encoded
+            index = chunk.find(SEPARATOR)
+            if index != -1:
+                self.fd.seek(index + 1 - len(chunk), os.SEEK_CUR)
+                return encoded + chunk[:index]
+            encoded += chunk
+        raise InvalidBlob('Preamble is too long')
+
     def _end_stream(self):
+        tag = self.tag
+        if self._tag_in_stream:
+            if self.armor:
+                self._body.flush()
+            tail = self._tail.buffer.getvalue()
+            if len(tail) < 16:
+                raise InvalidBlob('Blob is too short to have a tag.')
+            tag = tag or tail
         try:
-            self._aes.end()
-        except InvalidTag:
+            self._aes.finish(tag)
+        except (InvalidTag, ValueError, TypeError):
             raise InvalidBlob('Invalid Tag. Blob authentication failed.')
+        if self._decompressor is not None:
+            self._decompressor.finish()
         fd = self.result
         fd.seek(0)
         return self.result
@@ -432,17 +757,127 @@ class BlobDecryptor(object):
     def startProducing(self):
         if not self._producer:
             self._start_stream()
-        return self._producer.startProducing(self._aes)
+        self._tag_in_stream = True
+        return self._producer.startProducing(self._body)
+
+    def _decrypt_all(self):
+        # decrypt the rest of the file descriptor at once, without the reactor
+        self._tag_in_stream = True
+        self._body.write(self.fd.read())
+        return self._end_stream()
 
     def endStream(self):
         return self._end_stream()
 
     def write(self, data):
+        """
+        Decrypt a chunk of unarmored ciphertext that doesn't include the tag,
+        which must have been given when creating the decryptor.
+        """
         self._aes.write(data)
 
     def close(self):
-        result = self._aes.end()
-        return result
+        self._aes.finish(self.tag)
+        if self._decompressor is not None:
+            self._decompressor.finish()
+        return self._aes.aead, self.result.getvalue()
+
+
+class _StringReader(object):
+    """
+    A read-only file-like object over a string. Unlike BytesIO, which copies
+    its initial value, reads are served from the string itself.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def read(self, size=-1):
+        start = self._pos
+        if size is None or size < 0:
+            self._pos = len(self._data)
+        else:
+            self._pos = min(start + size, len(self._data))
+        return self._data[start:self._pos]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._data)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+
+class _Decompressor(object):
+    """
+    Decompresses data with zlib before writing it to a sink.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self._zlib = zlib.decompressobj()
+        self.written = 0
+
+    def write(self, data):
+        try:
+            self._write(self._zlib.decompress(data))
+        except zlib.error as e:
+            raise InvalidBlob('Invalid compressed content: %s' % e)
+
+    def finish(self):
+        """
+        Write the remaining data, checking that the compressed stream ended.
+        """
+        self._write(self._zlib.flush())
+        if self._zlib.unused_data:
+            raise InvalidBlob('Unexpected data after compressed content.')
+
+    def _write(self, data):
+        if data:
+            self.written += len(data)
+            self._sink.write(data)
+
+
+class _ArmorDecoder(object):
+    """
+    Decodes base64 data before writing it to a sink. Data is decoded in chunks
+    whose sizes are multiples of 4 characters, so the result is the same as if
+    it was all decoded at once.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self._rest = b''
+
+    def write(self, data):
+        data = self._rest + data
+        aligned = len(data) - len(data) % 4
+        self._rest = data[aligned:]
+        if aligned:
+            self._sink.write(self._decode(data[:aligned]))
+
+    def flush(self):
+        """
+        Decode and write the remaining data, which would only be there if the
+        stream was not correctly padded.
+        """
+        if self._rest:
+            rest, self._rest = self._rest, b''
+            self._sink.write(self._decode(rest))
+
+    def _decode(self, data):
+        try:
+            return base64.urlsafe_b64decode(data)
+        except (TypeError, ValueError):
+            raise InvalidBlob('Invalid base64 encoding.')
 
 
 @implementer(interfaces.IConsumer)
@@ -454,21 +889,25 @@ class AESWriter(object):
     It is used both for encryption and decryption of a stream, depending of the
     value of the tag parameter. If you pass a tag, it will operate in
     decryption mode, verifying the authenticity of the preamble and ciphertext.
-    If no tag is passed, encryption mode is assumed, which will generate a tag.
+    If no tag is passed, encryption mode is assumed, which will generate a tag,
+    unless decrypt is set, in which case the tag is given when finishing.
     """
 
-    def __init__(self, key, iv=None, _buffer=None, tag=None, mode=modes.GCM):
+    def __init__(self, key, iv=None, _buffer=None, tag=None, mode=modes.GCM,
+                 decrypt=False):
         if len(key) != 32:
             raise EncryptionDecryptionError('key is not 256 bits')
 
         if tag is not None:
             # if tag, we're decrypting
+            decrypt = True
+        if decrypt:
             assert iv is not None
 
         self.iv = iv or os.urandom(16)
         self.buffer = _buffer or BytesIO()
         cipher = _get_aes_cipher(key, self.iv, tag, mode)
-        cipher = cipher.decryptor() if tag else cipher.encryptor()
+        cipher = cipher.decryptor() if decrypt else cipher.encryptor()
         self.cipher, self.aead = cipher, ''
         self.written = 0
 
@@ -482,10 +921,28 @@ class AESWriter(object):
 
     def write(self, data):
         self.written += len(data)
-        self.buffer.write(self.cipher.update(data))
+        self._write(self.cipher.update(data))
+
+    def finish(self, tag=None):
+        """
+        Finalize the cipher, writing any remaining data to the buffer.
+
+        :param tag: The tag to verify, when decrypting without having given
+            it on creation.
+        :type tag: str
+        """
+        if tag is None:
+            self._write(self.cipher.finalize())
+        else:
+            self._write(self.cipher.finalize_with_tag(tag))
+
+    def _write(self, data):
+        # an empty write would end a chunked HTTP body
+        if data:
+            self.buffer.write(data)
 
     def end(self):
-        self.buffer.write(self.cipher.finalize())
+        self.finish()
         return self.aead, self.buffer.getvalue()
 
 
@@ -507,6 +964,101 @@ def is_symmetrically_encrypted(content):
 # utils
 
 
+def _check_preamble(doc_info, encoded_preamble):
+    """
+    Decode a preamble, checking that it was made for a given document with a
+    supported encryption method.
+
+    :return: The decoded preamble.
+    :rtype: leap.soledad.common.blobs.preamble.Preamble
+    """
+    try:
+        preamble = decode_preamble(encoded_preamble)
+    except InvalidPreambleException as e:
+        raise InvalidBlob(e)
+
+    if preamble.magic != MAGIC:
+        raise InvalidBlob
+    # TODO check timestamp. Just as a sanity check, but for instance
+    # we can refuse to process something that is in the future or
+    # too far in the past (1984 would be nice, hehe)
+    if preamble.scheme != ENC_SCHEME.symkey:
+        raise EncryptionSchemeNotImplementedException(preamble.scheme)
+    if preamble.method not in SUPPORTED_METHODS:
+        method = preamble.method
+        raise InvalidBlob('Invalid encryption scheme: %s' % method)
+    if preamble.rev != doc_info.rev:
+        rev = preamble.rev
+        msg = 'Invalid revision. Expected: %s, was: %s' % (doc_info.rev, rev)
+        raise InvalidBlob(msg)
+    if preamble.doc_id != doc_info.doc_id:
+        msg = 'Invalid doc_id. ' \
+            + 'Expected: %s, was: %s' % (doc_info.doc_id, preamble.doc_id)
+        raise InvalidBlob(msg)
+    return preamble
+
+
+class _KeyCache(object):
+    """
+    The keys derived from a secret for the last used documents. The least
+    recently used keys are dropped when the cache is full. It can be used
+    from many threads.
+    """
+
+    def __init__(self, secret, size):
+        self._secret = secret
+        self._size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_id):
+        """
+        Get the key for a document, deriving it if it is not cached.
+        """
+        with self._lock:
+            key = self._keys.pop(doc_id, None)
+            if key is not None:
+                self._keys[doc_id] = key
+                return key
+        key = _get_sym_key_for_doc(doc_id, self._secret)
+        with self._lock:
+            self._keys[doc_id] = key
+            if len(self._keys) > self._size:
+                self._keys.popitem(last=False)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def _compress(fd, chunk_size=2 ** 16):
+    """
+    Compress the content of a file into a new one, which is kept in memory
+    unless it is large.
+    """
+    compressed = tempfile.SpooledTemporaryFile(max_size=2 ** 22)
+    compressor = zlib.compressobj()
+    fd.seek(0)
+    chunk = fd.read(chunk_size)
+    while chunk:
+        compressed.write(compressor.compress(chunk))
+        chunk = fd.read(chunk_size)
+    compressed.write(compressor.flush())
+    compressed.seek(0)
+    return compressed
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 def _hmac_sha256(key, data):
     return hmac.new(key, data, hashlib.sha256).digest()
 
@@ -30,9 +30,12 @@ from io import BytesIO
 
 from twisted.logger import Logger
 from twisted.internet import defer
+from twisted.internet import threads
+from twisted.web.iweb import UNKNOWN_LENGTH
 
 import treq
 
+from leap.soledad.common.blobs.preamble import ENC_METHOD
 from leap.soledad.common.errors import SoledadError
 from leap.common.files import mkdir_p
 
@@ -46,6 +49,8 @@ from leap.soledad.client._http import HTTPClient
 from leap.soledad.client._pipes import TruncatedTailPipe
 from leap.soledad.client._pipes import PreamblePipe
 
+from .partial import PartialDownload
+from .partial import PartialUpload
 from .sql import SyncStatus
 from .sql import Priority
 from .sql import SQLiteBlobBackend
@@ -173,10 +178,12 @@ class BlobManager(BlobsSynchronizer):
     max_decrypt_retries = 3
     concurrent_transfers_limit = 3
     concurrent_writes_limit = 100
+    bulk_size = 500  # maximum number of operations in a bulk request
+    upload_chunk_size = 2 ** 20  # larger blobs are uploaded in chunks
 
     def __init__(
             self, local_path, remote, key, secret, user, token=None,
-            cert_file=None, remote_stream=None):
+            cert_file=None, remote_stream=None, encryption_methods=None):
         """
         Initialize the blob manager.
 
@@ -194,14 +201,22 @@ class BlobManager(BlobsSynchronizer):
         :type cert_file: str
         :param remote_stream: Remote storage stream URL, if supported.
         :type remote_stream: str
+        :param encryption_methods: The encryption method (one of ENC_METHOD)
+            to use for blobs of each namespace. Blobs of other namespaces are
+            encrypted with AES-256-GCM.
+        :type encryption_methods: dict
         """
         super(BlobsSynchronizer, self).__init__()
+        self._partial_path = None
         if local_path:
             mkdir_p(os.path.dirname(local_path))
             self.local = SQLiteBlobBackend(local_path, key=key, user=user)
+            self._partial_path = os.path.join(
+                os.path.dirname(local_path), 'partial')
         self.remote = remote
         self.remote_stream = remote_stream
         self.secret = secret
+        self.encryption_methods = encryption_methods or {}
         self.user = user
         self._client = HTTPClient(user, token, cert_file)
         self.semaphore = defer.DeferredSemaphore(self.concurrent_writes_limit)
@@ -268,6 +283,33 @@ class BlobManager(BlobsSynchronizer):
         check_http_status(response.code)
         defer.returnValue((yield response.json()))
 
+    @defer.inlineCallbacks
+    def remote_list_deletions(self, namespace='', since=None):
+        """
+        List blobs deleted from server since a given cursor.
+
+        :param namespace:
+            Optional parameter to restrict operation to a given namespace.
+        :type namespace: str
+        :param since:
+            The cursor returned by a previous listing, or None to list all
+            deletions that the server still knows about.
+        :type since: float
+        :return: A deferred that fires with a dict parsed from the JSON
+            response. The `deleted` key holds the list of deleted blob ids,
+            the `cursor` key holds the cursor for the next listing and the
+            `expired` key tells whether deletions that happened after the
+            given cursor may have been forgotten by the server.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        uri = urljoin(self.remote, self.user + '/')
+        params = {'namespace': namespace} if namespace else {}
+        params['deleted'] = True
+        params['since'] = repr(since) if since is not None else ''
+        response = yield self._client.get(uri, params=params)
+        check_http_status(response.code)
+        defer.returnValue((yield response.json()))
+
     def local_list(self, namespace=''):
         return self.local.list(namespace)
 
@@ -359,6 +401,35 @@ class BlobManager(BlobsSynchronizer):
         response = yield self._client.post(uri, data=flagsfd, params=params)
         check_http_status(response.code, blob_id=blob_id, flags=flags)
 
+    def set_flags_batch(self, items, namespace=''):
+        """
+        Set flags for many blobs using as few requests as possible.
+
+        :param items: A list of (blob_id, flags) tuples.
+        :type items: [(str, [leap.soledad.common.blobs.Flags])]
+        :param namespace:
+            Optional parameter to restrict operation to a given namespace.
+        :type namespace: str
+        :return: A deferred that fires with a dictionary mapping each blob id
+            to the HTTP status code of its operation.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._bulk('flags', [list(item) for item in items], namespace)
+
+    @defer.inlineCallbacks
+    def _bulk(self, operation, items, namespace):
+        uri = urljoin(self.remote, self.user + '/')
+        params = {'namespace': namespace} if namespace else None
+        results = {}
+        for i in xrange(0, len(items), self.bulk_size):
+            data = BytesIO(json.dumps(
+                {operation: items[i:i + self.bulk_size]}))
+            response = yield self._client.post(uri, data=data, params=params)
+            check_http_status(response.code)
+            content = yield response.json()
+            results.update(dict(content[operation]))
+        defer.returnValue(results)
+
     @defer.inlineCallbacks
     def get_flags(self, blob_id, namespace=''):
         """
@@ -468,24 +539,80 @@ class BlobManager(BlobsSynchronizer):
 
     @defer.inlineCallbacks
     def _encrypt_and_upload(self, blob_id, fd, namespace=''):
-        # TODO ------------------------------------------
-        # this is wrong, is doing 2 stages.
-        # the crypto producer can be passed to
-        # the uploader and react as data is written.
-        # try to rewrite as a tube: pass the fd to aes and let aes writer
-        # produce data to the treq request fd.
-        # ------------------------------------------------
         logger.info("Staring upload of blob: %s" % blob_id)
-        doc_info = DocInfo(blob_id, FIXED_REV)
         uri = urljoin(self.remote, self.user + "/" + blob_id)
-        crypter = BlobEncryptor(doc_info, fd, secret=self.secret,
-                                armor=False)
-        fd = yield crypter.encrypt()
-        params = {'namespace': namespace} if namespace else None
-        response = yield self._client.put(uri, data=fd, params=params)
-        check_http_status(response.code, blob_id)
+        params = {'namespace': namespace} if namespace else {}
+        partial = self._get_partial_upload(blob_id, namespace)
+        if partial and partial.size:
+            # the ciphertext of an interrupted upload was kept
+            yield self._upload_in_chunks(uri, blob_id, partial, params)
+            logger.info("Finished upload: %s" % (blob_id,))
+            return
+        doc_info = DocInfo(blob_id, FIXED_REV)
+        method = self.encryption_methods.get(
+            namespace, ENC_METHOD.aes_256_gcm)
+        if method == ENC_METHOD.aes_256_gcm:
+            crypter = BlobEncryptor(doc_info, fd, secret=self.secret,
+                                    armor=False)
+        else:
+            # the content is compressed when the encryptor is created
+            crypter = yield threads.deferToThread(
+                BlobEncryptor, doc_info, fd, secret=self.secret,
+                armor=False, method=method)
+        if partial and crypter.length > self.upload_chunk_size:
+            yield partial.store(crypter)
+            yield self._upload_in_chunks(uri, blob_id, partial, params)
+        else:
+            # the ciphertext is streamed as it is produced
+            response = yield self._client.put(
+                uri, data=crypter, params=params or None)
+            check_http_status(response.code, blob_id)
         logger.info("Finished upload: %s" % (blob_id,))
 
+    @defer.inlineCallbacks
+    def _upload_in_chunks(self, uri, blob_id, partial, params):
+        """
+        Upload the ciphertext of a blob in chunks, resuming the upload session
+        recorded in the partial upload if the server still has it.
+        """
+        offset = None
+        if partial.upload:
+            response = yield self._client.get(
+                uri, params=dict(params, upload=partial.upload))
+            if response.code == 200:
+                offset = (yield response.json())['offset']
+                logger.info("Resuming upload from byte %d" % offset)
+            else:
+                # the session has expired, so the upload starts over
+                yield treq.content(response)
+                if response.code != 404:
+                    check_http_status(response.code, blob_id)
+        try:
+            if offset is None:
+                data = BytesIO(json.dumps({'length': partial.size}))
+                response = yield self._client.post(
+                    uri, data=data, params=dict(params, upload='start'))
+                check_http_status(response.code, blob_id)
+                content = yield response.json()
+                partial.set_upload(content['upload'])
+                offset = content['offset']
+            while offset < partial.size:
+                data = BytesIO(partial.read(offset, self.upload_chunk_size))
+                response = yield self._client.put(
+                    uri, data=data,
+                    params=dict(params, upload=partial.upload, offset=offset))
+                if response.code != 416:
+                    check_http_status(response.code, blob_id)
+                # on 416, the server tells where the upload stopped
+                offset = (yield response.json())['offset']
+            response = yield self._client.post(
+                uri, params=dict(params, upload=partial.upload))
+            check_http_status(response.code, blob_id)
+        except BlobAlreadyExistsError:
+            partial.remove()
+            raise
+        partial.remove()
+
     @defer.inlineCallbacks
     def _downstream(self, blobs_id_list, namespace=''):
         uri = urljoin(self.remote_stream, self.user)
@@ -524,8 +651,11 @@ class BlobManager(BlobsSynchronizer):
         # TODO this needs to be connected in a tube
         uri = urljoin(self.remote, self.user + '/' + blob_id)
         params = {'namespace': namespace} if namespace else None
-        response = yield self._client.get(uri, params=params)
-        check_http_status(response.code, blob_id=blob_id)
+        partial = self._get_partial_download(blob_id, namespace)
+        headers = partial.get_headers() if partial else None
+        response = yield self._client.get(uri, params=params, headers=headers)
+        if response.code not in (206, 304):
+            check_http_status(response.code, blob_id=blob_id)
 
         if not response.headers.hasHeader('Tag'):
             msg = "Server didn't send a tag header for: %s" % blob_id
@@ -535,12 +665,75 @@ class BlobManager(BlobsSynchronizer):
         tag = base64.urlsafe_b64decode(tag)
         buf = DecrypterBuffer(blob_id, self.secret, tag)
 
-        # incrementally collect the body of the response
-        yield treq.collect(response, buf.write)
-        fd, size = buf.close()
+        try:
+            if response.code == 304:
+                # the stored download is complete and still valid
+                logger.info("Revalidated download of: %s" % blob_id)
+                partial.replay(buf.write)
+                yield treq.content(response)
+            else:
+                yield self._collect(response, buf, partial)
+            fd, size = buf.close()
+        except InvalidBlob:
+            if partial:
+                partial.remove()
+            raise
+        if partial:
+            partial.remove()
         logger.info("Finished download: (%s, %d)" % (blob_id, size))
         defer.returnValue((fd, size))
 
+    @defer.inlineCallbacks
+    def _collect(self, response, buf, partial):
+        """
+        Incrementally collect the body of a response into a decrypter buffer,
+        also storing it as a partial download if possible.
+        """
+        if not partial:
+            yield treq.collect(response, buf.write)
+            return
+        if response.code == 206:
+            content_range = response.headers.getRawHeaders(
+                'Content-Range', [None])[0]
+            if not partial.continues(content_range):
+                partial.remove()
+                raise RetriableTransferError(
+                    "Unexpected range: %s" % content_range)
+            # resume from where the previous download stopped
+            logger.info("Resuming download from byte %d" % partial.size)
+            partial.replay(buf.write)
+            partial.resume()
+        else:
+            etag = None
+            if response.headers.hasHeader('ETag'):
+                etag = response.headers.getRawHeaders('ETag')[0]
+            total = response.length
+            if total == UNKNOWN_LENGTH:
+                total = None
+            partial.start(etag, total)
+
+        def _write(data):
+            partial.write(data)
+            buf.write(data)
+
+        try:
+            yield treq.collect(response, _write)
+        finally:
+            partial.close()
+
+    def _get_partial_download(self, blob_id, namespace):
+        if not self._partial_path:
+            return None
+        name = '%s-%s-%s' % (self.user, namespace or 'default', blob_id)
+        return PartialDownload(os.path.join(self._partial_path, name))
+
+    def _get_partial_upload(self, blob_id, namespace):
+        if not self._partial_path:
+            return None
+        name = '%s-%s-%s' % (self.user, namespace or 'default', blob_id)
+        return PartialUpload(
+            os.path.join(self._partial_path, 'uploads', name))
+
     def delete(self, blob_id, namespace=''):
         """
         Delete a blob from local and remote storages.
@@ -568,6 +761,36 @@ class BlobManager(BlobsSynchronizer):
         yield self.local.update_sync_status(
             blob_id, SyncStatus.SYNCED, namespace=namespace)
 
+    @defer.inlineCallbacks
+    def delete_batch(self, blob_ids, namespace=''):
+        """
+        Delete many blobs from local and remote storages using as few
+        requests as possible.
+
+        :param blob_ids: The list of blob ids to delete.
+        :type blob_ids: [str]
+        :param namespace:
+            Optional parameter to restrict operation to a given namespace.
+        :type namespace: str
+        :return: A deferred that fires with a dictionary mapping each blob id
+            to the HTTP status code of its remote deletion.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        logger.info("Marking blobs as PENDING_DELETE: %s" % blob_ids)
+        for blob_id in blob_ids:
+            yield self.local.update_sync_status(
+                blob_id, SyncStatus.PENDING_DELETE, namespace=namespace)
+        logger.info("Staring deletion of blobs: %s" % blob_ids)
+        results = yield self._bulk('delete', list(blob_ids), namespace)
+        for blob_id in blob_ids:
+            if results.get(blob_id) != 200:
+                continue
+            if (yield self.local.exists(blob_id, namespace=namespace)):
+                yield self.local.delete(blob_id, namespace=namespace)
+            yield self.local.update_sync_status(
+                blob_id, SyncStatus.SYNCED, namespace=namespace)
+        defer.returnValue(results)
+
     @defer.inlineCallbacks
     def _delete_from_remote(self, blob_id, namespace=''):
         # TODO this needs to be connected in a tube
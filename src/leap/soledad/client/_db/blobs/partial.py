@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# partial.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Partially downloaded and uploaded blobs.
+"""
+import json
+import os
+
+from leap.common.files import mkdir_p
+
+
+class PartialDownload(object):
+    """
+    The ciphertext of a blob as received from the server, kept on disk
+    together with its ETag so an interrupted download can be resumed from
+    where it stopped, and a complete one can be revalidated instead of being
+    downloaded again.
+    """
+
+    chunk_size = 2**14
+
+    def __init__(self, path):
+        """
+        Initialize the partial download.
+
+        :param path: The path where the ciphertext is stored. Metadata is
+            stored in the same path with a ``.json`` suffix.
+        :type path: str
+        """
+        self.path = path
+        self.etag = None
+        self.total = None
+        self._fd = None
+        if os.path.isfile(path) and os.path.isfile(path + '.json'):
+            with open(path + '.json') as f:
+                meta = json.loads(f.read())
+            self.etag, self.total = meta['etag'], meta['total']
+
+    @property
+    def size(self):
+        if not os.path.isfile(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def get_headers(self):
+        """
+        Get the headers for a request that revalidates or resumes this
+        download.
+
+        :return: A dictionary of request headers.
+        :rtype: dict
+        """
+        if not self.etag or not self.size:
+            return {}
+        if self.total is not None and self.size >= self.total:
+            return {'If-None-Match': [self.etag]}
+        return {'Range': ['bytes=%d-' % self.size], 'If-Range': [self.etag]}
+
+    def start(self, etag, total):
+        """
+        Start storing a new download, discarding what was stored before.
+
+        :param etag: The ETag of the blob being downloaded.
+        :type etag: str
+        :param total: The total size of the blob, if known.
+        :type total: int
+        """
+        mkdir_p(os.path.dirname(self.path))
+        self.etag, self.total = etag, total
+        with open(self.path + '.json', 'w') as f:
+            f.write(json.dumps({'etag': etag, 'total': total}))
+        self._fd = open(self.path, 'wb')
+
+    def continues(self, content_range):
+        """
+        Check whether a partial response holds the data that follows what
+        was stored before.
+
+        :param content_range: The Content-Range header of the response, as
+            in ``bytes 100-199/200``. Range ends are inclusive.
+        :type content_range: str
+
+        :return: Whether the response resumes this download up to its end.
+        :rtype: bool
+        """
+        try:
+            unit, value = content_range.split(' ', 1)
+            span, total = value.split('/')
+            start, end = map(int, span.split('-'))
+            total = None if total == '*' else int(total)
+        except (AttributeError, ValueError):
+            return False
+        if unit != 'bytes' or start != self.size:
+            return False
+        return total is None or end + 1 == total
+
+    def resume(self):
+        """
+        Continue storing a download after what was stored before.
+        """
+        self._fd = open(self.path, 'ab')
+
+    def write(self, data):
+        self._fd.write(data)
+
+    def close(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+    def replay(self, write):
+        """
+        Pass the stored ciphertext to a write function, in chunks.
+
+        :param write: The function that will receive the data.
+        :type write: callable
+        """
+        with open(self.path, 'rb') as f:
+            data = f.read(self.chunk_size)
+            while data:
+                write(data)
+                data = f.read(self.chunk_size)
+
+    def remove(self):
+        """
+        Discard the stored download.
+        """
+        self.close()
+        for path in [self.path, self.path + '.json']:
+            if os.path.isfile(path):
+                os.unlink(path)
+
+
+class PartialUpload(object):
+    """
+    The ciphertext of a blob being uploaded in chunks, kept on disk together
+    with the id of its upload session, so an interrupted upload can be resumed
+    from the offset committed by the server without encrypting the blob again.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the partial upload.
+
+        :param path: The path where the ciphertext is stored. Metadata is
+            stored in the same path with a ``.json`` suffix.
+        :type path: str
+        """
+        self.path = path
+        self.upload = None
+        if os.path.isfile(path) and os.path.isfile(path + '.json'):
+            with open(path + '.json') as f:
+                self.upload = json.loads(f.read())['upload']
+
+    @property
+    def size(self):
+        if not os.path.isfile(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def store(self, producer):
+        """
+        Store the ciphertext of the blob.
+
+        :param producer: A body producer of the ciphertext.
+        :type producer: twisted.web.iweb.IBodyProducer
+
+        :return: A deferred that fires when the ciphertext is stored.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        mkdir_p(os.path.dirname(self.path))
+        # the ciphertext is only in place once it is complete
+        fd = open(self.path + '.tmp', 'wb')
+
+        def _stored(_):
+            os.rename(self.path + '.tmp', self.path)
+            self.set_upload(None)
+
+        d = producer.startProducing(fd)
+        d.addBoth(lambda result: fd.close() or result)
+        d.addCallback(_stored)
+        return d
+
+    def set_upload(self, upload):
+        """
+        Record the id of the upload session on the server.
+
+        :param upload: The id of the session.
+        :type upload: str
+        """
+        self.upload = upload
+        with open(self.path + '.json', 'w') as f:
+            f.write(json.dumps({'upload': upload}))
+
+    def read(self, offset, size):
+        """
+        Read a chunk of the stored ciphertext.
+
+        :param offset: The position of the chunk.
+        :type offset: int
+        :param size: The maximum size of the chunk.
+        :type size: int
+
+        :return: The data of the chunk.
+        :rtype: str
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def remove(self):
+        """
+        Discard the stored upload.
+        """
+        for path in [self.path, self.path + '.json']:
+            if os.path.isfile(path):
+                os.unlink(path)
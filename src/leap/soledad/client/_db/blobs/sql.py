@@ -242,6 +242,17 @@ class SQLiteBlobBackend(object):
         query = 'DELETE FROM blobs WHERE blob_id = ? AND namespace = ?'
         return self.dbpool.runQuery(query, (blob_id, namespace,))
 
+    @defer.inlineCallbacks
+    def get_deletions_cursor(self, namespace=''):
+        query = 'SELECT cursor FROM deletions_cursor WHERE namespace = ?'
+        result = yield self.dbpool.runQuery(query, (namespace,))
+        if result:
+            defer.returnValue(result[0][0])
+
+    def set_deletions_cursor(self, cursor, namespace=''):
+        query = 'INSERT OR REPLACE INTO deletions_cursor VALUES (?, ?)'
+        return self.dbpool.runOperation(query, (namespace, cursor))
+
     def batch_delete(self, blob_id_list, namespace=''):
         query = 'DELETE FROM blobs WHERE blob_id IN '
         size = len(blob_id_list)
@@ -254,6 +265,7 @@ def _init_tables(conn):
     # unified init for running under the same lock
     _init_blob_table(conn)
     _init_sync_table(conn)
+    _init_deletions_table(conn)
 
 
 def _init_sync_table(conn):
@@ -271,6 +283,15 @@ def _init_sync_table(conn):
     conn.execute(maybe_create)
 
 
+def _init_deletions_table(conn):
+    maybe_create = (
+        "CREATE TABLE IF NOT EXISTS "
+        "deletions_cursor ("
+        "namespace TEXT PRIMARY KEY, "
+        "cursor REAL)")
+    conn.execute(maybe_create)
+
+
 def _init_blob_table(conn):
     maybe_create = (
         "CREATE TABLE IF NOT EXISTS "
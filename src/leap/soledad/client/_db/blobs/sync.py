@@ -80,13 +80,24 @@ class BlobsSynchronizer(object):
 
     @defer.inlineCallbacks
     def _apply_deletions_from_server(self, namespace=''):
-        remote_deletions = self.remote_list(namespace=namespace, deleted=True)
-        remote_deletions = yield remote_deletions
-        yield self.local.batch_delete(remote_deletions)
-        yield self.local.update_batch_sync_status(
-            remote_deletions,
-            SyncStatus.SYNCED,
-            namespace=namespace)
+        since = yield self.local.get_deletions_cursor(namespace)
+        result = yield self.remote_list_deletions(namespace, since)
+        remote_deletions = result['deleted']
+        if result['expired']:
+            # the server may have forgotten about deletions we didn't see, so
+            # blobs that were synced but are not in the server were deleted.
+            d1 = self.remote_list(namespace=namespace)
+            d2 = self.local_list_status(SyncStatus.SYNCED, namespace)
+            remote_list, synced = yield defer.gatherResults([d1, d2])
+            missing = set(synced) - set(remote_list)
+            remote_deletions = list(set(remote_deletions) | missing)
+        if remote_deletions:
+            yield self.local.batch_delete(remote_deletions)
+            yield self.local.update_batch_sync_status(
+                remote_deletions,
+                SyncStatus.SYNCED,
+                namespace=namespace)
+        yield self.local.set_deletions_cursor(result['cursor'], namespace)
 
     def send_missing(self, namespace=''):
         """
@@ -75,9 +75,8 @@ class BlobsUpstreamProducer(object):
             blob_fd = yield self.db.get(blob_id, namespace=self.namespace)
             doc_info = DocInfo(blob_id, FIXED_REV)
             crypter = BlobEncryptor(doc_info, blob_fd, secret=self.secret,
-                                    armor=False)
-            fd = yield crypter.encrypt()
-            consumer.write(fd.read())
+                                    armor=False, sink=consumer)
+            yield crypter.encrypt()
 
     def sleep(self, secs):
         d = defer.Deferred()
@@ -406,8 +406,9 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         self.__replica_uid = replica_uid
         self._cert_file = cert_file
 
-        # storage for the documents received during a sync
+        # storage for the documents received and skipped during a sync
         self.received_docs = []
+        self.skipped_docs = {}
 
         self.running = False
         self._db_handle = None
@@ -442,7 +443,8 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
             raise DatabaseAccessError(str(e))
 
     @defer.inlineCallbacks
-    def sync(self, url, creds=None):
+    def sync(self, url, creds=None, doc_id_prefixes=None,
+             received_doc_callback=None, skipped_doc_callback=None):
         """
         Synchronize documents with remote replica exposed at url.
 
@@ -457,22 +459,57 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         :param creds: optional dictionary giving credentials to authorize the
                       operation with the server.
         :type creds: dict
+        :param doc_id_prefixes: If given, only documents whose ids start with
+                                one of these prefixes are received.
+        :type doc_id_prefixes: list
+        :param received_doc_callback: If given, a function called with the id
+                                      and the revision of each document
+                                      received, as soon as it is inserted.
+        :type received_doc_callback: function
+        :param skipped_doc_callback: If given, a function called with the id
+                                     and the revision of each document
+                                     skipped because of doc_id_prefixes.
+        :type skipped_doc_callback: function
 
         :return:
             A Deferred, that will fire with the local generation (type `int`)
             before the synchronisation was performed.
         :rtype: Deferred
         """
-        syncer = self._get_syncer(url, creds=creds)
+        syncer = self._get_syncer(
+            url, creds=creds, doc_id_prefixes=doc_id_prefixes,
+            received_doc_callback=received_doc_callback,
+            skipped_doc_callback=skipped_doc_callback)
         if DO_STATS:
             self.sync_phase = syncer.sync_phase
             self.syncer = syncer
             self.sync_exchange_phase = syncer.sync_exchange_phase
         local_gen_before_sync = yield syncer.sync()
         self.received_docs = syncer.received_docs
+        self.skipped_docs = syncer.skipped_docs
         defer.returnValue(local_gen_before_sync)
 
-    def _get_syncer(self, url, creds=None):
+    def fetch_docs(self, url, doc_ids, creds=None):
+        """
+        Fetch documents from the remote replica exposed at url, whatever their
+        generation.
+
+        :param url: The url of the target replica to fetch documents from.
+        :type url: str
+        :param doc_ids: The ids of the documents to fetch.
+        :type doc_ids: list
+        :param creds: optional dictionary giving credentials to authorize the
+                      operation with the server.
+        :type creds: dict
+
+        :return: A Deferred, that will fire when the documents were inserted.
+        :rtype: Deferred
+        """
+        syncer = self._get_syncer(url, creds=creds)
+        return syncer.fetch_docs(doc_ids)
+
+    def _get_syncer(self, url, creds=None, doc_id_prefixes=None,
+                    received_doc_callback=None, skipped_doc_callback=None):
         """
         Get a synchronizer for ``url`` using ``creds``.
 
@@ -481,6 +518,17 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
         :param creds: optional dictionary giving credentials.
                       to authorize the operation with the server.
         :type creds: dict
+        :param doc_id_prefixes: If given, only documents whose ids start with
+                                one of these prefixes are received.
+        :type doc_id_prefixes: list
+        :param received_doc_callback: If given, a function called with the id
+                                      and the revision of each document
+                                      received, as soon as it is inserted.
+        :type received_doc_callback: function
+        :param skipped_doc_callback: If given, a function called with the id
+                                     and the revision of each document
+                                     skipped because of doc_id_prefixes.
+        :type skipped_doc_callback: function
 
         :return: A synchronizer.
         :rtype: Synchronizer
@@ -493,7 +541,10 @@ class SQLCipherU1DBSync(SQLCipherDatabase):
                 self._replica_uid,
                 creds=creds,
                 crypto=self._crypto,
-                cert_file=self._cert_file))
+                cert_file=self._cert_file),
+            doc_id_prefixes=doc_id_prefixes,
+            received_doc_callback=received_doc_callback,
+            skipped_doc_callback=skipped_doc_callback)
 
     #
     # Symmetric encryption of syncing docs
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# _sync_scheduler.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Background sync scheduling, driven by local changes.
+"""
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from leap.soledad.common.log import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class SyncScheduler(object):
+    """
+    Schedule syncs in the background.
+
+    A sync is started when the number of local changes reaches a threshold,
+    when no other change was made for a quiet period after the last one, or
+    when there was no sync for a while, so changes made by other replicas
+    are received too.
+
+    Requests made while a sync is running are coalesced into a single sync
+    after it. After failures, syncs are delayed with an exponential backoff,
+    or as long as the server asks for in the Retry-After header of its
+    response.
+    """
+
+    # How many local changes start a sync right away.
+    change_threshold = 100
+
+    # How many seconds without local changes start a sync.
+    quiet_period = 10
+
+    # How many seconds without syncs start one.
+    interval = 5 * 60
+
+    # How many seconds to wait after a first failure, and at most after
+    # consecutive failures.
+    min_backoff = 10
+    max_backoff = 60 * 60
+
+    def __init__(self, sync, clock=None):
+        """
+        :param sync: A function that syncs and returns a deferred.
+        :type sync: function
+        :param clock: The clock used to schedule syncs, the reactor by
+                      default.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._sync = sync
+        self._clock = clock or reactor
+        self.running = False
+        self._call = None
+        self._syncing = None
+        self._waiting = []
+        self._changes = 0
+        self._last_change = 0
+        self._last_sync = 0
+        self._retry_time = 0
+        self._failures = 0
+        # metrics
+        self._syncs = 0
+        self._failed_syncs = 0
+        self._first_start = None
+        self._last_start = None
+        self._last_latency = None
+        self._total_latency = 0
+        self._max_latency = 0
+
+    def start(self):
+        """
+        Start scheduling syncs, beginning with one right away.
+        """
+        if self.running:
+            return
+        self.running = True
+        self._last_sync = self._clock.seconds() - self.interval
+        self._reschedule()
+
+    def stop(self):
+        """
+        Stop scheduling syncs. A sync that is running is not interrupted.
+        """
+        self.running = False
+        self._reschedule()
+
+    def local_change(self, count=1):
+        """
+        Take note of changes to the local database.
+
+        :param count: The number of documents changed.
+        :type count: int
+        """
+        self._changes += count
+        self._last_change = self._clock.seconds()
+        if self.running:
+            self._reschedule()
+
+    def sync_now(self):
+        """
+        Request a sync as soon as possible, which is the running one if it
+        started after the last request, or else the next one.
+
+        :return: A deferred that fires with the result of the sync.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._reschedule()
+        return d
+
+    @property
+    def next_sync(self):
+        """
+        The time when the next sync is scheduled, or None.
+        """
+        if self._call is None:
+            return None
+        return self._call.getTime()
+
+    def get_stats(self):
+        """
+        Get metrics about the frequency and latency of the syncs.
+
+        :return: A dictionary with the number of syncs and of failed ones,
+                 the number of consecutive failures, the last, mean and
+                 maximum latencies of syncs, the mean interval between their
+                 starts, and the time of the next one, in seconds.
+        :rtype: dict
+        """
+        mean_latency = mean_interval = None
+        if self._syncs:
+            mean_latency = self._total_latency / self._syncs
+        if self._syncs > 1:
+            mean_interval = \
+                (self._last_start - self._first_start) / (self._syncs - 1)
+        return {
+            'syncs': self._syncs,
+            'failed_syncs': self._failed_syncs,
+            'consecutive_failures': self._failures,
+            'last_latency': self._last_latency,
+            'mean_latency': mean_latency,
+            'max_latency': self._max_latency,
+            'mean_interval': mean_interval,
+            'next_sync': self.next_sync,
+        }
+
+    def _next_time(self):
+        now = self._clock.seconds()
+        times = []
+        if self._waiting:
+            times.append(now)
+        if self.running:
+            times.append(self._last_sync + self.interval)
+            if self._changes >= self.change_threshold:
+                times.append(now)
+            elif self._changes:
+                times.append(self._last_change + self.quiet_period)
+        if not times:
+            return None
+        return max(min(times), self._retry_time)
+
+    def _reschedule(self):
+        if self._syncing is not None:
+            # the next sync is scheduled when the running one finishes
+            return
+        when = self._next_time()
+        if when is None:
+            if self._call is not None:
+                self._call.cancel()
+                self._call = None
+            return
+        delay = max(0, when - self._clock.seconds())
+        if self._call is not None:
+            self._call.reset(delay)
+        else:
+            self._call = self._clock.callLater(delay, self._run)
+
+    def _run(self):
+        self._call = None
+        waiting, self._waiting = self._waiting, []
+        changes, self._changes = self._changes, 0
+        started = self._clock.seconds()
+        if self._first_start is None:
+            self._first_start = started
+        self._last_start = started
+        self._syncing = d = defer.maybeDeferred(self._sync)
+        d.addCallbacks(
+            self._succeeded, self._failed,
+            callbackArgs=(started,), errbackArgs=(started, changes))
+        d.addBoth(self._finished, waiting)
+
+    def _record(self, started):
+        now = self._clock.seconds()
+        self._syncs += 1
+        self._last_latency = now - started
+        self._total_latency += self._last_latency
+        self._max_latency = max(self._max_latency, self._last_latency)
+        self._last_sync = now
+        return now
+
+    def _succeeded(self, result, started):
+        self._record(started)
+        self._failures = 0
+        self._retry_time = 0
+        return result
+
+    def _failed(self, failure, started, changes):
+        now = self._record(started)
+        self._failed_syncs += 1
+        self._failures += 1
+        # the changes were not synced, so they still count for the next sync
+        self._changes += changes
+        delay = self._retry_after(failure.value)
+        if delay is None:
+            delay = min(self.max_backoff,
+                        self.min_backoff * 2 ** (self._failures - 1))
+        self._retry_time = now + delay
+        logger.warn("sync failed (%s), retrying in %d seconds"
+                    % (failure.getErrorMessage(), delay))
+        return failure
+
+    def _finished(self, result, waiting):
+        self._syncing = None
+        for d in waiting:
+            d.callback(result)
+        self._reschedule()
+
+    def _retry_after(self, error):
+        """
+        Get the delay the server asked for before retrying, if any.
+
+        :param error: The error the sync failed with.
+        :type error: Exception
+
+        :return: The delay, in seconds, or None.
+        :rtype: float
+        """
+        headers = getattr(error, 'headers', None)
+        if not headers:
+            return None
+        if hasattr(headers, 'getRawHeaders'):
+            values = headers.getRawHeaders('retry-after') or []
+        else:
+            values = [v for k, v in headers.items()
+                      if k.lower() == 'retry-after']
+        for value in values:
+            value = value.strip()
+            if value.isdigit():
+                return int(value)
+            date = parsedate_tz(value)
+            if date is not None:
+                return max(0, mktime_tz(date) - self._clock.seconds())
+        return None
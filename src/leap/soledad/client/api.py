@@ -46,6 +46,7 @@ from leap.common.plugins import collect_plugins
 
 from leap.soledad.common import soledad_assert
 from leap.soledad.common import soledad_assert_type
+from leap.soledad.common.blobs.preamble import ENC_METHOD
 from leap.soledad.common.log import getLogger
 from leap.soledad.common.l2db.remote import http_client
 from leap.soledad.common.l2db.remote.ssl_match_hostname import match_hostname
@@ -59,6 +60,7 @@ from ._db import blobs
 from ._db import sqlcipher
 from ._recovery_code import RecoveryCode
 from ._secrets import Secrets
+from ._sync_scheduler import SyncScheduler
 
 
 logger = getLogger(__name__)
@@ -109,7 +111,9 @@ class Soledad(object):
 
     def __init__(self, uuid, passphrase, secrets_path, local_db_path,
                  server_url, cert_file, shared_db=None,
-                 auth_token=None, with_blobs=False):
+                 auth_token=None, with_blobs=False,
+                 encryption_method=ENC_METHOD.aes_256_gcm,
+                 blob_encryption_methods=None):
         """
         Initialize configuration, cryptographic keys and dbs.
 
@@ -161,6 +165,18 @@ class Soledad(object):
             first initialization and the passed value is different from when
             the database was first initialized.
 
+        :param encryption_method:
+            The method (one of ENC_METHOD) used to encrypt documents before
+            syncing them. Documents are decrypted with whatever method they
+            were encrypted with.
+        :type encryption_method: int
+
+        :param blob_encryption_methods:
+            The encryption method (one of ENC_METHOD) to use for blobs of each
+            namespace. Blobs of other namespaces are encrypted with
+            AES-256-GCM.
+        :type blob_encryption_methods: dict
+
         :raise BootstrapSequenceError:
             Raised when the secret initialization sequence (i.e. retrieval
             from server or generation and storage on server) has failed for
@@ -174,8 +190,10 @@ class Soledad(object):
         self.server_url = server_url
         self.shared_db = shared_db
         self.token = auth_token
+        self._blob_encryption_methods = blob_encryption_methods
 
         self._dbsyncer = None
+        self.sync_scheduler = SyncScheduler(self.sync)
 
         # configure SSL certificate
         global SOLEDAD_CERT
@@ -186,7 +204,8 @@ class Soledad(object):
 
         self._recovery_code = RecoveryCode()
         self._secrets = Secrets(self)
-        self._crypto = SoledadCrypto(self._secrets.remote_secret)
+        self._crypto = SoledadCrypto(
+            self._secrets.remote_secret, method=encryption_method)
 
         try:
             # initialize database access, trap any problems so we can shutdown
@@ -288,7 +307,8 @@ class Soledad(object):
         key = self._secrets.local_key
         self.blobmanager = blobs.BlobManager(
             path, url, key, self._secrets.remote_secret,
-            self.uuid, self.token, SOLEDAD_CERT)
+            self.uuid, self.token, SOLEDAD_CERT,
+            encryption_methods=self._blob_encryption_methods)
 
     #
     # Closing methods
@@ -299,11 +319,13 @@ class Soledad(object):
         Close underlying U1DB database.
         """
         logger.debug("closing soledad")
+        self.sync_scheduler.stop()
         self._dbpool.close()
         if self.blobmanager:
             self.blobmanager.close()
         if getattr(self, '_dbsyncer', None):
             self._dbsyncer.close()
+        self._crypto.close()
 
     #
     # ILocalStorage
@@ -320,6 +342,13 @@ class Soledad(object):
         """
         return self._dbpool.runU1DBQuery(meth, *args, **kw)
 
+    def _local_change(self, result):
+        """
+        Let the sync scheduler know that the local database was changed.
+        """
+        self.sync_scheduler.local_change()
+        return result
+
     def put_doc(self, doc):
         """
         Update a document.
@@ -343,6 +372,7 @@ class Soledad(object):
         :rtype: twisted.internet.defer.Deferred
         """
         d = self._defer("put_doc", doc)
+        d.addCallback(self._local_change)
         return d
 
     def delete_doc(self, doc):
@@ -358,7 +388,9 @@ class Soledad(object):
         :rtype: twisted.internet.defer.Deferred
         """
         soledad_assert(doc is not None, "delete_doc doesn't accept None.")
-        return self._defer("delete_doc", doc)
+        d = self._defer("delete_doc", doc)
+        d.addCallback(self._local_change)
+        return d
 
     def get_doc(self, doc_id, include_deleted=False):
         """
@@ -440,6 +472,7 @@ class Soledad(object):
         # payloads for example) in which we already have the encoding in the
         # headers, so we don't need to guess it.
         doc = yield self._defer("create_doc", content, doc_id=doc_id)
+        self._local_change(doc)
         doc.set_store(self)
         defer.returnValue(doc)
 
@@ -460,7 +493,9 @@ class Soledad(object):
         :return: A deferred whose callback will be invoked with a document.
         :rtype: twisted.internet.defer.Deferred
         """
-        return self._defer("create_doc_from_json", json, doc_id=doc_id)
+        d = self._defer("create_doc_from_json", json, doc_id=doc_id)
+        d.addCallback(self._local_change)
+        return d
 
     def create_index(self, index_name, *index_expressions):
         """
@@ -629,7 +664,9 @@ class Soledad(object):
         :return: A deferred.
         :rtype: twisted.internet.defer.Deferred
         """
-        return self._defer("resolve_doc", doc, conflicted_doc_revs)
+        d = self._defer("resolve_doc", doc, conflicted_doc_revs)
+        d.addCallback(self._local_change)
+        return d
 
     @property
     def local_db_path(self):
@@ -643,13 +680,28 @@ class Soledad(object):
     # ISyncableStorage
     #
 
-    def sync(self):
+    def sync(self, doc_id_prefixes=None, received_doc_callback=None,
+             skipped_doc_callback=None):
         """
         Synchronize documents with the server replica.
 
         This method uses a lock to prevent multiple concurrent sync processes
         over the same local db file.
 
+        :param doc_id_prefixes: If given, only documents whose ids start with
+            one of these prefixes are received, and the other ones are
+            skipped. They can be fetched later with fetch_docs.
+        :type doc_id_prefixes: list
+        :param received_doc_callback: If given, a function called with the id
+            and the revision of each document received, as soon as it is
+            inserted, so documents can be processed while the sync is still
+            running.
+        :type received_doc_callback: function
+        :param skipped_doc_callback: If given, a function called with the id
+            and the revision of each document skipped because of
+            doc_id_prefixes, which later syncs do not receive either.
+        :type skipped_doc_callback: function
+
         :return: A deferred lock that will run the actual sync process when
                  the lock is acquired, and which will fire with with the local
                  generation before the synchronization was performed.
@@ -664,13 +716,27 @@ class Soledad(object):
             return defer.succeed(generation)
 
         d = self.sync_lock.run(
-            self._sync)
+            self._sync, doc_id_prefixes, received_doc_callback,
+            skipped_doc_callback)
         return d
 
-    def _sync(self):
+    def _sync(self, doc_id_prefixes=None, received_doc_callback=None,
+              skipped_doc_callback=None):
         """
         Synchronize documents with the server replica.
 
+        :param doc_id_prefixes: If given, only documents whose ids start with
+            one of these prefixes are received.
+        :type doc_id_prefixes: list
+        :param received_doc_callback: If given, a function called with the id
+            and the revision of each document received, as soon as it is
+            inserted.
+        :type received_doc_callback: function
+        :param skipped_doc_callback: If given, a function called with the id
+            and the revision of each document skipped because of
+            doc_id_prefixes.
+        :type skipped_doc_callback: function
+
         :return: A deferred whose callback will be invoked with the local
             generation before the synchronization was performed.
         :rtype: twisted.internet.defer.Deferred
@@ -681,7 +747,10 @@ class Soledad(object):
         if not self._dbsyncer:
             return
         creds = {'token': {'uuid': self.uuid, 'token': self.token}}
-        d = self._dbsyncer.sync(sync_url, creds=creds)
+        d = self._dbsyncer.sync(
+            sync_url, creds=creds, doc_id_prefixes=doc_id_prefixes,
+            received_doc_callback=received_doc_callback,
+            skipped_doc_callback=skipped_doc_callback)
 
         def _sync_callback(local_gen):
             self._last_received_docs = docs = self._dbsyncer.received_docs
@@ -717,6 +786,34 @@ class Soledad(object):
         d.addCallback(_emit_done_data_sync)
         return d
 
+    def fetch_docs(self, doc_ids):
+        """
+        Fetch documents from the server replica, whatever their generation,
+        for example the ones skipped by syncs with doc id prefixes.
+
+        This method uses the same lock as sync, so it does not run while
+        documents are being synced. It fails with
+        SyncFiltersNotSupportedError if the server can not filter the
+        documents it returns.
+
+        :param doc_ids: The ids of the documents to fetch.
+        :type doc_ids: list
+
+        :return: A deferred that will fire when the documents were inserted
+            in the local replica.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if not self.token:
+            return defer.succeed(None)
+        return self.sync_lock.run(self._fetch_docs, doc_ids)
+
+    def _fetch_docs(self, doc_ids):
+        if not self.server_url or not self._dbsyncer:
+            return
+        sync_url = urlparse.urljoin(self.server_url, 'user-%s' % self.uuid)
+        creds = {'token': {'uuid': self.uuid, 'token': self.token}}
+        return self._dbsyncer.fetch_docs(sync_url, doc_ids, creds=creds)
+
     @property
     def sync_lock(self):
         """
@@ -85,6 +85,15 @@ class SoledadHTTPSyncTarget(SyncTargetAPI, HTTPDocSender, HTTPDocFetcher):
         # TODO: DEPRECATED CRYPTO
         self._deprecated_crypto = old_crypto.SoledadCrypto(crypto.secret)
         self._insert_doc_cb = None
+        self._commit_callback = None
+        self._checkpoint_callback = None
+        self._binary_sync = False
+        self._sync_filters = False
+        self._sync_batches = False
+        self._sync_compression = False
+        self._doc_id_prefixes = None
+        self._doc_ids = None
+        self._skipped_doc_callback = None
 
         # Twisted default Agent with our own ssl context factory
         factory = getPolicyForHTTPS(cert_file)
@@ -27,6 +27,7 @@ from twisted.web.client import FileBodyProducer
 
 from leap.soledad.client.http_target.support import readBody
 from leap.soledad.common.errors import InvalidAuthTokenError
+from leap.soledad.common.errors import SyncFiltersNotSupportedError
 from leap.soledad.common.l2db.errors import HTTPError
 from leap.soledad.common.l2db import SyncTarget
 
@@ -101,6 +102,13 @@ class SyncTargetAPI(SyncTarget):
         """
         raw = yield self._http_request(self._url)
         res = json.loads(raw)
+        # servers that sync documents in binary format let us know here
+        self._binary_sync = res.get('binary_sync', False)
+        # and also whether they can filter the documents they return, split
+        # a sync in many requests, and compress request and response bodies
+        self._sync_filters = res.get('sync_filters', False)
+        self._sync_batches = res.get('sync_batches', False)
+        self._sync_compression = res.get('sync_compression', False)
         defer.returnValue((
             res['target_replica_uid'],
             res['target_replica_generation'],
@@ -152,7 +160,9 @@ class SyncTargetAPI(SyncTarget):
     def sync_exchange(self, docs_by_generation, source_replica_uid,
                       last_known_generation, last_known_trans_id,
                       insert_doc_cb, ensure_callback=None,
-                      sync_id=None):
+                      sync_id=None, commit_callback=None,
+                      checkpoint_callback=None, doc_id_prefixes=None,
+                      skipped_doc_callback=None):
         """
         Find out which documents the remote database does not know about,
         encrypt and send them. After that, receive documents from the remote
@@ -184,6 +194,27 @@ class SyncTargetAPI(SyncTarget):
                                 created.
         :type ensure_callback: function
 
+        :param commit_callback: A callback that commits the documents
+                                inserted with insert_doc_cb, called after
+                                each batch of received documents.
+        :type commit_callback: function
+
+        :param checkpoint_callback: A callback that records the generation
+                                    and transaction id of the target up to
+                                    which received documents were inserted,
+                                    called before each batch is committed.
+        :type checkpoint_callback: function
+
+        :param doc_id_prefixes: If given, only documents whose ids start with
+                                one of these prefixes are received, and the
+                                other ones are skipped.
+        :type doc_id_prefixes: list
+
+        :param skipped_doc_callback: A callback called with the id and the
+                                     revision of each document skipped
+                                     because of doc_id_prefixes.
+        :type skipped_doc_callback: function
+
         :return: A deferred which fires with the new generation and
                  transaction id of the target replica.
         :rtype: twisted.internet.defer.Deferred
@@ -201,6 +232,10 @@ class SyncTargetAPI(SyncTarget):
 
         # save a reference to the callback so we can use it after decrypting
         self._insert_doc_cb = insert_doc_cb
+        self._commit_callback = commit_callback
+        self._checkpoint_callback = checkpoint_callback
+        self._doc_id_prefixes = doc_id_prefixes
+        self._skipped_doc_callback = skipped_doc_callback
 
         gen_after_send, trans_id_after_send = yield self._send_docs(
             docs_by_generation,
@@ -230,6 +265,48 @@ class SyncTargetAPI(SyncTarget):
 
         defer.returnValue([cur_target_gen, cur_target_trans_id])
 
+    @defer.inlineCallbacks
+    def fetch_docs(self, doc_ids, insert_doc_cb, commit_callback=None):
+        """
+        Receive documents with the given ids from the remote database,
+        whatever their generation.
+
+        This needs a server that can filter the documents it returns, as told
+        by get_sync_info.
+
+        :param doc_ids: The ids of the documents to fetch.
+        :type doc_ids: list
+
+        :param insert_doc_cb: A callback for inserting received documents from
+                              target.
+        :type insert_doc_cb: function
+
+        :param commit_callback: A callback that commits the documents
+                                inserted with insert_doc_cb, called after
+                                each batch of received documents.
+        :type commit_callback: function
+
+        :return: A deferred which fires when the documents were inserted.
+        :rtype: twisted.internet.defer.Deferred
+
+        :raise SyncFiltersNotSupportedError: If the server can not filter
+                                             documents.
+        """
+        if not self._sync_filters:
+            raise SyncFiltersNotSupportedError(
+                'The server can not fetch documents by id')
+        self._ensure_callback = None
+        self._insert_doc_cb = insert_doc_cb
+        self._commit_callback = commit_callback
+        self._checkpoint_callback = None
+        self._doc_id_prefixes = None
+        self._skipped_doc_callback = None
+        self._doc_ids = list(doc_ids)
+        try:
+            yield self._receive_docs(0, None, None, str(uuid4()))
+        finally:
+            self._doc_ids = None
+
 
 def _unauth_to_invalid_token_error(failure):
     """
@@ -15,15 +15,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import json
+import time
 from twisted.internet import defer
+from twisted.internet import reactor
 from twisted.internet import threads
+from twisted.python import threadpool
+from twisted.python.failure import Failure
 
 from leap.soledad.client.events import SOLEDAD_SYNC_RECEIVE_STATUS
 from leap.soledad.client.events import emit_async
+from leap.soledad.client.http_target.support import AdaptiveBatchSize
 from leap.soledad.client.http_target.support import RequestBody
 from leap.soledad.common.log import getLogger
 from leap.soledad.client._crypto import is_symmetrically_encrypted
 from leap.soledad.common.l2db import errors
+from leap.soledad.common.sync_frames import Blob
+from leap.soledad.common.sync_frames import BINARY_STREAM
 from leap.soledad.client import crypto as old_crypto
 
 from .._document import Document
@@ -40,6 +47,25 @@ class HTTPDocFetcher(object):
     * Fetch the total on response and prepare to ask all remaining
     * (async) Documents will come encrypted.
               So we parse, decrypt and insert locally as they arrive.
+
+    Received documents are grouped in batches, which are decrypted in the
+    crypto pool as soon as they are complete, and then inserted in order by a
+    single thread, with one commit for each batch. The response stream is
+    paused while too many complete batches wait to be inserted.
+
+    Documents come in the order of their generation in the target, so after
+    each batch the generation of its last document is recorded as a
+    checkpoint, and an interrupted sync does not fetch them again.
+
+    Servers that can filter documents only send the ones whose ids start
+    with the prefixes given to sync_exchange, and the ids and revisions of
+    the other ones, while documents sent by other servers are filtered here
+    instead. Either way, the skipped documents are reported to the
+    skipped_doc_callback given to sync_exchange.
+
+    Servers that can split a sync in many requests send documents in batches
+    sized by AdaptiveBatchSize, and a batch that fails is requested again
+    from the first document that was not received.
     """
 
     # The uuid of the local replica.
@@ -49,25 +75,37 @@ class HTTPDocFetcher(object):
     uuid = 'undefined'
     userid = 'undefined'
 
+    # How many received documents are decrypted and inserted together.
+    insert_batch_size = 100
+
     @defer.inlineCallbacks
     def _receive_docs(self, last_known_generation, last_known_trans_id,
                       ensure_callback, sync_id):
         new_generation = last_known_generation
         new_transaction_id = last_known_trans_id
-        # Acts as a queue, ensuring line order on async processing
-        # as `self._insert_doc_cb` cant be run concurrently or out of order.
-        # DeferredSemaphore solves the concurrency and its implementation uses
-        # a queue, solving the ordering.
-        # FIXME: Find a proper solution to avoid surprises on Twisted changes
-        self.semaphore = defer.DeferredSemaphore(1)
-
-        metadata = yield self._fetch_all(
-            last_known_generation, last_known_trans_id,
-            sync_id)
-        number_of_changes, ngen, ntrans = self._parse_metadata(metadata)
+        self._received_docs = 0
+        self._fetched_docs = 0
+        self._fetched_size = 0
+        # the local replica is only written to from this thread while
+        # documents are received
+        self._writer = threadpool.ThreadPool(
+            minthreads=1, maxthreads=1, name='soledad-sync-writer')
+        self._writer.start()
+        self._inserter = _DocInserter(
+            self._prepare_docs, self._insert_docs, self.insert_batch_size)
+        try:
+            metadata = yield self._fetch_batches(
+                last_known_generation, last_known_trans_id,
+                sync_id)
+            number_of_changes, ngen, ntrans = self._parse_metadata(metadata)
+        except Exception:
+            # the documents received so far are still inserted
+            failure = Failure()
+            yield self._finish_inserts().addErrback(lambda _: None)
+            failure.raiseException()
 
         # wait for pending inserts
-        yield self.semaphore.acquire()
+        yield self._finish_inserts()
 
         if ngen:
             new_generation = ngen
@@ -75,61 +113,183 @@ class HTTPDocFetcher(object):
 
         defer.returnValue([new_generation, new_transaction_id])
 
+    def _finish_inserts(self):
+        d = self._inserter.finish()
+
+        def _stop(result):
+            self._writer.stop()
+            return result
+
+        d.addBoth(_stop)
+        return d
+
+    @defer.inlineCallbacks
+    def _fetch_batches(self, last_known_generation,
+                       last_known_trans_id, sync_id):
+        if not self._sync_batches:
+            metadata = yield self._fetch_all(
+                last_known_generation, last_known_trans_id, sync_id)
+            defer.returnValue(metadata)
+        batch_size = AdaptiveBatchSize()
+        while True:
+            fetched, size = self._fetched_docs, self._fetched_size
+            start = time.time()
+            try:
+                metadata = yield self._fetch_all(
+                    last_known_generation, last_known_trans_id, sync_id,
+                    received=fetched, limit=batch_size.docs)
+            except Exception as e:
+                # documents are inserted in the order they were received, so
+                # the ones received before the failure are not requested again
+                if self._inserter.failed or not batch_size.failed(e):
+                    raise
+                continue
+            batch_size.update(
+                self._fetched_docs - fetched, self._fetched_size - size,
+                time.time() - start)
+            number_of_changes, _, _ = self._parse_metadata(metadata)
+            if self._fetched_docs >= number_of_changes:
+                defer.returnValue(metadata)
+            if self._fetched_docs == fetched:
+                raise errors.BrokenSyncStream('No documents in batch')
+
     def _fetch_all(self, last_known_generation,
-                   last_known_trans_id, sync_id):
+                   last_known_trans_id, sync_id, received=0, limit=None):
         # add remote replica metadata to the request
+        args = self._filters()
+        if limit is not None:
+            args.update(received=received, limit=limit)
         body = RequestBody(
             last_known_generation=last_known_generation,
             last_known_trans_id=last_known_trans_id,
             sync_id=sync_id,
-            ensure=self._ensure_callback is not None)
-        self._received_docs = 0
+            ensure=self._ensure_callback is not None,
+            **args)
         # build a stream reader with _doc_parser as a callback
-        body_reader = fetch_protocol.build_body_reader(self._doc_parser)
+        body_reader = fetch_protocol.build_body_reader(
+            self._doc_parser, metadata_reader=self._metadata_parser)
+        headers = self._base_header
+        if self._binary_sync:
+            # the server may send documents in binary format
+            headers['accept'] = [BINARY_STREAM]
+        if self._sync_compression:
+            # the stream is decompressed as it is received
+            headers['accept-encoding'] = ['gzip']
         # start download stream
         return self._http_request(
             self._url,
             method='POST',
             body=str(body),
+            headers=headers,
             content_type='application/x-soledad-sync-get',
             body_reader=body_reader)
 
-    @defer.inlineCallbacks
+    def _filters(self):
+        if not self._sync_filters:
+            return {}
+        if self._doc_ids is not None:
+            return {'doc_ids': self._doc_ids}
+        if self._doc_id_prefixes is not None:
+            return {'doc_id_prefixes': list(self._doc_id_prefixes)}
+        return {}
+
+    def _metadata_parser(self, metadata):
+        """
+        Make sure we know the replica uid of a target that was just created
+        before its documents are inserted, so they can be checkpointed.
+
+        :param metadata: The metadata of the sync stream.
+        :type metadata: dict
+        """
+        if self._ensure_callback and 'replica_uid' in metadata:
+            self._ensure_callback(metadata['replica_uid'])
+
     def _doc_parser(self, doc_info, content, total):
         """
-        Insert a received document into the local replica, decrypting
-        if necessary. The case where it's not decrypted is when a doc gets
-        inserted from Server side with a GPG encrypted content.
+        Queue a received document to be inserted into the local replica,
+        decrypting if necessary. The case where it's not decrypted is when a
+        doc gets inserted from Server side with a GPG encrypted content.
 
         :param doc_info: Dictionary representing Document information.
         :type doc_info: dict
-        :param content: The Document's content.
+        :param content: The Document's content, or a blob if it was received
+            in binary format.
         :type idx: str
         :param total: The total number of operations.
         :type total: int
+
+        :return: A deferred that fails if the batch of the document could not
+            be inserted.
+        :rtype: twisted.internet.defer.Deferred
         """
-        yield self.semaphore.run(self.__atomic_doc_parse, doc_info, content,
-                                 total)
+        self._fetched_docs += 1
+        self._fetched_size += len(content or '')
+        skipped = doc_info.get('skipped', False) or (
+            self._doc_id_prefixes is not None and not self._sync_filters and
+            not doc_info['id'].startswith(tuple(self._doc_id_prefixes)))
+        if skipped:
+            # the server sent only the revision of a document that was
+            # filtered out, or could not filter this document out
+            if self._skipped_doc_callback is not None:
+                self._skipped_doc_callback(doc_info['id'], doc_info['rev'])
+            return defer.succeed(None)
+        return self._inserter.add((doc_info, content, total))
 
     @defer.inlineCallbacks
-    def __atomic_doc_parse(self, doc_info, content, total):
-        doc = Document(doc_info['id'], doc_info['rev'], content)
-        if is_symmetrically_encrypted(content):
-            content = (yield self._crypto.decrypt_doc(doc)).getvalue()
-        elif old_crypto.is_symmetrically_encrypted(doc):
-            content = self._deprecated_crypto.decrypt_doc(doc)
-        doc.set_json(content)
+    def _prepare_docs(self, entries):
+        """
+        Decrypt a batch of received documents in the crypto pool.
+
+        :return: A deferred that fires with a list of (doc, gen, trans_id,
+            total) tuples.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        def _encrypted(content):
+            return isinstance(content, Blob) or \
+                is_symmetrically_encrypted(content)
+
+        encrypted = [(doc_info['id'], doc_info['rev'], content)
+                     for doc_info, content, _ in entries
+                     if _encrypted(content)]
+        decrypted = iter((yield self._crypto.decrypt_docs(encrypted)))
+        docs = []
+        for doc_info, content, total in entries:
+            if _encrypted(content):
+                content = next(decrypted)
+            doc = Document(doc_info['id'], doc_info['rev'], content)
+            if old_crypto.is_symmetrically_encrypted(doc):
+                content = self._deprecated_crypto.decrypt_doc(doc)
+            doc.set_json(content)
+            docs.append((doc, doc_info['gen'], doc_info['trans_id'], total))
+        defer.returnValue(docs)
+
+    def _insert_docs(self, docs):
+        """
+        Insert a batch of decrypted documents in the writer thread.
 
+        :return: A deferred that fires when the documents were inserted.
+        :rtype: twisted.internet.defer.Deferred
+        """
         # TODO insert blobs here on the blob backend
-        # FIXME: This is wrong. Using the very same SQLite connection object
-        # from multiple threads is dangerous. We should bring the dbpool here
-        # or find an alternative.  Deferring to a thread only helps releasing
-        # the reactor for other tasks as this is an IO intensive call.
-        yield threads.deferToThread(self._insert_doc_cb,
-                                    doc, doc_info['gen'], doc_info['trans_id'])
-        self._received_docs += 1
+        d = threads.deferToThreadPool(
+            reactor, self._writer, self._insert_docs_in_thread, docs)
+        d.addCallback(lambda _: self._emit_receive_status(docs))
+        return d
+
+    def _insert_docs_in_thread(self, docs):
+        for doc, gen, trans_id, _ in docs:
+            self._insert_doc_cb(doc, gen, trans_id)
+        if self._checkpoint_callback is not None and docs:
+            _, gen, trans_id, _ = docs[-1]
+            self._checkpoint_callback(gen, trans_id)
+        if self._commit_callback is not None:
+            self._commit_callback()
+
+    def _emit_receive_status(self, docs):
         user_data = {'uuid': self.uuid, 'userid': self.userid}
-        _emit_receive_status(user_data, self._received_docs, total=total)
+        for _, _, _, total in docs:
+            self._received_docs += 1
+            _emit_receive_status(user_data, self._received_docs, total=total)
 
     def _parse_metadata(self, metadata):
         """
@@ -143,9 +303,6 @@ class HTTPDocFetcher(object):
         """
         try:
             metadata = json.loads(metadata)
-            # make sure we have replica_uid from fresh new dbs
-            if self._ensure_callback and 'replica_uid' in metadata:
-                self._ensure_callback(metadata['replica_uid'])
             return (metadata['number_of_changes'], metadata['new_generation'],
                     metadata['new_transaction_id'])
         except (ValueError, KeyError):
@@ -159,3 +316,88 @@ def _emit_receive_status(user_data, received_docs, total):
     if received_docs % 20 == 0:
         msg = "%d/%d" % (received_docs, total)
         logger.debug("Sync receive status: %s" % msg)
+
+
+class _DocInserter(object):
+    """
+    Groups received documents in batches that are prepared as soon as they
+    are complete, and inserted one batch at a time, in the order the
+    documents were received.
+    """
+
+    def __init__(self, prepare, insert, batch_size):
+        """
+        :param prepare: A function that receives a list of entries and
+            returns a deferred that fires with a list of prepared entries.
+        :type prepare: callable
+        :param insert: A function that receives a list of prepared entries and
+            returns a deferred that fires when they were inserted.
+        :type insert: callable
+        :param batch_size: How many entries are prepared and inserted
+            together.
+        :type batch_size: int
+        """
+        self._prepare = prepare
+        self._insert = insert
+        self._batch_size = batch_size
+        self._batch = []
+        self._inserted = defer.succeed(None)
+        self._failed = False
+
+    @property
+    def failed(self):
+        """
+        Whether a batch could not be prepared or inserted.
+        """
+        return self._failed
+
+    def add(self, entry):
+        """
+        Add an entry to the current batch, starting to prepare it if it is
+        complete.
+
+        :return: A deferred that fires when the batch of the entry was
+            inserted, or at once if the batch is not complete yet.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        self._batch.append(entry)
+        if len(self._batch) < self._batch_size:
+            return defer.succeed(None)
+        return self._flush()
+
+    def finish(self):
+        """
+        Insert the last batch.
+
+        :return: A deferred that fires when all entries were inserted, or
+            fails if any batch could not be prepared or inserted.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        self._flush().addErrback(lambda _: None)
+        return self._inserted
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        prepared = self._prepare(batch) if batch else defer.succeed([])
+        previous, self._inserted = self._inserted, defer.Deferred()
+
+        # batches are prepared concurrently but inserted in order, and after
+        # a failure nothing else is inserted
+        d = defer.gatherResults([previous, prepared], consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(lambda results: self._insert(results[1]))
+        d.chainDeferred(self._inserted)
+
+        # a failure is only reported once
+        done = defer.Deferred()
+
+        def _report(result):
+            if isinstance(result, Failure) and not self._failed:
+                self._failed = True
+                done.errback(result)
+            elif not done.called:
+                done.callback(None)
+            return result
+
+        self._inserted.addBoth(_report)
+        return done
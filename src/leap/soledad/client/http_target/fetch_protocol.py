@@ -15,12 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import json
+import zlib
 from functools import partial
-from six import StringIO
 from twisted.web._newclient import ResponseDone
 from leap.soledad.common.l2db import errors
 from leap.soledad.common.l2db.remote import utils
 from leap.soledad.common.log import getLogger
+from leap.soledad.common.sync_frames import Blob
+from leap.soledad.common.sync_frames import BINARY_STREAM
+from leap.soledad.common.sync_frames import parse_frame_header
 from .support import ReadBodyProtocol
 from .support import readBody
 
@@ -41,9 +44,31 @@ class DocStreamReceiver(ReadBodyProtocol):
     {doc_info},\r\n
     {content},\r\n
     ]
+
+    If the server sends documents in binary format, each content line is
+    replaced by a frame, as described in leap.soledad.common.sync_frames. If
+    the server compresses the stream with gzip, it is decompressed as it
+    arrives.
+
+    Only the data that arrives is scanned for line breaks, and the parts of a
+    line that is not complete yet are kept until the line is, so each line is
+    copied just once. While too many documents handed to the document reader
+    are pending, the transport is paused, so documents are not received
+    faster than they can be inserted.
     """
 
-    def __init__(self, response, deferred, doc_reader):
+    # The size of the largest line or frame accepted, which is larger than
+    # the largest entry the server accepts (200Mb) encoded with base64.
+    max_line_size = 300 * 1024 * 1024
+
+    # How many deferreds returned by the document reader can be pending
+    # before the transport is paused.
+    max_pending_reads = 4
+
+    # How many bytes of a compressed stream are decompressed at once.
+    decompress_size = 64 * 1024
+
+    def __init__(self, response, deferred, doc_reader, metadata_reader=None):
         self.deferred = deferred
         self.status = response.code if response else None
         self.message = response.phrase if response else None
@@ -51,12 +76,22 @@ class DocStreamReceiver(ReadBodyProtocol):
         self.delimiter = '\r\n'
         self.metadata = ''
         self._doc_reader = doc_reader
+        self._metadata_reader = metadata_reader
+        self._binary = _is_binary(response)
+        self._decompressor = _get_decompressor(response)
         self.reset()
 
     def reset(self):
         self._line = 0
-        self._buffer = StringIO()
+        self._chunks = []
+        self._chunks_size = 0
         self._properly_finished = False
+        self._frame = None
+        self._frame_parts = []
+        self._frame_received = 0
+        self._after_frame = False
+        self._pending_reads = 0
+        self._paused = False
 
     def connectionLost(self, reason):
         """
@@ -67,6 +102,8 @@ class DocStreamReceiver(ReadBodyProtocol):
             return
         try:
             if reason.check(ResponseDone):
+                if self._decompressor is not None:
+                    self._streamReceived(self._decompressor.flush())
                 self.dataBuffer = self.metadata
             else:
                 self.dataBuffer = self.finish()
@@ -74,30 +111,70 @@ class DocStreamReceiver(ReadBodyProtocol):
             return self.deferred.errback(e)
         return ReadBodyProtocol.connectionLost(self, reason)
 
-    def consumeBufferLines(self):
+    def dataReceived(self, data):
         """
-        Consumes lines from buffer and rewind it, writing remaining data
-        that didn't formed a line back into buffer.
+        Decompress incoming data if needed, a piece at a time, and handle it.
         """
-        content = self._buffer.getvalue()[0:self._buffer.tell()]
-        self._buffer.seek(0)
-        lines = content.split(self.delimiter)
-        self._buffer.write(lines.pop(-1))
-        return lines
+        if self._decompressor is None:
+            return self._streamReceived(data)
+        while data:
+            try:
+                stream = self._decompressor.decompress(
+                    data, self.decompress_size)
+            except zlib.error as e:
+                raise errors.BrokenSyncStream("Invalid compression: %s" % e)
+            data = self._decompressor.unconsumed_tail
+            self._streamReceived(stream)
 
-    def dataReceived(self, data):
+    def _streamReceived(self, data):
         """
-        Buffer incoming data until a line breaks comes in. We check only
-        the incoming data for efficiency.
+        Split incoming data in lines and frames. Only the incoming data is
+        scanned for line breaks, and the beginning of a line that is not
+        complete is kept until the rest of it comes in.
         """
-        self._buffer.write(data)
-        if '\n' not in data:
-            return
-        lines = self.consumeBufferLines()
-        while lines:
-            line, _ = utils.check_and_strip_comma(lines.pop(0))
-            self.lineReceived(line)
-            self._line += 1
+        start = 0
+        if self._chunks and self._chunks[-1].endswith('\r') \
+                and data.startswith('\n'):
+            # the line break was split between two chunks of data
+            self._chunks[-1] = self._chunks[-1][:-1]
+            start = 1
+            self._lineReceived(self._popLine(''))
+        while start < len(data):
+            if self._frame is not None:
+                start = self._frameDataReceived(data, start)
+                continue
+            index = data.find(self.delimiter, start)
+            if index == -1:
+                self._pushChunk(data[start:])
+                return
+            line = self._popLine(data[start:index])
+            start = index + len(self.delimiter)
+            self._lineReceived(line)
+
+    def _pushChunk(self, chunk):
+        self._chunks_size += len(chunk)
+        if self._chunks_size > self.max_line_size:
+            raise errors.BrokenSyncStream("Line too long")
+        self._chunks.append(chunk)
+
+    def _popLine(self, end):
+        if not self._chunks:
+            line = end
+        else:
+            self._chunks.append(end)
+            line = ''.join(self._chunks)
+            self._chunks = []
+            self._chunks_size = 0
+        if len(line) > self.max_line_size:
+            raise errors.BrokenSyncStream("Line too long")
+        return line
+
+    def _lineReceived(self, line):
+        if self._binary:
+            return self._binaryLineReceived(line)
+        line, _ = utils.check_and_strip_comma(line)
+        self.lineReceived(line)
+        self._line += 1
 
     def lineReceived(self, line):
         """
@@ -113,21 +190,101 @@ class DocStreamReceiver(ReadBodyProtocol):
         if ']' == line:
             self._properly_finished = True
         elif self._line == 0:
-            if line is not '[':
+            if line != '[':
                 raise errors.BrokenSyncStream("Invalid start")
         elif self._line == 1:
             self.metadata = line
             if 'error' in self.metadata:
                 raise errors.BrokenSyncStream("Error from server: %s" % line)
-            self.total = json.loads(line).get('number_of_changes', -1)
+            metadata = json.loads(line)
+            self.total = metadata.get('number_of_changes', -1)
+            if self._metadata_reader is not None:
+                self._metadata_reader(metadata)
         elif (self._line % 2) == 0:
             self.current_doc = json.loads(line)
             if 'error' in self.current_doc:
                 raise errors.BrokenSyncStream("Error from server: %s" % line)
         else:
-            d = self._doc_reader(
-                self.current_doc, line.strip() or None, self.total)
-            d.addErrback(self.deferred.errback)
+            self.contentReceived(line.strip() or None)
+
+    def contentReceived(self, content):
+        """
+        Hand the content of a document to the document reader, pausing the
+        transport if too many documents are pending.
+        """
+        d = self._doc_reader(self.current_doc, content, self.total)
+        if not d.called:
+            self._pending_reads += 1
+            if self._pending_reads >= self.max_pending_reads:
+                self._pauseProducing()
+            d.addBoth(self._readDone)
+        d.addErrback(self.deferred.errback)
+
+    def _readDone(self, result):
+        # after a failure the stream is still read, as nothing else would
+        # resume the transport
+        self._pending_reads -= 1
+        if self._pending_reads < self.max_pending_reads:
+            self._resumeProducing()
+        return result
+
+    def _pauseProducing(self):
+        if self._paused or self.transport is None:
+            return
+        self._paused = True
+        self.transport.pauseProducing()
+
+    def _resumeProducing(self):
+        if not self._paused:
+            return
+        self._paused = False
+        self.transport.resumeProducing()
+
+    def _binaryLineReceived(self, line):
+        line, _ = utils.check_and_strip_comma(line)
+        if self._after_frame:
+            # the data of a frame is followed by a line break
+            self._after_frame = False
+            if line:
+                raise errors.BrokenSyncStream("Invalid frame end")
+            return
+        if self._line > 1 and self._line % 2 == 1 and line != ']':
+            try:
+                self._frame = parse_frame_header(line)
+            except ValueError:
+                raise errors.BrokenSyncStream("Invalid frame: %s" % line)
+            if self._frame[1] > self.max_line_size:
+                raise errors.BrokenSyncStream("Frame too long")
+            if self._frame[1] == 0:
+                self._frameReceived()
+            return
+        self.lineReceived(line)
+        self._line += 1
+
+    def _frameDataReceived(self, data, start):
+        needed = self._frame[1] - self._frame_received
+        chunk = data[start:start + needed]
+        self._frame_parts.append(chunk)
+        self._frame_received += len(chunk)
+        if self._frame_received == self._frame[1]:
+            self._frameReceived()
+        return start + len(chunk)
+
+    def _frameReceived(self):
+        kind, _ = self._frame
+        data = ''.join(self._frame_parts)
+        self._frame = None
+        self._frame_parts = []
+        self._frame_received = 0
+        self._after_frame = True
+        if kind == 'null':
+            content = None
+        elif kind == 'blob':
+            content = Blob(data)
+        else:
+            content = data
+        self.contentReceived(content)
+        self._line += 1
 
     def finish(self):
         """
@@ -135,12 +292,29 @@ class DocStreamReceiver(ReadBodyProtocol):
         """
         if not self._properly_finished:
             raise errors.BrokenSyncStream('Stream not properly closed')
-        content = self._buffer.getvalue()[0:self._buffer.tell()]
-        self._buffer.close()
+        content = ''.join(self._chunks)
+        self._chunks = []
+        self._chunks_size = 0
         return content
 
 
-def build_body_reader(doc_reader):
+def _is_binary(response):
+    if response is None:
+        return False
+    content_types = response.headers.getRawHeaders('content-type') or []
+    return any(t.startswith(BINARY_STREAM) for t in content_types)
+
+
+def _get_decompressor(response):
+    if response is None:
+        return None
+    encodings = response.headers.getRawHeaders('content-encoding') or []
+    if 'gzip' not in [e.strip().lower() for e in encodings]:
+        return None
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def build_body_reader(doc_reader, metadata_reader=None):
     """
     Get the documents from a sync stream and call doc_reader on each
     doc received.
@@ -149,9 +323,13 @@ def build_body_reader(doc_reader):
         Will be called with doc metadata (dict parsed from 1st line) and doc
         content (string)
     @type doc_reader: function
+    @param metadata_reader: Function to be called with the metadata of the
+        stream (dict parsed from its 1st line), before any doc is received.
+    @type metadata_reader: function
 
     @return: A function that can be called by the http Agent to create and
     configure the proper protocol.
     """
-    protocolClass = partial(DocStreamReceiver, doc_reader=doc_reader)
+    protocolClass = partial(DocStreamReceiver, doc_reader=doc_reader,
+                            metadata_reader=metadata_reader)
     return partial(readBody, protocolClass=protocolClass)
@@ -15,13 +15,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import json
+import time
+
+from functools import partial
 
 from twisted.internet import defer
 
 from leap.soledad.common.log import getLogger
 from leap.soledad.client.events import emit_async
 from leap.soledad.client.events import SOLEDAD_SYNC_SEND_STATUS
+from leap.soledad.client.http_target.support import AdaptiveBatchSize
 from leap.soledad.client.http_target.support import RequestBody
+from leap.soledad.client.http_target.support import BinaryRequestBody
+from leap.soledad.common.sync_frames import BINARY_PUT
 from .send_protocol import DocStreamProducer
 
 logger = getLogger(__name__)
@@ -31,6 +37,11 @@ class HTTPDocSender(object):
     """
     Handles Document uploading from Soledad server, using HTTP as transport.
     They need to be encrypted and metadata prepared before sending.
+
+    Servers that can split a sync in many requests receive documents in
+    batches sized by AdaptiveBatchSize, and each batch is inserted when its
+    request ends. After a failure, the documents the server did not insert
+    are sent again.
     """
 
     # The uuid of the local replica.
@@ -40,6 +51,10 @@ class HTTPDocSender(object):
     uuid = 'undefined'
     userid = 'undefined'
 
+    # How many documents are loaded and encrypted together, ahead of the ones
+    # being written to the request.
+    encrypt_batch_size = 32
+
     @defer.inlineCallbacks
     def _send_docs(self, docs_by_generation, last_known_generation,
                    last_known_trans_id, sync_id):
@@ -47,56 +62,176 @@ class HTTPDocSender(object):
         if not docs_by_generation:
             defer.returnValue([None, None])
 
-        # add remote replica metadata to the request
-        body = RequestBody(
-            last_known_generation=last_known_generation,
-            last_known_trans_id=last_known_trans_id,
-            sync_id=sync_id,
-            ensure=self._ensure_callback is not None)
-        result = yield self._send_batch(body, docs_by_generation)
+        total, sent = len(docs_by_generation), 0
+        batch_size = AdaptiveBatchSize() if self._sync_batches else None
+        while sent < total:
+            limit = batch_size.docs if batch_size is not None else total
+            docs = docs_by_generation[sent:sent + limit]
+            # add remote replica metadata to the request
+            body_class = \
+                BinaryRequestBody if self._binary_sync else RequestBody
+            body = body_class(
+                last_known_generation=last_known_generation,
+                last_known_trans_id=last_known_trans_id,
+                sync_id=sync_id,
+                ensure=self._ensure_callback is not None)
+            start = time.time()
+            try:
+                result = yield self._send_batch(body, docs, sent, total)
+            except Exception as e:
+                if batch_size is None or not batch_size.failed(e):
+                    raise
+                sent = yield self._count_sent(docs_by_generation)
+                continue
+            if batch_size is not None:
+                batch_size.update(len(docs), body.size, time.time() - start)
+            sent += len(docs)
         response_dict = json.loads(result)[0]
         gen_after_send = response_dict['new_generation']
         trans_id_after_send = response_dict['new_transaction_id']
         defer.returnValue([gen_after_send, trans_id_after_send])
 
     @defer.inlineCallbacks
-    def _send_batch(self, body, docs):
-        total, calls = len(docs), []
+    def _count_sent(self, docs_by_generation):
+        # the server records the generation of each document it inserts, and
+        # documents are sent in the order of their generation
+        info = yield self.get_sync_info(self.source_replica_uid)
+        known_gen = info[3]
+        defer.returnValue(
+            len([gen for _, gen, _ in docs_by_generation if gen <= known_gen]))
+
+    @defer.inlineCallbacks
+    def _send_batch(self, body, docs, offset=0, total=None):
+        total, calls = total or len(docs), []
+        window = _EncryptionWindow(
+            self._encrypt_docs, docs, self.encrypt_batch_size)
         for i, entry in enumerate(docs):
             calls.append((self._prepare_one_doc,
-                         entry, body, i + 1, total))
+                         window, body, i, offset + i + 1, total))
         result = yield self._send_request(body, calls)
-        _emit_send_status(self.uuid, body.consumed, total)
+        _emit_send_status(self.uuid, offset + body.consumed, total)
 
         defer.returnValue(result)
 
     def _send_request(self, body, calls):
+        if isinstance(body, BinaryRequestBody):
+            content_type = BINARY_PUT
+        else:
+            content_type = 'application/x-soledad-sync-put'
+        headers = self._base_header
+        body_producer = DocStreamProducer
+        if self._sync_compression:
+            # the body is compressed as it is written
+            headers['content-encoding'] = ['gzip']
+            body_producer = partial(DocStreamProducer, compress=True)
         return self._http_request(
             self._url,
             method='POST',
             body=(body, calls),
-            content_type='application/x-soledad-sync-put',
-            body_producer=DocStreamProducer)
+            headers=headers,
+            content_type=content_type,
+            body_producer=body_producer)
 
     @defer.inlineCallbacks
-    def _prepare_one_doc(self, entry, body, idx, total):
-        get_doc_call, gen, trans_id = entry
-        doc, content = yield self._encrypt_doc(get_doc_call)
-        body.insert_info(
-            id=doc.doc_id, rev=doc.rev, content=content, gen=gen,
-            trans_id=trans_id, number_of_docs=total,
-            doc_idx=idx)
-        _emit_send_status(self.uuid, body.consumed, total)
+    def _prepare_one_doc(self, window, body, i, idx, total):
+        doc, content, gen, trans_id = yield window.get(i)
+
+        # documents are prepared concurrently, but inserted into the body in
+        # order, as they are written.
+        def _insert():
+            body.insert_info(
+                id=doc.doc_id, rev=doc.rev, content=content, gen=gen,
+                trans_id=trans_id, number_of_docs=total,
+                doc_idx=idx)
+            _emit_send_status(self.uuid, idx, total)
+
+        defer.returnValue(_insert)
 
     @defer.inlineCallbacks
-    def _encrypt_doc(self, get_doc_call):
-        f, args, kwargs = get_doc_call
-        doc = yield f(*args, **kwargs)
-        if doc.is_tombstone():
-            defer.returnValue((doc, None))
-        else:
-            content = yield self._crypto.encrypt_doc(doc)
-            defer.returnValue((doc, content))
+    def _encrypt_docs(self, entries):
+        """
+        Load a batch of documents and encrypt them in the crypto pool.
+
+        :param entries: A list of (get_doc_call, gen, trans_id) tuples.
+        :type entries: list
+
+        :return: A deferred that fires with a list of (doc, content, gen,
+            trans_id) tuples, where content is None for deleted documents.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        calls = [defer.maybeDeferred(f, *args, **kwargs)
+                 for (f, args, kwargs), _, _ in entries]
+        try:
+            docs = yield defer.gatherResults(calls, consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+        to_encrypt = [(doc.doc_id, doc.rev, doc.get_json())
+                      for doc in docs if not doc.is_tombstone()]
+        encrypted = yield self._crypto.encrypt_docs(
+            to_encrypt, armor=not self._binary_sync)
+        encrypted = iter(encrypted)
+        result = []
+        for doc, (_, gen, trans_id) in zip(docs, entries):
+            content = None if doc.is_tombstone() else next(encrypted)
+            result.append((doc, content, gen, trans_id))
+        defer.returnValue(result)
+
+
+class _EncryptionWindow(object):
+    """
+    Encrypts the documents to be sent in batches, keeping the next batch in
+    the crypto pool while the current one is written to the request.
+    """
+
+    def __init__(self, encrypt, entries, batch_size):
+        """
+        :param encrypt: A function that receives a list of entries and returns
+            a deferred that fires with a list of results in the same order.
+        :type encrypt: callable
+        :param entries: The entries to be encrypted.
+        :type entries: list
+        :param batch_size: How many entries are encrypted together.
+        :type batch_size: int
+        """
+        self._encrypt = encrypt
+        self._entries = entries
+        self._batch_size = batch_size
+        self._results = {}
+        self._started = set()
+
+    def get(self, idx):
+        """
+        Get the result for an entry, starting to encrypt its batch and the
+        next one if that was not done yet.
+
+        :param idx: The index of the entry.
+        :type idx: int
+
+        :return: A deferred that fires with the result for the entry.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        start = idx - idx % self._batch_size
+        for batch in (start, start + self._batch_size):
+            if batch < len(self._entries) and batch not in self._started:
+                self._start(batch)
+        return self._results.pop(idx)
+
+    def _start(self, start):
+        self._started.add(start)
+        entries = self._entries[start:start + self._batch_size]
+        waiting = [defer.Deferred() for _ in entries]
+
+        def _done(results):
+            for d, result in zip(waiting, results):
+                d.callback(result)
+
+        def _failed(failure):
+            for d in waiting:
+                d.errback(failure)
+
+        for i, d in enumerate(waiting):
+            self._results[start + i] = d
+        self._encrypt(entries).addCallbacks(_done, _failed)
 
 
 def _emit_send_status(user_data, idx, total):
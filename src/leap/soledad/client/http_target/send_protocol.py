@@ -14,9 +14,12 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import zlib
+
+from collections import deque
+
 from zope.interface import implementer
 from twisted.internet import defer
-from twisted.internet import reactor
 from twisted.web.iweb import IBodyProducer
 from twisted.web.iweb import UNKNOWN_LENGTH
 
@@ -25,19 +28,35 @@ from twisted.web.iweb import UNKNOWN_LENGTH
 class DocStreamProducer(object):
     """
     A producer that writes the body of a request to a consumer.
+
+    Up to ``lookahead`` documents are prepared concurrently while earlier
+    ones are written, and they are written in the order they were given.
+    Writing stops while the consumer has paused the producer. If asked to,
+    the body is compressed with gzip as it is written.
     """
 
-    def __init__(self, producer):
+    def __init__(self, producer, lookahead=64, compress=False):
         """
         Initialize the string produer.
 
-        :param producer: A RequestBody instance and a list of producer calls
+        :param producer: A RequestBody instance and a list of producer calls.
+            Each call returns a deferred that fires with a function that
+            inserts the prepared entry into the body, which writes it to the
+            consumer, or with None.
         :type producer: (.support.RequestBody, [(function, *args)])
+        :param lookahead: The maximum number of calls running at once.
+        :type lookahead: int
+        :param compress: Whether to compress the body with gzip.
+        :type compress: bool
         """
-        self.body, self.producer = producer
+        self.body, calls = producer
+        self.producer = deque(calls)
+        self.lookahead = lookahead
+        self.compress = compress
         self.length = UNKNOWN_LENGTH
-        self.pause = False
         self.stop = False
+        self._pending = deque()
+        self._paused = None
 
     @defer.inlineCallbacks
     def startProducing(self, consumer):
@@ -50,26 +69,75 @@ class DocStreamProducer(object):
         :return: A Deferred that fires when production ends.
         :rtype: twisted.internet.defer.Deferred
         """
-        while self.producer and not self.stop:
-            if self.pause:
-                yield self.sleep(0.001)
-                continue
-            call = self.producer.pop(0)
-            fun, args = call[0], call[1:]
-            yield fun(*args)
-            consumer.write(self.body.pop(1, leave_open=True))
-        consumer.write(self.body.pop(0))  # close stream
+        if self.compress:
+            consumer = GzipConsumer(consumer)
+        self.body.start(consumer)
+        try:
+            while (self._pending or self.producer) and not self.stop:
+                self._start_calls()
+                if self._paused is not None:
+                    yield self._paused
+                    continue
+                insert = yield self._pending.popleft()
+                if insert is not None:
+                    insert()
+        finally:
+            # the results of calls that were started but won't be written
+            # are discarded
+            while self._pending:
+                self._pending.popleft().addErrback(lambda _: None)
+        if not self.stop:
+            self.body.finish()  # close stream
+            if self.compress:
+                consumer.finish()
 
-    def sleep(self, secs):
-        d = defer.Deferred()
-        reactor.callLater(secs, d.callback, None)
-        return d
+    def _start_calls(self):
+        while self.producer and len(self._pending) < self.lookahead:
+            call = self.producer.popleft()
+            fun, args = call[0], call[1:]
+            self._pending.append(defer.maybeDeferred(fun, *args))
 
     def pauseProducing(self):
-        self.pause = True
+        if self._paused is None:
+            self._paused = defer.Deferred()
 
     def stopProducing(self):
         self.stop = True
+        self.resumeProducing()
 
     def resumeProducing(self):
-        self.pause = False
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+
+class GzipConsumer(object):
+    """
+    A consumer that compresses with gzip what is written to it, and writes
+    the compressed data to another consumer.
+    """
+
+    compresslevel = 6
+
+    def __init__(self, consumer):
+        self._consumer = consumer
+        self._compressor = zlib.compressobj(
+            self.compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._consumer.write(data)
+
+    def writeSequence(self, data):
+        # each part is compressed without being copied, and the compressor
+        # only gives data back once in a while
+        data = ''.join(self._compressor.compress(part) for part in data)
+        if data:
+            self._consumer.write(data)
+
+    def finish(self):
+        """
+        Write the end of the compressed data.
+        """
+        self._consumer.write(self._compressor.flush())
@@ -17,6 +17,8 @@
 import warnings
 import json
 
+from io import BytesIO
+
 from twisted.internet import defer
 from twisted.web.client import _ReadBodyProtocol
 from twisted.web.client import PartialDownloadError
@@ -25,6 +27,7 @@ from twisted.web._newclient import PotentialDataLoss
 
 from leap.soledad.common.l2db import errors
 from leap.soledad.common.l2db.remote import http_errors
+from leap.soledad.common.sync_frames import encode_frame_header
 
 # we want to make sure that HTTP errors will raise appropriate u1db errors,
 # that is, fire errbacks with the appropriate failures, in the context of
@@ -52,7 +55,11 @@ class ReadBodyProtocol(_ReadBodyProtocol):
         exc_cls = errors.wire_description_to_exc.get(descr)
         if exc_cls is not None:
             message = respdic.get("message")
-            self.deferred.errback(exc_cls(message))
+            if issubclass(exc_cls, errors.HTTPError):
+                # keep the headers, which may tell when to retry
+                self.deferred.errback(exc_cls(message, self.headers))
+            else:
+                self.deferred.errback(exc_cls(message))
         else:
             self.deferred.errback(
                 errors.HTTPError(self.status, respdic, self.headers))
@@ -146,6 +153,11 @@ class RequestBody(object):
     {...},
     {entryN},
     ]
+
+    The body is written to a consumer as entries are inserted, and the
+    content of each entry is written as a separate buffer, so it is not
+    copied. If no consumer is given, the body is written to a buffer and can
+    be got with str().
     """
 
     def __init__(self, **header_dict):
@@ -156,65 +168,142 @@ class RequestBody(object):
         :type header_dict: dict
         """
         self.headers = header_dict
-        self.entries = []
         self.consumed = 0
+        self.size = 0
+        self._consumer = None
+
+    def start(self, consumer):
+        """
+        Start writing the body to a consumer, beginning with the headers.
+
+        :param consumer: Any object with a ``write`` method, and optionally a
+            ``writeSequence`` one.
+        :type consumer: twisted.internet.interfaces.IConsumer
+        """
+        self._consumer = consumer
+        self._write('[\r\n', json.dumps(self.headers))
 
     def insert_info(self, **entry_dict):
         """
-        Dumps an entry into JSON format and add it to entries list.
-        Adds 'content' key on a new line if it's present.
+        Dumps an entry into JSON format and writes it to the consumer.
+        Writes 'content' key on a new line if it's present.
 
         :param entry_dict: Entry as a dictionary
         :type entry_dict: dict
         """
-        content = ''
+        if self._consumer is None:
+            self.start(BytesIO())
+        content = None
         if 'content' in entry_dict:
-            content = ',\r\n' + (entry_dict['content'] or '')
-        entry = json.dumps(entry_dict) + content
-        self.entries.append(entry)
-
-    def pop(self, amount=10, leave_open=False):
+            content = self._encode_content(entry_dict.pop('content'))
+        data = [',\r\n', json.dumps(entry_dict)]
+        if content is not None:
+            data.append(',\r\n')
+            data.extend(content)
+        self._write(*data)
+        self.consumed += 1
+
+    def _encode_content(self, content):
+        return [content or '']
+
+    def finish(self):
+        """
+        Close the stream.
         """
-        Removes entries and returns it formatted and ready
-        to be sent.
+        self._write('\r\n]')
+
+    def _write(self, *data):
+        # an empty write would end a chunked HTTP body
+        data = [part for part in data if part]
+        self.size += sum(len(part) for part in data)
+        write_sequence = getattr(self._consumer, 'writeSequence', None)
+        if write_sequence is not None:
+            write_sequence(data)
+        else:
+            for part in data:
+                self._consumer.write(part)
 
-        :param amount: number of entries to pop and format
-        :type amount: int
+    def __str__(self):
+        if self._consumer is None:
+            self.start(BytesIO())
+        self.finish()
+        return self._consumer.getvalue()
 
-        :param leave_open: flag to skip stream closing
-        :type amount: bool
 
-        :return: formatted body ready to be sent
-        :rtype: str
-        """
-        start = self.consumed == 0
-        amount = min([len(self.entries), amount])
-        entries = [self.entries.pop(0) for i in xrange(amount)]
-        self.consumed += amount
-        end = len(self.entries) == 0 if not leave_open else False
-        return self.entries_to_str(entries, start, end)
+class BinaryRequestBody(RequestBody):
+    """
+    A request body that sends the contents of documents in binary format, as
+    described in leap.soledad.common.sync_frames.
+    """
 
-    def __str__(self):
-        return self.pop(len(self.entries))
+    def _encode_content(self, content):
+        return [encode_frame_header(content), content or '']
+
+
+class AdaptiveBatchSize(object):
+    """
+    How many documents are sent or received in each request of a sync that is
+    split in many requests.
+
+    The size grows while requests get more documents through per second, and
+    shrinks when they get slower or fail. It is also capped so the contents
+    of the documents of one request add up to about max_bytes.
+    """
 
-    def __len__(self):
-        return len(self.entries)
+    initial_docs = 500
+    min_docs = 10
+    max_docs = 5000
+    max_bytes = 32 * 1024 * 1024
+
+    # How many times in a row a failed request is retried.
+    max_retries = 3
+
+    def __init__(self):
+        self.docs = self.initial_docs
+        self._throughput = None
+        self._failures = 0
+
+    def update(self, docs, size, elapsed):
+        """
+        Adapt the size after a request succeeded.
+
+        :param docs: How many documents went through the request.
+        :type docs: int
+        :param size: How many bytes the request had.
+        :type size: int
+        :param elapsed: How many seconds the request took.
+        :type elapsed: float
+        """
+        self._failures = 0
+        if not docs:
+            return
+        throughput = docs / max(elapsed, 0.001)
+        if self._throughput is None or throughput >= 0.9 * self._throughput:
+            target = self.docs * 2
+        else:
+            target = self.docs // 2
+        self._throughput = throughput
+        if size:
+            target = min(target, self.max_bytes * docs // size)
+        self.docs = max(self.min_docs, min(self.max_docs, target))
 
-    def entries_to_str(self, entries=None, start=True, end=True):
+    def failed(self, error):
         """
-        Format a list of entries into the body format expected
-        by the server.
+        Shrink the size after a request failed.
 
-        :param entries: entries to format
-        :type entries: list
+        :param error: The error of the request.
+        :type error: Exception
 
-        :return: formatted body ready to be sent
-        :rtype: str
+        :return: Whether the request can be retried.
+        :rtype: bool
         """
-        data = ''
-        if start:
-            data = '[\r\n' + json.dumps(self.headers)
-        data += ''.join(',\r\n' + entry for entry in entries)
-        if end:
-            data += '\r\n]'
-        return data
+        if isinstance(error, defer.CancelledError):
+            return False
+        if isinstance(error, errors.U1DBError) and \
+                not isinstance(error, (errors.HTTPError,
+                                       errors.BrokenSyncStream)):
+            # the server refused the request, and would do it again
+            return False
+        self._failures += 1
+        self.docs = max(self.min_docs, self.docs // 2)
+        return self._failures <= self.max_retries
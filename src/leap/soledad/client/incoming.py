@@ -36,6 +36,8 @@ class IncomingBoxProcessingLoop:
     http://soledad.readthedocs.io/en/latest/incoming_box.html
     """
 
+    batch_size = 250
+
     def __init__(self, incoming_box):
         self.incoming_box = incoming_box
         self.consumers = []
@@ -76,12 +78,35 @@ class IncomingBoxProcessingLoop:
         if not self.consumers:
             defer.returnValue(None)
         pending = yield self.incoming_box.list_pending()
-        for item_id in pending:
-            item = yield self.incoming_box.fetch_for_processing(item_id)
+        # flags are changed in bulk for each batch of items, so processing
+        # many items doesn't need many requests.
+        for i in xrange(0, len(pending), self.batch_size):
+            yield self._process_batch(pending[i:i + self.batch_size])
+
+    @defer.inlineCallbacks
+    def _process_batch(self, batch):
+        reserved = yield self.incoming_box.reserve_batch(batch)
+        processed, failed = [], set()
+        for item_id in batch:
+            if item_id not in reserved:
+                log.warn("Couldn't reserve item %s for processing, skipping."
+                         % item_id)
+                continue
+            # an item that can't be fetched is flagged as failed, so the rest
+            # of the batch is still processed and released
+            try:
+                item = yield self.incoming_box.get(item_id)
+            except Exception:
+                msg = "Failed to fetch item %s: %s"
+                msg %= (item_id, sys.exc_info()[0])
+                log.error(msg)
+                item = None
             if not item:
-                log.warn("Couldn't reserve item %s for processing, skipping.")
+                log.warn("Couldn't fetch item %s for processing, skipping."
+                         % item_id)
+                failed.add(item_id)
                 continue
-            failed = False
+            results = []
             for consumer in self.consumers:
                 try:
                     parts = yield consumer.process(item, item_id=item_id)
@@ -89,20 +114,30 @@ class IncomingBoxProcessingLoop:
                     msg = "Consumer %s failed to process item %s: %s"
                     msg %= (consumer.name, item_id, sys.exc_info()[0])
                     log.error(msg)
-                    failed = True
+                    failed.add(item_id)
                     continue
-                yield self.incoming_box.set_processed(item_id)
+                results.append((consumer, parts))
+            if results:
+                processed.append((item_id, results))
+        if processed:
+            yield self.incoming_box.set_processed_batch(
+                [item_id for item_id, _ in processed])
+        for item_id, results in processed:
+            for consumer, parts in results:
                 try:
                     yield consumer.save(parts, item_id=item_id)
                 except Exception:
                     msg = "Consumer %s failed to save item %s: %s"
                     msg %= (consumer.name, item_id, sys.exc_info()[0])
                     log.error(msg)
-                    failed = True
-            if failed:
-                yield self.incoming_box.set_failed(item_id)
-            else:
-                yield self.incoming_box.delete(item_id)
+                    failed.add(item_id)
+        if failed:
+            yield self.incoming_box.set_failed_batch(
+                [item_id for item_id in batch if item_id in failed])
+        done = [item_id for item_id in batch
+                if item_id in reserved and item_id not in failed]
+        if done:
+            yield self.incoming_box.delete_batch(done)
 
 
 class IncomingBox:
@@ -138,6 +173,35 @@ class IncomingBox:
         blob = yield self.blob_manager.get(blob_id, namespace=self.namespace)
         defer.returnValue(blob)
 
+    @defer.inlineCallbacks
+    def reserve_batch(self, blob_ids):
+        """
+        Try to reserve many blobs at once, by flagging them as PROCESSING.
+        :param blob_ids: Unique identifiers of the blobs.
+        :type blob_ids: list
+        :return: A deferred that fires with the list of blob ids that were
+            successfully reserved.
+        :rtype: Deferred
+        """
+        if not blob_ids:
+            defer.returnValue([])
+        results = yield self.blob_manager.set_flags_batch(
+            [(blob_id, [Flags.PROCESSING]) for blob_id in blob_ids],
+            namespace=self.namespace)
+        defer.returnValue(
+            [blob_id for blob_id in blob_ids if results.get(blob_id) == 200])
+
+    def get(self, blob_id):
+        """
+        Fetch a blob belonging to a namespace.
+        :param blob_id: Unique identifier of a blob.
+        :type blob_id: str
+        :return: A deferred that fires with a file-like object with the
+            requested blob.
+        :rtype: Deferred
+        """
+        return self.blob_manager.get(blob_id, namespace=self.namespace)
+
     def list_pending(self):
         """
         Lists blobs sorted by date (older first).
@@ -179,3 +243,47 @@ class IncomingBox:
         :rtype: Deferred
         """
         return self.blob_manager.delete(blob_id, namespace=self.namespace)
+
+    def set_processed_batch(self, blob_ids):
+        """
+        Flag many blobs with Flags.PROCESSED in as few requests as possible.
+        :param blob_ids: Unique identifiers of the blobs.
+        :type blob_ids: list
+        :return: A deferred that fires with a dictionary mapping each blob id
+            to the status of its operation.
+        :rtype: Deferred
+        """
+        return self._set_flags_batch(blob_ids, [Flags.PROCESSED])
+
+    def set_failed_batch(self, blob_ids):
+        """
+        Flag many blobs with Flags.FAILED in as few requests as possible.
+        :param blob_ids: Unique identifiers of the blobs.
+        :type blob_ids: list
+        :return: A deferred that fires with a dictionary mapping each blob id
+            to the status of its operation.
+        :rtype: Deferred
+        """
+        return self._set_flags_batch(blob_ids, [Flags.FAILED])
+
+    def _set_flags_batch(self, blob_ids, flags):
+        if not blob_ids:
+            return defer.succeed({})
+        return self.blob_manager.set_flags_batch(
+            [(blob_id, flags) for blob_id in blob_ids],
+            namespace=self.namespace)
+
+    def delete_batch(self, blob_ids):
+        """
+        Delete many blobs belonging to a namespace in as few requests as
+        possible.
+        :param blob_ids: Unique identifiers of the blobs.
+        :type blob_ids: list
+        :return: A deferred that fires with a dictionary mapping each blob id
+            to the status of its operation.
+        :rtype: Deferred
+        """
+        if not blob_ids:
+            return defer.succeed({})
+        return self.blob_manager.delete_batch(
+            blob_ids, namespace=self.namespace)
@@ -320,16 +320,30 @@ class ISyncableStorage(Interface):
     syncing = Attribute(
         "Property, True if the syncer is syncing.")
     token = Attribute("The authentication Token.")
+    sync_scheduler = Attribute(
+        "The SyncScheduler that syncs in the background once started.")
 
-    def sync(self):
+    def sync(self, doc_id_prefixes=None, received_doc_callback=None,
+             skipped_doc_callback=None):
         """
         Synchronize the local encrypted replica with a remote replica.
 
         This method blocks until a syncing lock is acquired, so there are no
         attempts of concurrent syncs from the same client replica.
 
-        :param url: the url of the target replica to sync with
-        :type url: str
+        :param doc_id_prefixes: If given, only documents whose ids start with
+            one of these prefixes are received, and the other ones are
+            skipped. They can be fetched later with fetch_docs.
+        :type doc_id_prefixes: list
+        :param received_doc_callback: If given, a function called with the id
+            and the revision of each document received, as soon as it is
+            inserted, so documents can be processed while the sync is still
+            running.
+        :type received_doc_callback: function
+        :param skipped_doc_callback: If given, a function called with the id
+            and the revision of each document skipped because of
+            doc_id_prefixes, which later syncs do not receive either.
+        :type skipped_doc_callback: function
 
         :return:
             A deferred that will fire with the local generation before the
@@ -337,6 +351,20 @@ class ISyncableStorage(Interface):
         :rtype: str
         """
 
+    def fetch_docs(self, doc_ids):
+        """
+        Fetch documents from the remote replica, whatever their generation.
+
+        This method blocks until a syncing lock is acquired.
+
+        :param doc_ids: The ids of the documents to fetch.
+        :type doc_ids: list
+
+        :return: A deferred that will fire when the documents were inserted
+            in the local replica.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
     def stop_sync(self):
         """
         Stop the current syncing process.
@@ -20,6 +20,7 @@ Soledad synchronization utilities.
 import os
 
 from twisted.internet import defer
+from twisted.internet import reactor
 
 from leap.soledad.common.log import getLogger
 from leap.soledad.common.l2db import errors
@@ -45,12 +46,44 @@ class SoledadSynchronizer(Synchronizer):
     However, it still recognizes that one side is initiating the request. Also,
     at the moment, conflicts are only created in the source.
 
-    Also modified to allow for interrupting the synchronization process.
+    Also modified to allow for interrupting the synchronization process, to
+    receive only the documents whose ids start with some prefixes, and to
+    keep track of the documents received while they are inserted.
+
+    The documents skipped because of the prefixes are kept in skipped_docs,
+    as the generation of the target recorded after the sync is past them,
+    and they are only received by fetching them with fetch_docs.
     """
     received_docs = []
 
-    def __init__(self, *args, **kwargs):
-        Synchronizer.__init__(self, *args, **kwargs)
+    def __init__(self, source, sync_target, doc_id_prefixes=None,
+                 received_doc_callback=None, skipped_doc_callback=None):
+        """
+        :param source: The local database.
+        :type source: SQLCipherDatabase
+        :param sync_target: The remote replica to sync with.
+        :type sync_target: SoledadHTTPSyncTarget
+        :param doc_id_prefixes: If given, only documents whose ids start with
+                                one of these prefixes are received.
+        :type doc_id_prefixes: list
+        :param received_doc_callback: If given, a function called in the
+                                      reactor thread with the id and the
+                                      revision of each document received,
+                                      once it is inserted.
+        :type received_doc_callback: function
+        :param skipped_doc_callback: If given, a function called in the
+                                     reactor thread with the id and the
+                                     revision of each document skipped
+                                     because of doc_id_prefixes.
+        :type skipped_doc_callback: function
+        """
+        Synchronizer.__init__(self, source, sync_target)
+        self.doc_id_prefixes = doc_id_prefixes
+        self.received_doc_callback = received_doc_callback
+        self.skipped_doc_callback = skipped_doc_callback
+        self.received_docs = []
+        self.received_revs = {}
+        self.skipped_docs = {}
         if DO_STATS:
             self.sync_phase = [0]
             self.sync_exchange_phase = None
@@ -67,6 +100,8 @@ class SoledadSynchronizer(Synchronizer):
 
         sync_target = self.sync_target
         self.received_docs = []
+        self.received_revs = {}
+        self.skipped_docs = {}
 
         # ---------- phase 1: get sync info from server ----------------------
         if DO_STATS:
@@ -148,8 +183,11 @@ class SoledadSynchronizer(Synchronizer):
         new_gen, new_trans_id = yield sync_target.sync_exchange(
             docs_by_generation, self.source._replica_uid,
             target_last_known_gen, target_last_known_trans_id,
-            self._insert_doc_from_target, ensure_callback=ensure_callback)
-        ids_sent = [doc_id for doc_id, _, _ in changes]
+            self._insert_doc_from_target, ensure_callback=ensure_callback,
+            commit_callback=getattr(self.source, 'commit', None),
+            checkpoint_callback=self._checkpoint,
+            doc_id_prefixes=self.doc_id_prefixes,
+            skipped_doc_callback=self._skip_doc_from_target)
         logger.debug("target gen after sync: %d" % new_gen)
         logger.debug("target trans_id after sync: %s" % new_trans_id)
         if hasattr(self.source, 'commit'):  # sqlcipher backend speed up
@@ -169,12 +207,6 @@ class SoledadSynchronizer(Synchronizer):
 
         yield self.complete_sync()
 
-        _, _, changes = self.source.whats_changed(target_my_gen)
-        changed_doc_ids = [doc_id for doc_id, _, _ in changes]
-
-        just_received = list(set(changed_doc_ids) - set(ids_sent))
-        self.received_docs = just_received
-
         # ---------- phase 5: sync is over -----------------------------------
         if DO_STATS:
             self.sync_phase[0] += 1
@@ -182,6 +214,74 @@ class SoledadSynchronizer(Synchronizer):
 
         defer.returnValue(my_gen)
 
+    @defer.inlineCallbacks
+    def fetch_docs(self, doc_ids):
+        """
+        Fetch documents from the target, whatever their generation, for
+        example the ones skipped by syncs with doc id prefixes.
+
+        :param doc_ids: The ids of the documents to fetch.
+        :type doc_ids: list
+
+        :return: A deferred which will fire when the documents were inserted.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        self.target_replica_uid = (yield self.sync_target.get_sync_info(
+            self.source._replica_uid))[0]
+        gen, trans_id = self.source._get_replica_gen_and_trans_id(
+            self.target_replica_uid)
+
+        def _insert_doc(doc, _, __):
+            # the documents do not come in the order of their generation, so
+            # the generation known for the target is kept as it is
+            self._insert_doc_from_target(doc, gen, trans_id)
+
+        yield self.sync_target.fetch_docs(
+            doc_ids, _insert_doc,
+            commit_callback=getattr(self.source, 'commit', None))
+
+    def _insert_doc_from_target(self, doc, replica_gen, trans_id):
+        """
+        Try to insert a synced document from the target, and record it as
+        received if the local database was updated.
+
+        This is called in the thread that inserts the documents, so the
+        received document callback is scheduled in the reactor thread.
+
+        :param doc: The document received from the target.
+        :type doc: SoledadDocument
+        :param replica_gen: The target generation of the document.
+        :type replica_gen: int
+        :param trans_id: The target transaction id of the document.
+        :type trans_id: str
+        """
+        num_inserted = self.num_inserted
+        Synchronizer._insert_doc_from_target(
+            self, doc, replica_gen, trans_id)
+        if self.num_inserted == num_inserted:
+            # converged or superseded, nothing changed locally
+            return
+        if doc.doc_id not in self.received_revs:
+            self.received_docs.append(doc.doc_id)
+        self.received_revs[doc.doc_id] = doc.rev
+        if self.received_doc_callback is not None:
+            reactor.callFromThread(
+                self.received_doc_callback, doc.doc_id, doc.rev)
+
+    def _skip_doc_from_target(self, doc_id, rev):
+        """
+        Record a document of the target that was skipped because of the doc
+        id prefixes of this sync, so it can be fetched later.
+
+        :param doc_id: The id of the skipped document.
+        :type doc_id: str
+        :param rev: The revision of the skipped document in the target.
+        :type rev: str
+        """
+        self.skipped_docs[doc_id] = rev
+        if self.skipped_doc_callback is not None:
+            self.skipped_doc_callback(doc_id, rev)
+
     def _docs_by_gen_from_changes(self, changes):
         docs_by_generation = []
         kwargs = {'include_deleted': True}
@@ -190,6 +290,22 @@ class SoledadSynchronizer(Synchronizer):
             docs_by_generation.append((get_doc, gen, trans))
         return docs_by_generation
 
+    def _checkpoint(self, gen, trans_id):
+        """
+        Record the generation of the target up to which received documents
+        were inserted, so an interrupted sync resumes from there.
+
+        :param gen: The target generation of the last inserted document.
+        :type gen: int
+        :param trans_id: The target transaction id of the last inserted
+                         document.
+        :type trans_id: str
+        """
+        if self.target_replica_uid is None:
+            return
+        self.source._set_replica_gen_and_trans_id(
+            self.target_replica_uid, gen, trans_id)
+
     def complete_sync(self):
         """
         Last stage of the synchronization:
@@ -19,7 +19,8 @@ Preamble is a binary packed metadata payload present on encrypted documents. It
 holds data about encryption scheme, iv, document id and sync related data.
    MAGIC, -> used to differentiate from other data formats
    ENC_SCHEME, -> cryptographic scheme (symmetric or asymmetric)
-   ENC_METHOD, -> cipher used, such as AES-GCM or AES-CTR or GPG
+   ENC_METHOD, -> cipher used, such as AES-GCM or AES-CTR or GPG, and whether
+                 the content was compressed before encryption
    current_time, -> time.time()
    self.iv, -> initialization vector if any, or 0 when not applicable
    str(self.doc_id), -> document id
@@ -35,7 +36,8 @@ PACMAN = struct.Struct('2sbbQ16s255p255pQ')
 LEGACY_PACMAN = struct.Struct('2sbbQ16s255p255p')  # DEPRECATED
 MAGIC = '\x13\x37'
 ENC_SCHEME = namedtuple('SCHEME', 'symkey external')(1, 2)
-ENC_METHOD = namedtuple('METHOD', 'aes_256_ctr aes_256_gcm pgp')(1, 2, 3)
+ENC_METHOD = namedtuple(
+    'METHOD', 'aes_256_ctr aes_256_gcm pgp aes_256_gcm_zlib')(1, 2, 3, 4)
 PREAMBLE_SIZE = 736  # 552 urlsafe base64 encoded (it's always armored)
 
 
@@ -325,6 +325,9 @@ class CouchDatabase(object):
             params['keys'] = doc_ids
         view = self._database.view("_all_docs", **params)
         for row in view.rows:
+            if not row.get('doc'):
+                # documents asked for by id that do not exist
+                continue
             result = copy.deepcopy(row['doc'])
             for file_name in result.get('_attachments', {}).keys():
                 data = self._database.get_attachment(result, file_name)
@@ -101,3 +101,10 @@ class MissingCouchConfigDocumentError(SoledadError):
     """
     Raised if a database has documents but lacks the couch config document.
     """
+
+
+class SyncFiltersNotSupportedError(SoledadError):
+    """
+    Raised when fetching documents by id from a server that can not filter
+    the documents it returns.
+    """
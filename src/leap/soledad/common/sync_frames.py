@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# sync_frames.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Binary framing of document contents in the sync protocol.
+
+In the default sync format, the content of each document is a line with a
+JSON string, and encrypted documents look like this:
+
+    {"raw": "<base64 preamble> <base64 ciphertext and tag>"}
+
+In the binary format, the content line is replaced by a frame: a header line
+with the kind of content and its length, followed by that many bytes. Frames
+can be of the following kinds:
+
+    null\\r\\n
+        The document has no content (it was deleted).
+
+    json <length>\\r\\n<content>
+        The content is sent as is (for example, it was not encrypted by the
+        client).
+
+    blob <length>\\r\\n<base64 preamble> <ciphertext and tag>
+        The content was symmetrically encrypted, and the ciphertext is not
+        encoded with base64, just like in blobs.
+
+Both formats are equivalent, and the server keeps storing the default one so
+older clients can still sync.
+"""
+import base64
+import json
+
+
+__all__ = [
+    'BINARY_PUT',
+    'BINARY_STREAM',
+    'Blob',
+    'encode_frame',
+    'encode_frame_header',
+    'parse_frame_header',
+    'decode_frame',
+    'content_to_blob',
+]
+
+
+# the content type of a request that sends documents in binary format
+BINARY_PUT = 'application/x-soledad-sync-put-binary'
+
+# the content type of a stream of documents in binary format, which clients
+# can accept when fetching documents
+BINARY_STREAM = 'application/x-soledad-sync-binary'
+
+_RAW_START = '{"raw": "'
+_RAW_END = '"}'
+
+
+class Blob(str):
+    """
+    The unarmored payload of a symmetrically encrypted document.
+    """
+
+
+def encode_frame(content):
+    """
+    Encode the content of a document as a frame.
+
+    :param content: The content of the document, or None if it has no
+        content.
+    :type content: str or Blob
+
+    :return: The frame.
+    :rtype: str
+    """
+    return encode_frame_header(content) + (content or '')
+
+
+def encode_frame_header(content):
+    """
+    Encode the header line of the frame of a document, so the content can be
+    written after it without being copied.
+
+    :param content: The content of the document, or None if it has no
+        content.
+    :type content: str or Blob
+
+    :return: The header line of the frame, with the line break.
+    :rtype: str
+    """
+    if content is None:
+        return 'null\r\n'
+    kind = 'blob' if isinstance(content, Blob) else 'json'
+    return '%s %d\r\n' % (kind, len(content))
+
+
+def parse_frame_header(line):
+    """
+    Parse the header line of a frame.
+
+    :param line: The header line, without the line break.
+    :type line: str
+
+    :return: The kind of the frame and the size of its data.
+    :rtype: (str, int)
+
+    :raise ValueError: If the line is not a valid frame header.
+    """
+    if line == 'null':
+        return 'null', 0
+    kind, size = line.split(' ')
+    size = int(size)
+    if kind not in ('json', 'blob') or size < 0:
+        raise ValueError('Invalid frame header: %r' % line)
+    return kind, size
+
+
+def decode_frame(kind, data):
+    """
+    Get the content of a document from the data of a frame.
+
+    :param kind: The kind of the frame.
+    :type kind: str
+    :param data: The data of the frame.
+    :type data: str
+
+    :return: The content of the document, with blobs converted back into
+        the default JSON format.
+    :rtype: str
+    """
+    if kind == 'null':
+        return None
+    if kind == 'json':
+        return data
+    preamble, ciphertext = data.split(' ', 1)
+    return (_RAW_START + preamble + ' ' +
+            base64.urlsafe_b64encode(ciphertext) + _RAW_END)
+
+
+def content_to_blob(content):
+    """
+    Convert the content of a symmetrically encrypted document into a blob.
+
+    :param content: The content of the document in the default JSON format.
+    :type content: str
+
+    :return: The blob, or None if the content is not in the format that
+        symmetric encryption produces, and has to be sent as is.
+    :rtype: Blob
+    """
+    if not content.startswith(_RAW_START) or \
+            not content.endswith(_RAW_END):
+        return None
+    try:
+        raw = json.loads(content)['raw']
+        preamble, ciphertext = str(raw).split(' ')
+        decoded = base64.urlsafe_b64decode(ciphertext)
+    except (ValueError, KeyError, TypeError, UnicodeError):
+        return None
+    # converting back has to give exactly the same content
+    if _RAW_START + preamble + ' ' + ciphertext + _RAW_END != content:
+        return None
+    if base64.urlsafe_b64encode(decoded) != ciphertext:
+        return None
+    return Blob(preamble + ' ' + decoded)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# threads.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Threadpools for blocking calls made from the reactor.
+"""
+import threading
+
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import threadpool
+
+
+__all__ = ['DaemonThreadPool']
+
+
+class DaemonThreadPool(threadpool.ThreadPool):
+    """
+    A threadpool that is started when the reactor runs and stopped when it
+    shuts down, and whose threads don't keep the process alive if the reactor
+    is not stopped cleanly.
+    """
+
+    def __init__(self, maxthreads, name):
+        """
+        :param maxthreads: The maximum number of threads in the pool.
+        :type maxthreads: int
+        :param name: The name of the pool.
+        :type name: str
+        """
+        threadpool.ThreadPool.__init__(
+            self, minthreads=0, maxthreads=maxthreads, name=name)
+        reactor.callWhenRunning(self.start)
+        self._shutdown = reactor.addSystemEventTrigger(
+            'after', 'shutdown', self.stop)
+
+    def threadFactory(self, *args, **kwargs):
+        thread = threading.Thread(*args, **kwargs)
+        thread.daemon = True
+        return thread
+
+    def run(self, f, *args, **kwargs):
+        """
+        Run a blocking function in the threadpool.
+
+        :return: A deferred that fires with the result of the function.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return threads.deferToThreadPool(reactor, self, f, *args, **kwargs)
+
+    def close(self):
+        """
+        Stop the threadpool without waiting for the reactor to shut down.
+        """
+        if self._shutdown is not None:
+            reactor.removeSystemEventTrigger(self._shutdown)
+            self._shutdown = None
+            self.stop()
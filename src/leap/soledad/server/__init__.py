@@ -26,6 +26,10 @@ import sys
 
 from leap.soledad.common.l2db.remote import http_app, utils
 from leap.soledad.common import SHARED_DB_NAME
+from leap.soledad.common.sync_frames import BINARY_PUT
+from leap.soledad.common.sync_frames import BINARY_STREAM
+from leap.soledad.common.sync_frames import decode_frame
+from leap.soledad.common.sync_frames import parse_frame_header
 
 from .sync import SyncResource
 from .sync import MAX_REQUEST_SIZE
@@ -156,7 +160,12 @@ class HTTPInvocationByMethodWithBody(
                 meth_args = self._lookup('%s_args' % method)
                 meth_args(args, line)
                 # handle incoming documents
-                if content_type == 'application/x-soledad-sync-put':
+                if content_type in ('application/x-soledad-sync-put',
+                                    BINARY_PUT):
+                    if content_type == BINARY_PUT:
+                        get_content = self._read_frame
+                    else:
+                        get_content = self._read_line
                     meth_put = self._lookup('%s_put' % method)
                     meth_end = self._lookup('%s_end' % method)
                     while True:
@@ -166,8 +175,7 @@ class HTTPInvocationByMethodWithBody(
                         if not entry or not comma:  # empty or no prec comma
                             raise http_app.BadRequest
                         entry, comma = utils.check_and_strip_comma(entry)
-                        content = body_getline().strip()
-                        content, comma = utils.check_and_strip_comma(content)
+                        content, comma = get_content(reader)
                         meth_put({'content': content or None}, entry)
                     if comma or body_getline():  # extra comma or data
                         raise http_app.BadRequest
@@ -175,12 +183,49 @@ class HTTPInvocationByMethodWithBody(
                 # handle outgoing documents
                 elif content_type == 'application/x-soledad-sync-get':
                     meth_get = self._lookup('%s_get' % method)
-                    return meth_get()
+                    accept = self.environ.get('HTTP_ACCEPT', '')
+                    return meth_get(binary=BINARY_STREAM in accept)
                 else:
                     raise http_app.BadRequest()
             else:
                 raise http_app.BadRequest()
 
+    def _read_line(self, reader):
+        """
+        Read the content of a document sent in the default format.
+        """
+        content = reader.getline().strip()
+        return utils.check_and_strip_comma(content)
+
+    def _read_frame(self, reader):
+        """
+        Read the content of a document sent in binary format.
+        """
+        try:
+            kind, size = parse_frame_header(reader.getline().strip())
+        except ValueError:
+            raise http_app.BadRequest()
+        if size > self.max_entry_size:
+            raise http_app.BadRequest()
+        parts = []
+        while size:
+            chunk = reader.read_chunk(size)
+            if not chunk:  # the body ended before the frame
+                raise http_app.BadRequest()
+            if len(chunk) > size:  # a chunk kept by the line reader
+                reader._kept = chunk[size:]
+                chunk = chunk[:size]
+            parts.append(chunk)
+            size -= len(chunk)
+        # the frame is followed by a comma or by the end of the line
+        rest, comma = utils.check_and_strip_comma(reader.getline().strip())
+        if rest:
+            raise http_app.BadRequest()
+        try:
+            return decode_frame(kind, ''.join(parts)), comma
+        except ValueError:
+            raise http_app.BadRequest()
+
 
 # monkey patch server with new http invocation
 http_app.HTTPInvocationByMethodWithBody = HTTPInvocationByMethodWithBody
@@ -18,6 +18,7 @@
 Blobs Server implementation.
 """
 from .fs_backend import FilesystemBlobsBackend
+from .s3_backend import S3BlobsBackend
 from .resource import BlobsResource
 from .state import BlobsServerState
 from .errors import BlobExists
@@ -27,6 +28,7 @@ from .errors import ImproperlyConfiguredException
 
 __all__ = [
     'FilesystemBlobsBackend',
+    'S3BlobsBackend',
     'BlobsResource',
     'BlobsServerState',
     'BlobExists',
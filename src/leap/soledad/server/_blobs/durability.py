@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# _blobs/durability.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Policies for making blobs written to the filesystem durable.
+
+A policy commits files that were written and closed, and fires a deferred
+when they (and the directory entries pointing to them) are safe on disk.
+"""
+import os
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from .errors import ImproperlyConfiguredException
+
+
+class NoSync(object):
+    """
+    Leave it to the operating system to write data to disk.
+    """
+
+    def commit(self, paths):
+        return defer.succeed(None)
+
+
+class Fsync(object):
+    """
+    Sync each set of files as soon as it is committed.
+    """
+
+    def __init__(self, io):
+        """
+        :param io: A function that runs a blocking function in a thread and
+            returns a deferred.
+        :type io: callable
+        """
+        self._io = io
+
+    def commit(self, paths):
+        return self._io(sync_paths, paths)
+
+
+class GroupCommit(object):
+    """
+    Sync together all files committed within a small time window, so the
+    cost of syncing directories and flushing disk caches is shared among
+    concurrent writes.
+    """
+
+    def __init__(self, io, window=0.005):
+        """
+        :param io: A function that runs a blocking function in a thread and
+            returns a deferred.
+        :type io: callable
+        :param window: For how long, in seconds, commits are gathered before
+            being synced.
+        :type window: float
+        """
+        self._io = io
+        self._window = window
+        self._pending = []
+        self._call = None
+
+    def commit(self, paths):
+        d = defer.Deferred()
+        self._pending.append((paths, d))
+        if self._call is None:
+            self._call = reactor.callLater(self._window, self._flush)
+        return d
+
+    def _flush(self):
+        self._call = None
+        pending, self._pending = self._pending, []
+        paths = [path for group, _ in pending for path in group]
+
+        def _done(result):
+            for _, d in pending:
+                d.callback(result)
+
+        def _failed(failure):
+            for _, d in pending:
+                d.errback(failure)
+
+        d = self._io(sync_paths, paths)
+        d.addCallbacks(_done, _failed)
+
+
+def get_policy(mode, io):
+    """
+    Get a durability policy by name.
+
+    :param mode: One of ``none``, ``fsync`` or ``group``.
+    :type mode: str
+    :param io: A function that runs a blocking function in a thread and
+        returns a deferred.
+    :type io: callable
+
+    :return: The durability policy.
+    """
+    if mode == 'none':
+        return NoSync()
+    if mode == 'fsync':
+        return Fsync(io)
+    if mode == 'group':
+        return GroupCommit(io)
+    raise ImproperlyConfiguredException("Invalid durability mode: %s" % mode)
+
+
+def sync_paths(paths):
+    """
+    Flush files and the directories that hold them to disk.
+
+    This function does blocking I/O and should be called from a thread.
+
+    :param paths: The paths of the files.
+    :type paths: list of str
+    """
+    dirs = set()
+    for path in paths:
+        _fsync(path)
+        dirs.add(os.path.dirname(path))
+    for path in dirs:
+        _fsync(path)
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -49,3 +49,23 @@ class RangeNotSatisfiable(Exception):
     Raised when the Range: HTTP header was sent but the server doesn't know how
     to satisfy it.
     """
+
+
+class BackendError(Exception):
+    """
+    Raised when the storage service behind a backend fails to perform an
+    operation.
+    """
+
+
+class UploadNotFound(Exception):
+    """
+    Raised when an upload session does not exist.
+    """
+
+
+class InvalidOffset(Exception):
+    """
+    Raised when a chunk is not appended where an upload session stopped. The
+    argument is the number of bytes committed to the session.
+    """
@@ -20,13 +20,17 @@ A backend for blobs that stores in filesystem.
 import base64
 import json
 import os
+import shutil
 import time
 
 from collections import defaultdict
 from zope.interface import implementer
 
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
 from twisted.internet import utils
+from twisted.python.lockfile import FilesystemLock
 from twisted.web.static import NoRangeStaticProducer
 from twisted.web.static import SingleRangeStaticProducer
 
@@ -34,17 +38,37 @@ from leap.common.files import mkdir_p
 from leap.soledad.common.blobs import ACCEPTED_FLAGS
 from leap.soledad.common.blobs import InvalidFlag
 from leap.soledad.common.log import getLogger
+from leap.soledad.common.threads import DaemonThreadPool
 from leap.soledad.server import interfaces
 
 from .errors import BlobExists
 from .errors import BlobNotFound
 from .errors import QuotaExceeded
+from .durability import get_policy
 from .util import VALID_STRINGS
+from .volumes import HashRing
+from .volumes import RelocationGate
+from .volumes import Volume
+from .volumes import sync_tree
 
 
 logger = getLogger(__name__)
 
 
+# The relocation gates, rebalance locks and blob locks of backends, by the
+# path where they store blobs. Backends of the same path share them, so that
+# operations of all resources in a process are isolated from each other and
+# held while any of them relocates users' data.
+_locks_by_path = {}
+
+
+def _get_shared_locks(path):
+    key = os.path.realpath(path)
+    if key not in _locks_by_path:
+        _locks_by_path[key] = (RelocationGate(), defer.DeferredLock(), {})
+    return _locks_by_path[key]
+
+
 class NoRangeProducer(NoRangeStaticProducer):
     """
     A static file producer that fires a deferred when it's finished.
@@ -82,68 +106,241 @@ class SingleRangeProducer(SingleRangeStaticProducer):
             self.deferred.callback(None)
 
 
-def isolated(path):
+def gated(method):
     """
-    A decorator that isolates execution of the decorated method using a file
-    system lock based on the given path. A symlink in ``{path}.lock`` will be
-    used to make sure only one isolated method is executed at a time for that
-    path.
+    A decorator that holds execution of the decorated backend method while the
+    data of the user passed as first argument is being relocated to another
+    volume.
     """
 
-    def decorator(method):
+    def new_method(self, user, *args, **kwargs):
+        return self._gate.run(user, method, self, user, *args, **kwargs)
 
-        def new_method(*args, **kwargs):
-            dirname, _ = os.path.split(path)
-            mkdir_p(dirname)
-            name = path + '.lock'
-            # TODO: evaluate the need to replace this for a readers-writer lock
-            lock = defer.DeferredFilesystemLock(name)
+    return new_method
 
-            def _release(result):
-                lock.unlock()
-                return result
 
-            d = lock.deferUntilLocked()
-            d.addCallback(lambda _: method(*args, **kwargs))
-            d.addCallbacks(_release, _release)
-            return d
+class _FileWriter(object):
+    """
+    A consumer that writes to a file in the I/O threadpool, pausing the
+    producer while each write is in progress.
+    """
 
-        return new_method
+    def __init__(self, fd, producer, io):
+        self._fd = fd
+        self._producer = producer
+        self._io = io
+        self._failure = None
 
-    return decorator
+    def write(self, data):
+        self._producer.pauseProducing()
+        d = self._io(self._fd.write, data)
+        d.addCallbacks(self._written, self._failed)
+
+    def _written(self, _):
+        self._producer.resumeProducing()
+
+    def _failed(self, failure):
+        self._failure = failure
+        self._producer.stopProducing()
+
+    def close(self):
+        """
+        Close the file once all data has been written.
+
+        :return: A deferred that fires when the file is closed, or fails if
+                 a write has failed.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = self._io(self._fd.close)
+        if self._failure:
+            d.addCallback(lambda _: self._failure)
+        return d
 
 
 @implementer(interfaces.IBlobsBackend)
 class FilesystemBlobsBackend(object):
+    """
+    A blobs backend that stores blobs in the filesystem.
+
+    All blocking filesystem calls are run in a dedicated threadpool of bounded
+    size, so a slow disk does not stall the reactor. Locks are always acquired
+    in the same order: the relocation gate of the user, then the lock of a
+    single blob, then the usage lock of the user. No operation holds the locks
+    of two blobs at the same time.
+
+    Backends that store blobs in the same path share their locks, so it is
+    safe to have more than one of them in a process.
+    """
 
     USAGE_TIMEOUT = 30
 
+    # For how long, in seconds, to wait for the filesystem lock of a blob
+    # held by another process, and how often to try taking it.
+    LOCK_TIMEOUT = 30
+    LOCK_INTERVAL = 0.01
+
     def __init__(self, blobs_path='/tmp/blobs/', quota=200 * 1024,
-                 concurrent_writes=50):
+                 concurrent_writes=50, volumes=None, io_threads=10,
+                 durability='none'):
+        """
+        Initialize the backend.
+
+        :param blobs_path: The path for blobs storage. If no volumes are
+            given, this is the only place where blobs are stored.
+        :type blobs_path: str
+        :param quota: The quota for each user, in units of 1024 bytes.
+        :type quota: int
+        :param concurrent_writes: Limit of concurrent writes to the
+            filesystem.
+        :type concurrent_writes: int
+        :param volumes: An optional list of (path, weight) tuples describing
+            the volumes among which users will be placed using consistent
+            hashing.
+        :type volumes: list
+        :param io_threads: The maximum number of threads running filesystem
+            operations.
+        :type io_threads: int
+        :param durability: When written blobs are synced to disk: ``none``
+            leaves it to the operating system, ``fsync`` syncs each blob
+            before acknowledging its write, and ``group`` syncs together the
+            blobs written within a small time window.
+        :type durability: str
+        """
         self.quota = quota
         self.semaphore = defer.DeferredSemaphore(concurrent_writes)
-        if not os.path.isdir(blobs_path):
-            os.makedirs(blobs_path)
         self.path = blobs_path
+        self.volumes = [Volume(path, weight)
+                        for path, weight in (volumes or [(blobs_path, 1)])]
+        if blobs_path not in [volume.path for volume in self.volumes]:
+            # a volume that is not in the ring, but which may still hold data
+            # from before volumes were configured.
+            self._legacy = Volume(blobs_path)
+        else:
+            self._legacy = None
+        for volume in self._all_volumes():
+            if not os.path.isdir(volume.path):
+                os.makedirs(volume.path)
+        self._ring = HashRing(self.volumes)
+        self._gate, self._rebalance_lock, self._locks = \
+            _get_shared_locks(blobs_path)
+        self._durability = get_policy(durability, self._io)
+        self._pool = DaemonThreadPool(io_threads, 'blobs-io')
         self.usage = defaultdict(lambda: (None, None))
         self.usage_locks = defaultdict(defer.DeferredLock)
 
-    def __touch(self, path):
-        open(path, 'a')
+    def close(self):
+        """
+        Stop the threadpool used for filesystem operations.
+        """
+        self._pool.close()
+
+    def _io(self, f, *args, **kwargs):
+        """
+        Run a blocking function in the I/O threadpool.
+
+        :return: A deferred that fires with the result of the function.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._pool.run(f, *args, **kwargs)
+
+    def _commit(self, paths):
+        """
+        Make written blobs durable, according to the durability mode.
+
+        :param paths: The paths of blobs that were written and closed.
+        :type paths: list of str
+
+        :return: A deferred that fires when the blobs are durable.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._durability.commit(paths)
+
+    def _isolated(self, user, blob_id, namespace, find=True):
+        """
+        A decorator that isolates execution of the decorated function using a
+        lock based on the given blob. Functions isolated on the same blob run
+        one at a time and in the order they were called. A symlink in
+        ``{path}.lock`` is also used, to isolate them from other processes.
+
+        The decorated function receives the path of the blob as its first
+        argument. If ``find`` is true and the blob doesn't exist, BlobNotFound
+        is raised instead.
+        """
+        key = (user, blob_id, namespace or 'default')
+
+        def decorator(method):
+
+            @defer.inlineCallbacks
+            def new_method(*args, **kwargs):
+                # the lock is taken before anything else is done, so the
+                # order of calls is kept.
+                lock = self._locks.get(key)
+                if lock is None:
+                    lock = self._locks[key] = defer.DeferredLock()
+                yield lock.acquire()
+                try:
+                    get_path = self._find_blob if find else self._get_path
+                    path = yield self._io(get_path, user, blob_id, namespace)
+                    fs_lock = yield self._lock(path)
+                    try:
+                        result = yield method(path, *args, **kwargs)
+                    finally:
+                        yield self._io(fs_lock.unlock)
+                finally:
+                    lock.release()
+                    if not lock.locked:
+                        del self._locks[key]
+                defer.returnValue(result)
+
+            return new_method
+
+        return decorator
 
-    def read_blob(self, user, blob_id, consumer, namespace='', range=None):
+    @defer.inlineCallbacks
+    def _lock(self, path):
+        """
+        Take the filesystem lock of a blob. While another process holds it,
+        retry from the reactor, so no thread of the I/O threadpool is kept
+        waiting.
+
+        :param path: The path of the blob.
+        :type path: str
+
+        :return: A deferred that fires with the lock, or fails with
+                 defer.TimeoutError if it can't be taken in LOCK_TIMEOUT
+                 seconds.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        deadline = reactor.seconds() + self.LOCK_TIMEOUT
+        while True:
+            lock = yield self._io(_try_lock, path)
+            if lock is not None:
+                defer.returnValue(lock)
+            if reactor.seconds() >= deadline:
+                raise defer.TimeoutError(
+                    'Timed out waiting for lock: %s' % path)
+            yield task.deferLater(reactor, self.LOCK_INTERVAL, lambda: None)
+
+    def _find_blob(self, user, blob_id, namespace):
         path = self._get_path(user, blob_id, namespace)
         if not os.path.isfile(path):
-            return defer.fail(BlobNotFound((user, blob_id)))
+            raise BlobNotFound((user, blob_id))
+        return path
+
+    @gated
+    def read_blob(self, user, blob_id, consumer, namespace='', range=None):
 
-        @isolated(path)
+        @self._isolated(user, blob_id, namespace)
         @defer.inlineCallbacks
-        def _read_blob():
+        def _read_blob(path):
+            volume = yield self._io(self._get_volume, user)
             logger.info('reading blob: %s - %s@%s'
                         % (user, blob_id, namespace))
             logger.debug('blob path: %s' % path)
-            with open(path) as fd:
+            fd = yield self._io(open, path)
+            try:
                 if range is None:
+                    size = yield self._io(_size, fd)
                     producer = NoRangeProducer(consumer, fd)
                 else:
                     start, end = range
@@ -152,72 +349,69 @@ class FilesystemBlobsBackend(object):
                     args = (consumer, fd, offset, size)
                     producer = SingleRangeProducer(*args)
                 yield producer.start()
+            finally:
+                yield self._io(fd.close)
+            volume.reads += 1
+            volume.bytes_read += size
 
         return _read_blob()
 
+    @gated
     def get_flags(self, user, blob_id, namespace=''):
-        path = self._get_path(user, blob_id, namespace)
-        if not os.path.isfile(path):
-            return defer.fail(BlobNotFound((user, blob_id)))
-        if not os.path.isfile(path + '.flags'):
-            return defer.succeed([])
 
-        @isolated(path)
-        def _get_flags():
-            try:
-                with open(path + '.flags', 'r') as flags_file:
-                    flags = json.loads(flags_file.read())
-                    return defer.succeed(flags)
-            except Exception as e:
-                return defer.fail(e)
+        @self._isolated(user, blob_id, namespace)
+        def _get_flags(path):
+            return self._io(_read_flags, path)
 
         return _get_flags()
 
+    @gated
     def set_flags(self, user, blob_id, flags, namespace=''):
-        path = self._get_path(user, blob_id, namespace)
-        if not os.path.isfile(path):
-            return defer.fail(BlobNotFound((user, blob_id)))
 
-        @isolated(path)
-        def _set_flags():
-            try:
-                for flag in flags:
-                    if flag not in ACCEPTED_FLAGS:
-                        raise InvalidFlag(flag)
-                with open(path + '.flags', 'w') as flags_file:
-                    raw_flags = json.dumps(flags)
-                    flags_file.write(raw_flags)
-                    return defer.succeed(None)
-            except Exception as e:
-                return defer.fail(e)
+        @self._isolated(user, blob_id, namespace)
+        def _set_flags(path):
+            for flag in flags:
+                if flag not in ACCEPTED_FLAGS:
+                    raise InvalidFlag(flag)
+            return self._io(_write_flags, path, flags)
 
         return _set_flags()
 
+    @gated
     def write_blob(self, user, blob_id, producer, namespace=''):
-        path = self._get_path(user, blob_id, namespace)
-        if os.path.isfile(path):
-            return defer.fail(BlobExists((user, blob_id)))
 
-        @isolated(path)
+        @self._isolated(user, blob_id, namespace, find=False)
         @defer.inlineCallbacks
-        def _write_blob():
+        def _write_blob(path):
+            if (yield self._io(os.path.isfile, path)):
+                raise BlobExists((user, blob_id))
+            volume = yield self._io(self._get_volume, user)
             try:
                 # limit the number of concurrent writes to disk
                 yield self.semaphore.acquire()
-
-                try:
-                    mkdir_p(os.path.split(path)[0])
-                except OSError as e:
-                    logger.warn(
-                        "Got exception trying to create directory: %r" % e)
                 used = yield self.get_total_storage(user)
                 length = producer.length / 1024.0
                 if used + length > self.quota:
                     raise QuotaExceeded
                 logger.info('writing blob: %s - %s' % (user, blob_id))
-                with open(path, 'wb') as blobfile:
-                    yield producer.startProducing(blobfile)
+                # write to a temporary file, so an interrupted write doesn't
+                # leave a partial blob behind.
+                tmp_path = path + '.part'
+                blobfile = yield self._io(open, tmp_path, 'wb')
+                writer = _FileWriter(blobfile, producer, self._io)
+                d = producer.startProducing(writer)
+                d.addBoth(lambda result: writer.close().addCallback(
+                    lambda _: result))
+                d.addErrback(lambda failure: self._io(
+                    _remove, tmp_path).addCallback(lambda _: failure))
+                yield d
+                yield self._io(os.rename, tmp_path, path)
+                # the blob may have been deleted before
+                yield self._io(_remove, path + '.deleted')
+                yield self._commit([path])
                 used += length
+                volume.writes += 1
+                volume.bytes_written += producer.length
                 yield self._update_usage(user, used)
             finally:
                 self.semaphore.release()
@@ -234,56 +428,48 @@ class FilesystemBlobsBackend(object):
         finally:
             lock.release()
 
+    @gated
     def delete_blob(self, user, blob_id, namespace=''):
-        path = self._get_path(user, blob_id, namespace)
-        if not os.path.isfile(path):
-            return defer.fail(BlobNotFound((user, blob_id)))
 
-        @isolated(path)
-        def _delete_blob():
-            self.__touch(path + '.deleted')
-            os.unlink(path)
-            try:
-                os.unlink(path + '.flags')
-            except Exception:
-                pass
-            return defer.succeed(None)
+        @self._isolated(user, blob_id, namespace)
+        @defer.inlineCallbacks
+        def _delete_blob(path):
+            volume = yield self._io(self._get_volume, user)
+            yield self._io(_delete, path)
+            volume.deletes += 1
 
         return _delete_blob()
 
+    @gated
     def get_blob_size(self, user, blob_id, namespace=''):
-        path = self._get_path(user, blob_id, namespace)
-        if not os.path.isfile(path):
-            return defer.fail(BlobNotFound((user, blob_id)))
 
-        @isolated(path)
-        def _get_blob_size():
-            size = os.stat(path).st_size
-            try:
-                return defer.succeed(size)
-            except Exception as e:
-                return defer.fail(e)
+        @self._isolated(user, blob_id, namespace)
+        def _get_blob_size(path):
+            return self._io(os.path.getsize, path)
 
         return _get_blob_size()
 
+    @gated
     def count(self, user, namespace=''):
-        try:
-            base_path = self._get_path(user, namespace=namespace)
-        except Exception as e:
-            return defer.fail(e)
+        return self._io(self._count, user, namespace)
+
+    def _count(self, user, namespace):
+        base_path = self._get_path(user, namespace=namespace)
         count = 0
         for _, _, filenames in os.walk(base_path):
             count += len(filter(lambda i: not i.endswith('.flags'), filenames))
-        return defer.succeed(count)
+        return count
 
+    @gated
     def list_blobs(self, user, namespace='', order_by=None, deleted=False,
                    filter_flag=False):
+        return self._io(self._list_blobs, user, namespace, order_by, deleted,
+                        filter_flag)
+
+    def _list_blobs(self, user, namespace, order_by, deleted, filter_flag):
         namespace = namespace or 'default'
         blob_ids = []
-        try:
-            base_path = self._get_path(user, namespace=namespace)
-        except Exception as e:
-            return defer.fail(e)
+        base_path = self._get_path(user, namespace=namespace)
 
         def match(name):
             if deleted:
@@ -293,25 +479,61 @@ class FilesystemBlobsBackend(object):
             blob_ids += [os.path.join(root, name) for name in filenames
                          if match(name)]
         if order_by in ['date', '+date']:
-            blob_ids.sort(key=lambda x: os.path.getmtime(x))
+            blob_ids = _sort_by_date(blob_ids)
         elif order_by == '-date':
-            blob_ids.sort(key=lambda x: os.path.getmtime(x), reverse=True)
+            blob_ids = _sort_by_date(blob_ids, reverse=True)
         elif order_by:
-            exc = Exception("Unsupported order_by parameter: %s" % order_by)
-            return defer.fail(exc)
+            raise Exception("Unsupported order_by parameter: %s" % order_by)
         if filter_flag:
             blob_ids = list(self._filter_flag(blob_ids, filter_flag))
-        blob_ids = [os.path.basename(path).replace('.deleted', '')
-                    for path in blob_ids]
-        return defer.succeed(blob_ids)
+        return [os.path.basename(path).replace('.deleted', '')
+                for path in blob_ids]
+
+    @gated
+    def list_deletions(self, user, namespace='', since=None):
+        return self._io(self._list_deletions, user, namespace, since)
+
+    def _list_deletions(self, user, namespace, since):
+        base_path = self._get_path(user, namespace=namespace or 'default')
+        deletions = []
+        for root, _, filenames in os.walk(base_path):
+            for name in filenames:
+                if not name.endswith('.deleted'):
+                    continue
+                try:
+                    mtime = os.path.getmtime(os.path.join(root, name))
+                except OSError:
+                    continue  # expired while listing
+                if since is None or mtime >= since:
+                    deletions.append((name[:-len('.deleted')], mtime))
+        return deletions
+
+    def expire_deletions(self, before):
+        return self._io(self._expire_deletions, before)
+
+    def _expire_deletions(self, before):
+        expired = 0
+        for volume in self._all_volumes():
+            for user in _list_users(volume.path):
+                root = os.path.join(volume.path, user)
+                for dirpath, _, filenames in os.walk(root):
+                    for name in filenames:
+                        if not name.endswith('.deleted'):
+                            continue
+                        if _remove_if_older(os.path.join(dirpath, name),
+                                            before):
+                            expired += 1
+        return expired
 
     def _filter_flag(self, blob_paths, flag):
         for blob_path in blob_paths:
             flag_path = blob_path + '.flags'
-            if not os.path.isfile(flag_path):
+            try:
+                with open(flag_path, 'r') as flags_file:
+                    blob_flags = json.loads(flags_file.read())
+            except IOError:
+                # no flags were set, or the blob was deleted while listing
                 continue
-            with open(flag_path, 'r') as flags_file:
-                blob_flags = json.loads(flags_file.read())
             if flag in blob_flags:
                 yield blob_path
 
@@ -322,64 +544,56 @@ class FilesystemBlobsBackend(object):
         try:
             used, timestamp = self.usage[user]
             if used is None or time.time() > timestamp + self.USAGE_TIMEOUT:
-                path = self._get_path(user)
+                path = yield self._io(self._get_path, user)
                 used = yield self._get_disk_usage(path)
                 self.usage[user] = (used, time.time())
             defer.returnValue(used)
         finally:
             lock.release()
 
+    @gated
     def get_tag(self, user, blob_id, namespace=''):
-        path = self._get_path(user, blob_id, namespace)
-        if not os.path.isfile(path):
-            return defer.fail(BlobNotFound((user, blob_id)))
 
-        @isolated(path)
-        def _get_tag():
-            try:
-                with open(path) as doc_file:
-                    doc_file.seek(-16, 2)
-                    tag = base64.urlsafe_b64encode(doc_file.read())
-                    return defer.succeed(tag)
-            except Exception as e:
-                return defer.fail(e)
+        @self._isolated(user, blob_id, namespace)
+        def _get_tag(path):
+            return self._io(_read_tag, path)
 
         return _get_tag()
 
     @defer.inlineCallbacks
     def _get_disk_usage(self, start_path):
-        if not os.path.isdir(start_path):
+        if not (yield self._io(os.path.isdir, start_path)):
             defer.returnValue(0)
         cmd = ['/usr/bin/du', '-s', '-c', start_path]
         output = yield utils.getProcessOutput(cmd[0], cmd[1:])
         size = output.split()[0]
         defer.returnValue(int(size))
 
-    def _validate_path(self, desired_path, user, blob_id):
+    def _validate_path(self, desired_path, user, blob_id, root=None):
         if not VALID_STRINGS.match(user):
             raise Exception("Invalid characters on user: %s" % user)
         if blob_id and not VALID_STRINGS.match(blob_id):
             raise Exception("Invalid characters on blob_id: %s" % blob_id)
         desired_path = os.path.realpath(desired_path)  # expand path references
-        root = os.path.realpath(self.path)
+        root = os.path.realpath(root or self.path)
         if not desired_path.startswith(root + os.sep + user):
             err = "User %s tried accessing a invalid path: %s" % (user,
                                                                   desired_path)
             raise Exception(err)
         return desired_path
 
-    @defer.inlineCallbacks
+    @gated
     def exists(self, user, blob_id, namespace):
-        path = self._get_path(user, blob_id, namespace)
 
-        @isolated(path)
-        @defer.inlineCallbacks
-        def _exists():
-            defer.returnValue(os.path.isfile(path))
+        @self._isolated(user, blob_id, namespace, find=False)
+        def _exists(path):
+            return self._io(os.path.isfile, path)
 
         return _exists()
 
     def _get_path(self, user, blob_id='', namespace=''):
+        if not VALID_STRINGS.match(user):
+            raise Exception("Invalid characters on user: %s" % user)
         parts = [user]
         if blob_id:
             namespace = namespace or 'default'
@@ -388,10 +602,198 @@ class FilesystemBlobsBackend(object):
             parts += [namespace]  # namespace path
         else:
             pass  # root path
-        path = os.path.join(self.path, *parts)
-        return self._validate_path(path, user, blob_id)
+        root = self._get_root(user)
+        path = os.path.join(root, *parts)
+        return self._validate_path(path, user, blob_id, root=root)
 
     def _get_path_parts(self, blob_id, custom):
         if custom and not blob_id:
             return [custom]
         return [custom] + [blob_id[0], blob_id[0:3], blob_id[0:6]] + [blob_id]
+
+    #
+    # volumes
+    #
+
+    def _all_volumes(self):
+        if self._legacy:
+            return self.volumes + [self._legacy]
+        return self.volumes
+
+    def _get_volume(self, user):
+        """
+        Get the volume that currently holds the data of a user.
+
+        The placement of a user is given by the hash ring, but their data may
+        still be in another volume if it has not been relocated yet.
+        """
+        if self._single_volume:
+            return self.volumes[0]
+        volume = self._ring.get(user)
+        if os.path.isdir(os.path.join(volume.path, user)):
+            return volume
+        for other in self._all_volumes():
+            if os.path.isdir(os.path.join(other.path, user)):
+                return other
+        return volume
+
+    def _get_root(self, user):
+        if self._single_volume:
+            return self.path
+        return self._get_volume(user).path
+
+    @property
+    def _single_volume(self):
+        return len(self.volumes) == 1 and not self._legacy
+
+    def get_volume_stats(self):
+        """
+        Get I/O and capacity metrics of each volume.
+
+        :return: A list of dictionaries with stats for each volume.
+        :rtype: list of dict
+        """
+        return [volume.stats() for volume in self._all_volumes()]
+
+    def add_volume(self, path, weight=1):
+        """
+        Add a volume to the hash ring and relocate the data of the users that
+        are now placed in it.
+
+        :param path: The path of the new volume.
+        :type path: str
+        :param weight: The weight of the new volume.
+        :type weight: int
+
+        :return: A deferred that fires when relocation has finished.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if path in [volume.path for volume in self.volumes]:
+            return self.rebalance()
+        volume = Volume(path, weight)
+        d = self._io(mkdir_p, path)
+        d.addCallback(lambda _: self._add_to_ring(volume))
+        return d
+
+    def _add_to_ring(self, volume):
+        if self._legacy and self._legacy.path == volume.path:
+            self._legacy = None
+        self.volumes.append(volume)
+        self._ring = HashRing(self.volumes)
+        return self.rebalance()
+
+    def rebalance(self):
+        """
+        Relocate the data of users that are not stored in the volume given by
+        the hash ring. Operations on a user's data are held only during the
+        final stage of its relocation, so reads stay correct while data is
+        being moved.
+
+        :return: A deferred that fires when relocation has finished.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._rebalance_lock.run(self._rebalance)
+
+    @defer.inlineCallbacks
+    def _rebalance(self):
+        for volume in self._all_volumes():
+            users = yield self._io(_list_users, volume.path)
+            for user in users:
+                target = self._ring.get(user)
+                if target.path != volume.path:
+                    yield self._relocate(user, volume, target)
+
+    @defer.inlineCallbacks
+    def _relocate(self, user, source, target):
+        logger.info('relocating blobs of %s from %s to %s'
+                    % (user, source.path, target.path))
+        src = os.path.join(source.path, user)
+        dst = os.path.join(target.path, user)
+        if (yield self._io(os.path.isdir, dst)):
+            # a previous relocation was interrupted after data was moved, so
+            # what is left in the source volume is stale.
+            yield self._io(shutil.rmtree, src, True)
+            return
+        staging = os.path.join(target.path, '.relocating', user)
+        # first pass happens while the user's data is still being served from
+        # the source volume.
+        yield self._io(sync_tree, src, staging)
+        yield self._gate.close(user)
+        try:
+            # second pass copies whatever changed during the first one.
+            yield self._io(sync_tree, src, staging)
+            yield self._io(os.rename, staging, dst)
+        finally:
+            self._gate.open(user)
+        yield self._io(shutil.rmtree, src, True)
+
+
+def _try_lock(path):
+    mkdir_p(os.path.dirname(path))
+    lock = FilesystemLock(path + '.lock')
+    if lock.lock():
+        return lock
+    return None
+
+
+def _size(fd):
+    return os.fstat(fd.fileno()).st_size
+
+
+def _read_flags(path):
+    if not os.path.isfile(path + '.flags'):
+        return []
+    with open(path + '.flags', 'r') as flags_file:
+        return json.loads(flags_file.read())
+
+
+def _write_flags(path, flags):
+    with open(path + '.flags', 'w') as flags_file:
+        flags_file.write(json.dumps(flags))
+
+
+def _read_tag(path):
+    with open(path) as doc_file:
+        doc_file.seek(-16, 2)
+        return base64.urlsafe_b64encode(doc_file.read())
+
+
+def _delete(path):
+    # the time of the deletion is kept as the mtime of the marker
+    open(path + '.deleted', 'a').close()
+    os.utime(path + '.deleted', None)
+    os.unlink(path)
+    _remove(path + '.flags')
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _remove_if_older(path, before):
+    try:
+        if os.path.getmtime(path) >= before:
+            return False
+        os.unlink(path)
+    except OSError:
+        return False  # removed in the meantime
+    return True
+
+
+def _sort_by_date(paths, reverse=False):
+    dated = []
+    for path in paths:
+        try:
+            dated.append((os.path.getmtime(path), path))
+        except OSError:
+            pass  # deleted while listing
+    dated.sort(key=lambda item: item[0], reverse=reverse)
+    return [path for _, path in dated]
+
+
+def _list_users(path):
+    users = filter(VALID_STRINGS.match, os.listdir(path))
+    return [user for user in users if os.path.isdir(os.path.join(path, user))]
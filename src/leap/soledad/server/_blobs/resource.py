@@ -18,7 +18,12 @@
 A Twisted Web resource for blobs.
 """
 import json
+import os
+import time
 
+from uuid import uuid4
+
+from twisted.internet import defer
 from twisted.python.compat import intToBytes
 from twisted.python.compat import networkString
 from twisted.web import resource
@@ -29,11 +34,15 @@ from leap.soledad.common.blobs import InvalidFlag
 from leap.soledad.server import interfaces
 
 from .fs_backend import FilesystemBlobsBackend
+from .s3_backend import S3BlobsBackend
 from .errors import BlobNotFound
 from .errors import BlobExists
 from .errors import ImproperlyConfiguredException
 from .errors import QuotaExceeded
 from .errors import RangeNotSatisfiable
+from .errors import UploadNotFound
+from .errors import InvalidOffset
+from .uploads import UploadSessions
 from .util import VALID_STRINGS
 
 from leap.soledad.common.log import getLogger
@@ -78,27 +87,164 @@ def _catchInvalidFlag(failure, request, user, blob_id):
     request.finish()
 
 
+def _catchUploadErrors(failure, request, user, upload_id):
+    failure.trap(UploadNotFound, InvalidOffset)
+    if failure.check(UploadNotFound):
+        logger.error("Error 404: Upload %s does not exist for user %s"
+                     % (upload_id, user))
+        request.setResponseCode(404)
+        request.write("Upload doesn't exist: %s" % upload_id)
+    else:
+        # tell the client where to resume the upload from
+        offset = failure.value.args[0]
+        logger.error("Error 416: Upload %s of user %s is at offset %d"
+                     % (upload_id, user, offset))
+        request.setResponseCode(416)
+        request.write(json.dumps({'upload': upload_id, 'offset': offset}))
+    request.finish()
+
+
+def _status(failure):
+    if failure.check(BlobNotFound):
+        return 404
+    if failure.check(InvalidFlag):
+        return 406
+    logger.error('Error processing bulk item: %r' % failure.value)
+    return 500
+
+
 def _catchAllErrors(failure, request):
     logger.error('Error processing request: %r' % failure.value)
     request.setResponseCode(500)
     request.finish()
 
 
+def _etag(tag):
+    return '"%s"' % tag
+
+
+def _matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    # weak comparison, as in RFC 7232
+    return etag in [c[2:] if c.startswith('W/') else c for c in candidates]
+
+
+class _PartConsumer(object):
+    """
+    A consumer that writes to a request but doesn't let producers finish it.
+    """
+
+    def __init__(self, request):
+        self._request = request
+
+    def write(self, data):
+        self._request.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self._request.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._request.unregisterProducer()
+
+    def finish(self):
+        pass
+
+
 class BlobsResource(resource.Resource):
 
     isLeaf = True
 
-    # Allowed backend classes are defined here
-    handlers = {"filesystem": FilesystemBlobsBackend}
+    # Maximum number of operations in a single bulk request
+    max_bulk_items = 1000
+
+    # Deletions are recorded at most this number of seconds after they
+    # happen, so cursors are kept this far behind the current time.
+    deletions_cursor_margin = 60
+
+    # Upload sessions are discarded after this number of seconds without
+    # receiving data.
+    uploads_retention = 24 * 60 * 60
+
+    # Maximum number of ranges in a single GET request. Requests for more
+    # ranges get the whole blob instead.
+    max_ranges = 16
 
-    def __init__(self, backend, blobs_path, **backend_kwargs):
+    # Allowed backend classes are defined here
+    handlers = {
+        "filesystem": FilesystemBlobsBackend,
+        "s3": S3BlobsBackend,
+    }
+
+    def __init__(self, backend, blobs_path, deletions_retention=None,
+                 **backend_kwargs):
+        """
+        Initialize the resource.
+
+        :param backend: The name of the backend for blobs storage, or a
+            backend to share with other resources.
+        :type backend: str or IBlobsBackend
+        :param blobs_path: The path for blobs storage.
+        :type blobs_path: str
+        :param deletions_retention: For how long, in seconds, deletions are
+            reported to clients before being expired. If None, deletions are
+            never expired.
+        :type deletions_retention: float
+        """
         resource.Resource.__init__(self)
         self._blobs_path = blobs_path
-        backend_kwargs.update({'blobs_path': blobs_path})
-        if backend not in self.handlers:
-            raise ImproperlyConfiguredException("No such backend: %s", backend)
-        self._handler = self.handlers[backend](**backend_kwargs)
+        self._deletions_retention = deletions_retention
+        if interfaces.IBlobsBackend.providedBy(backend):
+            self._handler = backend
+        else:
+            backend_kwargs.update({'blobs_path': blobs_path})
+            if backend not in self.handlers:
+                raise ImproperlyConfiguredException(
+                    "No such backend: %s", backend)
+            self._handler = self.handlers[backend](**backend_kwargs)
         assert interfaces.IBlobsBackend.providedBy(self._handler)
+        # staged chunks are written in the I/O threadpool of the backend, if
+        # it has one.
+        io = getattr(self._handler, '_io', None)
+        self._uploads = UploadSessions(
+            os.path.join(blobs_path, '.uploads'), io=io)
+
+    def rebalance(self):
+        """
+        Relocate users' blobs among the volumes of the backend.
+
+        :return: A deferred that fires when relocation has finished.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._handler.rebalance()
+
+    def collect_garbage(self):
+        """
+        Expire deletions older than the retention period, and discard
+        abandoned upload sessions.
+
+        :return: A deferred that fires when expired data was removed.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        deferreds = []
+        before = time.time() - self.uploads_retention
+        d = self._uploads.expire(before)
+        d.addCallback(
+            lambda count: logger.info('expired %d uploads' % count))
+        deferreds.append(d)
+        if self._deletions_retention:
+            before = time.time() - self._deletions_retention
+            d = self._handler.expire_deletions(before)
+            d.addCallback(
+                lambda count: logger.info('expired %d deletions' % count))
+            deferreds.append(d)
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addErrback(lambda f: logger.error(
+            'Error collecting garbage: %r' % f.value.subFailure.value))
+        return d
 
     # TODO double check credentials, we can have then
     # under request.
@@ -114,6 +260,8 @@ class BlobsResource(resource.Resource):
         order = request.args.get('order_by', [None])[0]
         filter_flag = request.args.get('filter_flag', [False])[0]
         deleted = request.args.get('deleted', [False])[0]
+        if deleted and 'since' in request.args:
+            return self._list_deletions(request, user, namespace)
         d = self._handler.list_blobs(user, namespace,
                                      order_by=order, deleted=deleted,
                                      filter_flag=filter_flag)
@@ -122,6 +270,35 @@ class BlobsResource(resource.Resource):
         d.addCallback(lambda _: request.finish())
         return NOT_DONE_YET
 
+    def _list_deletions(self, request, user, namespace):
+        since = request.args['since'][0]
+        try:
+            since = float(since) if since else None
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Invalid cursor: %s' % since
+        now = time.time()
+        retention = self._deletions_retention
+        # if the client is not aware of deletions that may have been expired
+        # already, it has to compare its blobs with the server's.
+        expired = bool(retention) and \
+            (since is None or since < now - retention)
+        cursor = now - self.deletions_cursor_margin
+
+        def _respond(deletions):
+            return json.dumps({
+                'deleted': [blob_id for blob_id, _ in deletions],
+                'cursor': cursor,
+                'expired': expired,
+            })
+
+        d = self._handler.list_deletions(user, namespace, since=since)
+        d.addCallback(_respond)
+        d.addCallback(lambda body: request.write(body))
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
     def _only_flags(self, request, user, blob_id, namespace):
         d = self._handler.get_flags(user, blob_id, namespace)
         d.addCallback(lambda flags: json.dumps(flags))
@@ -133,37 +310,74 @@ class BlobsResource(resource.Resource):
 
     def _get_blob(self, request, user, blob_id, namespace, range):
 
-        def _set_tag_header(tag):
-            request.responseHeaders.setRawHeaders('Tag', [tag])
+        def _finish(_):
+            # some backends finish the request when they are done producing
+            if not request.finished:
+                request.finish()
 
-        def _read_blob(_):
-            handler = self._handler
-            consumer = request
-            d = handler.read_blob(
+        d = self._handler.read_blob(
+            user, blob_id, request, namespace=namespace, range=range)
+        d.addCallback(_finish)
+        return d
+
+    @defer.inlineCallbacks
+    def _get_blob_ranges(self, request, user, blob_id, namespace, parts,
+                         boundary):
+        # the consumer passed to the backend can't finish the request, as
+        # more parts may follow.
+        consumer = _PartConsumer(request)
+        for header, range in parts:
+            request.write(header)
+            yield self._handler.read_blob(
                 user, blob_id, consumer, namespace=namespace, range=range)
-            return d
-
-        d = self._handler.get_tag(user, blob_id, namespace)
-        d.addCallback(_set_tag_header)
-        d.addCallback(_read_blob)
-        d.addErrback(_catchBlobNotFound, request, user, blob_id)
-        d.addErrback(_catchAllErrors, request)
-
-        return NOT_DONE_YET
-
-    def _parseRange(self, range):
+        request.write(b'\r\n--%s--\r\n' % boundary)
+        request.finish()
+
+    def _parseRange(self, range, size):
+        """
+        Parse the value of a Range header into a list of (start, end) tuples.
+        Range ends are inclusive in the header, and are returned as the
+        position after the last byte of each range, as backends expect.
+
+        Overlapping and adjacent ranges are merged, and None is returned,
+        so the whole blob is sent, if there are more than max_ranges ranges
+        or if they add up to more than the blob.
+        """
         if not range:
             return None
         try:
             kind, value = range.split(b'=', 1)
             if kind.strip() != b'bytes':
                 raise Exception('Unknown unit: %s' % kind)
-            start, end = value.split('-')
-            start = int(start) if start else None
-            end = int(end) if end else None
-            return start, end
+            ranges = []
+            for spec in value.split(b','):
+                start, end = spec.strip().split('-')
+                start = int(start) if start else None
+                end = int(end) if end else None
+                if start is None and end is None:
+                    raise Exception('Empty range: %s' % spec)
+                if start is None:
+                    # a suffix range, holding the last bytes of the blob
+                    start, end = max(size - end, 0), size
+                elif end is None or end >= size:
+                    end = size
+                else:
+                    end += 1
+                if start >= end:
+                    raise Exception('Unsatisfiable range: %s' % spec)
+                ranges.append((start, end))
         except Exception as e:
             raise RangeNotSatisfiable(e)
+        if len(ranges) > self.max_ranges or \
+                sum(end - start for start, end in ranges) > size:
+            return None
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        return merged
 
     def render_GET(self, request):
         logger.info("http get: %s" % request.path)
@@ -179,9 +393,12 @@ class BlobsResource(resource.Resource):
         if only_flags:
             return self._only_flags(request, user, blob_id, namespace)
 
-        def _handleRangeHeader(size):
+        if 'upload' in request.args:
+            return self._upload_offset(request, user, blob_id, namespace)
+
+        def _handleRangeHeader(size, tag):
             try:
-                range = self._parseRange(request.getHeader('Range'))
+                ranges = self._parseRange(request.getHeader('Range'), size)
             except RangeNotSatisfiable:
                 content_range = 'bytes */%d' % size
                 content_range = networkString(content_range)
@@ -189,23 +406,64 @@ class BlobsResource(resource.Resource):
                 request.setHeader(b'content-range', content_range)
                 request.finish()
                 return
+            if_range = request.getHeader('If-Range')
+            if if_range and if_range != _etag(tag):
+                # the client has a partial copy of another blob
+                ranges = None
 
-            if not range:
-                start = end = None
+            if not ranges:
                 request.setResponseCode(200)
                 request.setHeader(b'content-length', intToBytes(size))
-            else:
-                start, end = range
-                content_range = 'bytes %d-%d/%d' % (start, end, size)
+                return self._get_blob(request, user, blob_id, namespace, None)
+
+            request.setResponseCode(206)
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                content_range = 'bytes %d-%d/%d' % (start, end - 1, size)
                 content_range = networkString(content_range)
                 length = intToBytes(end - start)
-                request.setResponseCode(206)
                 request.setHeader(b'content-range', content_range)
                 request.setHeader(b'content-length', length)
-            return self._get_blob(request, user, blob_id, namespace, range)
-
-        d = self._handler.get_blob_size(user, blob_id, namespace=namespace)
-        d.addCallback(_handleRangeHeader)
+                return self._get_blob(
+                    request, user, blob_id, namespace, ranges[0])
+
+            boundary = uuid4().hex
+            parts = []
+            for start, end in ranges:
+                header = (
+                    '\r\n--%s\r\n'
+                    'Content-Type: application/octet-stream\r\n'
+                    'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                    % (boundary, start, end - 1, size))
+                parts.append((networkString(header), (start, end)))
+            length = sum(len(header) + end - start
+                         for header, (start, end) in parts)
+            length += len('\r\n--%s--\r\n' % boundary)
+            content_type = 'multipart/byteranges; boundary=%s' % boundary
+            request.setHeader(b'content-type', networkString(content_type))
+            request.setHeader(b'content-length', intToBytes(length))
+            return self._get_blob_ranges(
+                request, user, blob_id, namespace, parts,
+                networkString(boundary))
+
+        def _handleConditionalHeaders(result):
+            size, tag = result
+            etag = _etag(tag)
+            request.responseHeaders.setRawHeaders('Tag', [tag])
+            request.setHeader(b'etag', networkString(etag))
+            if _matches(request.getHeader('If-None-Match'), etag):
+                # blobs are immutable, so the client's copy is still valid
+                request.setResponseCode(304)
+                request.finish()
+                return
+            return _handleRangeHeader(size, tag)
+
+        d = defer.gatherResults([
+            self._handler.get_blob_size(user, blob_id, namespace=namespace),
+            self._handler.get_tag(user, blob_id, namespace)],
+            consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(_handleConditionalHeaders)
         d.addErrback(_catchBlobNotFound, request, user, blob_id)
         d.addErrback(_catchAllErrors, request)
         return NOT_DONE_YET
@@ -213,6 +471,8 @@ class BlobsResource(resource.Resource):
     def render_DELETE(self, request):
         logger.info("http put: %s" % request.path)
         user, blob_id, namespace = self._validate(request)
+        if 'upload' in request.args:
+            return self._abort_upload(request, user, blob_id, namespace)
         d = self._handler.delete_blob(user, blob_id, namespace=namespace)
         d.addCallback(lambda _: request.finish())
         d.addErrback(_catchBlobNotFound, request, user, blob_id)
@@ -222,6 +482,8 @@ class BlobsResource(resource.Resource):
     def render_PUT(self, request):
         logger.info("http put: %s" % request.path)
         user, blob_id, namespace = self._validate(request)
+        if 'upload' in request.args:
+            return self._upload_chunk(request, user, blob_id, namespace)
         producer = FileBodyProducer(request.content)
         handler = self._handler
         d = handler.write_blob(user, blob_id, producer, namespace=namespace)
@@ -234,6 +496,12 @@ class BlobsResource(resource.Resource):
     def render_POST(self, request):
         logger.info("http post: %s" % request.path)
         user, blob_id, namespace = self._validate(request)
+        if not blob_id:
+            return self._bulk(request, user, namespace)
+        if request.args.get('upload', [None])[0] == 'start':
+            return self._start_upload(request, user, blob_id, namespace)
+        if 'upload' in request.args:
+            return self._finalize_upload(request, user, blob_id, namespace)
         raw_flags = request.content.read()
         flags = json.loads(raw_flags)
         d = self._handler.set_flags(user, blob_id, flags, namespace=namespace)
@@ -244,6 +512,176 @@ class BlobsResource(resource.Resource):
         d.addErrback(_catchAllErrors, request)
         return NOT_DONE_YET
 
+    def _bulk(self, request, user, namespace):
+        """
+        Set flags and delete many blobs of a namespace in one request.
+
+        The body is a JSON object like ``{"flags": [[blob_id, flags], ...],
+        "delete": [blob_id, ...]}``, where both keys are optional. Flags are
+        set before blobs are deleted. The response has the same keys, each
+        with a list of ``[blob_id, status]`` pairs, where status is the HTTP
+        status code the operation would get if done in its own request.
+        """
+        try:
+            bulk = json.loads(request.content.read())
+            to_flag = [(blob_id, flags) for blob_id, flags
+                       in bulk.get('flags', [])]
+            to_delete = list(bulk.get('delete', []))
+            for blob_id in [b for b, _ in to_flag] + to_delete:
+                if not isinstance(blob_id, basestring):
+                    raise ValueError("Invalid blob id: %r" % blob_id)
+        except Exception as e:
+            logger.error("Error 400: Invalid bulk request: %r" % e)
+            request.setResponseCode(400)
+            return 'Invalid bulk request'
+        if len(to_flag) + len(to_delete) > self.max_bulk_items:
+            logger.error("Error 413: Too many items in bulk request")
+            request.setResponseCode(413)
+            return 'Too many items, the limit is %d' % self.max_bulk_items
+
+        def _apply(operations):
+            deferreds = []
+            for blob_id, f, args in operations:
+                if not VALID_STRINGS.match(blob_id):
+                    d = defer.succeed(400)
+                else:
+                    d = f(user, blob_id, *args, namespace=namespace)
+                    d.addCallbacks(lambda _: 200, _status)
+                d.addCallback(lambda status, blob_id=blob_id:
+                              [blob_id, status])
+                deferreds.append(d)
+            return defer.gatherResults(deferreds)
+
+        @defer.inlineCallbacks
+        def _run():
+            result = {}
+            if to_flag:
+                result['flags'] = yield _apply(
+                    [(blob_id, self._handler.set_flags, (flags,))
+                     for blob_id, flags in to_flag])
+            if to_delete:
+                result['delete'] = yield _apply(
+                    [(blob_id, self._handler.delete_blob, ())
+                     for blob_id in to_delete])
+            defer.returnValue(result)
+
+        d = _run()
+        d.addCallback(lambda result: request.write(json.dumps(result)))
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
+    def _start_upload(self, request, user, blob_id, namespace):
+        """
+        Start a session for uploading a blob in chunks.
+
+        The body is a JSON object like ``{"length": size}`` with the total
+        size of the blob. The lengths of all the uploads of the user that
+        were not finalized count towards their quota. The response is a JSON
+        object like ``{"upload": upload_id, "offset": 0}``.
+
+        Chunks are then sent with ``PUT ?upload=upload_id&offset=offset``,
+        and the upload is finalized with ``POST ?upload=upload_id``. A chunk
+        sent at the wrong offset gets a 416 response with the offset the
+        upload can be resumed from, which can also be queried with
+        ``GET ?upload=upload_id``.
+        """
+        try:
+            length = int(json.loads(request.content.read())['length'])
+            if length < 0:
+                raise ValueError('Negative length: %d' % length)
+        except Exception as e:
+            logger.error("Error 400: Invalid upload request: %r" % e)
+            request.setResponseCode(400)
+            return 'Invalid upload request'
+
+        @defer.inlineCallbacks
+        def _start():
+            if (yield self._handler.exists(user, blob_id, namespace)):
+                raise BlobExists((user, blob_id))
+            used = yield self._handler.get_total_storage(user)
+            available = (self._handler.quota - used) * 1024
+            upload_id = yield self._uploads.start(
+                user, blob_id, namespace, length, available=available)
+            defer.returnValue(upload_id)
+
+        d = _start()
+        d.addCallback(lambda upload_id: request.write(
+            json.dumps({'upload': upload_id, 'offset': 0})))
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchBlobExists, request, user, blob_id)
+        d.addErrback(_catchQuotaExceeded, request, user)
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
+    def _upload_offset(self, request, user, blob_id, namespace):
+        upload_id = request.args['upload'][0]
+        d = self._uploads.get_offset(user, blob_id, namespace, upload_id)
+        d.addCallback(lambda offset: request.write(
+            json.dumps({'upload': upload_id, 'offset': offset})))
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchUploadErrors, request, user, upload_id)
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
+    def _upload_chunk(self, request, user, blob_id, namespace):
+        upload_id = request.args['upload'][0]
+        try:
+            offset = int(request.args.get('offset', [None])[0])
+        except (TypeError, ValueError):
+            request.setResponseCode(400)
+            return 'Invalid offset'
+
+        def _catchTooLong(failure):
+            failure.trap(ValueError)
+            logger.error("Error 400: %s" % failure.value)
+            request.setResponseCode(400)
+            request.write(str(failure.value))
+            request.finish()
+
+        d = self._uploads.append(
+            user, blob_id, namespace, upload_id, offset, request.content)
+        d.addCallback(lambda offset: request.write(
+            json.dumps({'upload': upload_id, 'offset': offset})))
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchUploadErrors, request, user, upload_id)
+        d.addErrback(_catchTooLong)
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
+    def _finalize_upload(self, request, user, blob_id, namespace):
+        upload_id = request.args['upload'][0]
+
+        def _write(fd):
+            producer = FileBodyProducer(fd)
+            return self._handler.write_blob(
+                user, blob_id, producer, namespace=namespace)
+
+        def _discard(failure):
+            # the session can't ever be finalized
+            failure.trap(BlobExists)
+            d = self._uploads.remove(user, upload_id)
+            d.addCallback(lambda _: failure)
+            return d
+
+        d = self._uploads.finalize(
+            user, blob_id, namespace, upload_id, _write)
+        d.addErrback(_discard)
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchUploadErrors, request, user, upload_id)
+        d.addErrback(_catchBlobExists, request, user, blob_id)
+        d.addErrback(_catchQuotaExceeded, request, user)
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
+    def _abort_upload(self, request, user, blob_id, namespace):
+        upload_id = request.args['upload'][0]
+        d = self._uploads.remove(user, upload_id)
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(_catchUploadErrors, request, user, upload_id)
+        d.addErrback(_catchAllErrors, request)
+        return NOT_DONE_YET
+
     def _validate(self, request):
         for arg in request.postpath:
             if arg and not VALID_STRINGS.match(arg):
@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+# _blobs/s3_backend.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+A backend for blobs that stores in an object storage service that speaks the
+S3 API.
+
+Blob contents are stored as objects in a bucket, while sizes, tags, flags and
+deletion markers are kept in a metadata index, so listing and counting blobs
+don't need to reach the object storage service.
+
+The metadata index is a SQLite database, so this backend supports a single
+server host: other hosts serving the same bucket would not see blobs listed in
+it, and objects become unreachable if the index is lost. The index path has to
+be configured explicitly and should live on durable, backed up storage.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import treq
+
+from collections import defaultdict
+from urllib import quote
+from urlparse import urlparse
+from xml.etree import ElementTree
+
+from zope.interface import implementer
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+from leap.common.files import mkdir_p
+from leap.soledad.common.blobs import ACCEPTED_FLAGS
+from leap.soledad.common.blobs import InvalidFlag
+from leap.soledad.common.log import getLogger
+from leap.soledad.server import interfaces
+
+from .errors import BackendError
+from .errors import BlobExists
+from .errors import BlobNotFound
+from .errors import ImproperlyConfiguredException
+from .errors import QuotaExceeded
+from .util import VALID_STRINGS
+
+
+logger = getLogger(__name__)
+
+
+EMPTY_SHA256 = hashlib.sha256('').hexdigest()
+
+
+@implementer(interfaces.IBlobsBackend)
+class S3BlobsBackend(object):
+
+    # S3 requires all parts of a multipart upload but the last one to have at
+    # least 5 MiB, so blobs smaller than that are uploaded with a single PUT.
+    part_size = 5 * 1024 * 1024
+
+    def __init__(self, blobs_path='/tmp/blobs/', quota=200 * 1024,
+                 concurrent_writes=50, url=None, bucket=None, access_key=None,
+                 secret_key=None, region='us-east-1', index_path=None):
+        """
+        Initialize the backend.
+
+        :param blobs_path: Unused, accepted for compatibility with the other
+            backends.
+        :type blobs_path: str
+        :param quota: The quota for each user, in units of 1024 bytes.
+        :type quota: int
+        :param concurrent_writes: Limit of concurrent uploads to the object
+            storage service.
+        :type concurrent_writes: int
+        :param url: The URL of the object storage service.
+        :type url: str
+        :param bucket: The name of the bucket where blobs are stored.
+        :type bucket: str
+        :param access_key: The access key used to sign requests.
+        :type access_key: str
+        :param secret_key: The secret key used to sign requests.
+        :type secret_key: str
+        :param region: The region of the bucket, used to sign requests.
+        :type region: str
+        :param index_path: The path of the metadata index. It is the only
+            record of which blobs exist, so it must be kept on durable storage
+            and must not be shared by more than one server host.
+        :type index_path: str
+        """
+        if not (url and bucket and access_key and secret_key):
+            raise ImproperlyConfiguredException(
+                "The S3 backend needs an URL, a bucket and credentials.")
+        if not index_path:
+            raise ImproperlyConfiguredException(
+                "The S3 backend needs the path of its metadata index.")
+        self.quota = quota
+        self.semaphore = defer.DeferredSemaphore(concurrent_writes)
+        self.url = url.rstrip('/')
+        self.bucket = bucket
+        self._signer = _Signer(access_key, secret_key, region)
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._locks = defaultdict(defer.DeferredLock)
+        mkdir_p(os.path.dirname(os.path.abspath(index_path)))
+        self._index = _MetadataIndex(index_path)
+
+    def close(self):
+        """
+        Close connections to the object storage service and to the index.
+
+        :return: A deferred that fires when all connections are closed.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        self._index.close()
+        return self._pool.closeCachedConnections()
+
+    def read_blob(self, user, blob_id, consumer, namespace='', range=None):
+        namespace = namespace or 'default'
+        key = self._get_key(user, blob_id, namespace)
+
+        def _read(row):
+            if row is None:
+                raise BlobNotFound((user, blob_id))
+            logger.info('reading blob: %s - %s@%s'
+                        % (user, blob_id, namespace))
+            headers = {}
+            if range is not None:
+                start, end = range
+                if end <= start:
+                    return
+                headers['Range'] = 'bytes=%d-%d' % (start, end - 1)
+            d = self._request('GET', key, headers=headers)
+            d.addCallback(self._check_found, user, blob_id)
+            d.addCallback(_deliver, consumer)
+            return d
+
+        d = self._index.get(user, namespace, blob_id)
+        d.addCallback(_read)
+        return d
+
+    def get_flags(self, user, blob_id, namespace=''):
+        d = self._get_row(user, blob_id, namespace)
+        d.addCallback(lambda row: json.loads(row['flags']))
+        return d
+
+    def set_flags(self, user, blob_id, flags, namespace=''):
+        namespace = namespace or 'default'
+        for flag in flags:
+            if flag not in ACCEPTED_FLAGS:
+                return defer.fail(InvalidFlag(flag))
+        d = self._get_row(user, blob_id, namespace)
+        d.addCallback(lambda _: self._index.set_flags(
+            user, namespace, blob_id, json.dumps(flags)))
+        return d
+
+    @defer.inlineCallbacks
+    def write_blob(self, user, blob_id, producer, namespace=''):
+        namespace = namespace or 'default'
+        key = self._get_key(user, blob_id, namespace)
+        lock = self._locks[key]
+        yield lock.acquire()
+        try:
+            row = yield self._index.get(user, namespace, blob_id)
+            if row is not None:
+                raise BlobExists((user, blob_id))
+            # limit the number of concurrent uploads
+            yield self.semaphore.acquire()
+            try:
+                used = yield self.get_total_storage(user)
+                length = producer.length / 1024.0
+                if used + length > self.quota:
+                    raise QuotaExceeded
+                logger.info('writing blob: %s - %s' % (user, blob_id))
+                writer = _UploadWriter(self, key, producer)
+                size, tail = yield writer.upload()
+            finally:
+                self.semaphore.release()
+            tag = base64.urlsafe_b64encode(tail)
+            yield self._index.add(user, namespace, blob_id, size, tag)
+        finally:
+            lock.release()
+
+    @defer.inlineCallbacks
+    def delete_blob(self, user, blob_id, namespace=''):
+        namespace = namespace or 'default'
+        key = self._get_key(user, blob_id, namespace)
+        lock = self._locks[key]
+        yield lock.acquire()
+        try:
+            yield self._get_row(user, blob_id, namespace)
+            response = yield self._request('DELETE', key)
+            yield self._check_status(response)
+            yield self._index.mark_deleted(user, namespace, blob_id)
+        finally:
+            lock.release()
+
+    def get_blob_size(self, user, blob_id, namespace=''):
+        d = self._get_row(user, blob_id, namespace)
+        d.addCallback(lambda row: row['size'])
+        return d
+
+    def count(self, user, namespace=''):
+        try:
+            self._get_key(user, namespace=namespace)
+        except Exception as e:
+            return defer.fail(e)
+        return self._index.count(user, namespace)
+
+    def list_blobs(self, user, namespace='', order_by=None, deleted=False,
+                   filter_flag=False):
+        namespace = namespace or 'default'
+        try:
+            self._get_key(user, namespace=namespace)
+        except Exception as e:
+            return defer.fail(e)
+        if order_by not in [None, 'date', '+date', '-date']:
+            exc = Exception("Unsupported order_by parameter: %s" % order_by)
+            return defer.fail(exc)
+
+        def _filter(rows):
+            if filter_flag:
+                rows = [row for row in rows
+                        if filter_flag in json.loads(row['flags'])]
+            return [row['blob_id'] for row in rows]
+
+        d = self._index.list(user, namespace, bool(deleted), order_by)
+        d.addCallback(_filter)
+        return d
+
+    def list_deletions(self, user, namespace='', since=None):
+        namespace = namespace or 'default'
+        try:
+            self._get_key(user, namespace=namespace)
+        except Exception as e:
+            return defer.fail(e)
+        return self._index.list_deletions(user, namespace, since)
+
+    def expire_deletions(self, before):
+        return self._index.expire_deletions(before)
+
+    def get_total_storage(self, user):
+        d = self._index.usage(user)
+        d.addCallback(lambda used: used / 1024.0)
+        return d
+
+    def get_tag(self, user, blob_id, namespace=''):
+        d = self._get_row(user, blob_id, namespace)
+        d.addCallback(lambda row: row['tag'])
+        return d
+
+    def exists(self, user, blob_id, namespace):
+        namespace = namespace or 'default'
+        try:
+            self._get_key(user, blob_id, namespace)
+        except Exception as e:
+            return defer.fail(e)
+        d = self._index.get(user, namespace, blob_id)
+        d.addCallback(lambda row: row is not None)
+        return d
+
+    def _get_row(self, user, blob_id, namespace):
+        namespace = namespace or 'default'
+        try:
+            self._get_key(user, blob_id, namespace)
+        except Exception as e:
+            return defer.fail(e)
+
+        def _check(row):
+            if row is None:
+                raise BlobNotFound((user, blob_id))
+            return row
+
+        d = self._index.get(user, namespace, blob_id)
+        d.addCallback(_check)
+        return d
+
+    def _get_key(self, user, blob_id='', namespace=''):
+        for part in [user, blob_id, namespace]:
+            if part and not VALID_STRINGS.match(part):
+                raise Exception("Invalid characters on blob key: %s" % part)
+        if not user:
+            raise Exception("Invalid user: %s" % user)
+        return '/'.join([user, namespace or 'default', blob_id])
+
+    #
+    # object storage requests
+    #
+
+    def _request(self, method, key, query=None, headers=None, data=None):
+        path = '/%s/%s' % (self.bucket, quote(key))
+        query = query or []
+        headers = dict(headers or {})
+        payload_hash = hashlib.sha256(data).hexdigest() if data \
+            else EMPTY_SHA256
+        headers.update(self._signer.sign(
+            method, urlparse(self.url).netloc, path, query, payload_hash))
+        url = self.url + path
+        if query:
+            url += '?' + _canonical_query(query)
+        return treq.request(method, url, headers=headers, data=data,
+                            pool=self._pool)
+
+    def _check_found(self, response, user, blob_id):
+        if response.code == 404:
+            d = treq.content(response)
+            d.addCallback(lambda _: defer.fail(BlobNotFound((user, blob_id))))
+            return d
+        return self._check_status(response)
+
+    def _check_status(self, response):
+        if 200 <= response.code < 300:
+            return response
+        d = treq.content(response)
+
+        def _fail(body):
+            raise BackendError(
+                "Object storage replied with %d: %s" % (response.code, body))
+
+        d.addCallback(_fail)
+        return d
+
+    @defer.inlineCallbacks
+    def _put(self, key, data):
+        response = yield self._request('PUT', key, data=data)
+        yield self._check_status(response)
+        yield treq.content(response)
+
+    @defer.inlineCallbacks
+    def _create_multipart_upload(self, key):
+        response = yield self._request('POST', key, query=[('uploads', '')])
+        yield self._check_status(response)
+        body = yield treq.content(response)
+        defer.returnValue(_find_text(body, 'UploadId'))
+
+    @defer.inlineCallbacks
+    def _upload_part(self, key, upload_id, number, data):
+        query = [('partNumber', str(number)), ('uploadId', upload_id)]
+        response = yield self._request('PUT', key, query=query, data=data)
+        yield self._check_status(response)
+        yield treq.content(response)
+        defer.returnValue(response.headers.getRawHeaders('ETag')[0])
+
+    @defer.inlineCallbacks
+    def _complete_multipart_upload(self, key, upload_id, etags):
+        parts = ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>'
+            % (number, etag) for number, etag in enumerate(etags, 1))
+        data = ('<CompleteMultipartUpload>%s</CompleteMultipartUpload>'
+                % parts)
+        query = [('uploadId', upload_id)]
+        response = yield self._request('POST', key, query=query, data=data)
+        yield self._check_status(response)
+        body = yield treq.content(response)
+        # S3 may reply 200 with an error in the body
+        if '<Error>' in body:
+            raise BackendError("Could not complete upload: %s" % body)
+
+    @defer.inlineCallbacks
+    def _abort_multipart_upload(self, key, upload_id):
+        query = [('uploadId', upload_id)]
+        response = yield self._request('DELETE', key, query=query)
+        yield treq.content(response)
+
+
+class _UploadWriter(object):
+    """
+    A consumer that uploads what a producer writes, buffering at most one
+    part in memory. The producer is paused while a part is being uploaded.
+    """
+
+    def __init__(self, backend, key, producer):
+        self._backend = backend
+        self._key = key
+        self._producer = producer
+        self._buffer = []
+        self._buffered = 0
+        self._tail = ''
+        self._upload_id = None
+        self._etags = []
+        self._failure = None
+        self.size = 0
+
+    def upload(self):
+        """
+        Upload the contents of the producer.
+
+        :return: A deferred that fires with the size of the blob and its last
+            16 bytes.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = self._producer.startProducing(self)
+        d.addCallback(lambda _: self._finish())
+        d.addErrback(self._abort)
+        d.addCallback(lambda _: (self.size, self._tail))
+        return d
+
+    def write(self, data):
+        self.size += len(data)
+        self._tail = (self._tail + data)[-16:]
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._backend.part_size:
+            self._producer.pauseProducing()
+            d = self._flush()
+            d.addCallbacks(lambda _: self._producer.resumeProducing(),
+                           self._stop)
+
+    def _stop(self, failure):
+        self._failure = failure
+        self._producer.stopProducing()
+
+    @defer.inlineCallbacks
+    def _flush(self):
+        data = ''.join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        if self._upload_id is None:
+            self._upload_id = yield self._backend._create_multipart_upload(
+                self._key)
+        number = len(self._etags) + 1
+        etag = yield self._backend._upload_part(
+            self._key, self._upload_id, number, data)
+        self._etags.append(etag)
+
+    @defer.inlineCallbacks
+    def _finish(self):
+        if self._upload_id is None:
+            yield self._backend._put(self._key, ''.join(self._buffer))
+            return
+        if self._buffer:
+            yield self._flush()
+        yield self._backend._complete_multipart_upload(
+            self._key, self._upload_id, self._etags)
+
+    @defer.inlineCallbacks
+    def _abort(self, failure):
+        if self._upload_id is not None:
+            yield self._backend._abort_multipart_upload(
+                self._key, self._upload_id)
+        (self._failure or failure).raiseException()
+
+
+class _BodyDeliverer(protocol.Protocol):
+    """
+    Deliver the body of a response to a consumer, pausing the transfer when
+    the consumer can't keep up.
+    """
+
+    def __init__(self, consumer, finished):
+        self._consumer = consumer
+        self._finished = finished
+
+    def connectionMade(self):
+        self._consumer.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        self._consumer.write(data)
+
+    def connectionLost(self, reason):
+        self._consumer.unregisterProducer()
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._finished.callback(None)
+        else:
+            self._finished.errback(reason)
+
+
+def _deliver(response, consumer):
+    finished = defer.Deferred()
+    response.deliverBody(_BodyDeliverer(consumer, finished))
+    return finished
+
+
+def _find_text(body, tag):
+    for element in ElementTree.fromstring(body).iter():
+        if element.tag.split('}')[-1] == tag:
+            return element.text
+    raise BackendError("No %s in object storage reply: %s" % (tag, body))
+
+
+def _canonical_query(query):
+    return '&'.join(
+        '%s=%s' % (quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+        for k, v in sorted(query))
+
+
+class _Signer(object):
+    """
+    Sign requests using AWS Signature Version 4.
+    """
+
+    def __init__(self, access_key, secret_key, region):
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._region = region
+
+    def sign(self, method, host, path, query, payload_hash):
+        """
+        Get the headers that authenticate a request.
+
+        :return: A dictionary of headers to be added to the request.
+        :rtype: dict
+        """
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        datestamp = amz_date[:8]
+        headers = {
+            'host': host,
+            'x-amz-content-sha256': payload_hash,
+            'x-amz-date': amz_date,
+        }
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method,
+            path,
+            _canonical_query(query),
+            ''.join('%s:%s\n' % (k, headers[k]) for k in sorted(headers)),
+            signed_headers,
+            payload_hash])
+        scope = '%s/%s/s3/aws4_request' % (datestamp, self._region)
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request).hexdigest()])
+        key = 'AWS4' + self._secret_key
+        for message in [datestamp, self._region, 's3', 'aws4_request']:
+            key = hmac.new(key, message, hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+            'Signature=%s' % (self._access_key, scope, signed_headers,
+                              signature))
+        del headers['host']
+        return headers
+
+
+def _use_bytestrings(connection):
+    connection.text_factory = str
+
+
+class _MetadataIndex(object):
+    """
+    An index of blobs metadata stored in a SQLite database. Only one server
+    host may use it at a time.
+    """
+
+    def __init__(self, path):
+        self._dbpool = adbapi.ConnectionPool(
+            'sqlite3', path, check_same_thread=False, cp_min=1, cp_max=1,
+            cp_openfun=_use_bytestrings)
+        self._dbpool.runOperation(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            'user TEXT, namespace TEXT, blob_id TEXT, size INT, tag TEXT, '
+            'flags TEXT, deleted INT, mtime REAL, '
+            'PRIMARY KEY (user, namespace, blob_id))')
+
+    def close(self):
+        self._dbpool.close()
+
+    def get(self, user, namespace, blob_id):
+        query = ('SELECT size, tag, flags FROM blobs '
+                 'WHERE user = ? AND namespace = ? AND blob_id = ? '
+                 'AND NOT deleted')
+        d = self._dbpool.runQuery(query, (user, namespace, blob_id))
+        d.addCallback(
+            lambda rows: dict(zip(['size', 'tag', 'flags'], rows[0]))
+            if rows else None)
+        return d
+
+    def add(self, user, namespace, blob_id, size, tag):
+        query = ('INSERT OR REPLACE INTO blobs VALUES '
+                 '(?, ?, ?, ?, ?, ?, 0, ?)')
+        values = (user, namespace, blob_id, size, tag, '[]', time.time())
+        return self._dbpool.runOperation(query, values)
+
+    def set_flags(self, user, namespace, blob_id, flags):
+        query = ('UPDATE blobs SET flags = ? '
+                 'WHERE user = ? AND namespace = ? AND blob_id = ?')
+        return self._dbpool.runOperation(
+            query, (flags, user, namespace, blob_id))
+
+    def mark_deleted(self, user, namespace, blob_id):
+        query = ('UPDATE blobs SET deleted = 1, flags = ?, mtime = ? '
+                 'WHERE user = ? AND namespace = ? AND blob_id = ?')
+        values = ('[]', time.time(), user, namespace, blob_id)
+        return self._dbpool.runOperation(query, values)
+
+    def count(self, user, namespace):
+        query = 'SELECT COUNT(*) FROM blobs WHERE user = ? AND NOT deleted'
+        values = (user,)
+        if namespace:
+            query += ' AND namespace = ?'
+            values += (namespace,)
+        d = self._dbpool.runQuery(query, values)
+        d.addCallback(lambda rows: rows[0][0])
+        return d
+
+    def list(self, user, namespace, deleted, order_by):
+        query = ('SELECT blob_id, flags FROM blobs '
+                 'WHERE user = ? AND namespace = ? AND deleted = ?')
+        if order_by in ['date', '+date']:
+            query += ' ORDER BY mtime ASC'
+        elif order_by == '-date':
+            query += ' ORDER BY mtime DESC'
+        d = self._dbpool.runQuery(query, (user, namespace, int(deleted)))
+        d.addCallback(lambda rows: [
+            {'blob_id': blob_id, 'flags': flags} for blob_id, flags in rows])
+        return d
+
+    def list_deletions(self, user, namespace, since):
+        query = ('SELECT blob_id, mtime FROM blobs '
+                 'WHERE user = ? AND namespace = ? AND deleted')
+        values = (user, namespace)
+        if since is not None:
+            query += ' AND mtime >= ?'
+            values += (since,)
+        d = self._dbpool.runQuery(query, values)
+        d.addCallback(lambda rows: [tuple(row) for row in rows])
+        return d
+
+    def expire_deletions(self, before):
+
+        def _expire(cursor):
+            cursor.execute(
+                'DELETE FROM blobs WHERE deleted AND mtime < ?', (before,))
+            return cursor.rowcount
+
+        return self._dbpool.runInteraction(_expire)
+
+    def usage(self, user):
+        query = ('SELECT COALESCE(SUM(size), 0) FROM blobs '
+                 'WHERE user = ? AND NOT deleted')
+        d = self._dbpool.runQuery(query, (user,))
+        d.addCallback(lambda rows: rows[0][0])
+        return d
@@ -19,7 +19,9 @@ Get handlers that implement IBlobsBackend given a backend name.
 """
 
 from .errors import ImproperlyConfiguredException
+from .volumes import parse_volumes
 from .fs_backend import FilesystemBlobsBackend
+from .s3_backend import S3BlobsBackend
 
 
 class BlobsServerState(object):
@@ -27,7 +29,10 @@ class BlobsServerState(object):
     Given a backend name, it gives a instance of IBlobsBackend
     """
     # Allowed backend classes are defined here
-    handlers = {"filesystem": FilesystemBlobsBackend}
+    handlers = {
+        "filesystem": FilesystemBlobsBackend,
+        "s3": S3BlobsBackend,
+    }
 
     def __init__(self, backend, **backend_kwargs):
         if backend not in self.handlers:
@@ -41,3 +46,33 @@ class BlobsServerState(object):
         """
         # TODO: deprecate/refactor it as it's here for compatibility.
         return self.backend
+
+
+def get_backend_kwargs(conf):
+    """
+    Get the arguments for instantiating the blobs backend chosen in the server
+    configuration, except for ``blobs_path``.
+
+    :param conf: The ``soledad-server`` section of the server configuration.
+    :type conf: dict
+
+    :return: A dictionary of keyword arguments for the backend.
+    :rtype: dict
+    """
+    backend = conf['blobs_backend']
+    if backend == 'filesystem':
+        return {
+            'volumes': parse_volumes(conf['blobs_volumes']) or None,
+            'io_threads': int(conf['blobs_io_threads']),
+            'durability': conf['blobs_durability'],
+        }
+    if backend == 's3':
+        return {
+            'url': conf['blobs_s3_url'],
+            'bucket': conf['blobs_s3_bucket'],
+            'access_key': conf['blobs_s3_access_key'],
+            'secret_key': conf['blobs_s3_secret_key'],
+            'region': conf['blobs_s3_region'],
+            'index_path': conf['blobs_s3_index_path'],
+        }
+    return {}
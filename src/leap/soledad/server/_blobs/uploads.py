@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# _blobs/uploads.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Sessions for uploading blobs in chunks.
+
+The chunks of a blob are appended to a file in a staging area until the
+upload is finalized, when the whole blob is handed to the storage backend.
+An interrupted upload can then be resumed from the last committed offset.
+"""
+import json
+import os
+import shutil
+
+from collections import defaultdict
+from uuid import uuid4
+
+from twisted.internet import defer
+from twisted.internet import threads
+
+from leap.common.files import mkdir_p
+
+from .errors import UploadNotFound
+from .errors import InvalidOffset
+from .errors import QuotaExceeded
+from .util import VALID_STRINGS
+
+
+class UploadSessions(object):
+    """
+    The upload sessions of all users, stored in the filesystem.
+    """
+
+    def __init__(self, path, io=None):
+        """
+        :param path: The path of the staging area.
+        :type path: str
+        :param io: A function that runs a blocking function in a threadpool
+            and returns a deferred, by default ``threads.deferToThread``.
+        :type io: callable
+        """
+        self.path = path
+        self._io = io or threads.deferToThread
+        self._locks = {}
+        self._user_locks = defaultdict(defer.DeferredLock)
+
+    def _get_path(self, user, upload_id):
+        if not VALID_STRINGS.match(upload_id):
+            raise UploadNotFound(upload_id)
+        return os.path.join(self.path, user, upload_id)
+
+    @defer.inlineCallbacks
+    def _run(self, upload_id, f, *args):
+        # operations on a session run one at a time, in the order they were
+        # called.
+        lock = self._locks.get(upload_id)
+        if lock is None:
+            lock = self._locks[upload_id] = defer.DeferredLock()
+        yield lock.acquire()
+        try:
+            result = yield f(*args)
+        finally:
+            lock.release()
+            if not lock.locked:
+                del self._locks[upload_id]
+        defer.returnValue(result)
+
+    def start(self, user, blob_id, namespace, length, available=None):
+        """
+        Start a new upload session.
+
+        :param user: The user uploading the blob.
+        :type user: str
+        :param blob_id: The id of the blob being uploaded.
+        :type blob_id: str
+        :param namespace: The namespace of the blob.
+        :type namespace: str
+        :param length: The total size of the blob.
+        :type length: int
+        :param available: The number of bytes the user can still store, if
+            limited. The lengths of the user's sessions count towards it.
+        :type available: int
+
+        :return: A deferred that fires with the id of the session, or fails
+            with QuotaExceeded if the session doesn't fit what is available.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        upload_id = uuid4().hex
+        meta = {'blob_id': blob_id, 'namespace': namespace, 'length': length}
+        path = self._get_path(user, upload_id)
+
+        @defer.inlineCallbacks
+        def _start_session():
+            # sessions of a user are started one at a time, so all of them
+            # are taken into account when checking the space available.
+            if available is not None:
+                staged = yield self._io(_staged, os.path.dirname(path))
+                if staged + length > available:
+                    raise QuotaExceeded
+            yield self._io(_start, path, meta)
+            defer.returnValue(upload_id)
+
+        return self._user_locks[user].run(_start_session)
+
+    def get_offset(self, user, blob_id, namespace, upload_id):
+        """
+        Get the number of bytes committed to an upload session.
+
+        :return: A deferred that fires with the offset, or fails with
+            UploadNotFound if there is no such session for that blob.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        try:
+            path = self._get_path(user, upload_id)
+        except UploadNotFound as e:
+            return defer.fail(e)
+        d = self._io(_load, path, blob_id, namespace)
+        d.addCallback(lambda result: result[1])
+        return d
+
+    def append(self, user, blob_id, namespace, upload_id, offset, content):
+        """
+        Append a chunk of data to an upload session.
+
+        :param offset: The position of the chunk in the blob, which must be
+            the number of bytes committed so far.
+        :type offset: int
+        :param content: A file-like object with the data of the chunk.
+        :type content: file
+
+        :return: A deferred that fires with the new offset, or fails with
+            InvalidOffset if the chunk is not where the upload stopped.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        try:
+            path = self._get_path(user, upload_id)
+        except UploadNotFound as e:
+            return defer.fail(e)
+        return self._run(
+            upload_id, self._io,
+            _append, path, blob_id, namespace, offset, content)
+
+    def finalize(self, user, blob_id, namespace, upload_id, write):
+        """
+        Hand the complete blob to a function that stores it, and remove the
+        session once it is stored.
+
+        :param write: A function that receives an open file with the blob and
+            returns a deferred that fires when it has been stored.
+        :type write: callable
+
+        :return: A deferred that fires with the result of ``write``.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        try:
+            path = self._get_path(user, upload_id)
+        except UploadNotFound as e:
+            return defer.fail(e)
+
+        @defer.inlineCallbacks
+        def _finalize():
+            meta, offset = yield self._io(_load, path, blob_id, namespace)
+            if offset != meta['length']:
+                raise InvalidOffset(offset)
+            fd = yield self._io(open, path, 'rb')
+            try:
+                result = yield write(fd)
+            finally:
+                yield self._io(fd.close)
+            yield self._io(_remove, path)
+            defer.returnValue(result)
+
+        return self._run(upload_id, _finalize)
+
+    def remove(self, user, upload_id):
+        """
+        Discard an upload session.
+
+        :return: A deferred that fires when the session has been removed.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        try:
+            path = self._get_path(user, upload_id)
+        except UploadNotFound as e:
+            return defer.fail(e)
+        return self._run(upload_id, self._io, _remove, path)
+
+    def expire(self, before):
+        """
+        Discard sessions that had no data appended since some time.
+
+        :param before: A timestamp.
+        :type before: float
+
+        :return: A deferred that fires with the number of expired sessions.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._io(_expire, self.path, before)
+
+
+def _start(path, meta):
+    mkdir_p(os.path.dirname(path))
+    open(path, 'wb').close()
+    with open(path + '.json', 'w') as f:
+        f.write(json.dumps(meta))
+
+
+def _load(path, blob_id, namespace):
+    if not os.path.isfile(path + '.json'):
+        raise UploadNotFound(path)
+    with open(path + '.json') as f:
+        meta = json.loads(f.read())
+    if (meta['blob_id'], meta['namespace']) != (blob_id, namespace):
+        raise UploadNotFound(path)
+    return meta, os.path.getsize(path)
+
+
+def _append(path, blob_id, namespace, offset, content):
+    meta, size = _load(path, blob_id, namespace)
+    if offset != size:
+        raise InvalidOffset(size)
+    content.seek(0, os.SEEK_END)
+    length = content.tell()
+    content.seek(0)
+    if size + length > meta['length']:
+        raise ValueError('Chunk exceeds the length of the blob')
+    with open(path, 'ab') as f:
+        shutil.copyfileobj(content, f)
+    return size + length
+
+
+def _staged(path):
+    # the total length of the sessions in a user's staging directory
+    if not os.path.isdir(path):
+        return 0
+    total = 0
+    for name in os.listdir(path):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, name)) as f:
+                total += json.loads(f.read())['length'] or 0
+        except (IOError, OSError):
+            # the session was finalized meanwhile
+            continue
+    return total
+
+
+def _remove(path):
+    for name in [path + '.json', path]:
+        if os.path.isfile(name):
+            os.unlink(name)
+
+
+def _expire(path, before):
+    if not os.path.isdir(path):
+        return 0
+    count = 0
+    for user in os.listdir(path):
+        user_path = os.path.join(path, user)
+        for name in os.listdir(user_path):
+            if not name.endswith('.json'):
+                continue
+            upload_path = os.path.join(user_path, name[:-len('.json')])
+            try:
+                if os.path.getmtime(upload_path) < before:
+                    _remove(upload_path)
+                    count += 1
+            except OSError:
+                # the session was finalized meanwhile
+                continue
+    return count
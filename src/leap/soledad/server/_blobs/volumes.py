@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# _blobs/volumes.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Placement of users' blobs across many filesystem volumes.
+
+Users are assigned to volumes using consistent hashing, so adding a new volume
+only moves the data of the users that are now placed in that volume.
+"""
+import bisect
+import hashlib
+import os
+import shutil
+
+from collections import defaultdict
+
+from twisted.internet import defer
+
+from .errors import ImproperlyConfiguredException
+
+
+class Volume(object):
+    """
+    A filesystem volume where blobs can be stored, along with its I/O
+    counters.
+    """
+
+    def __init__(self, path, weight=1):
+        if weight < 1:
+            raise ImproperlyConfiguredException(
+                "Invalid weight for volume %s: %s" % (path, weight))
+        self.path = path
+        self.weight = int(weight)
+        self.reads = 0
+        self.writes = 0
+        self.deletes = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def stats(self):
+        """
+        Return I/O counters and capacity of this volume.
+
+        :return: A dictionary with the volume stats.
+        :rtype: dict
+        """
+        stats = {
+            'path': self.path,
+            'weight': self.weight,
+            'reads': self.reads,
+            'writes': self.writes,
+            'deletes': self.deletes,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+        try:
+            vfs = os.statvfs(self.path)
+            stats['capacity'] = vfs.f_blocks * vfs.f_frsize
+            stats['available'] = vfs.f_bavail * vfs.f_frsize
+        except OSError:
+            stats['capacity'] = stats['available'] = None
+        return stats
+
+
+class HashRing(object):
+    """
+    A consistent hashing ring that maps keys to weighted volumes.
+    """
+
+    replicas = 128  # number of points in the ring per unit of weight
+
+    def __init__(self, volumes):
+        self._points = []
+        self._volumes = {}
+        for volume in volumes:
+            for i in xrange(volume.weight * self.replicas):
+                point = _hash('%s-%d' % (volume.path, i))
+                self._points.append((point, volume.path))
+            self._volumes[volume.path] = volume
+        self._points.sort()
+        self._keys = [point for point, _ in self._points]
+
+    def get(self, key):
+        """
+        Get the volume in which a key should be placed.
+
+        :param key: The key to be placed (usually a user id).
+        :type key: str
+
+        :return: The volume where the key belongs.
+        :rtype: Volume
+        """
+        idx = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._volumes[self._points[idx][1]]
+
+
+class RelocationGate(object):
+    """
+    Allow concurrent operations on a user's data, unless that data is being
+    relocated between volumes. While a gate is closed for a user, new
+    operations wait for it to be reopened and the relocation waits for ongoing
+    operations to finish.
+    """
+
+    def __init__(self):
+        self._active = defaultdict(int)
+        self._waiting = {}
+        self._draining = {}
+
+    def run(self, user, f, *args, **kwargs):
+        """
+        Run an operation over a user's data once the gate is open.
+
+        :return: A deferred that fires with the result of the operation.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if user in self._waiting:
+            d = defer.Deferred()
+            self._waiting[user].append(d)
+            d.addCallback(lambda _: self.run(user, f, *args, **kwargs))
+            return d
+        self._active[user] += 1
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._leave, user)
+        return d
+
+    def _leave(self, result, user):
+        self._active[user] -= 1
+        if not self._active[user]:
+            del self._active[user]
+            if user in self._draining:
+                self._draining.pop(user).callback(None)
+        return result
+
+    def close(self, user):
+        """
+        Close the gate for a user.
+
+        :return: A deferred that fires when all ongoing operations over the
+                 user's data have finished.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        self._waiting[user] = []
+        if not self._active.get(user):
+            return defer.succeed(None)
+        d = self._draining[user] = defer.Deferred()
+        return d
+
+    def open(self, user):
+        """
+        Reopen the gate for a user, releasing waiting operations.
+        """
+        for d in self._waiting.pop(user, []):
+            d.callback(None)
+
+
+def parse_volumes(values):
+    """
+    Parse a list of volumes from configuration, in the form ``path:weight``.
+    The weight is optional and defaults to 1.
+
+    :param values: A list of volume descriptions.
+    :type values: list of str
+
+    :return: A list of (path, weight) tuples.
+    :rtype: list
+    """
+    volumes = []
+    for value in values:
+        if not value:
+            continue
+        path, _, weight = value.partition(':')
+        try:
+            volumes.append((path, int(weight or 1)))
+        except ValueError:
+            raise ImproperlyConfiguredException(
+                "Invalid volume description: %s" % value)
+    return volumes
+
+
+def sync_tree(src, dst):
+    """
+    Make the contents of directory ``dst`` equal to the contents of directory
+    ``src``, copying only files that are missing or that have changed. Lock
+    files are not copied.
+
+    This function does blocking I/O and should be called from a thread.
+
+    :param src: The source directory.
+    :type src: str
+    :param dst: The destination directory.
+    :type dst: str
+    """
+    seen = set()
+    for root, _, filenames in os.walk(src):
+        relative = os.path.relpath(root, src)
+        target = os.path.normpath(os.path.join(dst, relative))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in filenames:
+            if name.endswith('.lock'):
+                continue
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(target, name)
+            seen.add(dst_path)
+            if os.path.isfile(dst_path):
+                src_stat, dst_stat = os.stat(src_path), os.stat(dst_path)
+                if src_stat.st_size == dst_stat.st_size and \
+                        src_stat.st_mtime == dst_stat.st_mtime:
+                    continue
+            shutil.copy2(src_path, dst_path)
+    # remove files that are not in the source anymore
+    for root, _, filenames in os.walk(dst):
+        for name in filenames:
+            path = os.path.join(root, name)
+            if path not in seen:
+                os.unlink(path)
+
+
+def _hash(key):
+    return long(hashlib.md5(key).hexdigest()[:16], 16)
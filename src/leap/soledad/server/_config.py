@@ -36,6 +36,17 @@ CONFIG_DEFAULTS = {
         'batching': True,
         'blobs': False,
         'blobs_path': '/var/lib/soledad/blobs',
+        'blobs_volumes': [],
+        'blobs_io_threads': 10,
+        'blobs_durability': 'none',
+        'blobs_deletions_ttl': 30,
+        'blobs_backend': 'filesystem',
+        'blobs_s3_url': None,
+        'blobs_s3_bucket': None,
+        'blobs_s3_access_key': None,
+        'blobs_s3_secret_key': None,
+        'blobs_s3_region': 'us-east-1',
+        'blobs_s3_index_path': None,
         'services_tokens_file': '/etc/soledad/services.tokens',
         'concurrent_blob_writes': 50,
     },
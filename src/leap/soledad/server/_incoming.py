@@ -18,8 +18,11 @@
 A twisted resource that saves externally delivered documents into user's db.
 """
 import base64
+import json
 
+from collections import OrderedDict
 from io import BytesIO
+from twisted.internet import defer
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web.client import FileBodyProducer
@@ -37,6 +40,7 @@ from leap.soledad.server._config import get_config
 from leap.soledad.server._blobs import BlobsServerState
 from leap.soledad.server._blobs import BlobExists
 from leap.soledad.server._blobs import QuotaExceeded
+from leap.soledad.server._blobs.state import get_backend_kwargs
 
 
 __all__ = ['IncomingResource']
@@ -48,7 +52,9 @@ logger = getLogger(__name__)
 def _get_backend_from_config():
     conf = get_config()
     if conf['blobs']:
-        return BlobsServerState("filesystem", blobs_path=conf['blobs_path'])
+        return BlobsServerState(conf['blobs_backend'],
+                                blobs_path=conf['blobs_path'],
+                                **get_backend_kwargs(conf))
     return CouchServerState(conf['couch_url'])
 
 
@@ -59,6 +65,9 @@ def uses_legacy(db):
 class IncomingResource(Resource):
     isLeaf = True
 
+    # Maximum number of messages in a single bulk delivery
+    max_bulk_items = 1000
+
     def __init__(self, backend_factory=None):
         self.factory = backend_factory or _get_backend_from_config()
         self.formatter = IncomingFormatter()
@@ -85,8 +94,6 @@ class IncomingResource(Resource):
 
     def _put_incoming(self, user, blob_id, scheme, db, request):
         raw_content = request.content.read()
-        preamble = self.formatter.preamble(raw_content, blob_id)
-        request.content = BytesIO(preamble + ' ' + raw_content)
 
         def catchBlobExists(failure):
             failure.trap(BlobExists)
@@ -101,15 +108,105 @@ class IncomingResource(Resource):
             request.write('Quota Exceeded!')
             request.finish()
 
-        producer = FileBodyProducer(request.content)
+        d = self._write_incoming(user, blob_id, db, raw_content)
+        d.addCallback(lambda _: request.finish())
+        d.addErrback(catchBlobExists)
+        d.addErrback(catchQuotaExceeded)
+        d.addErrback(self._error, request)
+
+    def _write_incoming(self, user, blob_id, db, raw_content):
+        preamble = self.formatter.preamble(raw_content, blob_id)
+        producer = FileBodyProducer(BytesIO(preamble + ' ' + raw_content))
         d = db.write_blob(user, blob_id, producer, namespace='MX')
         flags = [Flags.PENDING]
         d.addCallback(lambda _: db.set_flags(user, blob_id, flags,
                                              namespace='MX'))
-        d.addCallback(lambda _: request.finish())
-        d.addErrback(catchBlobExists)
-        d.addErrback(catchQuotaExceeded)
+        return d
+
+    def render_POST(self, request):
+        """
+        Deliver many messages, possibly to many users, in a single request.
+
+        The body is a sequence of records, each one being a JSON list like
+        ``[user, blob_id, scheme, size]`` in its own line, followed by
+        ``size`` bytes with the message. If ``scheme`` is null, the message is
+        taken as encrypted with the public key of the user. The response is a
+        JSON list of ``[user, blob_id, status]`` lists, one for each record
+        and in the same order, where status is the HTTP status code that the
+        delivery would have if it was done in its own request.
+        """
+        try:
+            records = _parse_records(request.content, self.max_bulk_items)
+        except _TooManyRecords:
+            logger.error("Error 413: Too many messages in bulk delivery")
+            request.setResponseCode(413)
+            return 'Too many messages, the limit is %d' % self.max_bulk_items
+        except Exception as e:
+            logger.error("Error 400: Invalid bulk delivery: %r" % e)
+            request.setResponseCode(400)
+            return 'Invalid bulk delivery'
+
+        # messages are grouped by user, so the database of each user is
+        # opened only once.
+        by_user = OrderedDict()
+        for i, (user, blob_id, scheme, content) in enumerate(records):
+            by_user.setdefault(user, []).append((i, blob_id, scheme, content))
+        statuses = [None] * len(records)
+
+        def _deliver(user, items):
+            try:
+                db = self.factory.open_database(user)
+            except Exception as e:
+                logger.error('Error opening database of %s: %r' % (user, e))
+                for i, _, _, _ in items:
+                    statuses[i] = 500
+                return defer.succeed(None)
+            if uses_legacy(db):
+                return self._deliver_legacy(db, items, statuses)
+            return self._deliver_incoming(user, db, items, statuses)
+
+        def _respond(_):
+            body = json.dumps([[user, blob_id, status] for
+                               (user, blob_id, _, _), status
+                               in zip(records, statuses)])
+            request.setHeader('content-type', 'application/json')
+            request.setHeader('content-length', str(len(body)))
+            request.write(body)
+            request.finish()
+
+        d = defer.gatherResults(
+            [_deliver(user, items) for user, items in by_user.items()],
+            consumeErrors=True)
+        d.addCallback(_respond)
         d.addErrback(self._error, request)
+        return NOT_DONE_YET
+
+    def _deliver_legacy(self, db, items, statuses):
+        for i, doc_id, scheme, content in items:
+            try:
+                doc = ServerDocument(doc_id)
+                doc.content = self.formatter.format(content, scheme)
+                db.put_doc(doc)
+                statuses[i] = 200
+            except Exception as e:
+                logger.error('Error delivering %s: %r' % (doc_id, e))
+                statuses[i] = 500
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def _deliver_incoming(self, user, db, items, statuses):
+        for i, blob_id, _, content in items:
+            try:
+                yield self._write_incoming(user, blob_id, db, content)
+                statuses[i] = 200
+            except BlobExists:
+                statuses[i] = 409
+            except QuotaExceeded:
+                logger.error("Error 507: Quota exceeded for user: %s" % user)
+                statuses[i] = 507
+            except Exception as e:
+                logger.error('Error delivering %s: %r' % (blob_id, e))
+                statuses[i] = 500
 
     def _finish(self, request):
         request.write('{"success": true}')
@@ -122,6 +219,34 @@ class IncomingResource(Resource):
         request.finish()
 
 
+class _TooManyRecords(Exception):
+    pass
+
+
+def _parse_records(content, limit):
+    """
+    Parse the records of a bulk delivery.
+
+    :return: A list of (user, blob_id, scheme, content) tuples.
+    :rtype: list
+    """
+    records = []
+    for line in iter(content.readline, ''):
+        if not line.strip():
+            continue
+        if len(records) == limit:
+            raise _TooManyRecords()
+        user, blob_id, scheme, size = json.loads(line)
+        if not isinstance(size, int) or size < 0:
+            raise ValueError('Invalid size: %r' % size)
+        data = content.read(size)
+        if len(data) != size:
+            raise ValueError('Truncated message: %s' % blob_id)
+        scheme = scheme or EncryptionSchemes.PUBKEY
+        records.append((str(user), str(blob_id), scheme, data))
+    return records
+
+
 class IncomingFormatter(object):
     """
     Formats an incoming document. Today as it was by leap_mx and as expected by
@@ -19,21 +19,21 @@ A twisted resource that serves download as a single stream of multiple blobs.
 -> POST .../uuid/ DATA: [blob_id, blob_id2, ..., blob_idn]
 <- [(size(blob_id), content(blob_id)) for blob_id in DATA] (as a binary stream)
 """
-import os
 import json
-import base64
 
-from zope.interface import implementer
-from twisted.internet.interfaces import IPushProducer
-from twisted.internet import task, defer, threads
+from twisted.internet import defer
+from twisted.web.client import FileBodyProducer
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.resource import Resource
 
-from leap.common.files import mkdir_p
 from leap.soledad.common.log import getLogger
 from . import interfaces
 from ._blobs import FilesystemBlobsBackend
+from ._blobs import S3BlobsBackend
+from ._blobs import BlobExists
+from ._blobs import QuotaExceeded
 from ._blobs import ImproperlyConfiguredException
+from ._blobs.resource import _PartConsumer
 
 
 __all__ = ['StreamingResource']
@@ -46,15 +46,22 @@ class StreamingResource(Resource):
     isLeaf = True
 
     # Allowed backend classes are defined here
-    handlers = {"filesystem": FilesystemBlobsBackend}
+    handlers = {
+        "filesystem": FilesystemBlobsBackend,
+        "s3": S3BlobsBackend,
+    }
 
     def __init__(self, backend, blobs_path, **backend_kwargs):
         Resource.__init__(self)
         self._blobs_path = blobs_path
-        backend_kwargs.update({'blobs_path': blobs_path})
-        if backend not in self.handlers:
-            raise ImproperlyConfiguredException("No such backend: %s", backend)
-        self._handler = self.handlers[backend](**backend_kwargs)
+        if interfaces.IBlobsBackend.providedBy(backend):
+            self._handler = backend
+        else:
+            backend_kwargs.update({'blobs_path': blobs_path})
+            if backend not in self.handlers:
+                raise ImproperlyConfiguredException(
+                    "No such backend: %s", backend)
+            self._handler = self.handlers[backend](**backend_kwargs)
         assert interfaces.IBlobsBackend.providedBy(self._handler)
 
     def render_POST(self, request):
@@ -75,91 +82,83 @@ class StreamingResource(Resource):
         # TODO: at this point, Twisted wrote the request to a temporary file,
         # so it's a disk->disk operation. This has to be improved if benchmark
         # shows its worth.
-        args = (user, namespace, request)
-        d = threads.deferToThread(self._consume_stream, *args)
+        d = self._write_stream(user, namespace, request)
         d.addCallback(lambda _: request.finish())
-
+        d.addErrback(_abort_stream, request)
         return NOT_DONE_YET
 
-    def _consume_stream(self, user, namespace, request):
-        chunk_size = 2**14
+    @defer.inlineCallbacks
+    def _write_stream(self, user, namespace, request):
+        # blobs are written one at a time through the backend interface, so
+        # they are checked, isolated and made durable as single uploads are.
         content = request.content
         incoming_list = json.loads(content.readline())
         for (blob_id, size) in incoming_list:
-            db = self._handler
-            # TODO: NEEDS SANITIZING
-            path = db._get_path(user, blob_id, namespace)
+            reader = _BoundedReader(content, size)
+            producer = FileBodyProducer(reader)
+            producer.length = size
             try:
-                mkdir_p(os.path.split(path)[0])
-            except OSError as e:
-                logger.warn("Got exception trying to create directory: %r" % e)
-            with open(path, 'wb') as blob_fd:
-                consumed = 0
-                while consumed < size:
-                    read_size = min(size - consumed, chunk_size)
-                    data = content.read(read_size)
-                    consumed += read_size
-                    blob_fd.write(data)
+                yield self._handler.write_blob(
+                    user, blob_id, producer, namespace)
+            except BlobExists:
+                logger.warn("Skipping existing blob: %s - %s"
+                            % (user, blob_id))
+                reader.skip()
 
     def _startDownstream(self, user, namespace, request):
         raw_content = request.content.read()
         blob_ids = json.loads(raw_content)
-        deferreds = []
+        d = self._read_stream(user, namespace, blob_ids, request)
+        d.addErrback(_abort_stream, request)
+        return NOT_DONE_YET
+
+    @defer.inlineCallbacks
+    def _read_stream(self, user, namespace, blob_ids, request):
+        # blobs are read one at a time through the backend interface, so
+        # they are isolated from writes and relocations, and their files are
+        # handled as single downloads are.
         db = self._handler
+        infos = []
         for blob_id in blob_ids:
-
-            def _get_blob_info(blob_id, path):
-                d = db.get_blob_size(user, blob_id, namespace)
-                d.addCallback(lambda size: (blob_id, path, size))
-                return d
-
-            path = db._get_path(user, blob_id, namespace)
-            d = _get_blob_info(blob_id, path)
-            deferreds.append(d)
-        d = defer.gatherResults(deferreds)
-        d.addCallback(
-            lambda paths: DownstreamProducer(request, paths).start())
-        return NOT_DONE_YET
+            size = yield db.get_blob_size(user, blob_id, namespace)
+            tag = yield db.get_tag(user, blob_id, namespace)
+            infos.append((blob_id, size, tag))
+        # the consumer passed to the backend can't finish the request, as
+        # more blobs may follow.
+        consumer = _PartConsumer(request)
+        for blob_id, size, tag in infos:
+            request.write('%08x' % size)  # sends file size
+            request.write(tag)  # sends AES-GCM tag
+            request.write(' ')
+            yield db.read_blob(user, blob_id, consumer, namespace)
+        request.finish()
 
 
-@implementer(IPushProducer)
-class DownstreamProducer(object):
-    chunk_size = 2**14
+def _abort_stream(failure, request):
+    logger.error('Error streaming blobs: %r' % failure.value)
+    if not request.startedWriting:
+        request.setResponseCode(
+            507 if failure.check(QuotaExceeded) else 500)
+    request.finish()
 
-    def __init__(self, request, paths):
-        self.request = request
-        self.paths = paths
 
-    def start(self):
-        iterator = self._gen_data()
-        self.task = task.cooperate(iterator)
-        self.request.registerProducer(self, streaming=True)
+class _BoundedReader(object):
+    """
+    A file-like object that reads at most ``size`` bytes from another one.
+    """
 
-    def resumeProducing(self):
-        return self.task.resume()
+    def __init__(self, fd, size):
+        self._fd = fd
+        self._left = size
 
-    def pauseProducing(self):
-        return self.task.pause()
+    def read(self, size):
+        data = self._fd.read(min(size, self._left))
+        self._left -= len(data)
+        return data
 
-    def _gen_data(self):
-        request, paths = self.request, self.paths
-        while paths:
-            blob_id, path, size = paths.pop(0)
-            request.write('%08x' % size)  # sends file size
-            with open(path, 'rb') as blob_fd:
-                blob_fd.seek(-16, 2)
-                encoded_tag = base64.urlsafe_b64encode(blob_fd.read())
-                request.write(encoded_tag)  # sends AES-GCM tag
-                blob_fd.seek(0)
-                request.write(' ')
-                data = blob_fd.read(self.chunk_size)
-                while data:
-                    yield
-                    request.write(data)
-                    data = blob_fd.read(self.chunk_size)
-        request.unregisterProducer()
-        request.finish()
+    def skip(self):
+        while self.read(2**14):
+            pass
 
-    def stopProducing(self):
-        self.request = None
-        return self.task.stop()
+    def close(self):
+        pass
@@ -33,6 +33,8 @@ from twisted.cred.credentials import UsernamePassword
 from twisted.cred.portal import IRealm
 from twisted.cred.portal import Portal
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
 from twisted.web.iweb import ICredentialFactory
 from twisted.web.resource import IResource
 
@@ -42,6 +44,8 @@ from leap.soledad.common.log import getLogger
 from ._resource import PublicResource, AnonymousResource
 from ._resource import LocalResource
 from ._blobs import BlobsResource
+from ._blobs import BlobsServerState
+from ._blobs.state import get_backend_kwargs
 from ._streaming_resource import StreamingResource
 from ._config import get_config
 
@@ -57,19 +61,38 @@ def _update_with_defaults(conf):
 @implementer(IRealm)
 class SoledadRealm(object):
 
+    # interval between runs of the blobs garbage collector, in seconds
+    garbage_collection_interval = 60 * 60
+
     def __init__(self, sync_pool, conf={}):
         assert sync_pool is not None
         _update_with_defaults(conf)
         blobs = conf['blobs']
-        concurrent_writes = conf['concurrent_blob_writes']
-        blobs_resource = BlobsResource(
-            "filesystem",
-            conf['blobs_path'],
-            concurrent_writes=concurrent_writes) if blobs else None
-        streaming_resource = StreamingResource(
-            "filesystem",
-            conf['blobs_path'],
-            concurrent_writes=concurrent_writes) if blobs else None
+        backend_kwargs = get_backend_kwargs(conf)
+        backend_kwargs['concurrent_writes'] = conf['concurrent_blob_writes']
+        retention = float(conf['blobs_deletions_ttl']) * 24 * 60 * 60
+        blobs_resource = streaming_resource = None
+        if blobs:
+            # both resources use the same backend, so they share its I/O
+            # threadpool and write limit.
+            state = BlobsServerState(
+                conf['blobs_backend'], blobs_path=conf['blobs_path'],
+                **backend_kwargs)
+            blobs_resource = BlobsResource(
+                state.backend,
+                conf['blobs_path'],
+                deletions_retention=retention or None)
+            streaming_resource = StreamingResource(
+                state.backend,
+                conf['blobs_path'])
+        if blobs and backend_kwargs.get('volumes'):
+            # move users' data to where the hash ring places them
+            reactor.callWhenRunning(blobs_resource.rebalance)
+        if blobs:
+            # periodically expire old deletions and abandoned uploads
+            self._collector = task.LoopingCall(blobs_resource.collect_garbage)
+            reactor.callWhenRunning(
+                self._collector.start, self.garbage_collection_interval)
         self.anon_resource = AnonymousResource(
             enable_blobs=blobs)
         self.auth_resource = PublicResource(
@@ -17,51 +17,133 @@
 """
 Gzip middleware for WSGI apps.
 """
-from six import StringIO
-from gzip import GzipFile
+import zlib
+
+from leap.soledad.common.l2db.remote.http_app import BadRequest
+
+
+# the window size that makes zlib read and write gzip streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
 
 
 class GzipMiddleware(object):
     """
     GzipMiddleware class for WSGI.
+
+    Responses are compressed if the client accepts gzip, as the app writes
+    them, so they are still streamed. Request bodies compressed with gzip are
+    decompressed as the app reads them.
     """
     def __init__(self, app, compresslevel=9):
         self.app = app
         self.compresslevel = compresslevel
 
     def __call__(self, environ, start_response):
+        if _is_gzip(environ.get('HTTP_CONTENT_ENCODING', '')):
+            environ['wsgi.input'] = GzipReader(
+                environ['wsgi.input'], _content_length(environ))
+            # the length of the decompressed body is not known
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+
         if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
             return self.app(environ, start_response)
 
-        buffer = StringIO()
-        output = GzipFile(
-            mode='wb',
-            compresslevel=self.compresslevel,
-            fileobj=buffer
-        )
-
-        start_response_args = []
-
-        def dummy_start_response(status, headers, exc_info=None):
-            start_response_args.append(status)
-            start_response_args.append(headers)
-            start_response_args.append(exc_info)
-            return output.write
-
-        app_iter = self.app(environ, dummy_start_response)
-        for line in app_iter:
-            output.write(line)
-        if hasattr(app_iter, 'close'):
-            app_iter.close()
-        output.close()
-        buffer.seek(0)
-        result = buffer.getvalue()
-        headers = []
-        for name, value in start_response_args[1]:
-            if name.lower() != 'content-length':
-                headers.append((name, value))
-        headers.append(('Content-Length', str(len(result))))
-        headers.append(('Content-Encoding', 'gzip'))
-        start_response(start_response_args[0], headers, start_response_args[2])
-        buffer.close()
-        return [result]
+        compressor = zlib.compressobj(
+            self.compresslevel, zlib.DEFLATED, GZIP_WBITS)
+
+        def gzip_start_response(status, headers, exc_info=None):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', 'gzip'))
+            write = start_response(status, headers, exc_info)
+
+            def gzip_write(data):
+                data = compressor.compress(data)
+                if data:
+                    write(data)
+
+            return gzip_write
+
+        app_iter = self.app(environ, gzip_start_response)
+        return self._compress(app_iter, compressor)
+
+    def _compress(self, app_iter, compressor):
+        try:
+            for data in app_iter:
+                data = compressor.compress(data)
+                if data:
+                    yield data
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        yield compressor.flush()
+
+
+class GzipReader(object):
+    """
+    A file-like object that decompresses a body compressed with gzip as it
+    is read.
+    """
+
+    # How many bytes of compressed data are read at once.
+    chunk_size = 64 * 1024
+
+    def __init__(self, rfile, length=None):
+        """
+        :param rfile: The file to read the compressed body from.
+        :type rfile: file
+        :param length: The length of the compressed body, if known.
+        :type length: int
+        """
+        self._rfile = rfile
+        self._remaining = length
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    def read(self, size=-1):
+        """
+        Read at most size bytes of the decompressed body, or all of it if
+        size is negative.
+
+        :raise BadRequest: If the body is not valid gzip data.
+        """
+        parts = []
+        missing = size
+        while size < 0 or missing > 0:
+            data = self._decompress(max(missing, 0))
+            if not data:
+                break
+            parts.append(data)
+            missing -= len(data)
+        return ''.join(parts)
+
+    def _decompress(self, size):
+        decompressor = self._decompressor
+        while True:
+            data = decompressor.unconsumed_tail or self._read_compressed()
+            if not data:
+                return decompressor.flush()
+            try:
+                data = decompressor.decompress(data, size)
+            except zlib.error:
+                raise BadRequest()
+            if data:
+                return data
+
+    def _read_compressed(self):
+        if self._remaining is None:
+            return self._rfile.read(self.chunk_size)
+        data = self._rfile.read(min(self._remaining, self.chunk_size))
+        self._remaining -= len(data)
+        return data
+
+
+def _is_gzip(encoding):
+    return encoding.strip().lower() == 'gzip'
+
+
+def _content_length(environ):
+    try:
+        return int(environ['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        return None
@@ -42,7 +42,7 @@ class IBlobsBackend(Interface):
         :param namespace: An optional namespace for the blob.
         :type namespace: str
         :param range: An optional tuple indicating start and end position of
-            the blob to be produced.
+            the blob to be produced. The end position is not included.
         :type range: (int, int)
 
         :return: A deferred that fires when the blob has been written to the
@@ -157,6 +157,34 @@ class IBlobsBackend(Interface):
         :rtype: twisted.internet.defer.Deferred
         """
 
+    def list_deletions(user, namespace='', since=None):
+        """
+        List the blobs deleted at or after a certain time.
+
+        :param user: The id of the user who owns the blobs.
+        :type user: str
+        :param namespace: Restrict the listing to a certain namespace.
+        :type namespace: str
+        :param since: A timestamp, or None to list all deletions that were not
+            expired yet.
+        :type since: float
+
+        :return: A deferred that fires with a list of (blob_id, timestamp)
+            tuples.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+    def expire_deletions(before):
+        """
+        Forget about blobs deleted before a certain time, for all users.
+
+        :param before: A timestamp.
+        :type before: float
+
+        :return: A deferred that fires with the number of expired deletions.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
     def get_total_storage(user):
         """
         Get the size used by a given user as the sum of all the blobs stored
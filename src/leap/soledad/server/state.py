@@ -123,6 +123,18 @@ class ServerSyncState(object):
             number_of_changes = len(info['changes_to_return'])
         return gen, trans_id, number_of_changes
 
+    def changes_to_return(self):
+        """
+        Return the changes calculated to be returned during the sync process.
+
+        :return: A list of tuples with the changes to be returned, or None if
+                 they have not been calculated yet.
+        :rtype: list
+        """
+        if 'changes_to_return' not in self._storage:
+            return None
+        return self._storage.get('changes_to_return')[0]['changes_to_return']
+
     def next_change_to_return(self, received):
         """
         Return the next change to be returned to the source syncing replica.
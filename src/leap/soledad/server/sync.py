@@ -25,6 +25,9 @@ from leap.soledad.common.l2db.remote import http_app
 from leap.soledad.server.caching import get_cache_for
 from leap.soledad.server.state import ServerSyncState
 from leap.soledad.common.document import ServerDocument
+from leap.soledad.common.sync_frames import BINARY_STREAM
+from leap.soledad.common.sync_frames import content_to_blob
+from leap.soledad.common.sync_frames import encode_frame
 
 
 MAX_REQUEST_SIZE = float('inf')  # It's a stream.
@@ -34,7 +37,8 @@ ENTRY_CACHE_SIZE = 8192 * 1024
 
 class SyncExchange(sync.SyncExchange):
 
-    def __init__(self, db, source_replica_uid, last_known_generation, sync_id):
+    def __init__(self, db, source_replica_uid, last_known_generation, sync_id,
+                 doc_id_prefixes=None, doc_ids=None):
         """
         :param db: The target syncing database.
         :type db: SoledadBackend
@@ -45,11 +49,20 @@ class SyncExchange(sync.SyncExchange):
         :type last_known_generation: int
         :param sync_id: The id of the current sync session.
         :type sync_id: str
+        :param doc_id_prefixes: If given, only documents whose ids start with
+                                one of these prefixes are returned, and only
+                                the revisions of the other ones.
+        :type doc_id_prefixes: list
+        :param doc_ids: If given, only documents with these ids are returned,
+                        whatever their generation.
+        :type doc_ids: list
         """
         self._db = db
         self.source_replica_uid = source_replica_uid
         self.source_last_known_generation = last_known_generation
         self.sync_id = sync_id
+        self.doc_id_prefixes = doc_id_prefixes
+        self.doc_ids = doc_ids
         self.new_gen = None
         self.new_trans_id = None
         self._trace_hook = None
@@ -62,7 +75,12 @@ class SyncExchange(sync.SyncExchange):
 
         Find changes since last_known_generation in db generation
         order using whats_changed. It excludes documents ids that have
-        already been considered (superseded by the sender, etc).
+        already been considered (superseded by the sender, etc). The changes
+        of documents that do not match the prefixes of this sync, if any, are
+        kept, so the source replica is told which ones it skips.
+
+        If this sync asks for some documents ids, they are looked up directly
+        instead, whatever their generation.
 
         :return: the generation of this database, which the caller can
                  consider themselves to be synchronized after processing
@@ -73,24 +91,52 @@ class SyncExchange(sync.SyncExchange):
         # check if changes to return have already been calculated
         new_gen, new_trans_id, number_of_changes = self._sync_state.sync_info()
         if number_of_changes is None:
-            self._trace('before whats_changed')
-            new_gen, new_trans_id, changes = self._db.whats_changed(
-                self.source_last_known_generation)
-            self._trace('after whats_changed')
-            seen_ids = self._sync_state.seen_ids()
-            # changed docs that weren't superseded by or converged with
-            self.changes_to_return = [
-                (doc_id, gen, trans_id) for (doc_id, gen, trans_id) in changes
-                # there was a subsequent update
-                if doc_id not in seen_ids or seen_ids.get(doc_id) < gen]
+            if self.doc_ids is not None:
+                new_gen, new_trans_id, self.changes_to_return = \
+                    self._find_docs()
+            else:
+                new_gen, new_trans_id, self.changes_to_return = \
+                    self._find_changes()
             self._sync_state.put_changes_to_return(
                 new_gen, new_trans_id, self.changes_to_return)
             number_of_changes = len(self.changes_to_return)
+        else:
+            # a sync split in many requests returns the changes calculated
+            # by the first one
+            self.changes_to_return = self._sync_state.changes_to_return()
         self.new_gen = new_gen
         self.new_trans_id = new_trans_id
         return self.new_gen, number_of_changes
 
-    def return_docs(self, return_doc_cb):
+    def _find_changes(self):
+        self._trace('before whats_changed')
+        new_gen, new_trans_id, changes = self._db.whats_changed(
+            self.source_last_known_generation)
+        self._trace('after whats_changed')
+        seen_ids = self._sync_state.seen_ids()
+        # changed docs that weren't superseded by or converged with
+        changes = [
+            (doc_id, gen, trans_id) for (doc_id, gen, trans_id) in changes
+            # there was a subsequent update
+            if doc_id not in seen_ids or seen_ids.get(doc_id) < gen]
+        return new_gen, new_trans_id, changes
+
+    def _find_docs(self):
+        # the documents are returned with the current generation, as the
+        # source replica does not take their generation into account
+        new_gen, new_trans_id = self._db._get_generation_info()
+        docs = self._db.get_docs(
+            self.doc_ids, check_for_conflicts=False, include_deleted=True,
+            read_content=False)
+        changes = [(doc.doc_id, new_gen, new_trans_id) for doc in docs]
+        return new_gen, new_trans_id, changes
+
+    def _matches(self, doc_id):
+        return self.doc_id_prefixes is None or \
+            doc_id.startswith(tuple(self.doc_id_prefixes))
+
+    def return_docs(self, return_doc_cb, received=0, limit=None,
+                    skip_doc_cb=None):
         """Return the changed documents and their last change generation
         repeatedly invoking the callback return_doc_cb.
 
@@ -99,9 +145,21 @@ class SyncExchange(sync.SyncExchange):
         :param: return_doc_cb(doc, gen, trans_id): is a callback
                 used to return the documents with their last change generation
                 to the target replica.
+        :param received: How many documents the source replica has already
+                         received during the current sync process.
+        :type received: int
+        :param limit: How many documents to return at most, or None to return
+                      all the remaining ones.
+        :type limit: int
+        :param skip_doc_cb: A callback with the same arguments as
+                            return_doc_cb, used instead of it for documents
+                            that do not match the prefixes of this sync. If
+                            not given, those documents are not returned.
+        :type skip_doc_cb: function
         :return: None
         """
-        changes_to_return = self.changes_to_return
+        end = None if limit is None else received + limit
+        changes_to_return = self.changes_to_return[received:end]
         # return docs, including conflicts.
         # content as a file-object (will be read when writing)
         changed_doc_ids = [doc_id for doc_id, _, _ in changes_to_return]
@@ -109,11 +167,12 @@ class SyncExchange(sync.SyncExchange):
             changed_doc_ids, check_for_conflicts=False,
             include_deleted=True, read_content=False)
 
-        docs_by_gen = izip(
-            docs, (gen for _, gen, _ in changes_to_return),
-            (trans_id for _, _, trans_id in changes_to_return))
-        for doc, gen, trans_id in docs_by_gen:
-            return_doc_cb(doc, gen, trans_id)
+        docs_by_gen = izip(docs, changes_to_return)
+        for doc, (doc_id, gen, trans_id) in docs_by_gen:
+            if self._matches(doc_id):
+                return_doc_cb(doc, gen, trans_id)
+            elif skip_doc_cb is not None:
+                skip_doc_cb(doc, gen, trans_id)
 
     def batched_insert_from_source(self, entries, sync_id):
         if not entries:
@@ -177,11 +236,29 @@ class SyncResource(http_app.SyncResource):
 
     sync_exchange_class = SyncExchange
 
+    @http_app.http_method()
+    def get(self):
+        """
+        Return information about the sync state, and let the client know
+        that documents can be synced in binary format, filtered, in many
+        requests, and in request and response bodies compressed with gzip.
+        """
+        result = self.get_target().get_sync_info(self.source_replica_uid)
+        self.responder.send_response_json(
+            target_replica_uid=result[0], target_replica_generation=result[1],
+            target_replica_transaction_id=result[2],
+            source_replica_uid=self.source_replica_uid,
+            source_replica_generation=result[3],
+            source_transaction_id=result[4],
+            binary_sync=True, sync_filters=True, sync_batches=True,
+            sync_compression=True)
+
     @http_app.http_method(
         last_known_generation=int, last_known_trans_id=http_app.none_or_str,
         sync_id=http_app.none_or_str, content_as_args=True)
     def post_args(self, last_known_generation, last_known_trans_id=None,
-                  sync_id=None, ensure=False):
+                  sync_id=None, ensure=False, doc_id_prefixes=None,
+                  doc_ids=None, received=0, limit=None):
         """
         Handle the initial arguments for the sync POST request from client.
 
@@ -196,6 +273,18 @@ class SyncResource(http_app.SyncResource):
         :param ensure: Whether the server replica should be created if it does
                        not already exist.
         :type ensure: bool
+        :param doc_id_prefixes: If given, only documents whose ids start with
+                                one of these prefixes are returned, and only
+                                the revisions of the other ones.
+        :type doc_id_prefixes: list
+        :param doc_ids: If given, only documents with these ids are returned,
+                        whatever their generation.
+        :type doc_ids: list
+        :param received: How many documents the client has already received
+                         in previous requests of this sync.
+        :type received: int
+        :param limit: How many documents to return at most in this request.
+        :type limit: int
         """
         # create or open the database
         cache = get_cache_for('db-' + sync_id + self.dbname, expire=120)
@@ -209,8 +298,12 @@ class SyncResource(http_app.SyncResource):
             last_known_generation, last_known_trans_id)
         # get a sync exchange object
         self.sync_exch = self.sync_exchange_class(
-            db, self.source_replica_uid, last_known_generation, sync_id)
+            db, self.source_replica_uid, last_known_generation, sync_id,
+            doc_id_prefixes=doc_id_prefixes,
+            doc_ids=doc_ids)
         self._sync_id = sync_id
+        self._received = received
+        self._limit = limit
         self._staging = []
         self._staging_size = 0
 
@@ -248,9 +341,13 @@ class SyncResource(http_app.SyncResource):
             self._staging = []
             self._staging_size = 0
 
-    def post_get(self):
+    def post_get(self, binary=False):
         """
         Return syncing documents to the client.
+
+        :param binary: Whether to send the contents of documents in binary
+            format.
+        :type binary: bool
         """
         def send_doc(doc, gen, trans_id):
             entry = dict(id=doc.doc_id, rev=doc.rev,
@@ -259,18 +356,33 @@ class SyncResource(http_app.SyncResource):
             content_reader = doc.get_json()
             if content_reader:
                 content = content_reader.read()
-                self.responder.stream_entry(content)
                 content_reader.close()
+                if binary:
+                    content = encode_frame(content_to_blob(content) or content)
+                self.responder.stream_entry(content)
                 # throttle at 5mb/s
                 # FIXME: twistd cant control througput
                 # we need to either use gunicorn or go async
                 time.sleep(len(content) / (5.0 * 1024 * 1024))
             else:
-                self.responder.stream_entry('')
+                empty = encode_frame(None) if binary else ''
+                self.responder.stream_entry(empty)
+
+        def skip_doc(doc, gen, trans_id):
+            # only the revision of a document skipped by the filters of this
+            # sync is sent, so the client knows what it is missing
+            entry = dict(id=doc.doc_id, rev=doc.rev,
+                         gen=gen, trans_id=trans_id, skipped=True)
+            self.responder.stream_entry(entry)
+            empty = encode_frame(None) if binary else ''
+            self.responder.stream_entry(empty)
 
         new_gen, number_of_changes = \
             self.sync_exch.find_changes_to_return()
-        self.responder.content_type = 'application/x-u1db-sync-response'
+        if binary:
+            self.responder.content_type = BINARY_STREAM
+        else:
+            self.responder.content_type = 'application/x-u1db-sync-response'
         self.responder.start_response(200)
         self.responder.start_stream(),
         header = {
@@ -281,7 +393,9 @@ class SyncResource(http_app.SyncResource):
         if self.replica_uid is not None:
             header['replica_uid'] = self.replica_uid
         self.responder.stream_entry(header)
-        self.sync_exch.return_docs(send_doc)
+        self.sync_exch.return_docs(
+            send_doc, received=self._received, limit=self._limit,
+            skip_doc_cb=skip_doc)
         self.responder.end_stream()
         self.responder.finish_response()
 
@@ -290,6 +404,11 @@ class SyncResource(http_app.SyncResource):
         Return the current generation and transaction_id after inserting one
         incoming document.
         """
+        # a request of a sync split in many requests ends before the last
+        # document of the sync, so the staged documents are inserted now
+        self.sync_exch.batched_insert_from_source(self._staging, self._sync_id)
+        self._staging = []
+        self._staging_size = 0
         self.responder.content_type = 'application/x-soledad-sync-response'
         self.responder.start_response(200)
         self.responder.start_stream(),
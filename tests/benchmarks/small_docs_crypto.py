@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# small_docs_crypto.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the throughput of encrypting and decrypting batches of small
+documents, in documents per second.
+
+This is a standalone counterpart of the ``test_*_small_docs_*`` benchmarks in
+``test_crypto.py`` that doesn't need ``pytest-benchmark``. Run it with:
+
+    python tests/benchmarks/small_docs_crypto.py [docs] [rounds]
+
+The figures in the README were obtained with the defaults, 2000 documents and
+the best of 5 rounds, using the default pool size of ``SoledadCrypto``.
+"""
+import json
+import sys
+import time
+
+from uuid import uuid4
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from leap.soledad.client import _crypto
+
+
+SIZES = [200, 1000, 10000]
+
+
+@defer.inlineCallbacks
+def _measure(f, docs, rounds):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        yield f(docs)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    defer.returnValue(len(docs) / best)
+
+
+@defer.inlineCallbacks
+def main(reactor, length=2000, rounds=5):
+    length, rounds = int(length), int(rounds)
+    crypto = _crypto.SoledadCrypto('A' * 96)
+    try:
+        for size in SIZES:
+            content = json.dumps({'payload': 'x' * size})
+            docs = [(uuid4().hex, 'rev', content) for _ in xrange(length)]
+            encrypted = yield crypto.encrypt_docs(docs)
+            encrypt = yield _measure(crypto.encrypt_docs, docs, rounds)
+            docs = [(doc_id, rev, ciphertext)
+                    for (doc_id, rev, _), ciphertext in zip(docs, encrypted)]
+            decrypt = yield _measure(crypto.decrypt_docs, docs, rounds)
+            print('%d bytes: encrypt %d docs/s, decrypt %d docs/s'
+                  % (size, encrypt, decrypt))
+    finally:
+        crypto.close()
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -7,15 +7,20 @@ from twisted.internet._producer_helpers import _PullToPush
 from uuid import uuid4
 
 
-def create_write_test(amount, size):
+def create_write_test(amount, size, durability='none'):
+
+    group = 'test_blobs_fs_backend_write'
+    if durability != 'none':
+        group += '_' + durability
 
     @pytest.inlineCallbacks
-    @pytest.mark.benchmark(group='test_blobs_fs_backend_write')
+    @pytest.mark.benchmark(group=group)
     def test(txbenchmark_with_setup, payload, tmpdir):
         """
         Write many blobs of the same size to the filesystem backend.
         """
-        backend = FilesystemBlobsBackend(blobs_path=tmpdir.strpath)
+        backend = FilesystemBlobsBackend(blobs_path=tmpdir.strpath,
+                                         durability=durability)
         data = payload(size)
 
         @pytest.inlineCallbacks
@@ -49,6 +54,20 @@ test_blobs_fs_backend_write_10_1000k = create_write_test(10, 1000 * 1000)
 test_blobs_fs_backend_write_100_100k = create_write_test(100, 100 * 1000)
 test_blobs_fs_backend_write_1000_10k = create_write_test(1000, 10 * 1000)
 
+test_blobs_fs_backend_write_fsync_10_1000k = \
+    create_write_test(10, 1000 * 1000, durability='fsync')
+test_blobs_fs_backend_write_fsync_100_100k = \
+    create_write_test(100, 100 * 1000, durability='fsync')
+test_blobs_fs_backend_write_fsync_1000_10k = \
+    create_write_test(1000, 10 * 1000, durability='fsync')
+
+test_blobs_fs_backend_write_group_10_1000k = \
+    create_write_test(10, 1000 * 1000, durability='group')
+test_blobs_fs_backend_write_group_100_100k = \
+    create_write_test(100, 100 * 1000, durability='group')
+test_blobs_fs_backend_write_group_1000_10k = \
+    create_write_test(1000, 10 * 1000, durability='group')
+
 
 class DevNull(object):
 
@@ -6,6 +6,9 @@ SIZE_LIMT environment variable.
 For instance, to keep the maximum payload at 1MB:
 
 SIZE_LIMIT=1E6 py.test -s tests/perf/test_crypto.py
+
+Figures for the small documents batches, and the script that produces them
+without the benchmark plugin, are in README.md.
 """
 import pytest
 import os
@@ -16,6 +19,9 @@ from leap.soledad.common.document import SoledadDocument
 from leap.soledad.client import _crypto
 
 LIMIT = int(float(os.environ.get('SIZE_LIMIT', 50 * 1000 * 1000)))
+BATCH_LENGTH = 100
+BATCH_DOC_SIZE = int(1E5)
+SMALL_BATCH_LENGTH = 1000
 
 
 def create_doc_encryption(size):
@@ -83,6 +89,78 @@ def create_raw_decryption(size):
     return test_raw_decrypt
 
 
+def create_batch_encryption(pool_size):
+    @pytest.mark.benchmark(group="test_crypto_encrypt_docs_by_cores")
+    @pytest.inlineCallbacks
+    def test_batch_encryption(txbenchmark, payload):
+        """
+        Encrypt a batch of documents using a given number of threads.
+        """
+        crypto = _crypto.SoledadCrypto('A' * 96, pool_size=pool_size)
+        content = json.dumps({'payload': payload(BATCH_DOC_SIZE)})
+        docs = [(uuid4().hex, 'rev', content) for _ in xrange(BATCH_LENGTH)]
+
+        yield txbenchmark(crypto.encrypt_docs, docs)
+        crypto.close()
+    return test_batch_encryption
+
+
+def create_batch_decryption(pool_size):
+    @pytest.mark.benchmark(group="test_crypto_decrypt_docs_by_cores")
+    @pytest.inlineCallbacks
+    def test_batch_decryption(txbenchmark, payload):
+        """
+        Decrypt a batch of documents using a given number of threads.
+        """
+        crypto = _crypto.SoledadCrypto('A' * 96, pool_size=pool_size)
+        content = json.dumps({'payload': payload(BATCH_DOC_SIZE)})
+        docs = [(uuid4().hex, 'rev', content) for _ in xrange(BATCH_LENGTH)]
+        encrypted = yield crypto.encrypt_docs(docs)
+        docs = [(doc_id, rev, ciphertext)
+                for (doc_id, rev, _), ciphertext in zip(docs, encrypted)]
+
+        yield txbenchmark(crypto.decrypt_docs, docs)
+        crypto.close()
+    return test_batch_decryption
+
+
+def create_small_docs_encryption(size):
+    @pytest.mark.benchmark(group="test_crypto_encrypt_small_docs")
+    @pytest.inlineCallbacks
+    def test_small_docs_encryption(txbenchmark, payload):
+        """
+        Encrypt a batch of small documents.
+        """
+        crypto = _crypto.SoledadCrypto('A' * 96)
+        content = json.dumps({'payload': payload(size)})
+        docs = [(uuid4().hex, 'rev', content)
+                for _ in xrange(SMALL_BATCH_LENGTH)]
+
+        yield txbenchmark(crypto.encrypt_docs, docs)
+        crypto.close()
+    return test_small_docs_encryption
+
+
+def create_small_docs_decryption(size):
+    @pytest.mark.benchmark(group="test_crypto_decrypt_small_docs")
+    @pytest.inlineCallbacks
+    def test_small_docs_decryption(txbenchmark, payload):
+        """
+        Decrypt a batch of small documents.
+        """
+        crypto = _crypto.SoledadCrypto('A' * 96)
+        content = json.dumps({'payload': payload(size)})
+        docs = [(uuid4().hex, 'rev', content)
+                for _ in xrange(SMALL_BATCH_LENGTH)]
+        encrypted = yield crypto.encrypt_docs(docs)
+        docs = [(doc_id, rev, ciphertext)
+                for (doc_id, rev, _), ciphertext in zip(docs, encrypted)]
+
+        yield txbenchmark(crypto.decrypt_docs, docs)
+        crypto.close()
+    return test_small_docs_decryption
+
+
 # Create the TESTS in the global namespace, they'll be picked by the benchmark
 # plugin.
 
@@ -107,3 +185,17 @@ for name, size in encryption_tests:
         sz = int(size)
         globals()['test_encrypt_raw_' + name] = create_raw_encryption(sz)
         globals()['test_decrypt_raw_' + name] = create_raw_decryption(sz)
+
+
+for pool_size in [1, 2, 4, 8]:
+    name = '%d_cores' % pool_size
+    globals()['test_encrypt_docs_' + name] = create_batch_encryption(pool_size)
+    globals()['test_decrypt_docs_' + name] = create_batch_decryption(pool_size)
+
+
+for name, size in [('200b', 200), ('1k', 1E3), ('10k', 1E4)]:
+    sz = int(size)
+    globals()['test_encrypt_small_docs_' + name] = \
+        create_small_docs_encryption(sz)
+    globals()['test_decrypt_small_docs_' + name] = \
+        create_small_docs_decryption(sz)
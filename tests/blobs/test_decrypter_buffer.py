@@ -60,8 +60,12 @@ class DecrypterBufferCase(unittest.TestCase):
 
         @defer.inlineCallbacks
         def _check_result(uri, data, *args, **kwargs):
+            # the encryptor is passed as the body producer of the request
+            fd = BytesIO()
+            yield data.startProducing(fd)
+            self.assertEquals(data.length, len(fd.getvalue()))
             decryptor = _crypto.BlobDecryptor(
-                self.doc_info, data,
+                self.doc_info, fd,
                 armor=False,
                 secret=self.secret)
             decrypted = yield decryptor.decrypt()
@@ -96,3 +100,32 @@ class DecrypterBufferCase(unittest.TestCase):
         buf = DecrypterBuffer(self.doc_info.doc_id, self.secret, tag)
         buf.write(encrypted)
         self.assertRaises(InvalidBlob, buf.close)
+
+    @defer.inlineCallbacks
+    def test_decrypt_compressed_blob_of_namespace(self):
+        cleartext = 'up and up' * 100
+        uploads = []
+
+        def _put(uri, data, *args, **kwargs):
+            fd = BytesIO()
+            d = data.startProducing(fd)
+            d.addCallback(lambda _: uploads.append(fd.getvalue()))
+            d.addCallback(lambda _: Mock(code=200))
+            return d
+
+        methods = {'mail': _crypto.ENC_METHOD.aes_256_gcm_zlib}
+        manager = BlobManager('', '', self.secret, self.secret, 'user',
+                              encryption_methods=methods)
+        manager._client.put = _put
+        yield manager._encrypt_and_upload(
+            self.doc_info.doc_id, BytesIO(cleartext))
+        yield manager._encrypt_and_upload(
+            self.doc_info.doc_id, BytesIO(cleartext), namespace='mail')
+        assert len(uploads[1]) < len(uploads[0])
+
+        tag = uploads[1][-16:]
+        buf = DecrypterBuffer(self.doc_info.doc_id, self.secret, tag)
+        buf.write(uploads[1])
+        fd, size = buf.close()
+        self.assertEquals(fd.getvalue(), cleartext)
+        self.assertEquals(size, len(cleartext))
@@ -19,6 +19,8 @@ Tests for blobs backend on server side.
 """
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python.lockfile import FilesystemLock
 from twisted.web.client import FileBodyProducer
 from twisted.web.test.requesthelper import DummyRequest
 from leap.common.files import mkdir_p
@@ -29,6 +31,7 @@ import os
 import base64
 import io
 import pytest
+import threading
 
 
 class FilesystemBackendTestCase(unittest.TestCase):
@@ -62,28 +65,25 @@ class FilesystemBackendTestCase(unittest.TestCase):
         self.assertEquals(10, size)
 
     @pytest.mark.usefixtures("method_tmpdir")
-    @mock.patch('leap.soledad.server._blobs.fs_backend'
-                '.FilesystemBlobsBackend._get_path')
     @defer.inlineCallbacks
-    def test_read_blob(self, get_path):
+    def test_read_blob(self):
         path = os.path.join(self.tempdir, 'blob')
         with open(path, 'w') as f:
             f.write('bl0b')
-        get_path.return_value = path
         backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
         consumer = DummyRequest([''])
-        yield backend.read_blob('user', 'blob_id', consumer)
+        with mock.patch.object(backend, '_get_path', return_value=path):
+            yield backend.read_blob('user', 'blob_id', consumer)
         self.assertEqual(['bl0b'], consumer.written)
 
     @pytest.mark.usefixtures("method_tmpdir")
-    @mock.patch.object(os.path, 'isfile')
     @defer.inlineCallbacks
-    def test_cannot_overwrite(self, isfile):
-        isfile.return_value = True
+    def test_cannot_overwrite(self):
         backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
-        with pytest.raises(_blobs.BlobExists):
-            producer = Mock()
-            yield backend.write_blob('user', 'blob_id', producer)
+        with mock.patch.object(os.path, 'isfile', return_value=True):
+            with pytest.raises(_blobs.BlobExists):
+                producer = Mock()
+                yield backend.write_blob('user', 'blob_id', producer)
 
     @pytest.mark.usefixtures("method_tmpdir")
     @mock.patch.object(os.path, 'isfile')
@@ -121,23 +121,25 @@ class FilesystemBackendTestCase(unittest.TestCase):
             backend._get_path('user', 'blob_id', '..')
 
     @pytest.mark.usefixtures("method_tmpdir")
-    @mock.patch('leap.soledad.server._blobs.fs_backend.os.walk')
     @defer.inlineCallbacks
-    def test_list_blobs(self, walk_mock):
+    def test_list_blobs(self):
         backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
         _ = None
-        walk_mock.return_value = [('', _, ['blob_0']), ('', _, ['blob_1'])]
-        result = yield backend.list_blobs('user')
+        with mock.patch('leap.soledad.server._blobs.fs_backend.os.walk') \
+                as walk_mock:
+            walk_mock.return_value = [('', _, ['blob_0']), ('', _, ['blob_1'])]
+            result = yield backend.list_blobs('user')
         self.assertEquals(result, ['blob_0', 'blob_1'])
 
     @pytest.mark.usefixtures("method_tmpdir")
-    @mock.patch('leap.soledad.server._blobs.fs_backend.os.walk')
     @defer.inlineCallbacks
-    def test_list_blobs_limited_by_namespace(self, walk_mock):
+    def test_list_blobs_limited_by_namespace(self):
         backend = _blobs.FilesystemBlobsBackend(self.tempdir)
         _ = None
-        walk_mock.return_value = [('', _, ['blob_0']), ('', _, ['blob_1'])]
-        result = yield backend.list_blobs('user', namespace='incoming')
+        with mock.patch('leap.soledad.server._blobs.fs_backend.os.walk') \
+                as walk_mock:
+            walk_mock.return_value = [('', _, ['blob_0']), ('', _, ['blob_1'])]
+            result = yield backend.list_blobs('user', namespace='incoming')
         self.assertEquals(result, ['blob_0', 'blob_1'])
         target_dir = os.path.join(self.tempdir, 'user', 'incoming')
         walk_mock.assert_called_once_with(target_dir)
@@ -172,9 +174,8 @@ class FilesystemBackendTestCase(unittest.TestCase):
             yield backend.write_blob('user', 'id2', producer, namespace='..')
 
     @pytest.mark.usefixtures("method_tmpdir")
-    @mock.patch('leap.soledad.server._blobs.fs_backend.os.unlink')
     @defer.inlineCallbacks
-    def test_delete_blob(self, unlink_mock):
+    def test_delete_blob(self):
         backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
         # write a blob...
         path = backend._get_path('user', 'blob_id', '')
@@ -182,16 +183,17 @@ class FilesystemBackendTestCase(unittest.TestCase):
         with open(path, "w") as f:
             f.write("bl0b")
         # ...and delete it
-        yield backend.delete_blob('user', 'blob_id')
+        with mock.patch('leap.soledad.server._blobs.fs_backend.os.unlink') \
+                as unlink_mock:
+            yield backend.delete_blob('user', 'blob_id')
         unlink_mock.assert_any_call(backend._get_path('user',
                                                       'blob_id'))
         unlink_mock.assert_any_call(backend._get_path('user',
                                                       'blob_id') + '.flags')
 
     @pytest.mark.usefixtures("method_tmpdir")
-    @mock.patch('leap.soledad.server._blobs.fs_backend.os.unlink')
     @defer.inlineCallbacks
-    def test_delete_blob_custom_namespace(self, unlink_mock):
+    def test_delete_blob_custom_namespace(self):
         backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
         # write a blob...
         path = backend._get_path('user', 'blob_id', 'trash')
@@ -199,7 +201,9 @@ class FilesystemBackendTestCase(unittest.TestCase):
         with open(path, "w") as f:
             f.write("bl0b")
         # ...and delete it
-        yield backend.delete_blob('user', 'blob_id', namespace='trash')
+        with mock.patch('leap.soledad.server._blobs.fs_backend.os.unlink') \
+                as unlink_mock:
+            yield backend.delete_blob('user', 'blob_id', namespace='trash')
         unlink_mock.assert_any_call(backend._get_path('user',
                                                       'blob_id',
                                                       'trash'))
@@ -219,6 +223,22 @@ class FilesystemBackendTestCase(unittest.TestCase):
         self.assertEquals([], default)
         self.assertEquals(['blob_id'], custom)
 
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_interrupted_write_leaves_no_partial_blob(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        producer = FileBodyProducer(io.BytesIO('content'))
+        producer.startProducing = Mock(
+            return_value=defer.fail(Exception('connection lost')))
+        with pytest.raises(Exception):
+            yield backend.write_blob('user', 'blob_id', producer)
+        path = backend._get_path('user', 'blob_id')
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.part'))
+        producer = FileBodyProducer(io.BytesIO('content'))
+        yield backend.write_blob('user', 'blob_id', producer)
+        self.assertTrue(os.path.isfile(path))
+
     @pytest.mark.usefixtures("method_tmpdir")
     @defer.inlineCallbacks
     def test_count(self):
@@ -255,3 +275,205 @@ class FilesystemBackendTestCase(unittest.TestCase):
         consumer = DummyRequest([''])
         yield backend.read_blob('user', 'blob-id', consumer, range=(1, 3))
         self.assertEqual(['12'], consumer.written)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_users_placed_across_volumes(self):
+        volumes = [(os.path.join(self.tempdir, 'vol%d' % i), 1)
+                   for i in range(3)]
+        backend = _blobs.FilesystemBlobsBackend(
+            blobs_path=volumes[0][0], volumes=volumes)
+        users = ['user%d' % i for i in range(30)]
+        for user in users:
+            producer = FileBodyProducer(io.BytesIO('content'))
+            yield backend.write_blob(user, 'blob_id', producer)
+        used = set(backend._get_volume(user).path for user in users)
+        self.assertEqual(3, len(used))
+        writes = sum(s['writes'] for s in backend.get_volume_stats())
+        self.assertEqual(30, writes)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_add_volume_relocates_users(self):
+        first = os.path.join(self.tempdir, 'first')
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=first)
+        users = ['user%d' % i for i in range(20)]
+        for user in users:
+            producer = FileBodyProducer(io.BytesIO('content'))
+            yield backend.write_blob(user, 'blob_id', producer)
+            yield backend.set_flags(user, 'blob_id', ['PENDING'])
+        second = os.path.join(self.tempdir, 'second')
+        yield backend.add_volume(second)
+        moved = os.listdir(second)
+        self.assertTrue(moved)
+        for user in users:
+            volume = backend._ring.get(user)
+            self.assertTrue(os.path.isdir(os.path.join(volume.path, user)))
+            consumer = DummyRequest([''])
+            yield backend.read_blob(user, 'blob_id', consumer)
+            self.assertEqual(['content'], consumer.written)
+            flags = yield backend.get_flags(user, 'blob_id')
+            self.assertEqual(['PENDING'], flags)
+        for user in moved:
+            self.assertFalse(os.path.exists(os.path.join(first, user)))
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_operations_wait_for_relocation(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        yield backend._gate.close('user')
+        producer = FileBodyProducer(io.BytesIO('content'))
+        d = backend.write_blob('user', 'blob_id', producer)
+        self.assertFalse(d.called)
+        backend._gate.open('user')
+        yield d
+        count = yield backend.count('user')
+        self.assertEqual(1, count)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_backends_of_the_same_path_share_locks(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        other = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        self.assertIs(backend._locks, other._locks)
+        yield backend._gate.close('user')
+        producer = FileBodyProducer(io.BytesIO('content'))
+        d = other.write_blob('user', 'blob_id', producer)
+        self.assertFalse(d.called)
+        backend._gate.open('user')
+        yield d
+        count = yield backend.count('user')
+        self.assertEqual(1, count)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_filesystem_calls_run_in_io_threadpool(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir,
+                                                io_threads=2)
+        self.addCleanup(backend.close)
+        self.assertEqual(2, backend._pool.max)
+        threads = []
+        isfile = os.path.isfile
+
+        def _isfile(path):
+            threads.append(threading.current_thread())
+            return isfile(path)
+
+        producer = FileBodyProducer(io.BytesIO('content'))
+        with mock.patch.object(os.path, 'isfile', _isfile):
+            yield backend.write_blob('user', 'blob_id', producer)
+            yield backend.get_flags('user', 'blob_id')
+        self.assertTrue(threads)
+        main = threading.current_thread()
+        self.assertFalse([thread for thread in threads if thread is main])
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_operations_on_a_blob_run_in_order(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        producer = FileBodyProducer(io.BytesIO('content'))
+        yield backend.write_blob('user', 'blob_id', producer)
+        flags = [['PENDING'], ['PROCESSING'], ['PROCESSED'], ['FAILED']]
+        yield defer.gatherResults(
+            [backend.set_flags('user', 'blob_id', f) for f in flags])
+        result = yield backend.get_flags('user', 'blob_id')
+        self.assertEqual(['FAILED'], result)
+        self.assertEqual({}, backend._locks)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_wait_for_lock_held_by_other_process(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        backend.LOCK_TIMEOUT = 0.2
+        producer = FileBodyProducer(io.BytesIO('content'))
+        yield backend.write_blob('user', 'blob_id', producer)
+        path = backend._get_path('user', 'blob_id')
+        lock = FilesystemLock(path + '.lock')
+        self.assertTrue(lock.lock())
+        with pytest.raises(defer.TimeoutError):
+            yield backend.get_flags('user', 'blob_id')
+        self.assertEqual({}, backend._locks)
+        d = backend.get_flags('user', 'blob_id')
+        reactor.callLater(0.05, lock.unlock)
+        flags = yield d
+        self.assertEqual([], flags)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_list_deletions_since(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        for blob_id in ['old', 'new', 'kept']:
+            producer = FileBodyProducer(io.BytesIO('content'))
+            yield backend.write_blob('user', blob_id, producer)
+        yield backend.delete_blob('user', 'old')
+        yield backend.delete_blob('user', 'new')
+        marker = backend._get_path('user', 'old') + '.deleted'
+        os.utime(marker, (1000, 1000))
+        deletions = yield backend.list_deletions('user')
+        self.assertEqual(set(['old', 'new']),
+                         set(blob_id for blob_id, _ in deletions))
+        deletions = yield backend.list_deletions('user', since=2000)
+        self.assertEqual(['new'], [blob_id for blob_id, _ in deletions])
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_expire_deletions(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        for blob_id in ['old', 'new']:
+            producer = FileBodyProducer(io.BytesIO('content'))
+            yield backend.write_blob('user', blob_id, producer)
+            yield backend.delete_blob('user', blob_id)
+        marker = backend._get_path('user', 'old') + '.deleted'
+        os.utime(marker, (1000, 1000))
+        expired = yield backend.expire_deletions(2000)
+        self.assertEqual(1, expired)
+        self.assertFalse(os.path.exists(marker))
+        deleted = yield backend.list_blobs('user', deleted=True)
+        self.assertEqual(['new'], deleted)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_write_after_delete_is_not_listed_as_deleted(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir)
+        producer = FileBodyProducer(io.BytesIO('content'))
+        yield backend.write_blob('user', 'blob_id', producer)
+        yield backend.delete_blob('user', 'blob_id')
+        producer = FileBodyProducer(io.BytesIO('content'))
+        yield backend.write_blob('user', 'blob_id', producer)
+        deleted = yield backend.list_blobs('user', deleted=True)
+        self.assertEqual([], deleted)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_fsync_durability_syncs_blob_and_directory(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir,
+                                                durability='fsync')
+        producer = FileBodyProducer(io.BytesIO('content'))
+        with mock.patch('leap.soledad.server._blobs.durability.os.fsync') \
+                as fsync_mock:
+            yield backend.write_blob('user', 'blob_id', producer)
+        self.assertEqual(2, fsync_mock.call_count)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_group_commit_syncs_concurrent_writes_together(self):
+        backend = _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir,
+                                                durability='group')
+        backend._durability._window = 0.5
+        blob_ids = ['blob_0', 'blob_1', 'blob_2']
+        with mock.patch('leap.soledad.server._blobs.durability.sync_paths') \
+                as sync_mock:
+            yield defer.gatherResults([
+                backend.write_blob('user', blob_id,
+                                   FileBodyProducer(io.BytesIO('content')))
+                for blob_id in blob_ids])
+        sync_mock.assert_called_once()
+        paths = sync_mock.call_args[0][0]
+        expected = [backend._get_path('user', blob_id) for blob_id in blob_ids]
+        self.assertEqual(sorted(expected), sorted(paths))
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_invalid_durability_mode(self):
+        with pytest.raises(_blobs.ImproperlyConfiguredException):
+            _blobs.FilesystemBlobsBackend(blobs_path=self.tempdir,
+                                          durability='sometimes')
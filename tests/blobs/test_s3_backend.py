@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+# test_s3_backend.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the S3 blobs backend, using a local stand-in for the object storage
+service.
+"""
+import base64
+import hashlib
+import io
+import os
+import pytest
+import json
+import re
+import treq
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.web.client import FileBodyProducer
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from leap.soledad.common.blobs import Flags
+from leap.soledad.common.blobs import InvalidFlag
+from leap.soledad.server import _blobs
+from leap.soledad.server._blobs.errors import BlobExists
+from leap.soledad.server._blobs.errors import BlobNotFound
+from leap.soledad.server._blobs.errors import ImproperlyConfiguredException
+from leap.soledad.server._blobs.errors import QuotaExceeded
+from leap.soledad.server._blobs.resource import BlobsResource
+from leap.soledad.server._streaming_resource import StreamingResource
+
+
+class S3StandIn(Resource):
+    """
+    A minimal in-memory object storage service that speaks the subset of the
+    S3 API used by the backend.
+    """
+
+    isLeaf = True
+
+    def __init__(self, access_key):
+        Resource.__init__(self)
+        self.access_key = access_key
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+
+    def render(self, request):
+        auth = request.getHeader('authorization') or ''
+        credential = 'AWS4-HMAC-SHA256 Credential=%s/' % self.access_key
+        if not auth.startswith(credential):
+            request.setResponseCode(403)
+            return '<Error><Code>AccessDenied</Code></Error>'
+        self.requests.append((request.method, request.uri))
+        return Resource.render(self, request)
+
+    def _key(self, request):
+        return request.path.split('/', 2)[2]
+
+    def render_PUT(self, request):
+        data = request.content.read()
+        if 'partNumber' in request.args:
+            upload_id = request.args['uploadId'][0]
+            number = int(request.args['partNumber'][0])
+            self.uploads[upload_id][number] = data
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            request.setHeader('etag', etag)
+            return ''
+        self.objects[self._key(request)] = data
+        return ''
+
+    def render_POST(self, request):
+        key = self._key(request)
+        if 'uploads' in request.args:
+            upload_id = 'upload-%d' % len(self.uploads)
+            self.uploads[upload_id] = {}
+            return ('<InitiateMultipartUploadResult xmlns="http://s3.amazon'
+                    'aws.com/doc/2006-03-01/"><Key>%s</Key><UploadId>%s'
+                    '</UploadId></InitiateMultipartUploadResult>'
+                    % (key, upload_id))
+        upload_id = request.args['uploadId'][0]
+        parts = self.uploads.pop(upload_id)
+        body = request.content.read()
+        numbers = map(int, re.findall(r'<PartNumber>(\d+)</PartNumber>', body))
+        self.objects[key] = ''.join(parts[n] for n in numbers)
+        return '<CompleteMultipartUploadResult/>'
+
+    def render_GET(self, request):
+        key = self._key(request)
+        if key not in self.objects:
+            request.setResponseCode(404)
+            return '<Error><Code>NoSuchKey</Code></Error>'
+        data = self.objects[key]
+        range = request.getHeader('range')
+        if range:
+            start, end = map(int, range.split('=')[1].split('-'))
+            request.setResponseCode(206)
+            return data[start:end + 1]
+        return data
+
+    def render_DELETE(self, request):
+        if 'uploadId' in request.args:
+            self.uploads.pop(request.args['uploadId'][0], None)
+        else:
+            self.objects.pop(self._key(request), None)
+        request.setResponseCode(204)
+        return ''
+
+
+class Consumer(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+class S3BackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.service = S3StandIn('access')
+        self.port = reactor.listenTCP(
+            0, Site(self.service), interface='127.0.0.1')
+        host = self.port.getHost()
+        self.url = 'http://%s:%d' % (host.host, host.port)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.backend.close()
+        yield self.port.stopListening()
+
+    def _get_backend(self, **kwargs):
+        kwargs.setdefault('index_path', os.path.join(self.tempdir, 'index.db'))
+        self.backend = _blobs.S3BlobsBackend(
+            blobs_path=self.tempdir, url=self.url, bucket='blobs',
+            access_key='access', secret_key='secret', **kwargs)
+        return self.backend
+
+    def _write(self, backend, blob_id, content, user='user', namespace=''):
+        producer = FileBodyProducer(io.BytesIO(content))
+        return backend.write_blob(user, blob_id, producer, namespace)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_write_and_read_blob(self):
+        backend = self._get_backend()
+        yield self._write(backend, 'blob_id', 'A' * 40 + 'B' * 16)
+        self.assertEqual(
+            'A' * 40 + 'B' * 16, self.service.objects['user/default/blob_id'])
+        consumer = Consumer()
+        yield backend.read_blob('user', 'blob_id', consumer)
+        self.assertEqual('A' * 40 + 'B' * 16, ''.join(consumer.written))
+        size = yield backend.get_blob_size('user', 'blob_id')
+        self.assertEqual(56, size)
+        tag = yield backend.get_tag('user', 'blob_id')
+        self.assertEqual(base64.urlsafe_b64encode('B' * 16), tag)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_multipart_upload(self):
+        backend = self._get_backend()
+        backend.part_size = 10
+        content = os.urandom(35)
+        producer = FileBodyProducer(io.BytesIO(content), readSize=10)
+        yield backend.write_blob('user', 'blob_id', producer)
+        self.assertEqual(content, self.service.objects['user/default/blob_id'])
+        parts = [uri for method, uri in self.service.requests
+                 if method == 'PUT' and 'partNumber' in uri]
+        self.assertEqual(4, len(parts))
+        self.assertEqual({}, self.service.uploads)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_ranged_read(self):
+        backend = self._get_backend()
+        yield self._write(backend, 'blob_id', '0123456789')
+        consumer = Consumer()
+        yield backend.read_blob('user', 'blob_id', consumer, range=(1, 3))
+        self.assertEqual('12', ''.join(consumer.written))
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_cannot_overwrite(self):
+        backend = self._get_backend()
+        yield self._write(backend, 'blob_id', 'content')
+        with pytest.raises(BlobExists):
+            yield self._write(backend, 'blob_id', 'content')
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_quota(self):
+        backend = self._get_backend(quota=1)
+        yield self._write(backend, 'blob_id', 'A' * 1000)
+        with pytest.raises(QuotaExceeded):
+            yield self._write(backend, 'other', 'A' * 100)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_flags_kept_in_index(self):
+        backend = self._get_backend()
+        yield self._write(backend, 'blob_id', 'content')
+        requests = len(self.service.requests)
+        yield backend.set_flags('user', 'blob_id', [Flags.PROCESSING])
+        flags = yield backend.get_flags('user', 'blob_id')
+        self.assertEqual([Flags.PROCESSING], flags)
+        with pytest.raises(InvalidFlag):
+            yield backend.set_flags('user', 'blob_id', ['invalid'])
+        listed = yield backend.list_blobs(
+            'user', filter_flag=Flags.PROCESSING)
+        self.assertEqual(['blob_id'], listed)
+        self.assertEqual(requests, len(self.service.requests))
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_delete_blob(self):
+        backend = self._get_backend()
+        yield self._write(backend, 'blob_id', 'content')
+        yield self._write(backend, 'other', 'content')
+        yield backend.delete_blob('user', 'blob_id')
+        self.assertNotIn('user/default/blob_id', self.service.objects)
+        listed = yield backend.list_blobs('user')
+        self.assertEqual(['other'], listed)
+        deleted = yield backend.list_blobs('user', deleted=True)
+        self.assertEqual(['blob_id'], deleted)
+        count = yield backend.count('user')
+        self.assertEqual(1, count)
+        with pytest.raises(BlobNotFound):
+            yield backend.read_blob('user', 'blob_id', Consumer())
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_list_and_expire_deletions(self):
+        backend = self._get_backend()
+        yield self._write(backend, 'blob_id', 'content')
+        yield self._write(backend, 'other', 'content')
+        yield backend.delete_blob('user', 'blob_id')
+        deletions = yield backend.list_deletions('user')
+        self.assertEqual(['blob_id'], [blob_id for blob_id, _ in deletions])
+        _, deleted_at = deletions[0]
+        later = yield backend.list_deletions('user', since=deleted_at + 1)
+        self.assertEqual([], later)
+        expired = yield backend.expire_deletions(deleted_at + 1)
+        self.assertEqual(1, expired)
+        deleted = yield backend.list_blobs('user', deleted=True)
+        self.assertEqual([], deleted)
+        listed = yield backend.list_blobs('user')
+        self.assertEqual(['other'], listed)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_list_orders_by_date(self):
+        backend = self._get_backend()
+        for blob_id in ['blob1', 'blob2', 'blob3']:
+            yield self._write(backend, blob_id, 'content', namespace='ns')
+        listed = yield backend.list_blobs('user', 'ns', order_by='-date')
+        self.assertEqual(['blob3', 'blob2', 'blob1'], listed)
+        listed = yield backend.list_blobs('user', order_by='date')
+        self.assertEqual([], listed)
+        usage = yield backend.get_total_storage('user')
+        self.assertEqual(21 / 1024.0, usage)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    @defer.inlineCallbacks
+    def test_wrong_credentials(self):
+        self.service.access_key = 'other'
+        backend = self._get_backend()
+        with pytest.raises(_blobs.errors.BackendError):
+            yield self._write(backend, 'blob_id', 'content')
+        exists = yield backend.exists('user', 'blob_id', '')
+        self.assertFalse(exists)
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_index_path_is_required(self):
+        self._get_backend()
+        with pytest.raises(ImproperlyConfiguredException):
+            _blobs.S3BlobsBackend(
+                blobs_path=self.tempdir, url=self.url, bucket='blobs',
+                access_key='access', secret_key='secret')
+
+
+class S3ResourcesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.service = S3StandIn('access')
+        self.ports = [reactor.listenTCP(
+            0, Site(self.service), interface='127.0.0.1')]
+        host = self.ports[0].getHost()
+        kwargs = {
+            'url': 'http://%s:%d' % (host.host, host.port),
+            'bucket': 'blobs',
+            'access_key': 'access',
+            'secret_key': 'secret',
+            'index_path': os.path.join(self.tempdir, 'index.db'),
+        }
+        self.resources = [
+            StreamingResource("s3", self.tempdir, **kwargs),
+            BlobsResource("s3", self.tempdir, **kwargs)]
+        root = Resource()
+        root.putChild('stream', self.resources[0])
+        root.putChild('blobs', self.resources[1])
+        self.ports.append(reactor.listenTCP(
+            0, Site(root), interface='127.0.0.1'))
+        host = self.ports[1].getHost()
+        self.uri = 'http://%s:%d/' % (host.host, host.port)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for resource in self.resources:
+            yield resource._handler.close()
+        for port in self.ports:
+            yield port.stopListening()
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_upload_and_download_stream(self):
+        uri = self.uri + 'stream/user'
+        blobs = [('blob1', 'A' * 20), ('blob2', 'B' * 30)]
+        data = json.dumps([(blob_id, len(c)) for blob_id, c in blobs])
+        data += '\n' + ''.join(c for _, c in blobs)
+        response = yield treq.post(uri, params={'direction': 'upload'},
+                                   data=data, persistent=False)
+        yield treq.content(response)
+        self.assertEqual('A' * 20, self.service.objects['user/default/blob1'])
+        self.assertEqual('B' * 30, self.service.objects['user/default/blob2'])
+        response = yield treq.post(uri, params={'direction': 'download'},
+                                   data=json.dumps(['blob1', 'blob2']),
+                                   persistent=False)
+        content = yield treq.content(response)
+        tag1 = base64.urlsafe_b64encode('A' * 16)
+        tag2 = base64.urlsafe_b64encode('B' * 16)
+        expected = ('%08x%s %s' % (20, tag1, 'A' * 20) +
+                    '%08x%s %s' % (30, tag2, 'B' * 30))
+        self.assertEqual(expected, content)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_put_and_get_blob(self):
+        uri = self.uri + 'blobs/user/blob_id'
+        response = yield treq.put(uri, data='0123456789', persistent=False)
+        yield treq.content(response)
+        self.assertEqual(200, response.code)
+        response = yield treq.get(uri, persistent=False)
+        content = yield treq.content(response)
+        self.assertEqual('0123456789', content)
+        response = yield treq.get(uri, headers={'Range': 'bytes=2-5'},
+                                  persistent=False)
+        content = yield treq.content(response)
+        self.assertEqual(206, response.code)
+        self.assertEqual('2345', content)
@@ -22,6 +22,7 @@ import os
 from pytest import inlineCallbacks
 
 from leap.soledad.client import Soledad
+from leap.soledad.common.blobs.preamble import ENC_METHOD
 from leap.soledad.client._db.adbapi import U1DBConnectionPool
 from leap.soledad.client._secrets.util import SecretsError
 
@@ -91,6 +92,15 @@ class AuxMethodsTestCase(BaseSoledadTest):
         self.assertEqual('value_1', sol.server_url)
         sol.close()
 
+    def test__init_encryption_methods(self):
+        zlib = ENC_METHOD.aes_256_gcm_zlib
+        sol = self._soledad_instance(
+            prefix='_init_methods', encryption_method=zlib,
+            blob_encryption_methods={'mail': zlib})
+        self.assertEqual(zlib, sol._crypto.method)
+        self.assertEqual({'mail': zlib}, sol.blobmanager.encryption_methods)
+        sol.close()
+
     @inlineCallbacks
     def test_change_passphrase(self):
         """
@@ -35,6 +35,7 @@ from test_soledad.util import BaseSoledadTest
 from leap.soledad.client import _crypto
 from leap.soledad.client import _scrypt
 from leap.soledad.common.blobs import preamble as _preamble
+from leap.soledad.common import sync_frames
 
 from twisted.trial import unittest
 from twisted.internet import defer
@@ -200,6 +201,88 @@ class BlobTestCase(unittest.TestCase):
         decrypted = decryptor._end_stream()
         assert decrypted.getvalue() == snowden1
 
+    @defer.inlineCallbacks
+    def test_blob_encryptor_streams_to_sink(self):
+        content = os.urandom(2 ** 18 + 1)
+        writes = []
+
+        class Sink(object):
+            def write(self, data):
+                writes.append(data)
+
+        for armor in (True, False):
+            del writes[:]
+            blob = _crypto.BlobEncryptor(
+                self.doc_info, BytesIO(content), armor=armor,
+                secret='A' * 96, sink=Sink())
+            yield blob.encrypt()
+            encrypted = ''.join(writes)
+            # the preamble comes first, and the ciphertext in many chunks
+            preamble = base64.urlsafe_b64encode(blob._preamble)
+            assert writes[0] == preamble
+            assert writes[1] == _crypto.SEPARATOR
+            assert len(writes) > 4
+            assert max(map(len, writes)) <= 4 * 2 ** 16 / 3 + 4
+            assert len(encrypted) == blob.length
+
+            decryptor = _crypto.BlobDecryptor(
+                self.doc_info, BytesIO(encrypted), armor=armor,
+                secret='A' * 96)
+            decrypted = yield decryptor.decrypt()
+            assert decrypted.getvalue() == content
+
+    @defer.inlineCallbacks
+    def test_blob_decryptor_streams_from_fd(self):
+        content = os.urandom(2 ** 18 + 1)
+        for armor in (True, False):
+            blob = _crypto.BlobEncryptor(
+                self.doc_info, BytesIO(content), armor=armor,
+                secret='A' * 96)
+            encrypted = yield blob.encrypt()
+            writes = []
+
+            class Sink(BytesIO):
+                def write(self, data):
+                    writes.append(len(data))
+                    BytesIO.write(self, data)
+
+            decryptor = _crypto.BlobDecryptor(
+                self.doc_info, encrypted, result=Sink(), armor=armor,
+                secret='A' * 96)
+            decrypted = yield decryptor.decrypt()
+            assert decrypted.getvalue() == content
+            # the ciphertext was never decrypted all at once
+            assert len(writes) > 4
+            assert max(writes) <= 2 ** 16
+
+    @defer.inlineCallbacks
+    def test_blob_decryptor_reads_string_without_copying(self):
+        encrypted = yield self.blob.encrypt()
+        ciphertext = encrypted.getvalue()
+        reader = _crypto._StringReader(ciphertext)
+        assert reader.read() is ciphertext
+        reader.seek(-16, os.SEEK_END)
+        assert reader.read(32) == ciphertext[-16:]
+        reader.seek(0)
+        decryptor = _crypto.BlobDecryptor(
+            self.doc_info, reader, secret='A' * 96)
+        decrypted = yield decryptor.decrypt()
+        assert decrypted.getvalue() == snowden1
+
+    @defer.inlineCallbacks
+    def test_blob_decryptor_rejects_tampered_tag(self):
+        encrypted = yield self.blob.encrypt()
+        preamble, ciphertext = encrypted.getvalue().split()
+        ciphertext = base64.urlsafe_b64decode(ciphertext)
+        tampered = ciphertext[:-1] + chr(ord(ciphertext[-1]) ^ 1)
+        tampered = preamble + ' ' + base64.urlsafe_b64encode(tampered)
+
+        decryptor = _crypto.BlobDecryptor(
+            self.doc_info, BytesIO(tampered),
+            secret='A' * 96)
+        with pytest.raises(_crypto.InvalidBlob):
+            yield decryptor.decrypt()
+
     @defer.inlineCallbacks
     def test_blob_decryptor(self):
         ciphertext = yield self.blob.encrypt()
@@ -222,6 +305,29 @@ class BlobTestCase(unittest.TestCase):
         decrypted = yield decryptor.decrypt()
         assert decrypted.getvalue() == snowden1
 
+    @defer.inlineCallbacks
+    def test_compressed_blob_round_trip(self):
+        inf = BytesIO(snowden1 * 10)
+        blob = _crypto.BlobEncryptor(
+            self.doc_info, inf, armor=False, secret='A' * 96,
+            method=_crypto.ENC_METHOD.aes_256_gcm_zlib)
+        encrypted = yield blob.encrypt()
+        # the ciphertext is smaller than the cleartext
+        assert len(encrypted.getvalue()) < len(snowden1 * 10)
+
+        decryptor = _crypto.BlobDecryptor(
+            self.doc_info, encrypted, armor=False,
+            secret='A' * 96)
+        decrypted = yield decryptor.decrypt()
+        assert decrypted.getvalue() == snowden1 * 10
+        assert decryptor.decrypted_content_size == len(snowden1 * 10)
+
+    def test_unsupported_method_raises(self):
+        with pytest.raises(_crypto.EncryptionDecryptionError):
+            _crypto.BlobEncryptor(
+                self.doc_info, self.inf, secret='A' * 96,
+                method=_crypto.ENC_METHOD.pgp)
+
     @defer.inlineCallbacks
     def test_encrypt_and_decrypt(self):
         """
@@ -266,6 +372,115 @@ class BlobTestCase(unittest.TestCase):
         with pytest.raises(_crypto.InvalidBlob):
             yield crypto.decrypt_doc(doc2)
 
+    @defer.inlineCallbacks
+    def test_encrypt_and_decrypt_batch(self):
+        """
+        Check that batches are encrypted and decrypted in the crypto pool,
+        keeping the order of the documents.
+        """
+        crypto = _crypto.SoledadCrypto('A' * 96, pool_size=2)
+        self.addCleanup(crypto.close)
+        docs = [('id%d' % i, str(i), json.dumps({'key': 'val%d' % i}))
+                for i in range(10)]
+
+        encrypted = yield crypto.encrypt_docs(docs)
+        assert len(encrypted) == len(docs)
+        assert all(map(_crypto.is_symmetrically_encrypted, encrypted))
+
+        # documents encrypted in batch can be decrypted one at a time
+        doc = SoledadDocument('id3', '3')
+        doc.set_json(encrypted[3])
+        decrypted = (yield crypto.decrypt_doc(doc)).getvalue()
+        assert decrypted == docs[3][2]
+
+        entries = [(doc_id, rev, content)
+                   for (doc_id, rev, _), content in zip(docs, encrypted)]
+        decrypted = yield crypto.decrypt_docs(entries)
+        assert decrypted == [content for _, _, content in docs]
+
+    @defer.inlineCallbacks
+    def test_encrypt_and_decrypt_unarmored_batch(self):
+        crypto = _crypto.SoledadCrypto('A' * 96, pool_size=2)
+        self.addCleanup(crypto.close)
+        docs = [('id1', '1', '{"key": "val"}')]
+
+        blobs = yield crypto.encrypt_docs(docs, armor=False)
+        assert isinstance(blobs[0], sync_frames.Blob)
+        decrypted = yield crypto.decrypt_docs([('id1', '1', blobs[0])])
+        assert decrypted == ['{"key": "val"}']
+
+        # the server stores blobs in the default format
+        doc = SoledadDocument('id1', '1')
+        doc.set_json(sync_frames.decode_frame('blob', blobs[0]))
+        decrypted = (yield crypto.decrypt_doc(doc)).getvalue()
+        assert decrypted == '{"key": "val"}'
+
+    @defer.inlineCallbacks
+    def test_encrypt_and_decrypt_compressed_batch(self):
+        crypto = _crypto.SoledadCrypto(
+            'A' * 96, pool_size=2,
+            method=_crypto.ENC_METHOD.aes_256_gcm_zlib)
+        self.addCleanup(crypto.close)
+        docs = [('id1', '1', json.dumps({'key': 'val' * 100}))]
+
+        encrypted = yield crypto.encrypt_docs(docs)
+        decrypted = yield crypto.decrypt_docs(
+            [('id1', '1', encrypted[0])])
+        assert decrypted == [docs[0][2]]
+
+        # documents are decrypted whatever the method of the crypto object
+        doc = SoledadDocument('id1', '1')
+        doc.set_json(encrypted[0])
+        decrypted = (yield _crypto.SoledadCrypto('A' * 96).decrypt_doc(doc))
+        assert decrypted.getvalue() == docs[0][2]
+
+    @defer.inlineCallbacks
+    def test_small_and_large_documents_in_batch(self):
+        crypto = _crypto.SoledadCrypto('A' * 96, pool_size=2)
+        self.addCleanup(crypto.close)
+        crypto.batch_threshold = 100
+        docs = [('id1', '1', json.dumps({'key': 'small'})),
+                ('id2', '1', json.dumps({'key': 'large' * 100}))]
+
+        encrypted = yield crypto.encrypt_docs(docs)
+        # documents encrypted in one pass can be decrypted in chunks, and
+        # the other way around
+        for (doc_id, rev, content), ciphertext in zip(docs, encrypted):
+            doc = SoledadDocument(doc_id, rev)
+            doc.set_json(ciphertext)
+            decrypted = (yield crypto.decrypt_doc(doc)).getvalue()
+            assert decrypted == content
+        info = _crypto.DocInfo('id1', '1')
+        ciphertext = _crypto.encrypt_payload(info, docs[0][2], 'A' * 96)
+        decrypted = yield crypto.decrypt_docs([('id1', '1', ciphertext)])
+        assert decrypted == [docs[0][2]]
+
+        decrypted = yield crypto.decrypt_docs(
+            [('id1', '1', encrypted[0]), ('id2', '1', encrypted[1])])
+        assert decrypted == [docs[0][2], docs[1][2]]
+
+    def test_keys_cache_drops_least_recently_used_keys(self):
+        keys = _crypto._KeyCache('A' * 96, 2)
+        key1 = keys.get('id1')
+        assert key1 == _crypto._get_sym_key_for_doc('id1', 'A' * 96)
+        keys.get('id2')
+        keys.get('id1')
+        keys.get('id3')
+        assert len(keys) == 2
+        assert list(keys._keys) == ['id1', 'id3']
+        assert keys.get('id1') is key1
+
+    @defer.inlineCallbacks
+    def test_decrypt_batch_with_wrong_doc_raises(self):
+        crypto = _crypto.SoledadCrypto('A' * 96, pool_size=2)
+        self.addCleanup(crypto.close)
+        docs = [('id1', '1', '{}'), ('id2', '1', '{}')]
+        encrypted = yield crypto.encrypt_docs(docs)
+        # swap the contents of the documents
+        entries = [('id1', '1', encrypted[1]), ('id2', '1', encrypted[0])]
+        with pytest.raises(_crypto.InvalidBlob):
+            yield crypto.decrypt_docs(entries)
+
 
 class SoledadSecretsTestCase(BaseSoledadTest):
 
@@ -353,6 +568,17 @@ class PreambleTestCase(unittest.TestCase):
         size = unpacked[7]
         assert size == _crypto._ceiling(len(snowden1))
 
+    def test_preamble_of_compressed_blob(self):
+        cleartext = snowden1 * 200
+        blob = _crypto.BlobEncryptor(
+            self.doc_info, BytesIO(cleartext), secret='A' * 96,
+            method=_crypto.ENC_METHOD.aes_256_gcm_zlib)
+        unpacked = _preamble.PACMAN.unpack(blob._encode_preamble())
+        assert unpacked[2] == _crypto.ENC_METHOD.aes_256_gcm_zlib
+        # the size is the one of the compressed content
+        assert unpacked[7] == _crypto._ceiling(blob._cleartext_size)
+        assert unpacked[7] < _crypto._ceiling(len(cleartext))
+
     @defer.inlineCallbacks
     def test_preamble_can_come_without_size(self):
         # XXX: This test case is here only to test backwards compatibility!
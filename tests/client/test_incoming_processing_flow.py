@@ -66,25 +66,50 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         self.box = Mock()
         self.loop = IncomingBoxProcessingLoop(self.box)
 
-    def _set_pending_items(self, pending):
+    def _set_pending_items(self, pending, reserved=None):
         self.box.list_pending.return_value = defer.succeed(pending)
-        pending_iter = iter([defer.succeed(item) for item in pending])
-        self.box.fetch_for_processing.side_effect = pending_iter
+        if reserved is None:
+            reserved = pending
+        self.box.reserve_batch.side_effect = \
+            lambda batch: defer.succeed([i for i in batch if i in reserved])
+        self.box.get.side_effect = lambda item: defer.succeed(item)
 
     @defer.inlineCallbacks
     def test_processing_flow_reserves_a_message(self):
         self._set_pending_items(['one_item'])
         self.loop.add_consumer(GoodConsumer())
         yield self.loop()
-        self.box.fetch_for_processing.assert_called_once_with('one_item')
+        self.box.reserve_batch.assert_called_once_with(['one_item'])
+
+    @defer.inlineCallbacks
+    def test_items_not_reserved_are_skipped(self):
+        items = ['one', 'two', 'three']
+        self._set_pending_items(items, reserved=['one', 'three'])
+        consumer = GoodConsumer()
+        self.loop.add_consumer(consumer)
+        yield self.loop()
+        self.assertEquals(['one', 'three'], consumer.processed)
+        self.box.delete_batch.assert_called_once_with(['one', 'three'])
+
+    @defer.inlineCallbacks
+    def test_items_are_processed_in_batches(self):
+        items = ['one', 'two', 'three']
+        self._set_pending_items(items)
+        self.loop.batch_size = 2
+        self.loop.add_consumer(GoodConsumer())
+        yield self.loop()
+        self.box.reserve_batch.assert_has_calls(
+            [call(['one', 'two']), call(['three'])])
+        self.box.delete_batch.assert_has_calls(
+            [call(['one', 'two']), call(['three'])])
 
     @defer.inlineCallbacks
     def test_no_consumers(self):
         items = ['one', 'two', 'three']
         self._set_pending_items(items)
         yield self.loop()
-        self.box.fetch_for_processing.assert_not_called()
-        self.box.delete.assert_not_called()
+        self.box.reserve_batch.assert_not_called()
+        self.box.delete_batch.assert_not_called()
 
     @defer.inlineCallbacks
     def test_pending_list_with_multiple_items(self):
@@ -94,7 +119,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         self.loop.add_consumer(consumer)
         yield self.loop()
         calls = [call('one'), call('two'), call('three')]
-        self.box.fetch_for_processing.assert_has_calls(calls)
+        self.box.get.assert_has_calls(calls)
 
     @defer.inlineCallbacks
     def test_good_consumer_process_all(self):
@@ -133,7 +158,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = GoodConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.set_processed.assert_has_calls([call(x) for x in items])
+        self.box.set_processed_batch.assert_called_once_with(items)
 
     @defer.inlineCallbacks
     def test_good_consumer_deletes_items(self):
@@ -142,7 +167,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = GoodConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.delete.assert_has_calls([call(x) for x in items])
+        self.box.delete_batch.assert_called_once_with(items)
 
     @defer.inlineCallbacks
     def test_processing_failed_doesnt_mark_as_processed(self):
@@ -151,7 +176,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = ProcessingFailedConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.set_processed.assert_not_called()
+        self.box.set_processed_batch.assert_not_called()
 
     @defer.inlineCallbacks
     def test_processing_failed_doesnt_delete(self):
@@ -160,7 +185,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = ProcessingFailedConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.delete.assert_not_called()
+        self.box.delete_batch.assert_not_called()
 
     @defer.inlineCallbacks
     def test_processing_failed_marks_as_failed(self):
@@ -169,7 +194,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = ProcessingFailedConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.set_failed.assert_has_calls([call(x) for x in items])
+        self.box.set_failed_batch.assert_called_once_with(items)
 
     @defer.inlineCallbacks
     def test_saving_failed_marks_as_processed(self):
@@ -178,7 +203,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = SavingFailedConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.set_processed.assert_has_calls([call(x) for x in items])
+        self.box.set_processed_batch.assert_called_once_with(items)
 
     @defer.inlineCallbacks
     def test_saving_failed_doesnt_delete(self):
@@ -187,7 +212,7 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = SavingFailedConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.delete.assert_not_called()
+        self.box.delete_batch.assert_not_called()
 
     @defer.inlineCallbacks
     def test_saving_failed_marks_as_failed(self):
@@ -196,7 +221,21 @@ class IncomingBoxProcessingTestCase(unittest.TestCase):
         consumer = SavingFailedConsumer()
         self.loop.add_consumer(consumer)
         yield self.loop()
-        self.box.set_failed.assert_has_calls([call(x) for x in items])
+        self.box.set_failed_batch.assert_called_once_with(items)
+
+    @defer.inlineCallbacks
+    def test_items_that_can_not_be_fetched_are_marked_as_failed(self):
+        items = ['one', 'two', 'three']
+        self._set_pending_items(items)
+        fetched = {'one': defer.succeed(None), 'two': defer.fail(Exception())}
+        self.box.get.side_effect = \
+            lambda item: fetched.get(item, defer.succeed(item))
+        consumer = GoodConsumer()
+        self.loop.add_consumer(consumer)
+        yield self.loop()
+        self.assertEquals(['three'], consumer.processed)
+        self.box.set_failed_batch.assert_called_once_with(['one', 'two'])
+        self.box.delete_batch.assert_called_once_with(['three'])
 
 
 class IncomingBoxCase(unittest.TestCase):
@@ -247,3 +286,20 @@ class IncomingBoxCase(unittest.TestCase):
             namespace=self.namespace,
             order_by='+date',
             filter_flag=Flags.PENDING)
+
+    @defer.inlineCallbacks
+    def test_reserve_batch_returns_reserved_blobs(self):
+        self.manager.set_flags_batch.return_value = defer.succeed(
+            {'one': 200, 'two': 404})
+        reserved = yield self.box.reserve_batch(['one', 'two'])
+        self.assertEquals(['one'], reserved)
+        self.manager.set_flags_batch.assert_called_with(
+            [('one', [Flags.PROCESSING]), ('two', [Flags.PROCESSING])],
+            namespace=self.namespace)
+
+    @defer.inlineCallbacks
+    def test_delete_batch_deletes_from_namespace(self):
+        self.manager.delete_batch.return_value = defer.succeed({})
+        yield self.box.delete_batch(['one', 'two'])
+        self.manager.delete_batch.assert_called_with(
+            ['one', 'two'], namespace=self.namespace)
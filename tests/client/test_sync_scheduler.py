@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# test_sync_scheduler.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the background sync scheduler.
+"""
+from mock import Mock
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web._newclient import ResponseDone
+from twisted.web.http_headers import Headers
+
+from leap.soledad.client._sync_scheduler import SyncScheduler
+from leap.soledad.client.http_target.support import ReadBodyProtocol
+from leap.soledad.common.l2db import errors
+
+
+class SyncSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.syncs = []
+        self.scheduler = SyncScheduler(self._sync, clock=self.clock)
+        self.scheduler.change_threshold = 5
+        self.scheduler.quiet_period = 10
+        self.scheduler.interval = 100
+        self.scheduler.min_backoff = 10
+        self.scheduler.max_backoff = 60
+
+    def _sync(self):
+        d = defer.Deferred()
+        self.syncs.append(d)
+        return d
+
+    def _start(self):
+        # the first sync starts right away
+        self.scheduler.start()
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.syncs))
+        self.clock.advance(1)
+        self.syncs[-1].callback(None)
+
+    def test_sync_after_quiet_period(self):
+        self._start()
+        self.scheduler.local_change()
+        self.clock.advance(8)
+        self.scheduler.local_change()
+        self.clock.advance(8)
+        self.assertEqual(1, len(self.syncs))
+        self.clock.advance(2)
+        self.assertEqual(2, len(self.syncs))
+
+    def test_sync_when_changes_cross_threshold(self):
+        self._start()
+        self.scheduler.local_change(4)
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.syncs))
+        self.scheduler.local_change()
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.syncs))
+
+    def test_periodic_sync_without_changes(self):
+        self._start()
+        self.clock.advance(99)
+        self.assertEqual(1, len(self.syncs))
+        self.clock.advance(1)
+        self.assertEqual(2, len(self.syncs))
+
+    def test_requests_during_sync_are_coalesced(self):
+        self._start()
+        first = self.scheduler.sync_now()
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.syncs))
+        results = []
+        for _ in range(3):
+            self.scheduler.local_change(5)
+            self.scheduler.sync_now().addCallback(results.append)
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.syncs))
+        self.syncs[1].callback('first')
+        self.assertEqual('first', self.successResultOf(first))
+        self.assertEqual([], results)
+        self.clock.advance(0)
+        self.assertEqual(3, len(self.syncs))
+        self.syncs[2].callback('second')
+        self.assertEqual(['second'] * 3, results)
+
+    def test_exponential_backoff_on_failures(self):
+        self._start()
+        delays = []
+        self.scheduler.sync_now().addErrback(lambda _: None)
+        self.clock.advance(0)
+        for i in range(4):
+            self.syncs[-1].errback(errors.Unavailable())
+            self.scheduler.sync_now().addErrback(lambda _: None)
+            delays.append(self.scheduler.next_sync - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual([10, 20, 40, 60], delays)
+        # a success resets the backoff
+        self.syncs[-1].callback(None)
+        self.scheduler.local_change(5)
+        self.clock.advance(0)
+        self.assertEqual(7, len(self.syncs))
+
+    def test_changes_of_failed_sync_are_kept(self):
+        self._start()
+        self.scheduler.local_change(5)
+        self.clock.advance(0)
+        self.syncs[-1].errback(errors.HTTPError(500))
+        self.assertEqual(10, self.scheduler.next_sync - self.clock.seconds())
+        self.clock.advance(10)
+        self.assertEqual(3, len(self.syncs))
+
+    def test_retry_after_from_server(self):
+        self._start()
+        d = self.scheduler.sync_now()
+        self.clock.advance(0)
+        headers = Headers({'Retry-After': ['120']})
+        self.syncs[-1].errback(errors.Unavailable('busy', headers))
+        self.failureResultOf(d, errors.Unavailable)
+        self.assertEqual(120, self.scheduler.next_sync - self.clock.seconds())
+
+    def test_retry_after_is_kept_from_error_responses(self):
+        headers = Headers({'Retry-After': ['30']})
+        response = Mock(code=503, phrase='', headers=headers)
+        d = defer.Deferred()
+        protocol = ReadBodyProtocol(response, d)
+        protocol.dataReceived('{"error": "unavailable"}')
+        protocol.connectionLost(Failure(ResponseDone()))
+        error = self.failureResultOf(d, errors.Unavailable).value
+        self.assertEqual(30, self.scheduler._retry_after(error))
+
+    def test_retry_after_as_http_date(self):
+        self.clock.advance(1500000000)
+        error = errors.HTTPError(
+            503, headers={'retry-after': 'Fri, 14 Jul 2017 02:41:40 GMT'})
+        self.assertEqual(1500000100, self.scheduler._retry_after(error)
+                         + self.clock.seconds())
+
+    def test_no_syncs_after_stop(self):
+        self._start()
+        self.scheduler.stop()
+        self.scheduler.local_change(5)
+        self.clock.advance(1000)
+        self.assertEqual(1, len(self.syncs))
+        self.assertIsNone(self.scheduler.next_sync)
+
+    def test_stats(self):
+        self._start()
+        self.clock.advance(100)
+        self.clock.advance(3)
+        self.syncs[-1].callback(None)
+        stats = self.scheduler.get_stats()
+        self.assertEqual(2, stats['syncs'])
+        self.assertEqual(0, stats['failed_syncs'])
+        self.assertEqual(3, stats['last_latency'])
+        self.assertEqual(2, stats['mean_latency'])
+        self.assertEqual(3, stats['max_latency'])
+        self.assertEqual(101, stats['mean_interval'])
+        self.assertEqual(204, stats['next_sync'])
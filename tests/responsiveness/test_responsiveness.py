@@ -1,6 +1,12 @@
 import pytest
 
+from io import BytesIO
+from uuid import uuid4
+
 from twisted.internet import defer
+from twisted.web.client import FileBodyProducer
+
+from leap.soledad.server._blobs import FilesystemBlobsBackend
 
 
 @pytest.inlineCallbacks
@@ -48,3 +54,49 @@ def create_download(downloads, size):
 test_responsiveness_download_10_1000k = create_download(10, 1000 * 1000)
 test_responsiveness_download_100_100k = create_download(100, 100 * 1000)
 test_responsiveness_download_1000_10k = create_download(1000, 10 * 1000)
+
+
+def create_blobs_fs_backend(amount, size):
+
+    @pytest.mark.responsiveness
+    @pytest.inlineCallbacks
+    def _test(payload, watchdog, tmpdir):
+        backend = FilesystemBlobsBackend(blobs_path=tmpdir.strpath)
+        data = payload(size)
+
+        @pytest.inlineCallbacks
+        def _operate():
+            # write, inspect and flag many blobs concurrently, then delete them
+            semaphore = defer.DeferredSemaphore(100)
+
+            @pytest.inlineCallbacks
+            def _blob_lifecycle(blob_id):
+                producer = FileBodyProducer(BytesIO(data))
+                yield backend.write_blob('user', blob_id, producer)
+                yield backend.get_blob_size('user', blob_id)
+                yield backend.get_tag('user', blob_id)
+                yield backend.set_flags('user', blob_id, ['PROCESSED'])
+                yield backend.get_flags('user', blob_id)
+
+            deferreds = []
+            for i in xrange(amount):
+                d = semaphore.run(_blob_lifecycle, uuid4().hex)
+                deferreds.append(d)
+            yield defer.gatherResults(deferreds)
+            blob_ids = yield backend.list_blobs(
+                'user', filter_flag='PROCESSED')
+            deferreds = []
+            for blob_id in blob_ids:
+                d = semaphore.run(backend.delete_blob, 'user', blob_id)
+                deferreds.append(d)
+            yield defer.gatherResults(deferreds)
+
+        yield watchdog(_operate)
+
+    return _test
+
+
+test_responsiveness_blobs_fs_backend_100_100k = \
+    create_blobs_fs_backend(100, 100 * 1000)
+test_responsiveness_blobs_fs_backend_1000_10k = \
+    create_blobs_fs_backend(1000, 10 * 1000)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# common.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Fakes shared by the tests of the sync resource.
+"""
+import json
+
+from io import BytesIO
+
+from leap.soledad.common.document import ServerDocument
+from leap.soledad.server import HTTPInvocationByMethodWithBody
+
+
+class FakeSyncResource(object):
+    """
+    A sync resource that records the arguments and documents it receives.
+    """
+
+    max_request_size = float('inf')
+    max_entry_size = 1024 * 1024
+
+    def __init__(self):
+        self.puts = []
+
+    def post_args(self, args, content):
+        self.args = json.loads(content)
+
+    def post_put(self, args, content):
+        self.puts.append((json.loads(content), args['content']))
+
+    def post_end(self):
+        return 'end'
+
+    def post_get(self, binary=False):
+        return binary
+
+
+class FakeDatabase(object):
+    """
+    A database with a list of (doc_id, gen, trans_id) changes, whose
+    generation is the one of its last change unless given.
+    """
+
+    def __init__(self, changes, generation=None):
+        self.changes = list(changes)
+        self.generation = generation
+
+    def _get_generation_info(self):
+        if self.generation is not None:
+            return self.generation
+        _, gen, trans_id = self.changes[-1]
+        return gen, trans_id
+
+    def whats_changed(self, old_generation=0):
+        gen, trans_id = self._get_generation_info()
+        return gen, trans_id, self.changes[old_generation:]
+
+    def get_docs(self, doc_ids, **kwargs):
+        existing = set(doc_id for doc_id, _, _ in self.changes)
+        return (ServerDocument(doc_id, 'rev-' + doc_id)
+                for doc_id in doc_ids if doc_id in existing)
+
+
+def invoke(resource, body, content_type, **environ):
+    """
+    Invoke a sync resource with a POST request.
+    """
+    environ.update({
+        'QUERY_STRING': '',
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': content_type,
+        'wsgi.input': BytesIO(body),
+    })
+    return HTTPInvocationByMethodWithBody(resource, environ, resource)()
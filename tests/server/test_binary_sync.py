@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# test_binary_sync.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for syncing documents in binary format.
+"""
+from twisted.trial import unittest
+
+from leap.soledad.client import _crypto
+from leap.soledad.client.http_target.support import RequestBody
+from leap.soledad.client.http_target.support import BinaryRequestBody
+from leap.soledad.common import sync_frames
+from leap.soledad.common.l2db.remote import http_app
+
+from .common import FakeSyncResource
+from .common import invoke
+
+
+class BinarySyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        info = _crypto.DocInfo('doc-1', 'rev-1')
+        self.encrypted = _crypto.encrypt_payload(info, '{"a": 1}', 'A' * 96)
+        self.contents = [self.encrypted, '{"b": "\\r\\n"}', None]
+
+    def _make_body(self, body_class, contents):
+        body = body_class(last_known_generation=0)
+        for i, content in enumerate(contents):
+            body.insert_info(
+                id='doc-%d' % i, rev='rev', content=content, gen=i,
+                trans_id='T-%d' % i, number_of_docs=len(contents),
+                doc_idx=i + 1)
+        return str(body)
+
+    def test_blob_round_trip(self):
+        blob = sync_frames.content_to_blob(self.encrypted)
+        assert isinstance(blob, sync_frames.Blob)
+        frame = sync_frames.encode_frame(blob)
+        header, data = frame.split('\r\n', 1)
+        kind, size = sync_frames.parse_frame_header(header)
+        assert (kind, size) == ('blob', len(data))
+        assert sync_frames.decode_frame(kind, data) == self.encrypted
+
+    def test_content_that_does_not_convert_back_is_sent_as_is(self):
+        assert sync_frames.content_to_blob('{"raw": "a QQ=="}') == 'a A'
+        for content in ['{"a": 1}', '{"raw": "a b"}', '{"raw": "a QR=="}',
+                        '{"raw":  "a QQ=="}', '{"raw": "a\\u0020QQ=="}']:
+            assert sync_frames.content_to_blob(content) is None
+
+    def test_binary_put_gives_the_same_documents(self):
+        default = FakeSyncResource()
+        body = self._make_body(RequestBody, self.contents)
+        invoke(default, body, 'application/x-soledad-sync-put')
+
+        binary = FakeSyncResource()
+        contents = [sync_frames.content_to_blob(self.encrypted)]
+        contents += self.contents[1:]
+        body = self._make_body(BinaryRequestBody, contents)
+        result = invoke(binary, body, sync_frames.BINARY_PUT)
+
+        assert result == 'end'
+        assert binary.args == default.args
+        assert len(binary.puts) == 3
+        assert binary.puts == default.puts
+        assert binary.puts[0][1] == self.encrypted
+
+    def test_binary_put_with_truncated_frame(self):
+        body = self._make_body(BinaryRequestBody, ['{"b": 2}'])
+        body = body.replace('json 8', 'json 80')
+        with self.assertRaises(http_app.BadRequest):
+            invoke(FakeSyncResource(), body, sync_frames.BINARY_PUT)
+
+    def test_binary_put_with_invalid_frame(self):
+        body = self._make_body(BinaryRequestBody, ['{"b": 2}'])
+        body = body.replace('json 8', 'text 8')
+        with self.assertRaises(http_app.BadRequest):
+            invoke(FakeSyncResource(), body, sync_frames.BINARY_PUT)
+
+    def test_get_in_binary_format_if_accepted(self):
+        body = '[\r\n{"last_known_generation": 0}\r\n]'
+        content_type = 'application/x-soledad-sync-get'
+        assert not invoke(FakeSyncResource(), body, content_type)
+        assert invoke(FakeSyncResource(), body, content_type,
+                      HTTP_ACCEPT=sync_frames.BINARY_STREAM)
@@ -17,18 +17,22 @@
 """
 Integration tests for blobs server
 """
+import json
 import os
 import pytest
 import re
+import time
 import treq
 from urlparse import urljoin
 from uuid import uuid4
 from io import BytesIO
 from twisted.trial import unittest
+from twisted.web.client import FileBodyProducer
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 from twisted.internet import reactor
 from twisted.internet import defer
+from twisted.internet import task
 from treq._utils import set_global_pool
 
 from leap.soledad.common.blobs import Flags
@@ -61,7 +65,9 @@ class BlobServerTestCase(unittest.TestCase):
     def setUp(self):
         client_blobs.sync.MAX_WAIT = 0.1
         blobs_resource = server_blobs.BlobsResource("filesystem", self.tempdir)
+        self.resource = blobs_resource
         stream_resource = StreamingResource("filesystem", self.tempdir)
+        self.stream_resource = stream_resource
         root = Resource()
         root.putChild('blobs', blobs_resource)
         root.putChild('stream', stream_resource)
@@ -189,6 +195,56 @@ class BlobServerTestCase(unittest.TestCase):
         blobs_list = yield manager.remote_list()
         self.assertEquals(set(['blob_id1', 'blob_id2']), set(blobs_list))
 
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_bulk_set_flags_and_delete(self):
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, uuid4().hex)
+        self.addCleanup(manager.close)
+        for blob_id in ['blob1', 'blob2', 'blob3']:
+            yield manager._encrypt_and_upload(
+                blob_id, BytesIO(blob_id), namespace='ns')
+        results = yield manager.set_flags_batch(
+            [('blob1', [Flags.PROCESSING]), ('blob2', [Flags.PROCESSED]),
+             ('blob3', ['invalid']), ('missing', [Flags.PROCESSED])],
+            namespace='ns')
+        self.assertEquals(
+            {'blob1': 200, 'blob2': 200, 'blob3': 406, 'missing': 404},
+            results)
+        flags = yield manager.get_flags('blob2', namespace='ns')
+        self.assertEquals([Flags.PROCESSED], flags)
+        results = yield manager.delete_batch(
+            ['blob1', 'blob2', 'missing'], namespace='ns')
+        self.assertEquals(
+            {'blob1': 200, 'blob2': 200, 'missing': 404}, results)
+        blobs_list = yield manager.remote_list(namespace='ns')
+        self.assertEquals(['blob3'], blobs_list)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_bulk_operations_are_split_in_requests(self):
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, uuid4().hex)
+        self.addCleanup(manager.close)
+        manager.bulk_size = 2
+        for blob_id in ['blob1', 'blob2', 'blob3']:
+            yield manager._encrypt_and_upload(blob_id, BytesIO(blob_id))
+        results = yield manager.set_flags_batch(
+            [(blob_id, [Flags.PENDING])
+             for blob_id in ['blob1', 'blob2', 'blob3']])
+        self.assertEquals([200, 200, 200], results.values())
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_bulk_request_limit(self):
+        self.patch(server_blobs.BlobsResource, 'max_bulk_items', 2)
+        user = uuid4().hex
+        uri = urljoin(self.uri, user + '/')
+        data = json.dumps({'delete': ['a', 'b', 'c']})
+        res = yield treq.post(uri, data=data, persistent=False)
+        yield res.content()
+        self.assertEquals(413, res.code)
+
     @defer.inlineCallbacks
     @pytest.mark.usefixtures("method_tmpdir")
     def test_list_orders_by_date(self):
@@ -263,6 +319,33 @@ class BlobServerTestCase(unittest.TestCase):
         result = yield manager.local.get(blob_id2, namespace)
         self.assertEquals(content2, result.getvalue())
 
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_downstream_reads_through_the_backend(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id,
+                              remote_stream=self.stream_uri)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', 'test'
+        yield manager._encrypt_and_upload(blob_id, BytesIO(content))
+        backend = self.stream_resource._handler
+        reads = []
+        read_blob = backend.read_blob
+        self.patch(backend, 'read_blob',
+                   lambda *args: reads.append(args[1]) or read_blob(*args))
+        # reads are isolated from relocations of the user's blobs
+        gate = backend._gate
+        yield gate.close(user_id)
+        d = manager._downstream([blob_id])
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertFalse(d.called)
+        gate.open(user_id)
+        yield d
+        result = yield manager.local.get(blob_id)
+        self.assertEquals(content, result.getvalue())
+        self.assertEquals([blob_id], reads)
+
     @defer.inlineCallbacks
     @pytest.mark.usefixtures("method_tmpdir")
     def test_upstream_from_namespace(self):
@@ -280,6 +363,34 @@ class BlobServerTestCase(unittest.TestCase):
                                                            namespace='test')
             self.assertEquals(got_blob[0].getvalue(), "X" * i)
 
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_upstream_checks_quota_and_existing_blobs(self):
+        uri = urljoin(self.stream_uri, 'user')
+        handler = self.resource._handler
+        producer = FileBodyProducer(BytesIO('old'))
+        yield handler.write_blob('user', 'blob1', producer)
+        blobs = [('blob1', 'A' * 20), ('blob2', 'B' * 30)]
+        data = json.dumps([(blob_id, len(c)) for blob_id, c in blobs])
+        data += '\n' + ''.join(c for _, c in blobs)
+        response = yield treq.post(uri, params={'direction': 'upload'},
+                                   data=data, persistent=False)
+        yield treq.content(response)
+        self.assertEquals(200, response.code)
+        blob1 = handler._get_path('user', 'blob1')
+        blob2 = handler._get_path('user', 'blob2')
+        self.assertEquals('old', open(blob1).read())
+        self.assertEquals('B' * 30, open(blob2).read())
+        self.assertFalse(os.path.exists(blob2 + '.part'))
+        self.stream_resource._handler.quota = 0
+        data = json.dumps([('blob3', 10)]) + '\n' + 'C' * 10
+        response = yield treq.post(uri, params={'direction': 'upload'},
+                                   data=data, persistent=False)
+        yield treq.content(response)
+        self.assertEquals(507, response.code)
+        blob3 = handler._get_path('user', 'blob3')
+        self.assertFalse(os.path.exists(blob3))
+
     @defer.inlineCallbacks
     @pytest.mark.usefixtures("method_tmpdir")
     def test_download_from_namespace(self):
@@ -445,6 +556,47 @@ class BlobServerTestCase(unittest.TestCase):
         self.assertEquals(set(['blob_id2']), set(blobs_list))
         self.assertEquals(set(['blob_id1']), set(deleted_blobs_list))
 
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_list_deletions_since_cursor(self):
+        manager = BlobManager('', self.uri, self.secret,
+                              self.secret, uuid4().hex)
+        yield manager._encrypt_and_upload('blob_id1', BytesIO("1"))
+        yield manager._encrypt_and_upload('blob_id2', BytesIO("2"))
+        yield manager._delete_from_remote('blob_id1')
+        result = yield manager.remote_list_deletions()
+        self.assertEquals(['blob_id1'], result['deleted'])
+        self.assertFalse(result['expired'])
+        yield manager._delete_from_remote('blob_id2')
+        # cursors are kept behind the time of listing, so move it forward
+        result = yield manager.remote_list_deletions(
+            since=result['cursor'] + self.resource.deletions_cursor_margin)
+        self.assertEquals(['blob_id2'], result['deleted'])
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_sync_applies_deletions_after_cursor_expired(self):
+        self.resource._deletions_retention = 60
+        user = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user)
+        self.addCleanup(manager.close)
+        for blob_id in ['blob_id1', 'blob_id2']:
+            doc = BlobDoc(BytesIO(blob_id), blob_id)
+            yield manager.put(doc, len(blob_id))
+        yield manager.sync()
+        yield manager._delete_from_remote('blob_id1')
+        # deletion markers are expired and the cursor is too old
+        yield self.resource._handler.expire_deletions(time.time() + 1)
+        yield manager.local.set_deletions_cursor(time.time() - 3600)
+        yield manager.sync()
+        local_list = yield manager.local_list()
+        self.assertEquals(['blob_id2'], local_list)
+        remote_list = yield manager.remote_list()
+        self.assertEquals(['blob_id2'], remote_list)
+        cursor = yield manager.local.get_deletions_cursor()
+        self.assertTrue(cursor > time.time() - 3600)
+
     @defer.inlineCallbacks
     @pytest.mark.usefixtures("method_tmpdir")
     def test_get_fails_if_no_blob_found(self):
@@ -479,7 +631,296 @@ class BlobServerTestCase(unittest.TestCase):
         self.assertTrue(res.headers.hasHeader('content-range'))
         content_range = res.headers.getRawHeaders('content-range').pop()
         self.assertIsNotNone(re.match('^bytes 10-20/[0-9]+$', content_range))
-        self.assertEqual(10, len(text))
+        self.assertEqual(11, len(text))
+        res = yield _get(uri, headers={'Range': 'bytes=0-0'})
+        text = yield res.text()
+        self.assertEqual(206, res.code)
+        content_range = res.headers.getRawHeaders('content-range').pop()
+        self.assertIsNotNone(re.match('^bytes 0-0/[0-9]+$', content_range))
+        self.assertEqual(1, len(text))
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_get_multiple_ranges(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', '0123456789'
+        doc = BlobDoc(BytesIO(content), blob_id)
+        yield manager.put(doc, len(content))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, blob_id))
+        res = yield _get(uri)
+        full = yield res.content()
+        res = yield _get(uri, headers={'Range': 'bytes=0-5, 10-15'})
+        body = yield res.content()
+        self.assertEqual(206, res.code)
+        content_type = res.headers.getRawHeaders('content-type').pop()
+        match = re.match('^multipart/byteranges; boundary=(.+)$', content_type)
+        boundary = match.group(1)
+        parts = body.split('--%s' % boundary)
+        self.assertEqual(['\r\n', '--\r\n'], [parts[0], parts[-1]])
+        ranges = re.findall(r'Content-Range: bytes (\d+)-(\d+)/', body)
+        self.assertEqual([('0', '5'), ('10', '15')], ranges)
+        data = [part.split('\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]]
+        self.assertEqual([full[0:6], full[10:16]], data)
+        self.assertEqual(len(body), res.length)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_overlapping_ranges_are_merged(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', '0123456789'
+        doc = BlobDoc(BytesIO(content), blob_id)
+        yield manager.put(doc, len(content))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, blob_id))
+        res = yield _get(uri)
+        full = yield res.content()
+        res = yield _get(uri, headers={'Range': 'bytes=20-21, 3-8, 0-5, 9-9'})
+        body = yield res.content()
+        self.assertEqual(206, res.code)
+        ranges = re.findall(r'Content-Range: bytes (\d+)-(\d+)/', body)
+        self.assertEqual([('0', '9'), ('20', '21')], ranges)
+        boundary = res.headers.getRawHeaders('content-type').pop().split(
+            'boundary=')[1]
+        parts = body.split('--%s' % boundary)
+        data = [part.split('\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]]
+        self.assertEqual([full[0:10], full[20:22]], data)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_too_many_ranges_get_the_whole_blob(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', '0123456789'
+        doc = BlobDoc(BytesIO(content), blob_id)
+        yield manager.put(doc, len(content))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, blob_id))
+        res = yield _get(uri)
+        full = yield res.content()
+        many = ','.join('%d-%d' % (i, i) for i in range(0, 34, 2))
+        # ranges that add up to more than the blob are not sent either
+        for ranges in [many, '0-,0-', '0-,-1']:
+            res = yield _get(uri, headers={'Range': 'bytes=' + ranges})
+            self.assertEqual(200, res.code)
+            self.assertEqual(full, (yield res.content()))
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_conditional_get(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', '0123456789'
+        doc = BlobDoc(BytesIO(content), blob_id)
+        yield manager.put(doc, len(content))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, blob_id))
+        res = yield _get(uri)
+        yield res.content()
+        etag = res.headers.getRawHeaders('etag').pop()
+        tag = res.headers.getRawHeaders('tag').pop()
+        self.assertEqual('"%s"' % tag, etag)
+        res = yield _get(uri, headers={'If-None-Match': etag})
+        body = yield res.content()
+        self.assertEqual(304, res.code)
+        self.assertEqual('', body)
+        res = yield _get(uri, headers={'If-None-Match': '"other"'})
+        yield res.content()
+        self.assertEqual(200, res.code)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_download_resumes_partial_blob(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', 'content' * 100
+        yield manager._encrypt_and_upload(blob_id, BytesIO(content))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, blob_id))
+        res = yield _get(uri)
+        ciphertext = yield res.content()
+        etag = res.headers.getRawHeaders('etag').pop()
+        # store part of the blob as if a download was interrupted
+        partial = manager._get_partial_download(blob_id, '')
+        partial.start(etag, len(ciphertext))
+        partial.write(ciphertext[:100])
+        partial.close()
+        self.assertEqual(
+            {'Range': ['bytes=100-'], 'If-Range': [etag]},
+            partial.get_headers())
+        blob, size = yield manager._download_and_decrypt(blob_id)
+        self.assertEqual(content, blob.getvalue())
+        self.assertFalse(os.path.isfile(partial.path))
+
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_partial_download_checks_content_range(self):
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, uuid4().hex)
+        self.addCleanup(manager.close)
+        partial = manager._get_partial_download('blob_id', '')
+        partial.start('"etag"', 200)
+        partial.write('X' * 100)
+        partial.close()
+        self.assertTrue(partial.continues('bytes 100-199/200'))
+        self.assertTrue(partial.continues('bytes 100-199/*'))
+        self.assertFalse(partial.continues('bytes 100-200/200'))
+        self.assertFalse(partial.continues('bytes 99-199/200'))
+        self.assertFalse(partial.continues('bytes */200'))
+        self.assertFalse(partial.continues(None))
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_download_revalidates_complete_blob(self):
+        user_id = uuid4().hex
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, user_id)
+        self.addCleanup(manager.close)
+        blob_id, content = 'blob_id', 'content'
+        yield manager._encrypt_and_upload(blob_id, BytesIO(content))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, blob_id))
+        res = yield _get(uri)
+        ciphertext = yield res.content()
+        etag = res.headers.getRawHeaders('etag').pop()
+        partial = manager._get_partial_download(blob_id, '')
+        partial.start(etag, len(ciphertext))
+        partial.write(ciphertext)
+        partial.close()
+        self.assertEqual({'If-None-Match': [etag]}, partial.get_headers())
+        blob, size = yield manager._download_and_decrypt(blob_id)
+        self.assertEqual(content, blob.getvalue())
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_upload_in_chunks(self):
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, uuid4().hex)
+        self.addCleanup(manager.close)
+        manager.upload_chunk_size = 100
+        blob_id, content = 'blob_id', 'content' * 100
+        yield manager._encrypt_and_upload(blob_id, BytesIO(content))
+        partial = manager._get_partial_upload(blob_id, '')
+        self.assertFalse(os.path.isfile(partial.path))
+        blob, size = yield manager._download_and_decrypt(blob_id)
+        self.assertEqual(content, blob.getvalue())
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_upload_resumes_from_committed_offset(self):
+        manager = BlobManager(self.tempdir, self.uri, self.secret,
+                              self.secret, uuid4().hex)
+        self.addCleanup(manager.close)
+        manager.upload_chunk_size = 100
+        blob_id, content = 'blob_id', 'content' * 100
+        put, offsets = manager._client.put, []
+
+        def _put(uri, **kwargs):
+            offsets.append(kwargs['params'].get('offset'))
+            if len(offsets) == 3:
+                raise Exception('connection lost')
+            return put(uri, **kwargs)
+
+        manager._client.put = _put
+        with pytest.raises(Exception):
+            yield manager._encrypt_and_upload(blob_id, BytesIO(content))
+        yield manager._encrypt_and_upload(blob_id, BytesIO(content))
+        # the chunk that failed is sent again, and the others only once
+        self.assertEqual([0, 100, 200, 200], offsets[:4])
+        self.assertEqual(len(offsets), len(set(offsets)) + 1)
+        blob, size = yield manager._download_and_decrypt(blob_id)
+        self.assertEqual(content, blob.getvalue())
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_upload_chunk_at_wrong_offset(self):
+        user_id = uuid4().hex
+        uri = urljoin(self.uri, '%s/%s' % (user_id, 'blob_id'))
+        res = yield treq.post(uri, data=BytesIO(json.dumps({'length': 40})),
+                              params={'upload': 'start'}, persistent=False)
+        upload = (yield res.json())['upload']
+        params = {'upload': upload, 'offset': 20}
+        res = yield treq.put(uri, data=BytesIO('a' * 20), params=params,
+                             persistent=False)
+        self.assertEqual(416, res.code)
+        self.assertEqual({'upload': upload, 'offset': 0}, (yield res.json()))
+        params['offset'] = 0
+        res = yield treq.put(uri, data=BytesIO('a' * 20), params=params,
+                             persistent=False)
+        self.assertEqual({'upload': upload, 'offset': 20}, (yield res.json()))
+        # finalizing an incomplete upload also tells where it stopped
+        res = yield treq.post(uri, params={'upload': upload},
+                              persistent=False)
+        self.assertEqual(416, res.code)
+        yield res.content()
+        res = yield _get(uri, params={'upload': upload})
+        self.assertEqual({'upload': upload, 'offset': 20}, (yield res.json()))
+        params['offset'] = 20
+        res = yield treq.put(uri, data=BytesIO('b' * 20), params=params,
+                             persistent=False)
+        yield res.content()
+        res = yield treq.post(uri, params={'upload': upload},
+                              persistent=False)
+        self.assertEqual(200, res.code)
+        yield res.content()
+        res = yield _get(uri)
+        self.assertEqual('a' * 20 + 'b' * 20, (yield res.content()))
+        res = yield _get(uri, params={'upload': upload})
+        self.assertEqual(404, res.code)
+        yield res.content()
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_uploads_count_towards_quota(self):
+        user_id = uuid4().hex
+        self.resource._handler.quota = 1
+        # the disk usage of the user's directory depends on the filesystem
+        self.patch(self.resource._handler, 'get_total_storage',
+                   lambda user: defer.succeed(0))
+        uri = urljoin(self.uri, '%s/%s' % (user_id, 'blob_id'))
+        res = yield treq.post(uri, params={'upload': 'start'},
+                              persistent=False)
+        self.assertEqual(400, res.code)
+        yield res.content()
+        res = yield treq.post(uri, data=BytesIO(json.dumps({'length': 600})),
+                              params={'upload': 'start'}, persistent=False)
+        upload = (yield res.json())['upload']
+        # the first upload was not finalized, but its length is reserved
+        other = urljoin(self.uri, '%s/%s' % (user_id, 'other_id'))
+        res = yield treq.post(other, data=BytesIO(json.dumps({'length': 600})),
+                              params={'upload': 'start'}, persistent=False)
+        self.assertEqual(507, res.code)
+        yield res.content()
+        params = {'upload': upload, 'offset': 0}
+        res = yield treq.put(uri, data=BytesIO('a' * 601), params=params,
+                             persistent=False)
+        self.assertEqual(400, res.code)
+        yield res.content()
+        res = yield treq.delete(uri, params={'upload': upload},
+                                persistent=False)
+        yield res.content()
+        res = yield treq.post(other, data=BytesIO(json.dumps({'length': 600})),
+                              params={'upload': 'start'}, persistent=False)
+        self.assertEqual(200, res.code)
+        yield res.content()
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_collect_garbage_expires_abandoned_uploads(self):
+        uri = urljoin(self.uri, '%s/%s' % (uuid4().hex, 'blob_id'))
+        res = yield treq.post(uri, data=BytesIO(json.dumps({'length': 10})),
+                              params={'upload': 'start'}, persistent=False)
+        upload = (yield res.json())['upload']
+        self.resource.uploads_retention = -1
+        yield self.resource.collect_garbage()
+        res = yield _get(uri, params={'upload': upload})
+        self.assertEqual(404, res.code)
+        yield res.content()
 
     @defer.inlineCallbacks
     @pytest.mark.usefixtures("method_tmpdir")
@@ -506,4 +947,4 @@ class BlobServerTestCase(unittest.TestCase):
             res = yield _get(uri, headers={'Range': range})
             self.assertEqual(416, res.code)
             content_range = res.headers.getRawHeaders('content-range').pop()
-            self.assertIsNotNone(re.match('^bytes \*/[0-9]+$', content_range))
+            self.assertIsNotNone(re.match(r'^bytes \*/[0-9]+$', content_range))
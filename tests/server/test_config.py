@@ -67,6 +67,17 @@ class ConfigurationParsingTest(unittest.TestCase):
             'blobs': False,
             'services_tokens_file': '/etc/soledad/services.tokens',
             'blobs_path': '/var/lib/soledad/blobs',
+            'blobs_volumes': [],
+            'blobs_io_threads': 10,
+            'blobs_durability': 'none',
+            'blobs_deletions_ttl': 30,
+            'blobs_backend': 'filesystem',
+            'blobs_s3_url': None,
+            'blobs_s3_bucket': None,
+            'blobs_s3_access_key': None,
+            'blobs_s3_secret_key': None,
+            'blobs_s3_region': 'us-east-1',
+            'blobs_s3_index_path': None,
             'concurrent_blob_writes': 50
         }
         expected = _reflect_environment({'soledad-server': expected})
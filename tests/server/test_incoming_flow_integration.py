@@ -17,7 +17,9 @@
 """
 Integration tests for the complete flow of IncomingBox feature
 """
+import json
 import pytest
+from io import BytesIO
 from uuid import uuid4
 from twisted.trial import unittest
 from twisted.web.server import Site
@@ -95,3 +97,45 @@ class IncomingFlowIntegrationTestCase(unittest.TestCase):
         self.loop.add_consumer(consumer)
         yield self.loop()
         self.assertIn('msg1', consumer.processed)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_consume_many_messages_with_few_requests(self):
+        messages = [('msg%d' % i, 'blob') for i in range(10)]
+        yield self.fill(messages)
+        consumer = GoodConsumer()
+        self.loop.add_consumer(consumer)
+        post = self.blob_manager._client.post
+        self.posts = 0
+
+        def _post(*args, **kwargs):
+            self.posts += 1
+            return post(*args, **kwargs)
+        self.blob_manager._client.post = _post
+        yield self.loop()
+        self.assertEquals(sorted(m for m, _ in messages),
+                          sorted(consumer.saved))
+        # reserve, mark as processed and delete
+        self.assertEquals(3, self.posts)
+        pending = yield self.box.list_pending()
+        self.assertEquals([], pending)
+
+    @defer.inlineCallbacks
+    @pytest.mark.usefixtures("method_tmpdir")
+    def test_bulk_delivery_to_many_users(self):
+        other_user = 'user-' + uuid4().hex
+        records = [(self.user_id, 'msg1'), (other_user, 'msg2'),
+                   (self.user_id, 'msg1'), (self.user_id, 'msg3')]
+        body = ''.join(json.dumps([user, message_id, None, 4]) + '\nblob'
+                       for user, message_id in records)
+        response = yield self.client.post(self.incoming_uri,
+                                          data=BytesIO(body))
+        statuses = yield response.json()
+        self.assertEquals([[self.user_id, 'msg1', 200],
+                           [other_user, 'msg2', 200],
+                           [self.user_id, 'msg1', 409],
+                           [self.user_id, 'msg3', 200]], statuses)
+        consumer = GoodConsumer()
+        self.loop.add_consumer(consumer)
+        yield self.loop()
+        self.assertEquals(['msg1', 'msg3'], sorted(consumer.saved))
@@ -17,6 +17,8 @@
 """
 Unit tests for incoming API resource
 """
+import json
+
 from twisted.trial import unittest
 from twisted.web.test.test_web import DummyRequest
 from leap.soledad.server._incoming import IncomingResource
@@ -51,6 +53,34 @@ class IncomingResourceTestCase(unittest.TestCase):
         self.assertEquals(doc_id, doc.doc_id)
         self.assertEquals(formatter.format(content, scheme), doc.content)
 
+    def test_bulk_delivery_opens_each_database_once(self):
+        other_uuid = uuid4().hex
+        records = [(self.user_uuid, 'id1', 'first'),
+                   (other_uuid, 'id2', 'second'),
+                   (self.user_uuid, 'id3', 'third')]
+        body = ''.join(json.dumps([user, doc_id, None, len(content)]) + '\n' +
+                       content for user, doc_id, content in records)
+        request = DummyRequest([''])
+        request.content = BytesIO(body)
+        self.resource.render_POST(request)
+
+        calls = self.backend_factory.open_database.call_args_list
+        self.assertEquals([((self.user_uuid,),), ((other_uuid,),)], calls)
+        docs = [c[0][0] for c in self.couchdb.put_doc.call_args_list]
+        self.assertEquals(['id1', 'id3', 'id2'], [d.doc_id for d in docs])
+        self.assertEquals(
+            [[user, doc_id, 200] for user, doc_id, _ in records],
+            json.loads(''.join(request.written)))
+
+    def test_bulk_delivery_rejects_truncated_message(self):
+        request = DummyRequest([''])
+        request.content = BytesIO(
+            json.dumps([self.user_uuid, 'id', None, 10]) + '\nshort')
+        result = self.resource.render_POST(request)
+        self.assertEquals(400, request.responseCode)
+        self.assertEquals('Invalid bulk delivery', result)
+        self.couchdb.put_doc.assert_not_called()
+
     def test_formatter(self):
         formatter = IncomingFormatter()
         formatted = formatter.format('content', EncryptionSchemes.PUBKEY)
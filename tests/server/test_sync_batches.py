@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# test_sync_batches.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for returning the documents of a sync in many requests.
+"""
+from uuid import uuid4
+
+from twisted.trial import unittest
+
+from leap.soledad.server.sync import SyncExchange
+
+from .common import FakeDatabase
+
+
+class SyncBatchesTestCase(unittest.TestCase):
+
+    def _make_db(self, number_of_docs):
+        return FakeDatabase([('doc-%d' % i, i + 1, 'T-%d' % i)
+                             for i in range(number_of_docs)])
+
+    def _return_docs(self, db, sync_id, received=0, limit=None):
+        sync_exch = SyncExchange(db, 'replica', 0, sync_id)
+        new_gen, number_of_changes = sync_exch.find_changes_to_return()
+        returned = []
+        sync_exch.return_docs(
+            lambda doc, gen, trans_id: returned.append((doc.doc_id, gen)),
+            received=received, limit=limit)
+        return new_gen, number_of_changes, returned
+
+    def test_docs_are_returned_in_batches(self):
+        db = self._make_db(5)
+        sync_id = uuid4().hex
+        assert self._return_docs(db, sync_id, 0, 2) == \
+            (5, 5, [('doc-0', 1), ('doc-1', 2)])
+
+        # the changes of a sync are calculated only once
+        db.changes.append(('doc-5', 6, 'T-5'))
+        assert self._return_docs(db, sync_id, 2, 2) == \
+            (5, 5, [('doc-2', 3), ('doc-3', 4)])
+        assert self._return_docs(db, sync_id, 4, 2) == \
+            (5, 5, [('doc-4', 5)])
+
+    def test_all_docs_are_returned_without_limit(self):
+        new_gen, number_of_changes, returned = self._return_docs(
+            self._make_db(3), uuid4().hex)
+        assert (new_gen, number_of_changes) == (3, 3)
+        assert [doc for doc, _ in returned] == ['doc-0', 'doc-1', 'doc-2']
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# test_sync_compression.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for syncing with request and response bodies compressed with gzip.
+"""
+import os
+import zlib
+
+from io import BytesIO
+
+from twisted.trial import unittest
+
+from leap.soledad.client.http_target.support import RequestBody
+from leap.soledad.common.l2db.remote import http_app
+from leap.soledad.server import HTTPInvocationByMethodWithBody
+from leap.soledad.server.gzip_middleware import GzipMiddleware
+from leap.soledad.server.gzip_middleware import GzipReader
+
+from .common import FakeSyncResource
+
+
+def gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class GzipMiddlewareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.status = None
+        self.headers = None
+        self.written = []
+
+    def _start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = dict(headers)
+        return self.written.append
+
+    def _call(self, app, body='', **environ):
+        environ.setdefault('wsgi.input', BytesIO(body))
+        environ.setdefault('CONTENT_LENGTH', str(len(body)))
+        result = GzipMiddleware(app)(environ, self._start_response)
+        return ''.join(self.written) + ''.join(result)
+
+    def test_response_is_compressed_as_it_is_written(self):
+        chunks = [os.urandom(32).encode('hex') * 1024 for _ in range(8)]
+        streamed = []
+
+        def app(environ, start_response):
+            write = start_response(
+                '200 OK', [('Content-Length', '%d' % len(''.join(chunks)))])
+            for chunk in chunks:
+                write(chunk)
+            # compressed data reached the client before the response ended
+            streamed.append(bool(self.written))
+            return []
+
+        body = self._call(app, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        assert streamed == [True]
+        assert self.headers == {'Content-Encoding': 'gzip'}
+        assert gunzip(body) == ''.join(chunks)
+
+    def test_response_is_not_compressed_if_not_accepted(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return ['ok']
+
+        assert self._call(app) == 'ok'
+        assert self.headers == {'Content-Length': '2'}
+
+    def test_compressed_request_is_decompressed_as_it_is_read(self):
+        resource = FakeSyncResource()
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return HTTPInvocationByMethodWithBody(
+                resource, environ, resource)()
+
+        body = RequestBody(last_known_generation=0)
+        for i in range(3):
+            body.insert_info(id='doc-%d' % i, content='{"a": %d}' % i)
+        body = str(body)
+        result = self._call(
+            app, gzip(body), HTTP_CONTENT_ENCODING='gzip',
+            REQUEST_METHOD='POST', QUERY_STRING='',
+            CONTENT_TYPE='application/x-soledad-sync-put')
+        assert result == 'end'
+        assert resource.args == {'last_known_generation': 0}
+        assert [put[1] for put in resource.puts] == \
+            ['{"a": 0}', '{"a": 1}', '{"a": 2}']
+
+    def test_invalid_compressed_request(self):
+        reader = GzipReader(BytesIO('not gzip'), 8)
+        with self.assertRaises(http_app.BadRequest):
+            reader.read(10)
+
+    def test_reads_are_limited_in_size(self):
+        data = 'a' * 100000
+        compressed = gzip(data)
+        reader = GzipReader(BytesIO(compressed + 'extra'), len(compressed))
+        reader.chunk_size = 7
+        assert reader.read(10) == 'a' * 10
+        assert reader.read(99980) == 'a' * 99980
+        assert reader.read() == 'a' * 10
+        assert reader.read(10) == ''
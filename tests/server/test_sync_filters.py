@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# test_sync_filters.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for filtering the documents returned by a sync.
+"""
+from uuid import uuid4
+
+from twisted.trial import unittest
+
+from leap.soledad.server.sync import SyncExchange
+
+from .common import FakeDatabase
+
+
+CHANGES = [('mail-1', 1, 'T-1'), ('flags-1', 2, 'T-2'),
+           ('mail-2', 3, 'T-3'), ('flags-2', 4, 'T-4')]
+
+
+class SyncFiltersTestCase(unittest.TestCase):
+
+    def _return_docs(self, db=None, **filters):
+        if db is None:
+            db = FakeDatabase(CHANGES, generation=(5, 'T-5'))
+        sync_exch = SyncExchange(db, 'replica', 0, uuid4().hex, **filters)
+        new_gen, number_of_changes = sync_exch.find_changes_to_return()
+        assert len(sync_exch.changes_to_return) == number_of_changes
+        returned, skipped = [], []
+        sync_exch.return_docs(
+            lambda doc, gen, trans_id: returned.append(doc.doc_id),
+            skip_doc_cb=lambda doc, gen, trans_id: skipped.append(
+                (doc.doc_id, doc.rev)))
+        return new_gen, returned, skipped
+
+    def test_no_filters(self):
+        new_gen, doc_ids, skipped = self._return_docs()
+        assert new_gen == 5
+        assert doc_ids == ['mail-1', 'flags-1', 'mail-2', 'flags-2']
+        assert skipped == []
+
+    def test_doc_id_prefixes(self):
+        new_gen, doc_ids, skipped = self._return_docs(
+            doc_id_prefixes=['flags-'])
+        # the generation is the one of the whole database, so the revisions
+        # of the documents filtered out are returned too
+        assert new_gen == 5
+        assert doc_ids == ['flags-1', 'flags-2']
+        assert skipped == [('mail-1', 'rev-mail-1'), ('mail-2', 'rev-mail-2')]
+
+    def test_doc_ids(self):
+        db = FakeDatabase(CHANGES, generation=(5, 'T-5'))
+        db.whats_changed = None
+        new_gen, doc_ids, skipped = self._return_docs(
+            db, doc_ids=['mail-2', 'flags-1', 'missing'])
+        # the documents are looked up directly, whatever their generation
+        assert doc_ids == ['mail-2', 'flags-1']
+        new_gen, doc_ids, skipped = self._return_docs(
+            doc_ids=['mail-2', 'flags-1'], doc_id_prefixes=['mail-'])
+        assert doc_ids == ['mail-2']
+        assert skipped == [('flags-1', 'rev-flags-1')]
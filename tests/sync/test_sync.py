@@ -22,6 +22,7 @@ import time
 from six.moves.urllib.parse import urljoin
 from mock import Mock
 from twisted.internet import defer
+from twisted.internet import reactor
 
 from testscenarios import TestWithScenarios
 
@@ -231,3 +232,71 @@ class TestSoledadSynchronizer(BaseSoledadTest):
         f, args, kwargs = docs_by_gen[0][0]
         self.assertIn('include_deleted', kwargs)
         self.assertTrue(kwargs['include_deleted'])
+
+    def test_checkpoint_records_the_target_generation(self):
+        self.synchronizer.target_replica_uid = 'target'
+        self.synchronizer._checkpoint(3, 'T-3')
+        self.db._set_replica_gen_and_trans_id.assert_called_once_with(
+            'target', 3, 'T-3')
+
+    def test_no_checkpoint_without_target_replica_uid(self):
+        self.synchronizer.target_replica_uid = None
+        self.synchronizer._checkpoint(3, 'T-3')
+        self.assertFalse(self.db._set_replica_gen_and_trans_id.called)
+
+    def test_fetched_docs_keep_the_known_target_generation(self):
+        self.target.get_sync_info.return_value = defer.succeed(
+            ('target', 9, 'T-9', 0, ''))
+        self.db._get_replica_gen_and_trans_id.return_value = (5, 'T-5')
+        self.db._put_doc_if_newer.return_value = ('inserted', 1)
+
+        doc = make_soledad_document_for_test(self, 'id', 'rev', '{}')
+
+        def fetch_docs(doc_ids, insert_doc_cb, commit_callback=None):
+            insert_doc_cb(doc, 7, 'T-7')
+            return defer.succeed(None)
+
+        self.target.fetch_docs.side_effect = fetch_docs
+        self.synchronizer.fetch_docs(['id'])
+        self.db._put_doc_if_newer.assert_called_once_with(
+            doc, save_conflict=True, replica_uid='target', replica_gen=5,
+            replica_trans_id='T-5')
+
+    def test_received_docs_are_recorded_as_they_are_inserted(self):
+        self.synchronizer.target_replica_uid = 'target'
+        states = ['inserted', 'superseded', 'converged', 'conflicted',
+                  'inserted']
+        self.db._put_doc_if_newer.side_effect = \
+            lambda *args, **kwargs: (states.pop(0), 1)
+        for doc_id, rev in [('a', 'r1'), ('b', 'r1'), ('c', 'r1'),
+                            ('d', 'r1'), ('a', 'r2')]:
+            doc = make_soledad_document_for_test(self, doc_id, rev, '{}')
+            self.synchronizer._insert_doc_from_target(doc, 1, 'T-1')
+        self.assertEqual(['a', 'd'], self.synchronizer.received_docs)
+        self.assertEqual({'a': 'r2', 'd': 'r1'},
+                         self.synchronizer.received_revs)
+
+    def test_received_doc_callback_is_called_in_the_reactor_thread(self):
+        received = []
+        self.synchronizer.received_doc_callback = \
+            lambda doc_id, rev: received.append((doc_id, rev))
+        self.db._put_doc_if_newer.return_value = ('inserted', 1)
+        doc = make_soledad_document_for_test(self, 'a', 'r1', '{}')
+        d = defer.Deferred()
+
+        def _insert():
+            self.synchronizer._insert_doc_from_target(doc, 1, 'T-1')
+            reactor.callFromThread(d.callback, None)
+
+        reactor.callInThread(_insert)
+        d.addCallback(lambda _: self.assertEqual([('a', 'r1')], received))
+        return d
+
+    def test_skipped_docs_are_recorded(self):
+        skipped = []
+        self.synchronizer.skipped_doc_callback = \
+            lambda doc_id, rev: skipped.append((doc_id, rev))
+        self.synchronizer._skip_doc_from_target('a', 'r1')
+        self.synchronizer._skip_doc_from_target('a', 'r2')
+        self.assertEqual({'a': 'r2'}, self.synchronizer.skipped_docs)
+        self.assertEqual([('a', 'r1'), ('a', 'r2')], skipped)
@@ -24,21 +24,30 @@ import pytest
 import random
 import string
 import shutil
+import threading
+import zlib
+import mock
 
 from six import StringIO as cStringIO
 from uuid import uuid4
 
 from testscenarios import TestWithScenarios
 from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+from twisted.web.http_headers import Headers
 
 from leap.soledad.client import http_target as target
 from leap.soledad.client.http_target.fetch_protocol import DocStreamReceiver
+from leap.soledad.client.http_target.send_protocol import DocStreamProducer
 from leap.soledad.client._db.sqlcipher import SQLCipherU1DBSync
 from leap.soledad.client._db.sqlcipher import SQLCipherOptions
 from leap.soledad.client._db.sqlcipher import SQLCipherDatabase
 from leap.soledad.client import _crypto
 
 from leap.soledad.common import l2db
+from leap.soledad.common import sync_frames
+from leap.soledad.common.errors import SyncFiltersNotSupportedError
 
 from leap.soledad.common.document import SoledadDocument
 from test_soledad import u1db_tests as tests
@@ -122,6 +131,569 @@ class TestSoledadParseReceivedDocResponse(unittest.TestCase):
         with self.assertRaises(l2db.errors.BrokenSyncStream):
             self.parse('[\r\n{"error": "?"}\r\n')
 
+    def test_binary_stream(self):
+        blob = sync_frames.Blob('preamble \r\nciphertext')
+        stream = ''.join([
+            '[\r\n{"new_generation": 2, "number_of_changes": 3}',
+            ',\r\n{"id": "a", "rev": "r", "gen": 1, "trans_id": "T-a"}',
+            ',\r\n' + sync_frames.encode_frame(blob),
+            ',\r\n{"id": "b", "rev": "r", "gen": 2, "trans_id": "T-b"}',
+            ',\r\n' + sync_frames.encode_frame(None),
+            ',\r\n{"id": "c", "rev": "r", "gen": 3, "trans_id": "T-c"}',
+            ',\r\n' + sync_frames.encode_frame('{"a": "b"}'),
+            '\r\n]\r\n'])
+        response = mock.Mock(code=200, phrase='OK', headers=Headers(
+            {'content-type': [sync_frames.BINARY_STREAM]}))
+        received = []
+
+        def doc_reader(doc_info, content, total):
+            received.append((doc_info['id'], content, total))
+            return defer.succeed(None)
+
+        # deliver the stream in small chunks, to split lines and frames
+        parser = DocStreamReceiver(response, defer.Deferred(), doc_reader)
+        for i in range(0, len(stream), 7):
+            parser.dataReceived(stream[i:i + 7])
+        parser.finish()
+
+        assert received == [
+            ('a', blob, 3), ('b', None, 3), ('c', '{"a": "b"}', 3)]
+        assert isinstance(received[0][1], sync_frames.Blob)
+
+    def test_binary_stream_with_broken_frame(self):
+        response = mock.Mock(code=200, phrase='OK', headers=Headers(
+            {'content-type': [sync_frames.BINARY_STREAM]}))
+        parser = DocStreamReceiver(response, defer.Deferred(),
+                                   lambda *_: defer.succeed(42))
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            parser.dataReceived(
+                '[\r\n{"number_of_changes": 1},\r\n{"id": "a"},\r\n'
+                'json 2\r\n{}}\r\n]')
+
+    def test_metadata_is_read_before_documents(self):
+        received = []
+
+        def doc_reader(doc_info, content, total):
+            received.append(doc_info['id'])
+            return defer.succeed(None)
+
+        parser = DocStreamReceiver(
+            None, defer.Deferred(), doc_reader,
+            metadata_reader=lambda metadata: received.append(metadata))
+        parser.dataReceived(
+            '[\r\n{"number_of_changes": 1, "replica_uid": "r"},\r\n'
+            '{"id": "a"},\r\n{}\r\n]\r\n')
+        parser.finish()
+
+        assert received == [{'number_of_changes': 1, 'replica_uid': 'r'}, 'a']
+
+    def test_lines_split_between_chunks(self):
+        stream = ''.join([
+            '[\r\n{"new_generation": 2, "number_of_changes": 2}',
+            ',\r\n{"id": "a", "rev": "r", "gen": 1, "trans_id": "T-a"}',
+            ',\r\n{"a": "b"}',
+            ',\r\n{"id": "b", "rev": "r", "gen": 2, "trans_id": "T-b"}',
+            ',\r\n{"c": "d"}',
+            '\r\n]\r\n'])
+        received = []
+
+        def doc_reader(doc_info, content, total):
+            received.append((doc_info['id'], content, total))
+            return defer.succeed(None)
+
+        # every line break is split between two chunks
+        parser = DocStreamReceiver(None, defer.Deferred(), doc_reader)
+        for chunk in stream.split('\n'):
+            parser.dataReceived(chunk)
+            parser.dataReceived('\n')
+        parser.finish()
+
+        assert received == [('a', '{"a": "b"}', 2), ('b', '{"c": "d"}', 2)]
+
+    def test_line_too_long(self):
+        parser = DocStreamReceiver(None, defer.Deferred(),
+                                   lambda *_: defer.succeed(42))
+        parser.max_line_size = 10
+        parser.dataReceived('[\r\n{"number')
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            parser.dataReceived('_of_changes": 1},\r\n')
+
+    def test_frame_too_long(self):
+        response = mock.Mock(code=200, phrase='OK', headers=Headers(
+            {'content-type': [sync_frames.BINARY_STREAM]}))
+        parser = DocStreamReceiver(response, defer.Deferred(),
+                                   lambda *_: defer.succeed(42))
+        parser.max_line_size = 32
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            parser.dataReceived(
+                '[\r\n{"number_of_changes": 1},\r\n{"id": "a"},\r\n'
+                'json 33\r\n')
+
+    def test_transport_is_paused_while_reads_are_pending(self):
+        pending = []
+
+        def doc_reader(doc_info, content, total):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        parser = DocStreamReceiver(None, defer.Deferred(), doc_reader)
+        parser.max_pending_reads = 2
+        parser.makeConnection(mock.Mock())
+        parser.dataReceived('[\r\n{"number_of_changes": 3},\r\n')
+        for i in range(3):
+            parser.dataReceived('{"id": "%d"},\r\n{},\r\n' % i)
+        assert parser.transport.pauseProducing.call_count == 1
+
+        # the transport is resumed once reads are not pending anymore
+        pending[0].callback(None)
+        assert parser.transport.resumeProducing.call_count == 0
+        pending[1].callback(None)
+        assert parser.transport.resumeProducing.call_count == 1
+
+    def test_compressed_stream_is_decompressed_as_it_arrives(self):
+        stream = ''.join([
+            '[\r\n{"new_generation": 2, "number_of_changes": 2}',
+            ',\r\n{"id": "a", "rev": "r", "gen": 1, "trans_id": "T-a"}',
+            ',\r\n{"a": "%s"}' % ('b' * 1000),
+            ',\r\n{"id": "b", "rev": "r", "gen": 2, "trans_id": "T-b"}',
+            ',\r\n{"c": "d"}',
+            '\r\n]\r\n'])
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(stream) + compressor.flush()
+        response = mock.Mock(code=200, phrase='OK', headers=Headers(
+            {'content-encoding': ['gzip']}))
+        received = []
+
+        def doc_reader(doc_info, content, total):
+            received.append((doc_info['id'], len(content)))
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        parser = DocStreamReceiver(response, d, doc_reader)
+        parser.decompress_size = 16
+        for i in range(0, len(compressed), 10):
+            parser.dataReceived(compressed[i:i + 10])
+        assert received == [('a', 1009), ('b', 10)]
+        parser.connectionLost(Failure(ResponseDone()))
+        metadata = json.loads(self.successResultOf(d))
+        assert metadata['number_of_changes'] == 2
+
+    def test_invalid_compressed_stream(self):
+        response = mock.Mock(code=200, phrase='OK', headers=Headers(
+            {'content-encoding': ['gzip']}))
+        parser = DocStreamReceiver(response, defer.Deferred(),
+                                   lambda *_: defer.succeed(42))
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            parser.dataReceived('[\r\n{"number_of_changes": 1},\r\n')
+
+
+class TestDocStreamProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.body = target.support.RequestBody(last_known_generation=0)
+        self.waiting = []
+        self.calls = [(self._prepare, i) for i in xrange(5)]
+        self.written = []
+        self.consumer = mock.Mock(spec=['write'], write=self.written.append)
+        self.headers = '[\r\n{"last_known_generation": 0}'
+
+    def _prepare(self, i):
+        d = defer.Deferred()
+        self.waiting.append((i, d))
+        d.addCallback(lambda _: lambda: self.body.insert_info(idx=i))
+        return d
+
+    def test_documents_are_prepared_ahead_and_written_in_order(self):
+        producer = DocStreamProducer((self.body, self.calls), lookahead=3)
+        d = producer.startProducing(self.consumer)
+        assert [i for i, _ in self.waiting] == [0, 1, 2]
+
+        # later documents are ready first
+        self.waiting[2][1].callback(None)
+        self.waiting[1][1].callback(None)
+        assert ''.join(self.written) == self.headers
+        self.waiting[0][1].callback(None)
+        assert ''.join(self.written).count('idx') == 3
+        assert [i for i, _ in self.waiting] == [0, 1, 2, 3, 4]
+
+        for _, waiting in self.waiting[3:]:
+            waiting.callback(None)
+        self.successResultOf(d)
+        entries = json.loads(''.join(self.written))
+        assert [entry['idx'] for entry in entries[1:]] == range(5)
+
+    def test_nothing_is_written_while_paused(self):
+        producer = DocStreamProducer((self.body, self.calls), lookahead=2)
+        producer.pauseProducing()
+        d = producer.startProducing(self.consumer)
+        for _, waiting in self.waiting[:]:
+            waiting.callback(None)
+        # documents keep being prepared up to the lookahead
+        assert len(self.waiting) == 2
+        assert ''.join(self.written) == self.headers
+
+        producer.resumeProducing()
+        for i in xrange(2, 5):
+            self.waiting[i][1].callback(None)
+        self.successResultOf(d)
+        assert len(json.loads(''.join(self.written))) == 6
+
+    def test_failure_stops_producing(self):
+        producer = DocStreamProducer((self.body, self.calls), lookahead=2)
+        d = producer.startProducing(self.consumer)
+        self.waiting[1][1].errback(ValueError())
+        self.waiting[0][1].callback(None)
+        self.failureResultOf(d, ValueError)
+        assert ''.join(self.written) == self.headers + ',\r\n{"idx": 0}'
+
+    def test_compressed_body(self):
+        producer = DocStreamProducer(
+            (self.body, self.calls), lookahead=2, compress=True)
+        d = producer.startProducing(self.consumer)
+        for i in xrange(5):
+            self.waiting[i][1].callback(None)
+        self.successResultOf(d)
+        body = zlib.decompress(
+            ''.join(self.written), 16 + zlib.MAX_WBITS)
+        entries = json.loads(body)
+        assert [entry['idx'] for entry in entries[1:]] == range(5)
+
+
+class TestRequestBody(unittest.TestCase):
+
+    def test_content_is_written_without_being_copied(self):
+        written = []
+        consumer = mock.Mock(spec=['writeSequence'],
+                             writeSequence=written.extend)
+        body = target.support.BinaryRequestBody(last_known_generation=0)
+        body.start(consumer)
+        content = sync_frames.Blob('x' * 100)
+        body.insert_info(id='a', content=content)
+        body.insert_info(id='b', content=None)
+        body.finish()
+
+        assert any(part is content for part in written)
+        assert '' not in written
+        assert body.consumed == 2
+        assert ''.join(written) == (
+            '[\r\n{"last_known_generation": 0},\r\n{"id": "a"},\r\n'
+            'blob 100\r\n' + content + ',\r\n{"id": "b"},\r\nnull\r\n'
+            '\r\n]')
+
+    def test_body_as_string(self):
+        body = target.support.RequestBody(last_known_generation=0)
+        body.insert_info(id='a', content='{}')
+        assert str(body) == \
+            '[\r\n{"last_known_generation": 0},\r\n{"id": "a"},\r\n{}\r\n]'
+        body = target.support.RequestBody(last_known_generation=0)
+        assert str(body) == '[\r\n{"last_known_generation": 0}\r\n]'
+
+
+class TestHTTPDocSender(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_encrypt_docs_loaded_with_and_without_deferreds(self):
+        sender = target.send.HTTPDocSender()
+        sender._binary_sync = False
+        sender._crypto = _crypto.SoledadCrypto('A' * 96)
+        self.addCleanup(sender._crypto.close)
+        docs = [SoledadDocument('id%d' % i, 'rev', '{"i": %d}' % i)
+                for i in xrange(2)]
+        entries = [((lambda: docs[0], (), {}), 1, 'T-1'),
+                   ((defer.succeed, (docs[1],), {}), 2, 'T-2')]
+
+        result = yield sender._encrypt_docs(entries)
+        assert [r[0] for r in result] == docs
+        assert [r[2:] for r in result] == [(1, 'T-1'), (2, 'T-2')]
+        decrypted = yield sender._crypto.decrypt_docs(
+            [('id0', 'rev', result[0][1]), ('id1', 'rev', result[1][1])])
+        assert decrypted == ['{"i": 0}', '{"i": 1}']
+
+    @defer.inlineCallbacks
+    def test_docs_are_sent_again_from_the_last_one_inserted(self):
+        sender = target.send.HTTPDocSender()
+        sender._binary_sync = False
+        sender._sync_batches = True
+        sender._ensure_callback = None
+        sender.source_replica_uid = 'replica'
+        sender._crypto = _crypto.SoledadCrypto('A' * 96)
+        self.addCleanup(sender._crypto.close)
+        self.patch(target.support.AdaptiveBatchSize, 'initial_docs', 4)
+        self.patch(target.support.AdaptiveBatchSize, 'min_docs', 1)
+        self.patch(target.support.AdaptiveBatchSize, 'update',
+                   lambda *_: None)
+        docs = [SoledadDocument('id%d' % i, 'rev', '{"i": %d}' % i)
+                for i in xrange(10)]
+        entries = [((lambda doc=doc: doc, (), {}), i + 1, 'T-%d' % i)
+                   for i, doc in enumerate(docs)]
+        requests = []
+
+        @defer.inlineCallbacks
+        def _send_request(body, calls):
+            requests.append([])
+            for call in calls:
+                insert = yield call[0](*call[1:])
+                insert()
+                requests[-1].append(call[4])
+                if len(requests) == 2 and len(requests[-1]) == 3:
+                    raise ValueError()
+            defer.returnValue(json.dumps(
+                [{'new_generation': len(requests),
+                  'new_transaction_id': 'T'}]))
+
+        def get_sync_info(source_replica_uid):
+            # the server inserted the first document of the failed batch
+            return defer.succeed(('target', 0, '', 5, 'T-4'))
+
+        sender._send_request = _send_request
+        sender.get_sync_info = get_sync_info
+        result = yield sender._send_docs(entries, 0, '', 'sync-id')
+        assert result == [5, 'T']
+        # the failed batch is sent again, in smaller batches
+        assert requests == [[1, 2, 3, 4], [5, 6, 7], [6, 7], [8, 9], [10]]
+
+    def test_docs_are_sent_in_one_request_by_default(self):
+        sender = target.send.HTTPDocSender()
+        sender._binary_sync = False
+        sender._sync_batches = False
+        sender._ensure_callback = None
+        sender._send_batch = mock.Mock(return_value=defer.succeed(
+            json.dumps([{'new_generation': 1, 'new_transaction_id': 'T'}])))
+        result = sender._send_docs([None] * 1000, 0, '', 'sync-id')
+        assert self.successResultOf(result) == [1, 'T']
+        assert sender._send_batch.call_count == 1
+
+
+class TestEncryptionWindow(unittest.TestCase):
+
+    def test_each_entry_is_encrypted_once(self):
+        calls = []
+
+        def encrypt(entries):
+            calls.append(list(entries))
+            return defer.succeed([entry * 2 for entry in entries])
+
+        window = target.send._EncryptionWindow(encrypt, range(100), 32)
+        results = [self.successResultOf(window.get(i)) for i in xrange(100)]
+        assert results == [i * 2 for i in xrange(100)]
+        assert [len(batch) for batch in calls] == [32, 32, 32, 4]
+        assert window._results == {}
+
+    def test_next_batch_is_encrypted_ahead(self):
+        calls = []
+
+        def encrypt(entries):
+            calls.append(list(entries))
+            return defer.Deferred()
+
+        window = target.send._EncryptionWindow(encrypt, range(10), 4)
+        window.get(0)
+        assert calls == [[0, 1, 2, 3], [4, 5, 6, 7]]
+        window.get(1)
+        window.get(4)
+        assert calls == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+
+    def setUp(self):
+        self.size = target.support.AdaptiveBatchSize()
+
+    def test_size_grows_while_throughput_does_not_drop(self):
+        self.size.update(500, 1000, 1.0)
+        assert self.size.docs == 1000
+        self.size.update(1000, 2000, 1.5)
+        assert self.size.docs == 2000
+        self.size.update(2000, 4000, 10.0)
+        assert self.size.docs == 1000
+
+    def test_size_is_capped_by_bytes(self):
+        self.size.update(500, self.size.max_bytes, 1.0)
+        assert self.size.docs == 500
+
+    def test_size_shrinks_on_failures(self):
+        assert self.size.failed(ValueError())
+        assert self.size.docs == 250
+        assert self.size.failed(l2db.errors.Unavailable('', {}))
+        assert self.size.failed(l2db.errors.BrokenSyncStream())
+        assert not self.size.failed(ValueError())
+        assert self.size.docs == 31
+
+    def test_requests_refused_by_the_server_are_not_retried(self):
+        assert not self.size.failed(l2db.errors.InvalidGeneration())
+        assert not self.size.failed(defer.CancelledError())
+        assert self.size.docs == 500
+
+
+class TestDocInserter(unittest.TestCase):
+
+    def setUp(self):
+        self.preparing = []
+        self.inserted = []
+        self.inserter = target.fetch._DocInserter(
+            self._prepare, self._insert, batch_size=2)
+
+    def _prepare(self, batch):
+        d = defer.Deferred()
+        self.preparing.append((batch, d))
+        return d
+
+    def _insert(self, batch):
+        self.inserted.extend(batch)
+        return defer.succeed(None)
+
+    def test_batches_are_prepared_at_once_and_inserted_in_order(self):
+        for i in xrange(5):
+            self.inserter.add(i)
+        assert [batch for batch, _ in self.preparing] == [[0, 1], [2, 3]]
+        d = self.inserter.finish()
+        assert [batch for batch, _ in self.preparing][2] == [4]
+
+        self.preparing[2][1].callback(['c'])
+        self.preparing[1][1].callback(['b'])
+        assert self.inserted == []
+        self.preparing[0][1].callback(['a'])
+        self.successResultOf(d)
+        assert self.inserted == ['a', 'b', 'c']
+
+    def test_failure_is_reported_once(self):
+        done = [self.inserter.add(i) for i in xrange(6)]
+        self.preparing[0][1].callback(['a'])
+        self.preparing[1][1].errback(ValueError())
+        self.preparing[2][1].callback(['c'])
+        self.failureResultOf(done[3], ValueError)
+        self.successResultOf(done[5])
+        self.failureResultOf(self.inserter.finish(), ValueError)
+        assert self.inserted == ['a']
+
+
+class TestHTTPDocFetcher(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_received_docs_are_inserted_in_batches(self):
+        fetcher = target.fetch.HTTPDocFetcher()
+        fetcher._crypto = _crypto.SoledadCrypto('A' * 96)
+        self.addCleanup(fetcher._crypto.close)
+        fetcher.insert_batch_size = 2
+        fetcher._ensure_callback = None
+        fetcher._doc_id_prefixes = None
+        fetcher._sync_batches = False
+        inserted, threads = [], set()
+        fetcher._insert_doc_cb = lambda doc, gen, trans_id: \
+            inserted.append((doc.doc_id, doc.get_json(), gen))
+        fetcher._commit_callback = lambda: \
+            threads.add(threading.current_thread()) or \
+            inserted.append('commit')
+        fetcher._checkpoint_callback = lambda gen, trans_id: \
+            inserted.append((gen, trans_id))
+
+        def _fetch_all(*args):
+            for i in xrange(3):
+                info = _crypto.DocInfo('id%d' % i, 'rev')
+                content = _crypto.encrypt_payload(
+                    info, '{"i": %d}' % i, 'A' * 96)
+                doc_info = {'id': info.doc_id, 'rev': info.rev, 'gen': i,
+                            'trans_id': 'T-%d' % i}
+                fetcher._doc_parser(doc_info, content, 3)
+            return json.dumps({'number_of_changes': 3, 'new_generation': 3,
+                               'new_transaction_id': 'T-2'})
+
+        fetcher._fetch_all = _fetch_all
+        result = yield fetcher._receive_docs(0, '', None, 'sync-id')
+        assert result == [3, 'T-2']
+        assert inserted == [('id0', '{"i": 0}', 0), ('id1', '{"i": 1}', 1),
+                            (1, 'T-1'), 'commit',
+                            ('id2', '{"i": 2}', 2), (2, 'T-2'), 'commit']
+        assert len(threads) == 1
+        assert threading.current_thread() not in threads
+
+    @defer.inlineCallbacks
+    def test_docs_are_fetched_again_from_the_first_one_not_received(self):
+        fetcher = target.fetch.HTTPDocFetcher()
+        fetcher._crypto = _crypto.SoledadCrypto('A' * 96)
+        self.addCleanup(fetcher._crypto.close)
+        fetcher._sync_batches = True
+        fetcher._ensure_callback = None
+        fetcher._doc_id_prefixes = None
+        fetcher._commit_callback = None
+        fetcher._checkpoint_callback = None
+        self.patch(target.support.AdaptiveBatchSize, 'initial_docs', 4)
+        self.patch(target.support.AdaptiveBatchSize, 'min_docs', 1)
+        self.patch(target.support.AdaptiveBatchSize, 'update',
+                   lambda *_: None)
+        inserted, requests = [], []
+        fetcher._insert_doc_cb = lambda doc, gen, trans_id: \
+            inserted.append(gen)
+
+        def _fetch_all(gen, trans_id, sync_id, received=0, limit=None):
+            requests.append((received, limit))
+            for i in xrange(received, min(received + limit, 10)):
+                doc_info = {'id': 'id%d' % i, 'rev': 'rev', 'gen': i + 1,
+                            'trans_id': 'T-%d' % i}
+                fetcher._doc_parser(doc_info, '{}', 10)
+                if len(requests) == 2 and i == received + 1:
+                    return defer.fail(l2db.errors.BrokenSyncStream())
+            return defer.succeed(json.dumps({
+                'number_of_changes': 10, 'new_generation': 10,
+                'new_transaction_id': 'T-9'}))
+
+        fetcher._fetch_all = _fetch_all
+        result = yield fetcher._receive_docs(0, '', None, 'sync-id')
+        assert result == [10, 'T-9']
+        assert requests == [(0, 4), (4, 4), (6, 2), (8, 2)]
+        assert inserted == range(1, 11)
+
+    def test_docs_are_filtered_by_the_server_if_it_can(self):
+        fetcher = target.fetch.HTTPDocFetcher()
+        fetcher._doc_ids = None
+        fetcher._doc_id_prefixes = ('a-', 'b-')
+        fetcher._sync_filters = False
+        assert fetcher._filters() == {}
+        fetcher._sync_filters = True
+        assert fetcher._filters() == {'doc_id_prefixes': ['a-', 'b-']}
+        fetcher._doc_ids = ['c-1']
+        assert fetcher._filters() == {'doc_ids': ['c-1']}
+        fetcher._sync_filters = False
+        assert fetcher._filters() == {}
+
+    def test_docs_are_filtered_here_if_the_server_can_not(self):
+        fetcher = target.fetch.HTTPDocFetcher()
+        fetcher._doc_id_prefixes = ['a-']
+        fetcher._sync_filters = False
+        fetcher._inserter = mock.Mock()
+        fetcher._fetched_docs = fetcher._fetched_size = 0
+        skipped = []
+        fetcher._skipped_doc_callback = lambda *args: skipped.append(args)
+        fetcher._doc_parser({'id': 'b-1', 'rev': 'r1'}, '{}', 2)
+        fetcher._doc_parser({'id': 'a-1', 'rev': 'r2'}, '{}', 2)
+        fetcher._inserter.add.assert_called_once_with(
+            ({'id': 'a-1', 'rev': 'r2'}, '{}', 2))
+        assert skipped == [('b-1', 'r1')]
+
+    def test_docs_skipped_by_the_server_are_reported(self):
+        fetcher = target.fetch.HTTPDocFetcher()
+        fetcher._doc_id_prefixes = ['a-']
+        fetcher._sync_filters = True
+        fetcher._inserter = mock.Mock()
+        fetcher._fetched_docs = fetcher._fetched_size = 0
+        skipped = []
+        fetcher._skipped_doc_callback = lambda *args: skipped.append(args)
+        fetcher._doc_parser({'id': 'b-1', 'rev': 'r1', 'skipped': True}, '', 2)
+        fetcher._doc_parser({'id': 'a-1', 'rev': 'r2'}, '{}', 2)
+        fetcher._inserter.add.assert_called_once_with(
+            ({'id': 'a-1', 'rev': 'r2'}, '{}', 2))
+        assert skipped == [('b-1', 'r1')]
+        assert fetcher._fetched_docs == 2
+
+    def test_docs_are_not_fetched_if_the_server_can_not_filter_them(self):
+        sync_target = target.SoledadHTTPSyncTarget.__new__(
+            target.SoledadHTTPSyncTarget)
+        sync_target._sync_filters = False
+        d = sync_target.fetch_docs(['a-1'], lambda *_: None)
+        self.failureResultOf(d, SyncFiltersNotSupportedError)
+
+
 #
 # functions for TestRemoteSyncTargets
 #
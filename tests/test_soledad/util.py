@@ -269,7 +269,8 @@ class BaseSoledadTest(BaseLeapTest, MockedSharedDBTest):
                           server_url='https://127.0.0.1/',
                           cert_file=None,
                           shared_db_class=None,
-                          auth_token='auth-token'):
+                          auth_token='auth-token',
+                          **kwargs):
 
         def _put_doc_side_effect(doc):
             self._doc_put = doc
@@ -291,7 +292,8 @@ class BaseSoledadTest(BaseLeapTest, MockedSharedDBTest):
             cert_file=cert_file,
             shared_db=MockSharedDB(),
             auth_token=auth_token,
-            with_blobs=True)
+            with_blobs=True,
+            **kwargs)
         self.addCleanup(soledad.close)
         return soledad
 